@@ -2,15 +2,17 @@
 # -*- coding: utf-8 -*-
 
 ##-Imports
-from flask import Flask, render_template, request, jsonify, make_response, redirect, url_for
+from flask import Flask, render_template, request, jsonify, make_response, redirect, url_for, send_file
 from flask_bcrypt import Bcrypt
 import requests
 from sys import argv
 
 import re # To check email
 
-from src.load_config import get_db_service, get_vars
+from src.load_config import get_db_service, get_vars, get_profiling_config, get_tracing_config
 from src.authentication import TokenManager, token_required, UserAuthentication
+from observability.profiling import RequestProfiler
+from observability.tracing import TRACER, configure_tracing
 
 ##-Init
 app = Flask(__name__)
@@ -27,6 +29,26 @@ app.config['SECRET_KEY'] = SECRET_KEY
 token_manager = TokenManager(SECRET_KEY)
 user_authentication = UserAuthentication(db_service, bcrypt, token_manager, PLATFORM_URL)
 
+# On-demand request profiling (X-Profile header from an admin, or sampling)
+profiling_config = get_profiling_config()
+profiler = None
+if profiling_config['enabled']:
+    profiler = RequestProfiler(
+        profiling_config['directory'],
+        is_admin=lambda: token_manager.is_admin(token_manager.retrieve_token('first')),
+        sample_rate=profiling_config['sample_rate'],
+        default_mode=profiling_config['mode'],
+        interval_ms=profiling_config['interval_ms'],
+        max_profiles=profiling_config['max_profiles'],
+    )
+    profiler.init_app(app)
+
+# Distributed tracing: the calls to the platform carry the `traceparent` header, so the platform continues the traces
+configure_tracing('frontend', get_tracing_config())
+if TRACER.enabled:
+    TRACER.init_app(app)
+    TRACER.instrument_requests(PLATFORM_URL)
+
 
 ##-Utils
 def is_valid_email(email: str) -> bool:
@@ -121,9 +143,9 @@ def reservation_page():
         try:
             token = token_manager.retrieve_token('cookies')
 
-            # Request free nodes to IoT platform API
+            # Request reservable nodes (free and online) to IoT platform API
             response_1 = requests.get(
-                f'{PLATFORM_URL}/api/nodes?status=free',
+                f'{PLATFORM_URL}/api/nodes?reservable',
                 headers={'Authorization': token}
             )
 
@@ -542,6 +564,62 @@ def logout():
     response.delete_cookie('token')
     return response
 
+@app.route('/profiles')
+@token_required(SECRET_KEY, only_admins=True)
+def list_profiles():
+    '''
+    Lists the request profiles of the frontend, newest first (cf `observability/profiling.py`, in `shared/`).
+    Access restricted to admins.
+
+    Query string: `limit` (default 50), `route` (e.g `/nodes_page`)
+    '''
+
+    if profiler is None:
+        return jsonify({'error': 'Profiling is disabled (PROFILING_ENABLED)'}), 404
+
+    try:
+        profiles = profiler.list_profiles(int(request.args.get('limit', 50)), request.args.get('route'))
+        return jsonify({'profiles': profiles}), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/profiles/<profile_id>')
+@token_required(SECRET_KEY, only_admins=True)
+def download_profile(profile_id):
+    '''
+    Downloads a request profile (`.folded` collapsed stacks, or `.prof` pstats file).
+    Access restricted to admins.
+    '''
+
+    if profiler is None:
+        return jsonify({'error': 'Profiling is disabled (PROFILING_ENABLED)'}), 404
+
+    try:
+        return send_file(profiler.profile_path(profile_id), as_attachment=True)
+
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+
+@app.route('/traces')
+@token_required(SECRET_KEY, only_admins=True)
+def slowest_traces():
+    '''
+    Returns the slowest traces of the frontend worker, with the time spent per hop (`http.*` are the calls to the platform).
+    Access restricted to admins.
+
+    Query string: `limit` (default 20)
+    '''
+
+    if not TRACER.enabled:
+        return jsonify({'error': 'Tracing is disabled (TRACING_ENABLED)'}), 404
+
+    try:
+        return jsonify({'stats': TRACER.stats(), 'traces': TRACER.slowest(int(request.args.get('limit', 20)))}), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/not_allowed')
 def not_allowed():
     '''Route for not allowed page'''
@@ -2,11 +2,21 @@
 # -*- coding: utf-8 -*-
 
 ##-Imports
+from datetime import datetime
+import json
+import sqlite3
+
 from pymongo import MongoClient
 
+##-Init
+SQLITE_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f' # Format of the datetimes stored by the platform (cf platform `sqlite_database`)
+
 ##-Database service
 class DatabaseService:
-    '''Manages the connection and communication to the MongoDB database'''
+    '''
+    Manages the connection and communication to the database of the platform:
+    a MongoDB server (`mongodb://...`) or the SQLite file of the platform (`sqlite:///path/to/file.db`, read-only)
+    '''
 
     def __init__(self, connection_string: str, db_name: str):
         '''Initiates the class'''
@@ -18,15 +28,25 @@ class DatabaseService:
 
         self.user_collection_name = 'user_collection'
 
+    def is_sqlite(self) -> bool:
+        return self.connection_string.startswith('sqlite:///')
+
     def connect(self) -> None:
         '''Tries to connect to the database'''
 
         try:
-            self.client = MongoClient(self.connection_string)
-            self.db = self.client[self.db_name]
+            if self.is_sqlite():
+                # Read-only: the platform creates and writes the file (WAL mode, readers do not block it)
+                path = self.connection_string.removeprefix('sqlite:///')
+                self.client = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30, check_same_thread=False)
+                self.db = self.db_name
+
+            else:
+                self.client = MongoClient(self.connection_string)
+                self.db = self.client[self.db_name]
 
         except Exception as e:
-            raise ConnectionError(f'Failed to connect to MongoDB: {e}')
+            raise ConnectionError(f'Failed to connect to the database: {e}')
 
     def disconnect(self) -> None:
         '''Disconnects from the database'''
@@ -61,11 +81,55 @@ class DatabaseService:
         '''
     
         if not self.is_connected():
-            raise ConnectionError('Not connected to MongoDB')
+            raise ConnectionError('Not connected to the database')
 
         try:
+            if self.is_sqlite():
+                return self._sqlite_find_one(*args, **kargs)
+
             return self.db[self.user_collection_name].find_one(*args, **kargs)
 
         except Exception as e:
             raise Exception(f'Failed to get user: {e}')
 
+    def _sqlite_find_one(self, filter: dict, projection: dict | None = None) -> dict | None:
+        '''
+        `find_one` on the SQLite file of the platform, for the filters of this class (`_id` or `profile.username`)
+        and inclusion projections.
+        The documents are stored as JSON in the `<db>.<collection>` table, cf platform `sqlite_database`.
+        '''
+
+        (field, value), = filter.items()
+        table = '"' + f'{self.db}.{self.user_collection_name}'.replace('"', '""') + '"'
+
+        if field == '_id':
+            query = f'SELECT doc FROM {table} WHERE id = ?'
+            value = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+        else:
+            path = '$.' + '.'.join(f'"{key}"' for key in field.split('.'))
+            query = f"SELECT doc FROM {table} WHERE json_extract(doc, '{path}') = ?"
+
+        try:
+            row = self.client.execute(query + ' LIMIT 1', (value,)).fetchone()
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e): # No user created yet
+                return None
+            raise
+
+        if row is None:
+            return None
+
+        document = json.loads(row[0], object_hook=_decode_sqlite_object)
+
+        if projection:
+            document = {key: item for key, item in document.items() if key == '_id' or projection.get(key)}
+
+        return document
+
+def _decode_sqlite_object(value: dict):
+    '''Datetimes are stored as {"$date": ...} by the platform'''
+
+    if len(value) == 1 and '$date' in value:
+        return datetime.strptime(value['$date'], SQLITE_DATE_FORMAT)
+
+    return value
@@ -30,6 +30,8 @@ const uint32_t RESERVATION_TIMEOUT_MS = 120000;  // 120 s
 const uint32_t AUTH_TIMEOUT_MS        = 60000;   // 60 s
 const uint32_t RETRY_TIMEOUT_MS       = 5000;    // 05 s
 const uint16_t STABILITY_DELAY_MS     = 10000;
+const uint32_t HEARTBEAT_PERIOD_MS    = 30000;   // 30 s (platform considers the node offline after 3 missed heartbeats)
+const uint32_t TELEMETRY_PERIOD_MS    = 60000;   // 60 s
 
 
 // RFID
@@ -50,7 +52,8 @@ enum NodeState : uint8_t {
   ST_WAIT_AUTH,
   ST_UNAUTHORIZED,
   ST_VIOLATION,
-  ST_OCCUPIED
+  ST_OCCUPIED,
+  ST_MAINTENANCE
 };
 
 const char* stateToStr(NodeState s) {
@@ -61,6 +64,7 @@ const char* stateToStr(NodeState s) {
     case ST_UNAUTHORIZED:return "UNAUTHORIZED";
     case ST_VIOLATION:   return "VIOLATION";
     case ST_OCCUPIED:    return "OCCUPIED";
+    case ST_MAINTENANCE: return "MAINTENANCE";
     default:             return "ERROR";
   }
 }
@@ -73,6 +77,9 @@ NodeState originState = ST_FREE;
 uint32_t stateEnterTime       = 0;
 uint32_t lastUltrasonicMs     = 0;
 uint32_t lastLEDBlinkMs       = 0;
+uint32_t lastHeartbeatMs      = 0;
+uint32_t lastTelemetryMs      = 0;
+uint32_t rfidErrors           = 0;     // RFID auth/read/write failures since boot
 
 bool     occupancy            = false;     // true = car detected
 bool     prevOccupancy        = false;
@@ -83,7 +90,18 @@ uint16_t BLINK_PERIOD         = 400;
 
 bool     mqttReservedFlag     = false;
 bool     mqttCancellationFlag = false;
+bool     mqttMaintenanceFlag  = false;
+bool     mqttOpenFlag         = false;
 String   topicReserve         = "nodes/" + String(ID_NODE);
+String   topicAck             = "nodes/" + String(ID_NODE) + "/ack";
+String   topicStatus          = "nodes/" + String(ID_NODE) + "/status";    // "online" / "offline" (Last Will)
+String   topicHeartbeat       = "nodes/" + String(ID_NODE) + "/heartbeat";
+String   topicTelemetry       = "nodes/" + String(ID_NODE) + "/telemetry";
+
+// Group topics (broadcast commands from the platform)
+String   topicGroupAll        = "groups/all";
+String   topicGroupSite       = "groups/" + String(NODE_SITE) + "/all";
+String   topicGroupZone       = "groups/" + String(NODE_SITE) + "/" + String(NODE_ZONE);
 
 bool     invalidCardTried     = false;
 bool     validCardTried       = false;
@@ -143,6 +161,12 @@ void updateLEDs() {
     case ST_OCCUPIED:
       red = true;
       break;
+
+    case ST_MAINTENANCE:
+      blink = true;
+      green = ledBlinkState;
+      red   = !ledBlinkState;
+      break;
   }
 
   if (!blink) {
@@ -238,6 +262,7 @@ bool readCurrentAuthBytes(byte blockAddr, byte* currentBytes) {
 
   if (status != MFRC522::STATUS_OK) {
     Serial.printf("[RFID] Auth failed: %s\n", rfid.GetStatusCodeName(status));
+    rfidErrors++;
     endCardSession();
     return false;
   }
@@ -248,6 +273,7 @@ bool readCurrentAuthBytes(byte blockAddr, byte* currentBytes) {
   status = rfid.MIFARE_Read(blockAddr, buffer, &size);
   if (status != MFRC522::STATUS_OK) {
     Serial.printf("[RFID] Read failed: %s\n", rfid.GetStatusCodeName(status));
+    rfidErrors++;
     endCardSession();
     return false;
   }
@@ -275,6 +301,7 @@ bool replaceAuthBytes(byte blockAddr, const byte* newBytes) {
 
   if (status != MFRC522::STATUS_OK) {
     Serial.printf("[RFID] Auth failed: %s\n", rfid.GetStatusCodeName(status));
+    rfidErrors++;
     endCardSession();
     return false;
   }
@@ -285,6 +312,7 @@ bool replaceAuthBytes(byte blockAddr, const byte* newBytes) {
   status = rfid.MIFARE_Read(blockAddr, buffer, &size);
   if (status != MFRC522::STATUS_OK) {
     Serial.printf("[RFID] Read failed: %s\n", rfid.GetStatusCodeName(status));
+    rfidErrors++;
     endCardSession();
     return false;
   }
@@ -299,6 +327,7 @@ bool replaceAuthBytes(byte blockAddr, const byte* newBytes) {
   status = rfid.MIFARE_Write(blockAddr, blockData, 16);
   if (status != MFRC522::STATUS_OK) {
     Serial.printf("[RFID] Write failed: %s\n", rfid.GetStatusCodeName(status));
+    rfidErrors++;
     endCardSession();
     return false;
   }
@@ -475,9 +504,14 @@ bool mqttConnect() {
   Serial.print("[MQTT] Connecting as ");
   Serial.println(nodeId);
 
-  if (mqtt.connect(nodeId.c_str())) { //   if (mqtt.connect(nodeId.c_str(), MQTT_USERNAME, MQTT_PASSWORD)) {
+  // Last Will: the broker publishes "offline" (retained) if the node disappears
+  if (mqtt.connect(nodeId.c_str(), topicStatus.c_str(), 1, true, "offline")) { //   if (mqtt.connect(nodeId.c_str(), MQTT_USERNAME, MQTT_PASSWORD, topicStatus.c_str(), 1, true, "offline")) {
     Serial.println("[MQTT] Connected");
+    mqtt.publish(topicStatus.c_str(), "online", true);
     mqtt.subscribe(topicReserve.c_str());
+    mqtt.subscribe(topicGroupAll.c_str());
+    mqtt.subscribe(topicGroupSite.c_str());
+    mqtt.subscribe(topicGroupZone.c_str());
     return true;
   } else {
     Serial.print("[MQTT] Failed: ");
@@ -497,6 +531,36 @@ void mqttCallback(char* topic, byte* payload, unsigned int length) {
   }
   Serial.println(message);
 
+  // Group command: {"cmd": str, "id": str}
+  if (String(topic).startsWith("groups/")) {
+    StaticJsonDocument<128> doc;
+    if (deserializeJson(doc, message)) {
+      return;
+    }
+
+    String cmd = doc["cmd"] | "";
+
+    if (cmd == "free" && curState == ST_RESERVED) {
+      originState = ST_RESERVED;
+      mqttCancellationFlag = true;
+    }
+    else if (cmd == "maintenance" && (curState == ST_FREE || curState == ST_RESERVED)) {
+      mqttMaintenanceFlag = true;
+    }
+    else if (cmd == "open" && curState == ST_MAINTENANCE) {
+      mqttOpenFlag = true;
+    }
+    else {
+      return; // Not concerned (the platform only expects an ack from the nodes it updated)
+    }
+
+    Serial.printf("[MQTT] GROUP COMMAND %s\n", cmd.c_str());
+
+    const char* commandId = doc["id"] | "";
+    mqtt.publish(topicAck.c_str(), commandId);
+    return;
+  }
+
   if (message == "reserved") {
     if (curState == ST_FREE || curState == ST_WAIT_AUTH || curState == ST_UNAUTHORIZED) {
       mqttReservedFlag = true;
@@ -512,6 +576,34 @@ void mqttCallback(char* topic, byte* payload, unsigned int length) {
   }
 }
 
+void sendHeartbeat() {
+  uint32_t now = millis();
+  if (now - lastHeartbeatMs < HEARTBEAT_PERIOD_MS) return;
+  lastHeartbeatMs = now;
+
+  if (mqtt.connected()) {
+    mqtt.publish(topicHeartbeat.c_str(), String(now).c_str()); // Payload: uptime (ms)
+  }
+}
+
+void sendTelemetry() {
+  uint32_t now = millis();
+  if (now - lastTelemetryMs < TELEMETRY_PERIOD_MS) return;
+  lastTelemetryMs = now;
+
+  if (!mqtt.connected()) return;
+
+  StaticJsonDocument<128> doc;
+  doc["rssi"]        = WiFi.RSSI();
+  doc["uptime"]      = now / 1000;
+  doc["free_heap"]   = ESP.getFreeHeap();
+  doc["rfid_errors"] = rfidErrors;
+
+  String payload;
+  serializeJson(doc, payload);
+  mqtt.publish(topicTelemetry.c_str(), payload.c_str());
+}
+
 // =================== WIFI  ===================
 
 void connectWiFi() {
@@ -556,6 +648,12 @@ void runStateMachine() {
         stateEnterTime = now;
         Serial.println("\n====== [STATE] Reserved (FREE => RESERVED) ======");
       }
+      else if (mqttMaintenanceFlag) {
+        mqttMaintenanceFlag = false;
+        curState = ST_MAINTENANCE;
+        stateEnterTime = now;
+        Serial.println("\n====== [STATE] Maintenance (FREE => MAINTENANCE) ======");
+      }
       break;
 
     case ST_RESERVED:
@@ -579,6 +677,13 @@ void runStateMachine() {
         stateEnterTime = now;
         Serial.println("\n====== [STATE] Cancelled (RESERVED => FREE) ======");
       }
+      else if (mqttMaintenanceFlag) {
+        mqttMaintenanceFlag = false;
+        curState = ST_MAINTENANCE;
+        originState = ST_FREE;
+        stateEnterTime = now;
+        Serial.println("\n====== [STATE] Maintenance (RESERVED => MAINTENANCE) ======");
+      }
       break;
 
     case ST_WAIT_AUTH:
@@ -635,6 +740,17 @@ void runStateMachine() {
         sendNodeStatusUpdate("free");
       }
       break;
+
+    case ST_MAINTENANCE:
+      // Cars and badges are ignored: the platform already knows the spot is closed
+      if (mqttOpenFlag) {
+        mqttOpenFlag = false;
+        curState = ST_FREE;
+        originState = ST_FREE;
+        stateEnterTime = now;
+        Serial.println("\n\t[STATE] Reopened (ST_MAINTENANCE => ST_FREE)");
+      }
+      break;
   }
 }
 
@@ -681,6 +797,8 @@ void loop() {
     mqttConnect();
   }
   mqtt.loop();
+  sendHeartbeat();
+  sendTelemetry();
 
   if(!StabilityFlag){
     updateUltrasonic();
@@ -5,6 +5,10 @@
 #define ID_NODE "node_0"
 #define NODE_SECRET_TOKEN "change-me"
 
+// Node group (same values as `profile.site` and `profile.zone` in the platform)
+#define NODE_SITE "site_0"
+#define NODE_ZONE "zone_0"
+
 // WiFi
 #define WIFI_SSID     "change-me"
 #define WIFI_PASSWORD "change-me"
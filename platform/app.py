@@ -10,16 +10,31 @@ from sys import argv
 
 from dotenv import load_dotenv
 import os
+import atexit
 
 #---Internal
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
 from src.services.database_service import DatabaseService
+from src.services.status_history import StatusHistory
+from src.services.query_monitor import QueryMonitor
+from observability.tracing import TRACER, configure_tracing
+from src.services.fault_injection import FAULTS, configure_faults
+from src.services.traffic_capture import CAPTURE, configure_capture
+from src.services.memory_diagnostics import MemoryDiagnostics
 from src.digital_twin.dt_factory import DTFactory
+from src.digital_twin.instance_manager import DTInstanceManager
+from src.digital_twin.scheduler import ServiceScheduler
+from src.digital_twin.execution_engine import ServiceExecutionEngine
 
 from src.application.api import register_api_blueprints
 from src.application.nodes_api import register_node_blueprint
 from src.application.users_api import register_user_blueprint
+from src.application.metrics_api import register_metrics
+from src.application.diagnostics_api import register_diagnostics_blueprint
+from observability.profiling import RequestProfiler
+from src.application.authentication import is_admin
 from src.application.mqtt_handler import NodeMQTTHandler
+from src.application.mqtt_gateway import MQTTGatewayClient
 
 from config.config_loader import ConfigLoader
 
@@ -57,18 +72,88 @@ class FlaskServer:
         # db_config = ConfigLoader.load_database_config()
         db_config = ConfigLoader.load_database_config_env()
         connection_string = ConfigLoader.build_connection_string(db_config)
+        if os.environ.get('MQTT_GATEWAY_SOCKET'): # Under gunicorn: the database is shared with the gateway and the other workers
+            ConfigLoader.check_shared_database(db_config)
+
+        # Distributed tracing (continues the traces of the frontend, cf /api/diagnostics/traces)
+        configure_tracing('platform', ConfigLoader.load_tracing_config_env())
+
+        # Faults injected in the calls to the dependencies (load tests only, cf FAULTS)
+        configure_faults(ConfigLoader.load_fault_injection_config_env())
+
+        # Capture of the traffic, to replay it on a test instance (cf CAPTURE_DIR)
+        configure_capture('platform', ConfigLoader.load_capture_config_env())
+        if CAPTURE.enabled:
+            atexit.register(CAPTURE.stop) # Write the pending events when the worker exits
+
+        # Per query shape timings and slow-query log (cf /api/diagnostics/queries)
+        monitor_config = ConfigLoader.load_query_monitor_config_env()
+        query_monitor = None
+        if monitor_config['enabled'] and db_config['backend'] == 'mongodb': # pymongo command events
+            query_monitor = QueryMonitor(slow_ms=monitor_config['slow_ms'], explain_slow=monitor_config['explain_slow'])
 
         # Initialize DatabaseService with populated schema_registry
         db_service = DatabaseService(
             connection_string=connection_string,
             db_name=db_config["settings"]["name"],
             schema_registry=schema_registry,
+            event_listeners=[query_monitor] if query_monitor else None,
         )
         db_service.connect()
+        db_service.ensure_indexes()
+        if query_monitor:
+            query_monitor.attach(db_service.db)
+        db_service = FAULTS.wrap('db', db_service)
+
+        # Initialize the node status history (batched asynchronous writes)
+        history_config = ConfigLoader.load_status_history_config_env()
+        status_history = StatusHistory(
+            db_service,
+            retention_days=history_config['retention_days'],
+            batch_size=history_config['batch_size'],
+            flush_period=history_config['flush_period_s'],
+        )
+        status_history.start()
+        atexit.register(status_history.stop) # Flush the pending transitions when the worker exits
 
         # Initialize DTFactory
         dt_factory = DTFactory(db_service, schema_registry)
 
+        # Live Digital Twin instances (kept hydrated in memory, updated incrementally)
+        # Worker processes running the CPU-bound services (out of the request threads)
+        engine_config = ConfigLoader.load_service_engine_config_env()
+        dt_engine = None
+        if engine_config['workers'] > 0:
+            dt_engine = ServiceExecutionEngine(
+                max_workers=engine_config['workers'],
+                timeout_s=engine_config['timeout_s'],
+                memory_mb=engine_config['memory_mb'],
+                max_concurrency=engine_config['max_concurrency'],
+            )
+            atexit.register(dt_engine.shutdown)
+
+        dt_cache_config = ConfigLoader.load_dt_cache_config_env()
+        dt_manager = DTInstanceManager(
+            dt_factory,
+            max_instances=dt_cache_config['max_instances'],
+            watch_changes=dt_cache_config['watch_changes'],
+            engine=dt_engine,
+            max_age_s=dt_cache_config['max_age_s'],
+        )
+        dt_manager.start()
+
+        # Scheduled service executions, and cache of the service results
+        dt_scheduler = ServiceScheduler(
+            dt_manager,
+            service_context={
+                'OccupancyService': {'status_history': status_history},
+                'OccupancyForecastService': {'status_history': status_history},
+                'SimulationService': {'status_history': status_history},
+            },
+            tick=dt_cache_config['scheduler_tick_s'],
+        )
+        dt_scheduler.start()
+
         # Initialize MQTT handler
         self.app.config['MQTT_CONFIG'] = {
             'broker': os.environ.get('MQTT_DOMAIN'),
@@ -76,14 +161,67 @@ class FlaskServer:
             'username': os.environ.get('MQTT_USERNAME'),
             'password': os.environ.get('MQTT_PWD')
         }
-        mqtt_handler = NodeMQTTHandler(self.app)
+        self.app.config['TELEMETRY_CONFIG'] = ConfigLoader.load_telemetry_config_env()
+
+        # When running under gunicorn, the broker connection is owned by the MQTT gateway
+        # process (cf gunicorn.conf.py), and the workers forward their calls to it.
+        gateway_socket = os.environ.get('MQTT_GATEWAY_SOCKET')
+        if gateway_socket:
+            mqtt_handler = MQTTGatewayClient(gateway_socket)
+        else:
+            mqtt_handler = NodeMQTTHandler(self.app)
+
         mqtt_handler.start()
+        mqtt_handler = FAULTS.wrap('mqtt', mqtt_handler)
 
         # Store references
         self.app.config['SCHEMA_REGISTRY'] = schema_registry
         self.app.config['DB_SERVICE'] = db_service
+        self.app.config['STATUS_HISTORY'] = status_history
         self.app.config['DT_FACTORY'] = dt_factory
+        self.app.config['DT_MANAGER'] = dt_manager
+        self.app.config['DT_SCHEDULER'] = dt_scheduler
+        self.app.config['DT_ENGINE'] = dt_engine
+        self.app.config['DT_RESULTS_MAX_AGE_S'] = dt_cache_config['results_max_age_s']
         self.app.config['MQTT_HANDLER'] = mqtt_handler
+        self.app.config['METRICS_TOKEN'] = ConfigLoader.load_metrics_config_env()['token']
+        self.app.config['QUERY_MONITOR'] = query_monitor
+
+        # On-demand request profiling (X-Profile header from an admin, or sampling)
+        profiling_config = ConfigLoader.load_profiling_config_env()
+        profiler = None
+        if profiling_config['enabled']:
+            profiler = RequestProfiler(
+                profiling_config['directory'],
+                is_admin=is_admin,
+                sample_rate=profiling_config['sample_rate'],
+                default_mode=profiling_config['mode'],
+                interval_ms=profiling_config['interval_ms'],
+                max_profiles=profiling_config['max_profiles'],
+            )
+            profiler.init_app(self.app)
+        self.app.config['PROFILER'] = profiler
+
+        if TRACER.enabled:
+            TRACER.init_app(self.app)
+
+        if CAPTURE.enabled:
+            CAPTURE.init_app(self.app)
+
+        # Memory diagnostics (tracemalloc snapshots, RSS and sizes of the in-memory caches)
+        memory_config = ConfigLoader.load_memory_diagnostics_config_env()
+        memory_diagnostics = MemoryDiagnostics(
+            memory_config['snapshot_dir'],
+            max_snapshots=memory_config['max_snapshots'],
+            frames=memory_config['frames'],
+        )
+        memory_diagnostics.register_cache('dt_instances', dt_manager.stats)
+        memory_diagnostics.register_cache('dt_scheduler', dt_scheduler.stats)
+        memory_diagnostics.register_cache('status_history_buffer', status_history.stats)
+        memory_diagnostics.register_cache('traces', TRACER.stats)
+        if query_monitor:
+            memory_diagnostics.register_cache('query_shapes', lambda: query_monitor.stats()['shapes'])
+        self.app.config['MEMORY_DIAGNOSTICS'] = memory_diagnostics
 
         self.app.config['FRONTEND_URL'] = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
 
@@ -102,6 +240,8 @@ class FlaskServer:
         register_api_blueprints(self.app)
         register_node_blueprint(self.app)
         register_user_blueprint(self.app)
+        register_metrics(self.app)
+        register_diagnostics_blueprint(self.app)
 
     def run(self, host="0.0.0.0", port=5000, debug=True):
         """Run the Flask server"""
@@ -0,0 +1,9 @@
+'''
+Microbenchmarks of the hot paths of the platform, against the in-memory database (`src.services.memory_database`):
+deterministic, and no MongoDB needed.
+
+    - `harness`: timing of the cases, JSON baselines and comparison
+    - `cases`: the benchmarked code paths (node routes, DR factory, schema registry, aggregation)
+
+Cf `python -m benchmarks --help` (from `platform/`).
+'''
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Command line of the benchmarks (run from `platform/`):
+
+    python -m benchmarks [--sizes 10,1000,100000] [--filter REGEX] [--save baseline.json]
+    python -m benchmarks --compare baseline.json [--threshold 0.2]
+
+Exits with 1 when a case regressed past the threshold (compared with the baseline).
+'''
+
+##-Imports
+import argparse
+import re
+import sys
+
+from benchmarks import cases
+from benchmarks.harness import compare, environment, format_comparison, format_results, load_baseline, measure, save_baseline
+
+##-Main
+def run_cases(options) -> dict[str, dict]:
+    '''Runs the cases selected by `options`. Out: {case: stats} (cf `harness.measure`)'''
+
+    pattern = re.compile(options.filter) if options.filter else None
+    results = {}
+
+    def run(group: list) -> None:
+        for case in group:
+            if pattern is not None and not pattern.search(case.name):
+                continue
+
+            print(f'  {case.name}...', file=sys.stderr)
+            results[case.name] = measure(case, options.min_time, options.min_calls)
+
+    print('Models', file=sys.stderr)
+    run(cases.model_cases())
+
+    platforms = {}
+    for nb_nodes in sorted(set(options.sizes) | {cases.ROUTES_SIZE}):
+        print(f'Platform with {nb_nodes} nodes', file=sys.stderr)
+        platforms[nb_nodes] = cases.BenchmarkPlatform(nb_nodes)
+
+        if nb_nodes in options.sizes:
+            run(cases.list_cases(platforms[nb_nodes], nb_nodes))
+        if nb_nodes == cases.ROUTES_SIZE:
+            run(cases.route_cases(platforms[nb_nodes]))
+
+        del platforms[nb_nodes] # Free the database before creating the next one
+
+    return results
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Microbenchmarks of the platform hot paths (in-memory database)')
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')], default=list(cases.DEFAULT_SIZES), help='Numbers of nodes of the `list_nodes` cases (comma separated)')
+    parser.add_argument('--filter', default=None, help='Only run the cases whose name matches this regex')
+    parser.add_argument('--min-time', type=float, default=1.0, help='Minimum measured time per case (s)')
+    parser.add_argument('--min-calls', type=int, default=5, help='Minimum number of measured calls per case')
+    parser.add_argument('--save', default=None, help='Write the results to this JSON baseline')
+    parser.add_argument('--compare', default=None, help='Compare the results with this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative slow-down of the median flagged as a regression (0.2: 20 %%)')
+
+    options = parser.parse_args(argv)
+
+    baseline = load_baseline(options.compare) if options.compare else None # Fail before running
+
+    results = run_cases(options)
+    print(format_results(results))
+
+    if options.save:
+        save_baseline(options.save, results, {'sizes': options.sizes, 'min_time': options.min_time, 'min_calls': options.min_calls})
+        print(f'\nBaseline written to {options.save}')
+
+    if baseline is not None:
+        if baseline['environment'].get('node') != environment()['node']:
+            print(f'\nWarning: the baseline was measured on an other machine ({baseline["environment"].get("node")})', file=sys.stderr)
+
+        partial = options.filter is not None or set(options.sizes) != set(baseline['settings'].get('sizes', options.sizes))
+        rows = compare(results, baseline, options.threshold, ignore_missing=partial)
+        print()
+        print(format_comparison(rows, options.threshold))
+
+        if any(row['verdict'] == 'regression' for row in rows):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
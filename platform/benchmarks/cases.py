@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+The benchmarked code paths:
+
+    - `authentication_request` (POST /api/nodes/<id>): a successful badge authentication
+    - `update_node` (PATCH /api/nodes/<id>): a car leaving (node), a reservation and its cancellation (user),
+      an edition of the profile and status (admin)
+    - `list_nodes` (GET /api/nodes/): all the nodes (user and admin) and the reservable ones, for each fleet size
+    - `DRFactory.create_dr`, `SchemaRegistry.load_schema` and `AggregationService.execute`
+
+The routes are called through the Flask test client (whole request handling, without network), on the nodes API
+of a minimal app whose database is in memory and whose MQTT handler does nothing. The nodes have the layout of the
+load test (`loadtest.seed`), and the data is reset before each call when the route changes it.
+'''
+
+##-Imports
+import os
+
+os.environ.setdefault('JWT_SHARED_TOKEN', 'benchmarks_shared_secret_of_32_bytes_or_more') # Read by `authentication` at import
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import jwt
+from flask import Flask
+
+from src.application import authentication
+from src.application.nodes_api import register_node_blueprint
+from src.services.analytics import AggregationService
+from src.services.database_service import DatabaseService
+from src.virtualization.digital_replica.dr_factory import DRFactory
+from src.virtualization.digital_replica.schema_registry import SchemaRegistry
+
+from benchmarks.harness import Case
+from loadtest import seed as seeding
+
+##-Init
+NODE_TEMPLATE = 'src/virtualization/templates/node.yaml'
+USER_TEMPLATE = 'src/virtualization/templates/user.yaml'
+
+PREFIX = 'bench_'
+NODE_TOKEN = 'benchmarks_node_token'
+BLANK_BADGE = '0' * 16
+NEW_BADGE = 'f' * 16
+SEED = 42 # Of the synthetic measurements
+
+DEFAULT_SIZES = (10, 1_000, 100_000)
+ROUTES_SIZE = 1_000 # Number of nodes of the database of the `authentication_request` and `update_node` cases
+NB_USERS = 10
+
+##-Platform
+class NoMQTTHandler:
+    '''Stands for `NodeMQTTHandler`: the messages to the nodes are dropped'''
+
+    def reserve_node(self, node_id: str) -> None:
+        pass
+
+    def cancel_reservation(self, node_id: str) -> None:
+        pass
+
+class BenchmarkPlatform:
+    '''The nodes API on an in-memory database holding `nb_nodes` nodes and `NB_USERS` users'''
+
+    def __init__(self, nb_nodes: int):
+        schema_registry = SchemaRegistry()
+        schema_registry.load_schema('node', NODE_TEMPLATE)
+        schema_registry.load_schema('user', USER_TEMPLATE)
+
+        self.db_service = DatabaseService('memory://', 'benchmarks', schema_registry)
+        self.db_service.connect()
+        self.db_service.ensure_indexes()
+
+        self._seed(nb_nodes)
+
+        self.nodes = self.db_service.db[schema_registry.get_collection_name('node')] # For the resets (not timed)
+        self.users = self.db_service.db[schema_registry.get_collection_name('user')]
+
+        app = Flask(__name__)
+        register_node_blueprint(app)
+        app.config['DB_SERVICE'] = self.db_service
+        app.config['MQTT_HANDLER'] = NoMQTTHandler()
+        self.client = app.test_client()
+
+    def _seed(self, nb_nodes: int) -> None:
+        '''
+        Creates the nodes (all `free`) and the users.
+        Only the first node is created by the `DRFactory` (slow), the others are copies with their own id and profile.
+        '''
+
+        node = DRFactory(NODE_TEMPLATE).create_dr('node', {'_id': '', 'profile': {'id': 0, 'position': '', 'token': NODE_TOKEN}})
+        for k, layout in enumerate(seeding.node_layout(nb_nodes, max(nb_nodes // 100, 1), PREFIX)):
+            self.db_service.save_dr('node', {
+                **node,
+                '_id': layout['_id'],
+                'profile': {'id': k, 'position': f'{layout["site"]} / {layout["zone"]} / {k}', 'token': NODE_TOKEN, 'site': layout['site'], 'zone': layout['zone']},
+            })
+
+        user_factory = DRFactory(USER_TEMPLATE)
+        badge_expiration = datetime.utcnow() + timedelta(days=365)
+        for uid in seeding.user_ids(NB_USERS, PREFIX):
+            self.db_service.save_dr('user', user_factory.create_dr('user', {
+                '_id': uid,
+                'profile': {'username': uid, 'email': f'{uid}@example.invalid', 'is_admin': False, 'badge_expiration': badge_expiration},
+            }))
+
+    @staticmethod
+    def node_id(k: int) -> str:
+        return f'{PREFIX}node_{k}'
+
+    @staticmethod
+    def uid(k: int) -> str:
+        return f'{PREFIX}user_{k}'
+
+    @staticmethod
+    def token(uid: str, is_admin: bool = False) -> str:
+        '''JWT of a user (same payload as the frontend `TokenManager.generate_token`)'''
+
+        payload = {'uid': uid, 'username': uid, 'is_admin': is_admin, 'exp': datetime.now(timezone.utc) + timedelta(days=1)}
+        return jwt.encode(payload, authentication.SECRET_KEY, algorithm='HS256')
+
+    def set_node(self, k: int, status: str, used_by: str = '') -> None:
+        self.nodes.update_one({'_id': self.node_id(k)}, {'$set': {'data.status': status, 'used_by': used_by}})
+
+    def set_user(self, k: int, **fields) -> None:
+        self.users.update_one({'_id': self.uid(k)}, {'$set': fields})
+
+def _ok(response) -> bool:
+    return response.status_code == 200
+
+##-Cases
+def route_cases(platform: BenchmarkPlatform) -> list[Case]:
+    '''The `authentication_request` and `update_node` cases (each on its own node and user)'''
+
+    user_token = platform.token(platform.uid(2))
+    cancel_token = platform.token(platform.uid(3))
+    admin_token = platform.token('bench_admin', is_admin=True)
+    profile = platform.db_service.get_dr('node', platform.node_id(4))['profile']
+
+    def reset_authentication():
+        platform.set_node(0, 'free')
+        platform.set_user(0, is_parked=False, auth_bytes=BLANK_BADGE, nb_reservations=0)
+
+    def reset_car_left():
+        platform.set_node(1, 'occupied', platform.uid(1))
+        platform.set_user(1, is_parked=True)
+
+    def reset_reservation():
+        platform.set_node(2, 'free')
+        platform.set_user(2, nb_reservations=0, is_parked=False)
+
+    def reset_cancellation():
+        platform.set_node(3, 'reserved', platform.uid(3))
+        platform.set_user(3, nb_reservations=1)
+
+    return [
+        Case(
+            'authentication_request',
+            lambda: platform.client.post(f'/api/nodes/{platform.node_id(0)}', json={
+                'token': NODE_TOKEN,
+                'user_data': {'UID': platform.uid(0), 'AUTH_BYTES': BLANK_BADGE, 'NEW_AUTH_BYTES': NEW_BADGE},
+            }),
+            reset_authentication, _ok,
+        ),
+        Case(
+            'update_node.node',
+            lambda: platform.client.patch(f'/api/nodes/{platform.node_id(1)}', json={
+                'source': 'node', 'token': NODE_TOKEN, 'data_to_update': {'status': 'free'},
+            }),
+            reset_car_left, _ok,
+        ),
+        Case(
+            'update_node.user_reserve',
+            lambda: platform.client.patch(f'/api/nodes/{platform.node_id(2)}', headers={'Authorization': user_token}, json={
+                'source': 'ui', 'data_to_update': {'status': 'reserved'},
+            }),
+            reset_reservation, _ok,
+        ),
+        Case(
+            'update_node.user_cancel',
+            lambda: platform.client.patch(f'/api/nodes/{platform.node_id(3)}', headers={'Authorization': cancel_token}, json={
+                'source': 'ui', 'data_to_update': {'status': 'free'},
+            }),
+            reset_cancellation, _ok,
+        ),
+        Case(
+            'update_node.admin',
+            lambda: platform.client.patch(f'/api/nodes/{platform.node_id(4)}', headers={'Authorization': admin_token}, json={
+                'source': 'ui', 'data_to_update': {'status': 'maintenance', 'profile': profile},
+            }),
+            check=_ok,
+        ),
+    ]
+
+def list_cases(platform: BenchmarkPlatform, nb_nodes: int) -> list[Case]:
+    '''The `list_nodes` cases on a platform of `nb_nodes` nodes'''
+
+    user_token = platform.token(platform.uid(0))
+    admin_token = platform.token('bench_admin', is_admin=True)
+
+    def all_nodes(response) -> bool:
+        return response.status_code == 200 and len(response.get_json()['nodes']) == nb_nodes
+
+    return [
+        Case(f'list_nodes.user.{nb_nodes}', lambda: platform.client.get('/api/nodes/', headers={'Authorization': user_token}), check=all_nodes),
+        Case(f'list_nodes.admin.{nb_nodes}', lambda: platform.client.get('/api/nodes/', headers={'Authorization': admin_token}), check=all_nodes),
+        Case(f'list_nodes.reservable.{nb_nodes}', lambda: platform.client.get('/api/nodes/?reservable', headers={'Authorization': user_token}), check=_ok),
+    ]
+
+def model_cases() -> list[Case]:
+    '''The cases without database: DR creation, schema loading and measurements aggregation'''
+
+    node_factory = DRFactory(NODE_TEMPLATE)
+    user_factory = DRFactory(USER_TEMPLATE)
+    badge_expiration = datetime.utcnow() + timedelta(days=365)
+
+    # 1000 DRs of 30 measurements of 3 types
+    rng = random.Random(SEED)
+    measure_types = ('occupancy', 'temperature', 'battery')
+    data = {'digital_replicas': [
+        {'_id': f'dr_{k}', 'type': 'node', 'data': {'measurements': [
+            {'measure_type': measure_types[m % 3], 'value': rng.uniform(0, 100), 'timestamp': datetime(2026, 1, 1)}
+            for m in range(30)
+        ]}}
+        for k in range(1_000)
+    ]}
+    aggregation = AggregationService()
+
+    return [
+        Case('dr_factory.create_dr.node', lambda: node_factory.create_dr('node', {
+            '_id': 'bench_node', 'profile': {'id': 1, 'position': 'site / zone / 1', 'token': NODE_TOKEN, 'site': 'site', 'zone': 'zone'},
+        })),
+        Case('dr_factory.create_dr.user', lambda: user_factory.create_dr('user', {
+            '_id': 'bench_user', 'profile': {'username': 'bench_user', 'email': 'bench_user@example.invalid', 'is_admin': False, 'badge_expiration': badge_expiration},
+        })),
+        Case('schema_registry.load_schema', lambda: SchemaRegistry().load_schema('node', NODE_TEMPLATE)),
+        Case('aggregation.execute', lambda: aggregation.execute(data, 'node'), check=lambda result: 'error' not in result),
+        Case('aggregation.execute.sketch', lambda: aggregation.execute(data, 'node', include_sketch=True), check=lambda result: 'error' not in result),
+    ]
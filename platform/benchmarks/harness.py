@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Timing of the benchmark cases, JSON baselines and comparison with a baseline.
+
+Each call of a case is timed individually (the `reset` of a case, run before each call, is not timed), with the
+garbage collector disabled, until both `min_calls` calls and `min_time` seconds are reached. The comparison is made
+on the median, which is the least sensitive to the noise of the machine.
+'''
+
+##-Imports
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+##-Init
+BASELINE_VERSION = 1
+
+##-Cases
+@dataclass
+class Case:
+    '''
+    A benchmarked code path
+
+    In:
+        - name: e.g `update_node.user_reserve`
+        - step: the timed call
+        - reset: called (not timed) before each call, to put the data back in the state expected by `step`
+        - check: tells if the result of `step` is the expected one (checked on the warm-up call, so that a
+                 benchmark does not silently measure an error path)
+    '''
+
+    name: str
+    step: Callable[[], Any]
+    reset: Callable[[], None] | None = None
+    check: Callable[[Any], bool] | None = None
+
+def measure(case: Case, min_time: float = 1.0, min_calls: int = 5, max_calls: int = 100_000) -> dict:
+    '''
+    Times a case
+
+    In:
+        - min_time: minimum total time of the timed calls (s)
+        - min_calls, max_calls: bounds of the number of timed calls
+    Out:
+        {calls, median_s, mean_s, stdev_s, min_s, p95_s, ops_per_s}
+    :raise RuntimeError: if the warm-up call fails its check
+    '''
+
+    # Warm-up (caches, lazy imports) and check of the path taken
+    if case.reset is not None:
+        case.reset()
+    result = case.step()
+    if case.check is not None and not case.check(result):
+        raise RuntimeError(f'{case.name}: unexpected result of the warm-up call: {result!r}')
+
+    durations = []
+    total = 0.0
+
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        while len(durations) < max_calls and (len(durations) < min_calls or total < min_time):
+            if case.reset is not None:
+                case.reset()
+
+            started = time.perf_counter()
+            case.step()
+            duration = time.perf_counter() - started
+
+            durations.append(duration)
+            total += duration
+
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    durations.sort()
+    median = statistics.median(durations)
+
+    return {
+        'calls': len(durations),
+        'median_s': median,
+        'mean_s': statistics.fmean(durations),
+        'stdev_s': statistics.stdev(durations) if len(durations) > 1 else 0.0,
+        'min_s': durations[0],
+        'p95_s': durations[max(round(0.95 * len(durations)) - 1, 0)],
+        'ops_per_s': 1 / median if median else None,
+    }
+
+##-Baselines
+def environment() -> dict:
+    '''Where the results were measured (only comparable on the same machine)'''
+
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def save_baseline(path: str, results: dict[str, dict], settings: dict) -> None:
+    '''Writes the `results` ({case: stats}) and the `settings` of the run to the JSON baseline `path`'''
+
+    baseline = {
+        'version': BASELINE_VERSION,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'environment': environment(),
+        'settings': settings,
+        'results': results,
+    }
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+def load_baseline(path: str) -> dict:
+    ''':raise ValueError: if `path` is not a baseline of this version'''
+
+    with open(path) as f:
+        baseline = json.load(f)
+
+    if baseline.get('version') != BASELINE_VERSION or 'results' not in baseline:
+        raise ValueError(f'{path}: not a benchmark baseline (version {BASELINE_VERSION})')
+
+    return baseline
+
+def compare(results: dict[str, dict], baseline: dict, threshold: float, ignore_missing: bool = False) -> list[dict]:
+    '''
+    Compares the medians of `results` with the ones of `baseline`
+
+    In:
+        - threshold: relative slow-down above which a case is a regression (e.g 0.2: 20 % slower)
+        - ignore_missing: skip the cases of the baseline that are not in `results` (only a part of the cases was run)
+    Out:
+        [{name, baseline_s, current_s, change, verdict}], `verdict` in (regression, improvement, same, new, missing)
+        and `change` the relative change of the median (None for new / missing cases)
+    '''
+
+    rows = []
+    names = set(results) if ignore_missing else set(results) | set(baseline['results'])
+    for name in sorted(names):
+        current = results.get(name, {}).get('median_s')
+        previous = baseline['results'].get(name, {}).get('median_s')
+
+        if current is None or previous is None:
+            verdict = 'new' if previous is None else 'missing'
+            rows.append({'name': name, 'baseline_s': previous, 'current_s': current, 'change': None, 'verdict': verdict})
+            continue
+
+        change = current / previous - 1 if previous else 0.0
+        if change > threshold:
+            verdict = 'regression'
+        elif change < -threshold:
+            verdict = 'improvement'
+        else:
+            verdict = 'same'
+
+        rows.append({'name': name, 'baseline_s': previous, 'current_s': current, 'change': change, 'verdict': verdict})
+
+    return rows
+
+##-Formatting
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return '-'
+    if seconds >= 1:
+        return f'{seconds:.2f} s'
+    if seconds >= 1e-3:
+        return f'{seconds * 1e3:.2f} ms'
+    return f'{seconds * 1e6:.1f} us'
+
+def format_results(results: dict[str, dict]) -> str:
+    '''Text table of the results'''
+
+    header = f'{"case":<36}{"calls":>8}{"median":>12}{"min":>12}{"p95":>12}{"stdev":>12}{"ops/s":>12}'
+    lines = [header, '-' * len(header)]
+
+    for name, stats in results.items():
+        lines.append(
+            f'{name:<36}{stats["calls"]:>8}{format_duration(stats["median_s"]):>12}{format_duration(stats["min_s"]):>12}'
+            f'{format_duration(stats["p95_s"]):>12}{format_duration(stats["stdev_s"]):>12}{stats["ops_per_s"] or 0:>12.1f}'
+        )
+
+    return '\n'.join(lines)
+
+def format_comparison(rows: list[dict], threshold: float) -> str:
+    '''Text table of a comparison (cf `compare`)'''
+
+    header = f'{"case":<36}{"baseline":>12}{"current":>12}{"change":>10}  verdict'
+    lines = [f'Median compared with the baseline (threshold: {threshold:.0%})', '', header, '-' * len(header)]
+
+    for row in rows:
+        change = '-' if row['change'] is None else f'{row["change"]:+.1%}'
+        lines.append(
+            f'{row["name"]:<36}{format_duration(row["baseline_s"]):>12}{format_duration(row["current_s"]):>12}{change:>10}  {row["verdict"]}'
+        )
+
+    regressions = [row['name'] for row in rows if row['verdict'] == 'regression']
+    lines += ['', f'{len(regressions)} regression(s)' + (f': {", ".join(regressions)}' if regressions else '')]
+
+    return '\n'.join(lines)
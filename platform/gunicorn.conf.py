@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Gunicorn configuration.
+
+The master starts a single MQTT gateway process (cf `src/application/mqtt_gateway.py`) before forking the workers.
+The workers find the gateway socket in `MQTT_GATEWAY_SOCKET` and forward their MQTT calls to it,
+so there is only one broker session whatever the number of workers.
+A thread of the master checks the gateway every `GATEWAY_CHECK_PERIOD_S` seconds and restarts it if it died
+(the workers reconnect on their next call).
+
+With several workers, set `PROMETHEUS_MULTIPROC_DIR` so that `/metrics` aggregates the metrics of all
+the processes (the directory is emptied when gunicorn starts).
+'''
+
+##-Imports
+import os
+import shutil
+from multiprocessing import Process
+from threading import Event, Lock, Thread
+
+from prometheus_client import multiprocess
+
+from src.application.mqtt_gateway import run_gateway, DEFAULT_SOCKET_PATH
+
+##-Settings
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+
+GATEWAY_CHECK_PERIOD_S = 5
+
+##-Gateway
+_gateway_process = None
+_gateway_lock = Lock()
+_stopping = Event()
+
+def _start_gateway(server, socket_path: str):
+    '''Starts the MQTT gateway process'''
+
+    global _gateway_process
+
+    _gateway_process = Process(target=run_gateway, args=(socket_path,), daemon=True, name='mqtt_gateway')
+    _gateway_process.start()
+
+    server.log.info(f'MQTT gateway started (pid: {_gateway_process.pid}, socket: {socket_path})')
+
+def _watch_gateway(server, socket_path: str):
+    '''Restarts the MQTT gateway process when it dies (thread of the master)'''
+
+    while not _stopping.wait(GATEWAY_CHECK_PERIOD_S):
+        with _gateway_lock:
+            if _stopping.is_set() or _gateway_process.is_alive():
+                continue
+
+            server.log.error(f'MQTT gateway exited (code: {_gateway_process.exitcode}), restarting it')
+            try:
+                _start_gateway(server, socket_path)
+            except Exception as e:
+                server.log.error(f'Failed to restart the MQTT gateway: {e}')
+
+##-Hooks
+def on_starting(server):
+    '''Starts the MQTT gateway process and its watchdog (called once, in the master)'''
+
+    # Metrics files of a previous run
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    socket_path = os.environ.setdefault('MQTT_GATEWAY_SOCKET', DEFAULT_SOCKET_PATH)
+
+    _start_gateway(server, socket_path)
+    Thread(target=_watch_gateway, args=(server, socket_path), daemon=True, name='mqtt_gateway_watchdog').start()
+
+def child_exit(server, worker):
+    '''Removes the live gauges of an exited worker from the aggregated metrics'''
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
+
+def on_exit(server):
+    '''Stops the MQTT gateway process (and its watchdog first, so that it is not restarted)'''
+
+    with _gateway_lock:
+        _stopping.set()
+
+        if _gateway_process is not None and _gateway_process.is_alive():
+            _gateway_process.terminate()
+            _gateway_process.join(timeout=5)
@@ -0,0 +1,14 @@
+'''
+Load test of the platform: a fleet of simulated parking nodes (following the state machine of `node/node.ino`)
+and concurrent users of the reservation page, driven by asyncio in a single process.
+
+    - `mqtt`: minimal MQTT 3.1.1 broker stand-in and client
+    - `http`: minimal HTTP/1.1 client
+    - `fleet`: the simulated nodes and the walk-in drivers
+    - `users`: the users reserving and cancelling
+    - `seed`: creation / removal of the load test nodes and users in the database
+    - `stats`: latency percentiles and throughput per operation
+
+Everything runs locally (platform, frontend, MongoDB, and the embedded broker or a local Mosquitto).
+Cf `python -m loadtest --help`.
+'''
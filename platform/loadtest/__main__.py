@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Command line of the load test (run from `platform/`):
+
+    python -m loadtest broker [--host 127.0.0.1] [--port 1883]
+    python -m loadtest seed --nodes 2000 --users 200 [--drivers N]
+    python -m loadtest run --nodes 2000 --users 200 --duration 300 --speed 10 [--ui-url http://localhost:3000]
+    python -m loadtest run ... --json faults.json --compare baseline.json   # Degradation under injected faults (FAULTS)
+    python -m loadtest pseudonymize --capture-key <CAPTURE_KEY>   # Test database copied from production, before replaying
+    python -m loadtest replay <CAPTURE_DIR or files> --speed 10 [--since 2026-10-19T07:00 --until 2026-10-19T10:00]
+    python -m loadtest cleanup
+'''
+
+##-Imports
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from loadtest.fleet import Badge, Fleet
+from loadtest.http import HTTPClient
+from loadtest.mqtt import Broker
+from loadtest.replay import replay
+from loadtest.stats import Recorder, compare_reports, format_comparison, format_report
+from loadtest.users import SimulatedUser, user_token
+from loadtest import seed as seeding
+
+##-Helpers
+def timestamp(text: str) -> float:
+    '''Epoch time of an ISO date (UTC if it has no time zone)'''
+
+    date = datetime.fromisoformat(text)
+    return (date if date.tzinfo else date.replace(tzinfo=timezone.utc)).timestamp()
+
+def replay_speed(text: str) -> float:
+    '''Speed of a replay: a factor, or `max` (0: as fast as possible)'''
+
+    if text == 'max':
+        return 0.0
+
+    speed = float(text)
+    if speed <= 0:
+        raise ValueError(text)
+    return speed
+
+def raise_open_files_limit() -> int:
+    '''Raises the soft limit of open files to the hard limit (one MQTT connection per node). Out: the new limit'''
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ValueError, OSError):
+        return soft
+
+async def injected_faults(platform: HTTPClient, secret: str) -> dict | None:
+    '''The faults injected by the platform worker answering (cf `GET /api/diagnostics/faults`), None if unavailable'''
+
+    token = user_token('loadtest_admin', secret, timedelta(minutes=5), is_admin=True)
+    try:
+        response = await platform.request('GET', '/api/diagnostics/faults', headers={'Authorization': token})
+    except (ConnectionError, OSError, asyncio.TimeoutError):
+        return None
+
+    return response.json() if response.status == 200 else None
+
+##-Commands
+async def run_broker(options) -> None:
+    broker = Broker(options.host, options.port)
+    await broker.start()
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await broker.stop()
+
+async def run_load_test(options) -> dict:
+    '''Runs the load test for `options.duration` seconds. Out: the report (cf `Recorder.report`) and the injected `faults`'''
+
+    if options.seed_random is not None:
+        random.seed(options.seed_random)
+
+    broker = None
+    if options.broker == 'embedded':
+        broker = Broker(options.mqtt_host, options.mqtt_port)
+        await broker.start()
+
+    recorder = Recorder()
+    platform = HTTPClient(options.platform_url, options.connections, options.timeout)
+    ui = HTTPClient(options.ui_url, options.connections, options.timeout) if options.ui_url else None
+
+    nb_drivers = options.nodes if options.drivers is None else options.drivers
+    uids = seeding.user_ids(options.users + nb_drivers, options.prefix)
+    badges = [Badge(uid) for uid in uids]
+
+    fleet = Fleet(options, platform, recorder, seeding.node_layout(options.nodes, options.sites, options.prefix), badges[options.users:])
+    users = [SimulatedUser(fleet, badge, user_token(badge.uid, options.jwt_secret), platform, ui, recorder) for badge in badges[:options.users]]
+
+    print(f'Connecting {options.nodes} nodes to {options.mqtt_host}:{options.mqtt_port}...', file=sys.stderr)
+    await fleet.start()
+
+    recorder.started = time.perf_counter() # Throughput over the load phase
+    tasks = [asyncio.create_task(fleet.walk_ins())] + [asyncio.create_task(user.run()) for user in users]
+
+    print(f'Running for {options.duration} s (speed x{options.speed})...', file=sys.stderr)
+    deadline = time.monotonic() + options.duration
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(10, max(deadline - time.monotonic(), 0)))
+        done = sum(stats['count'] for stats in recorder.report()['operations'].values())
+        print(f'  {options.duration - max(deadline - time.monotonic(), 0):.0f} s: {done} operations', file=sys.stderr)
+
+    recorder.stop()
+    for task in tasks:
+        task.cancel()
+
+    faults = await injected_faults(platform, options.jwt_secret)
+
+    for node in fleet.nodes:
+        recorder.count(f'final_state.{node.state}')
+
+    await fleet.stop()
+    await platform.close()
+    if ui is not None:
+        await ui.close()
+    if broker is not None:
+        recorder.count('broker.messages', broker.messages)
+        await broker.stop()
+
+    return {**recorder.report(), 'faults': faults}
+
+##-Main
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m loadtest', description='Load test of the parking platform with simulated nodes and users')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    # Broker
+    broker = commands.add_parser('broker', help='Run the embedded MQTT broker stand-in (instead of a local Mosquitto)')
+    broker.add_argument('--host', default='127.0.0.1')
+    broker.add_argument('--port', type=int, default=1883)
+
+    # Seed / cleanup
+    for name, help_text in (('seed', 'Create the load test nodes and users in the database'), ('cleanup', 'Remove the load test nodes and users'), ('run', 'Run the load test')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--prefix', default=seeding.DEFAULT_PREFIX, help='Prefix of the ids of the load test nodes and users')
+
+        if name == 'cleanup':
+            continue
+
+        command.add_argument('--nodes', type=int, default=1000, help='Number of simulated nodes')
+        command.add_argument('--users', type=int, default=100, help='Number of concurrent users of the reservation page')
+        command.add_argument('--drivers', type=int, default=None, help='Number of walk-in drivers (badges), default: one per node')
+        command.add_argument('--sites', type=int, default=10, help='Number of sites the nodes are spread over')
+        command.add_argument('--node-token', default='loadtest_node_token', help='Secret token of the simulated nodes')
+
+    run = commands.choices['run']
+    run.add_argument('--duration', type=float, default=300, help='Duration of the load phase (s)')
+    run.add_argument('--speed', type=float, default=10, help='Simulated time speed-up (firmware timeouts and drivers, not the heartbeats)')
+    run.add_argument('--platform-url', default='http://localhost:5000')
+    run.add_argument('--ui-url', default=None, help='Frontend URL: the users go through the UI endpoints (default: the platform API)')
+    run.add_argument('--broker', choices=('embedded', 'external'), default='embedded', help='Start the embedded broker, or use a running one (e.g Mosquitto)')
+    run.add_argument('--mqtt-host', default='127.0.0.1')
+    run.add_argument('--mqtt-port', type=int, default=1883)
+    run.add_argument('--jwt-secret', default=os.environ.get('JWT_SHARED_TOKEN'), help='Secret of the user JWTs (default: JWT_SHARED_TOKEN)')
+    run.add_argument('--arrival-rate', type=float, default=0.5, help='Walk-in cars per node per simulated hour')
+    run.add_argument('--dwell-minutes', type=float, default=90, help='Mean parking time (simulated)')
+    run.add_argument('--think-time', type=float, default=600, help='Mean time between two reservations of a user (simulated s)')
+    run.add_argument('--cancel-rate', type=float, default=0.2, help='Share of the reservations cancelled')
+    run.add_argument('--no-show-rate', type=float, default=0.1, help='Share of the reservations that time out on the node')
+    run.add_argument('--invalid-badge-rate', type=float, default=0.02, help='Share of the walk-ins with an unknown badge')
+    run.add_argument('--connections', type=int, default=100, help='Maximum HTTP connections per server')
+    run.add_argument('--connect-concurrency', type=int, default=200, help='Nodes connecting to the broker at the same time')
+    run.add_argument('--timeout', type=float, default=10, help='HTTP timeout (s)')
+    run.add_argument('--no-seed', action='store_true', help='Use the nodes and users created by `seed` (they must not have been used since)')
+    run.add_argument('--seed-random', type=int, default=None, help='Seed of the random generator')
+    run.add_argument('--json', default=None, help='Also write the report to this file')
+    run.add_argument('--compare', default=None, help='Report of a baseline run (--json): show how the p99 latency and the throughput degrade')
+
+    # Pseudonymize
+    pseudonymizing = commands.add_parser('pseudonymize', help='Replace the badge bytes of the users of the (test) database by their pseudonym in a capture')
+    pseudonymizing.add_argument('--capture-key', default=os.environ.get('CAPTURE_KEY'), help='CAPTURE_KEY of the captured platform (default: CAPTURE_KEY)')
+
+    # Replay
+    replaying = commands.add_parser('replay', help='Replay a captured traffic (CAPTURE_DIR) on a test instance')
+    replaying.add_argument('captures', nargs='+', help='Capture files, or directories of capture files')
+    replaying.add_argument('--speed', type=replay_speed, default=1.0, help='Time speed-up (1: real time, 10, ...), or max: as fast as possible (the events of each node stay in order)')
+    replaying.add_argument('--since', type=timestamp, default=None, help='Only the events from this date (ISO, UTC by default)')
+    replaying.add_argument('--until', type=timestamp, default=None, help='Only the events before this date')
+    replaying.add_argument('--platform-url', default='http://localhost:5000')
+    replaying.add_argument('--mqtt-host', default='127.0.0.1')
+    replaying.add_argument('--mqtt-port', type=int, default=1883)
+    replaying.add_argument('--no-mqtt', action='store_true', help='Do not publish the captured MQTT messages of the nodes')
+    replaying.add_argument('--jwt-secret', default=os.environ.get('JWT_SHARED_TOKEN'), help='Secret of the JWTs of the test instance (default: JWT_SHARED_TOKEN)')
+    replaying.add_argument('--node-token', default='loadtest_node_token', help='Secret token of the nodes of the test instance')
+    replaying.add_argument('--connections', type=int, default=100, help='Maximum HTTP connections')
+    replaying.add_argument('--timeout', type=float, default=10, help='HTTP timeout (s)')
+    replaying.add_argument('--json', default=None, help='Also write the report to this file')
+    replaying.add_argument('--compare', default=None, help='Report of a previous replay (--json), e.g on another build')
+
+    options = parser.parse_args(argv)
+
+    if options.command == 'broker':
+        raise_open_files_limit()
+        asyncio.run(run_broker(options))
+        return
+
+    if options.command == 'replay':
+        if not options.jwt_secret:
+            parser.error('the JWT secret of the test instance is needed (--jwt-secret or JWT_SHARED_TOKEN)')
+
+        baseline = None
+        if options.compare:
+            with open(options.compare) as f:
+                baseline = json.load(f)
+
+        try:
+            report = asyncio.run(replay(options))
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+        print(format_report(report))
+
+        if baseline is not None:
+            print()
+            print(format_comparison(compare_reports(baseline, report)))
+
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
+
+    if options.command == 'pseudonymize':
+        if not options.capture_key:
+            parser.error('the key of the capture is needed (--capture-key or CAPTURE_KEY)')
+
+        db_service = seeding.connect_database()
+        print(f'{seeding.pseudonymize_badges(db_service, options.capture_key)} badges pseudonymized')
+        db_service.disconnect()
+        return
+
+    if options.command == 'cleanup':
+        print(f'{seeding.cleanup(seeding.connect_database(), options.prefix)} load test nodes and users removed')
+        return
+
+    nb_drivers = options.nodes if options.drivers is None else options.drivers
+
+    if options.command == 'seed' or not options.no_seed:
+        db_service = seeding.connect_database()
+        seeding.seed(db_service, options.nodes, options.users + nb_drivers, options.sites, options.node_token, options.prefix)
+        db_service.disconnect()
+        print(f'{options.nodes} nodes and {options.users + nb_drivers} users created', file=sys.stderr)
+
+    if options.command == 'seed':
+        return
+
+    if not options.jwt_secret:
+        parser.error('the JWT secret is needed for the users (--jwt-secret or JWT_SHARED_TOKEN)')
+
+    limit = raise_open_files_limit()
+    if limit < options.nodes * (2 if options.broker == 'embedded' else 1) + 2 * options.connections + 64:
+        print(f'Warning: the open files limit ({limit}) is too low for {options.nodes} nodes', file=sys.stderr)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    report = asyncio.run(run_load_test(options))
+    print(format_report(report))
+
+    if baseline is not None:
+        print()
+        print(format_comparison(compare_reports(baseline, report)))
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Simulated parking nodes (a port of the state machine of `node/node.ino`) and the drivers using them.
+
+Each node has its own MQTT connection (Last Will, `online` status, subscriptions to `nodes/<id>` and to its group
+topics, heartbeats and telemetry) and calls the platform like the firmware: badge authentication POSTs and status PATCHes.
+
+The durations of the firmware (reservation / authentication / retry timeouts) and of the drivers (badge delay,
+dwell time, ...) are divided by the `speed` factor of the run. The heartbeat and telemetry periods are not:
+the platform tracks the liveness in real time.
+'''
+
+##-Imports
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+import secrets
+import time
+
+from loadtest.http import HTTPClient
+from loadtest.mqtt import MQTTClient
+from loadtest.stats import Recorder
+
+##-Init
+# Firmware durations (s), cf node.ino
+RESERVATION_TIMEOUT_S = 120
+AUTH_TIMEOUT_S = 60
+RETRY_TIMEOUT_S = 5
+HEARTBEAT_PERIOD_S = 30
+TELEMETRY_PERIOD_S = 60
+
+FREE, RESERVED, WAIT_AUTH, UNAUTHORIZED, VIOLATION, OCCUPIED, MAINTENANCE = (
+    'FREE', 'RESERVED', 'WAIT_AUTH', 'UNAUTHORIZED', 'VIOLATION', 'OCCUPIED', 'MAINTENANCE'
+)
+
+##-Badges
+class Badge:
+    '''An RFID badge: the UID and the rolling authentication bytes written on the card'''
+
+    def __init__(self, uid: str, auth_bytes: str = '0' * 16):
+        self.uid = uid
+        self.auth_bytes = auth_bytes
+        self.desynced = False # The card was rewritten but the platform did not get the new bytes (next use: cloning)
+
+##-Node
+class SimulatedNode:
+    '''One parking node (cf `runStateMachine` and `mqttCallback` in node.ino)'''
+
+    def __init__(self, fleet: Fleet, node_id: str, site: str, zone: str):
+        self.fleet = fleet
+        self.node_id = node_id
+        self.site = site
+        self.zone = zone
+
+        self.state = FREE
+        self.origin_state = FREE
+        self.state_enter_time = time.monotonic()
+
+        # Inputs of the state machine (same names as the firmware flags)
+        self.occupancy = False
+        self.mqtt_reserved_flag = False
+        self.mqtt_cancellation_flag = False
+        self.mqtt_maintenance_flag = False
+        self.mqtt_open_flag = False
+        self.valid_card_tried = False
+        self.invalid_card_tried = False
+        self.violation = False
+        self.badge = None # Badge presented to the reader
+
+        self.mqtt = MQTTClient(node_id, self._on_message)
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._tasks = []
+
+    ##-Lifecycle
+    async def start(self) -> None:
+        '''Connects to the broker (with the `offline` Last Will) and starts the state machine'''
+
+        options = self.fleet.options
+        recorder = self.fleet.recorder
+        topic_status = f'nodes/{self.node_id}/status'
+
+        started = time.perf_counter()
+        try:
+            await self.mqtt.connect(options.mqtt_host, options.mqtt_port, will=(topic_status, 'offline', 1, True))
+            await self.mqtt.publish(topic_status, 'online', qos=1, retain=True)
+            await self.mqtt.subscribe([
+                (f'nodes/{self.node_id}', 0),
+                ('groups/all', 0),
+                (f'groups/{self.site}/all', 0),
+                (f'groups/{self.site}/{self.zone}', 0),
+            ])
+
+        except (OSError, asyncio.TimeoutError) as e:
+            recorder.record('mqtt.connect', time.perf_counter() - started, type(e).__name__)
+            raise
+
+        recorder.record('mqtt.connect', time.perf_counter() - started)
+
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(self._periodic(HEARTBEAT_PERIOD_S, self._send_heartbeat)),
+            asyncio.create_task(self._periodic(TELEMETRY_PERIOD_S, self._send_telemetry)),
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await self.mqtt.disconnect()
+
+    ##-Inputs (drivers)
+    def car_arrives(self) -> None:
+        self.occupancy = True
+        self._wakeup.set()
+
+    def car_leaves(self) -> None:
+        self.occupancy = False
+        self.badge = None
+        self._wakeup.set()
+
+    def present_badge(self, badge: Badge) -> None:
+        self.badge = badge
+        self._wakeup.set()
+
+    async def wait_state(self, states: tuple[str, ...], timeout: float) -> bool:
+        '''Waits until the node is in one of `states`. Out: False on timeout'''
+
+        deadline = time.monotonic() + timeout
+        while self.state not in states:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+
+        return True
+
+    ##-MQTT (cf mqttCallback)
+    def _on_message(self, topic: str, payload: bytes) -> None:
+        message = payload.decode(errors='replace')
+
+        # Group command: {"cmd": str, "id": str}
+        if topic.startswith('groups/'):
+            try:
+                command = json.loads(message)
+            except ValueError:
+                return
+
+            cmd = command.get('cmd', '')
+            if cmd == 'free' and self.state == RESERVED:
+                self.origin_state = RESERVED
+                self.mqtt_cancellation_flag = True
+            elif cmd == 'maintenance' and self.state in (FREE, RESERVED):
+                self.mqtt_maintenance_flag = True
+            elif cmd == 'open' and self.state == MAINTENANCE:
+                self.mqtt_open_flag = True
+            else:
+                return # Not concerned
+
+            self.fleet.recorder.count(f'group_command.{cmd}')
+            asyncio.create_task(self.mqtt.publish(f'nodes/{self.node_id}/ack', command.get('id', '')))
+
+        elif message == 'reserved':
+            self.fleet.delivered(self.node_id, 'reserved')
+            if self.state in (FREE, WAIT_AUTH, UNAUTHORIZED):
+                self.mqtt_reserved_flag = True
+
+        elif message == 'free':
+            self.fleet.delivered(self.node_id, 'free')
+            if self.state == RESERVED or self.origin_state == RESERVED:
+                self.origin_state = RESERVED
+                self.mqtt_cancellation_flag = True
+
+        self._wakeup.set()
+
+    async def _periodic(self, period: float, send) -> None:
+        await asyncio.sleep(random.uniform(0, period)) # Spread the fleet
+
+        while True:
+            try:
+                await send()
+            except (OSError, asyncio.TimeoutError):
+                self.fleet.recorder.count('mqtt.publish_failures')
+            await asyncio.sleep(period)
+
+    async def _send_heartbeat(self) -> None:
+        await self.mqtt.publish(f'nodes/{self.node_id}/heartbeat', str(int(time.monotonic() * 1000)))
+        self.fleet.recorder.count('mqtt.heartbeats')
+
+    async def _send_telemetry(self) -> None:
+        payload = {'rssi': random.randint(-90, -40), 'uptime': int(time.monotonic() * 1000), 'free_heap': random.randint(20000, 40000), 'rfid_errors': 0}
+        await self.mqtt.publish(f'nodes/{self.node_id}/telemetry', json.dumps(payload))
+        self.fleet.recorder.count('mqtt.telemetry')
+
+    ##-HTTP (cf sendNodeStatusUpdate and requestBackendAuthorization)
+    async def _send_status_update(self, status: str) -> None:
+        payload = {'data_to_update': {'status': status}, 'source': 'node', 'token': self.fleet.options.node_token}
+        await self.fleet.call('node.patch_status', 'PATCH', f'/api/nodes/{self.node_id}', payload)
+
+    async def _check_rfid(self) -> None:
+        '''Reads the presented badge, rewrites its authentication bytes and asks the platform (cf checkRFID)'''
+
+        if self.state != WAIT_AUTH or self.badge is None:
+            return
+
+        badge, self.badge = self.badge, None
+        current, new = badge.auth_bytes, secrets.token_hex(8).upper()
+        badge.auth_bytes = new # The card is rewritten before the platform answers
+
+        payload = {'user_data': {'UID': badge.uid, 'AUTH_BYTES': current, 'NEW_AUTH_BYTES': new}, 'token': self.fleet.options.node_token}
+        response = await self.fleet.call('node.auth', 'POST', f'/api/nodes/{self.node_id}', payload, ok_statuses=(200, 403, 404))
+
+        result = None
+        if response is not None:
+            try:
+                result = response.json().get('status')
+            except ValueError:
+                pass
+
+        if response is None or (result == 'error' and response.status >= 500):
+            badge.desynced = True
+
+        self.fleet.recorder.count(f'auth.{result or "no_response"}')
+
+        if result == 'success':
+            self.valid_card_tried, self.invalid_card_tried, self.violation = True, False, False
+        elif result == 'violation':
+            self.valid_card_tried, self.invalid_card_tried, self.violation = False, False, True
+        elif result == 'invalid':
+            self.valid_card_tried, self.invalid_card_tried, self.violation = False, True, False
+
+    ##-State machine (cf runStateMachine)
+    def _transition(self, state: str, origin_state: str | None = None) -> None:
+        self.fleet.recorder.count(f'transition.{self.state}->{state}')
+
+        self.state = state
+        if origin_state is not None:
+            self.origin_state = origin_state
+        self.state_enter_time = time.monotonic()
+
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _step(self) -> bool:
+        '''One iteration of `runStateMachine`. Out: True if the state changed'''
+
+        time_in_state = (time.monotonic() - self.state_enter_time) * self.fleet.options.speed
+        state = self.state
+
+        if state == FREE:
+            if self.occupancy:
+                self._transition(WAIT_AUTH)
+            elif self.mqtt_reserved_flag:
+                self.mqtt_reserved_flag = False
+                self._transition(RESERVED, RESERVED)
+            elif self.mqtt_maintenance_flag:
+                self.mqtt_maintenance_flag = False
+                self._transition(MAINTENANCE)
+
+        elif state == RESERVED:
+            if self.occupancy:
+                self._transition(WAIT_AUTH)
+            elif time_in_state > RESERVATION_TIMEOUT_S:
+                self._transition(FREE, FREE)
+                await self._send_status_update('free')
+            elif self.mqtt_cancellation_flag:
+                self.mqtt_cancellation_flag = False
+                self._transition(FREE, FREE)
+            elif self.mqtt_maintenance_flag:
+                self.mqtt_maintenance_flag = False
+                self._transition(MAINTENANCE, FREE)
+
+        elif state == WAIT_AUTH:
+            if time_in_state > AUTH_TIMEOUT_S or self.violation:
+                self._transition(VIOLATION)
+                await self._send_status_update('violation')
+            elif self.invalid_card_tried:
+                self._transition(UNAUTHORIZED)
+            elif self.valid_card_tried:
+                self._transition(OCCUPIED)
+            elif not self.occupancy:
+                self._transition(self.origin_state)
+
+        elif state == UNAUTHORIZED:
+            if time_in_state > RETRY_TIMEOUT_S:
+                self.invalid_card_tried = False
+                self._transition(WAIT_AUTH)
+
+        elif state == VIOLATION:
+            if not self.occupancy:
+                self.violation = False
+                origin_state = self.origin_state
+                self._transition(origin_state)
+                await self._send_status_update('reserved' if origin_state == RESERVED else 'free')
+
+        elif state == OCCUPIED:
+            if not self.occupancy:
+                self.valid_card_tried = False
+                self._transition(FREE, FREE)
+                await self._send_status_update('free')
+
+        elif state == MAINTENANCE:
+            # Cars and badges are ignored: the platform already knows the spot is closed
+            if self.mqtt_open_flag:
+                self.mqtt_open_flag = False
+                self._transition(FREE, FREE)
+
+        return self.state != state
+
+    def _next_timeout(self) -> float | None:
+        '''Real time (s) until the timeout of the current state, None if the state has none'''
+
+        timeout = {RESERVED: RESERVATION_TIMEOUT_S, WAIT_AUTH: AUTH_TIMEOUT_S, UNAUTHORIZED: RETRY_TIMEOUT_S}.get(self.state)
+        if timeout is None:
+            return None
+
+        elapsed = time.monotonic() - self.state_enter_time
+        return max(timeout / self.fleet.options.speed - elapsed, 0) + 0.001
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+
+            await self._check_rfid()
+            while await self._step():
+                pass
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_timeout())
+            except asyncio.TimeoutError:
+                pass
+
+##-Fleet
+class Fleet:
+    '''The simulated nodes, the walk-in drivers and the driving of the UI users to their reserved spot'''
+
+    def __init__(self, options, platform: HTTPClient, recorder: Recorder, nodes: list[dict], badges: list[Badge]):
+        '''
+        In:
+            - options: the options of the run (cf `loadtest.__main__`)
+            - platform: HTTP client of the platform
+            - nodes: [{_id, site, zone}]
+            - badges: the badges of the walk-in drivers
+        '''
+
+        self.options = options
+        self.platform = platform
+        self.recorder = recorder
+
+        self.nodes = [SimulatedNode(self, node['_id'], node['site'], node['zone']) for node in nodes]
+        self.nodes_by_id = {node.node_id: node for node in self.nodes}
+        self.idle_badges = list(badges)
+
+        self._expected: dict[tuple[str, str], float] = {} # (node id, message) -> time of the UI request
+        self._drivers = set()
+
+    async def start(self) -> None:
+        '''Connects the nodes (at most `connect_concurrency` at a time)'''
+
+        semaphore = asyncio.Semaphore(self.options.connect_concurrency)
+
+        async def start_node(node):
+            async with semaphore:
+                try:
+                    await node.start()
+                except (OSError, asyncio.TimeoutError):
+                    pass
+
+        await asyncio.gather(*(start_node(node) for node in self.nodes))
+        self.recorder.count('nodes.connected', sum(node.mqtt.connected for node in self.nodes))
+
+    async def stop(self) -> None:
+        for task in list(self._drivers):
+            task.cancel()
+        await asyncio.gather(*(node.stop() for node in self.nodes if node.mqtt.connected), return_exceptions=True)
+
+    async def call(self, operation: str, method: str, path: str, payload: dict, ok_statuses: tuple[int, ...] = (200,)):
+        '''
+        Sends a request to the platform and records its latency
+
+        Out:
+            The response  (None on network errors)
+        '''
+
+        started = time.perf_counter()
+        try:
+            response = await self.platform.request(method, path, json_data=payload)
+
+        except (OSError, asyncio.TimeoutError) as e:
+            self.recorder.record(operation, time.perf_counter() - started, type(e).__name__)
+            return None
+
+        self.recorder.record(operation, response.elapsed, None if response.status in ok_statuses else f'HTTP {response.status}')
+        return response
+
+    ##-Reservation messages
+    def expect(self, node_id: str, message: str) -> None:
+        '''A UI user requested a reservation (`reserved`) or a cancellation (`free`) of `node_id`'''
+
+        self._expected[(node_id, message)] = time.perf_counter()
+
+    def forget(self, node_id: str, message: str) -> None:
+        '''The UI request was refused: no message expected'''
+
+        self._expected.pop((node_id, message), None)
+
+    def delivered(self, node_id: str, message: str) -> None:
+        '''The node received `message`: records the delay since the UI request (`mqtt.<message>_delivery`)'''
+
+        started = self._expected.pop((node_id, message), None)
+        if started is not None:
+            self.recorder.record(f'mqtt.{message}_delivery', time.perf_counter() - started)
+
+    ##-Drivers
+    def _sleep(self, simulated_s: float):
+        return asyncio.sleep(simulated_s / self.options.speed)
+
+    def spawn(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._drivers.add(task)
+        task.add_done_callback(self._drivers.discard)
+        return task
+
+    async def walk_ins(self) -> None:
+        '''Poisson arrivals of walk-in drivers (`arrival_rate` cars per node per simulated hour)'''
+
+        rate = len(self.nodes) * self.options.arrival_rate / 3600 * self.options.speed # Per real second
+        if rate <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            self.recorder.count('drivers.arrivals')
+
+            # The driver looks for a green spot
+            candidates = [node for node in random.sample(self.nodes, min(20, len(self.nodes))) if node.state == FREE and not node.occupancy and node.mqtt.connected]
+            if not candidates:
+                self.recorder.count('drivers.turned_away')
+                continue
+
+            if random.random() < self.options.invalid_badge_rate:
+                badge = Badge(f'loadtest_unknown_{secrets.token_hex(4)}')
+            elif self.idle_badges:
+                badge = self.idle_badges.pop(random.randrange(len(self.idle_badges)))
+            else:
+                self.recorder.count('drivers.no_badge')
+                continue
+
+            self.park(candidates[0], badge, release=True)
+
+    def park(self, node: SimulatedNode, badge: Badge, release: bool = False) -> asyncio.Task:
+        '''
+        A driver parks on `node`: the car is detected (now, so that no other driver takes the spot),
+        the badge is presented, then the car stays or leaves.
+
+        In:
+            - release: put the badge back in the pool of the walk-in drivers afterwards
+        Out:
+            The task of the driver. Its result is the state reached after the badge (OCCUPIED, UNAUTHORIZED,
+            VIOLATION, or WAIT_AUTH if no answer)
+        '''
+
+        node.car_arrives()
+        return self.spawn(self._park(node, badge, release))
+
+    async def _park(self, node: SimulatedNode, badge: Badge, release: bool) -> str:
+        options = self.options
+        outcome = WAIT_AUTH
+
+        try:
+            await self._sleep(random.uniform(2, 10)) # Getting out of the car
+            node.present_badge(badge)
+
+            if await node.wait_state((OCCUPIED, UNAUTHORIZED, VIOLATION), (AUTH_TIMEOUT_S + 5) / options.speed):
+                outcome = node.state
+            self.recorder.count(f'drivers.{outcome.lower()}')
+
+            if outcome == OCCUPIED:
+                await self._sleep(random.expovariate(1 / (options.dwell_minutes * 60)))
+            else:
+                await self._sleep(random.uniform(5, 30)) # Gives up
+
+            node.car_leaves()
+
+        finally:
+            if release and not badge.desynced and not badge.uid.startswith('loadtest_unknown_'):
+                self.idle_badges.append(badge)
+            elif badge.desynced:
+                self.recorder.count('badges.desynced')
+
+        return outcome
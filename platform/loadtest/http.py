@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Minimal asyncio HTTP/1.1 client with keep-alive connections (no dependency, enough for the platform and the frontend).
+'''
+
+##-Imports
+from __future__ import annotations
+
+import asyncio
+import json
+import ssl
+import time
+from urllib.parse import urlencode, urlsplit
+
+##-Response
+class Response:
+    '''An HTTP response. `elapsed` is the time from sending the request to the end of the body (connection wait excluded)'''
+
+    def __init__(self, status: int, headers: dict[str, str], body: bytes, elapsed: float):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.elapsed = elapsed
+
+    def json(self):
+        return json.loads(self.body)
+
+    @property
+    def cookies(self) -> dict[str, str]:
+        '''Cookies set by the response (name -> value)'''
+
+        cookies = {}
+        for value in self.headers.get('set-cookie', '').split('\n'):
+            if '=' in value:
+                name, rest = value.split('=', 1)
+                cookies[name.strip()] = rest.split(';', 1)[0]
+        return cookies
+
+##-Client
+class HTTPClient:
+    '''HTTP client for one server, with a pool of at most `max_connections` keep-alive connections'''
+
+    def __init__(self, base_url: str, max_connections: int = 100, timeout: float = 10):
+        '''
+        In:
+            - base_url: e.g `http://localhost:5000`
+            - max_connections: maximum number of concurrent connections (the other requests wait for one)
+            - timeout: timeout of a request, in seconds
+        '''
+
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+
+        self._ssl = ssl.create_default_context() if url.scheme == 'https' else None
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(max_connections)
+
+    async def request(self, method: str, path: str, json_data=None, form: dict | None = None, headers: dict | None = None) -> Response:
+        '''
+        Sends a request and reads the whole response
+
+        In:
+            - path: path (and query string) relative to the base URL
+            - json_data: JSON body
+            - form: urlencoded form body
+        Out:
+            The response
+            ConnectionError / asyncio.TimeoutError  on network errors
+        '''
+
+        body = b''
+        all_headers = {'Host': f'{self.host}:{self.port}', 'Connection': 'keep-alive'}
+        if json_data is not None:
+            body = json.dumps(json_data).encode()
+            all_headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            body = urlencode(form).encode()
+            all_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        all_headers['Content-Length'] = str(len(body))
+        all_headers.update(headers or {})
+
+        head = f'{method} {self.prefix}{path} HTTP/1.1\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in all_headers.items()) + '\r\n'
+
+        async with self._slots:
+            # A kept-alive connection may have been closed by the server: retry once on a new one
+            for attempt in range(2):
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=self._ssl), self.timeout
+                )
+
+                started = time.perf_counter()
+                try:
+                    writer.write(head.encode() + body)
+                    status, response_headers, response_body, keep_alive = await asyncio.wait_for(self._read_response(reader), self.timeout)
+
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise ConnectionError(str(e) or 'connection closed')
+
+                except BaseException:
+                    writer.close()
+                    raise
+
+                elapsed = time.perf_counter() - started
+
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+
+                return Response(status, response_headers, response_body, elapsed)
+
+    async def close(self) -> None:
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> tuple[int, dict[str, str], bytes, bool]:
+        status_line = await reader.readuntil(b'\r\n')
+        version, status = status_line.split(b' ', 2)[:2]
+
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            name = name.strip().lower()
+            headers[name] = f'{headers[name]}\n{value.strip()}' if name in headers else value.strip() # Set-Cookie can be repeated
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readuntil(b'\r\n')
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+            body = bytes(body)
+
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+
+        else: # Until the connection is closed
+            body = await reader.read()
+            return int(status), headers, body, False
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == b'HTTP/1.1'
+        return int(status), headers, body, keep_alive
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Minimal asyncio MQTT 3.1.1: a broker stand-in and a client, enough to simulate thousands of nodes in one process.
+
+Supported: CONNECT (clean session, Last Will, username / password ignored), SUBSCRIBE with `+` and `#` wildcards,
+PUBLISH QoS 0 and 1 (no retransmission), retained messages, PINGREQ, DISCONNECT.
+Not supported: persistent sessions, QoS 2 (the connection is closed), UNSUBSCRIBE.
+
+The broker is a stand-in for a local Mosquitto (paho clients, e.g the platform, can connect to it):
+    python -m loadtest broker --port 1883
+'''
+
+##-Imports
+from __future__ import annotations
+
+import asyncio
+import logging
+import struct
+from typing import Awaitable, Callable
+
+##-Init
+logger = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK, PINGREQ, PINGRESP, DISCONNECT = 1, 2, 3, 4, 8, 9, 12, 13, 14
+
+##-Codec
+def _encode_length(length: int) -> bytes:
+    '''Encodes the remaining length (variable length, 7 bits per byte)'''
+
+    out = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+def _string(value: str | bytes) -> bytes:
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+def packet(kind: int, body: bytes, flags: int = 0) -> bytes:
+    '''Builds a packet from its type, flags and body (variable header + payload)'''
+
+    return bytes([kind << 4 | flags]) + _encode_length(len(body)) + body
+
+def publish_packet(topic: str, payload: bytes, qos: int = 0, retain: bool = False, packet_id: int = 0) -> bytes:
+    body = _string(topic) + (struct.pack('!H', packet_id) if qos else b'') + payload
+    return packet(PUBLISH, body, qos << 1 | int(retain))
+
+async def read_packet(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+    '''
+    Reads one packet
+
+    Out:
+        (type, flags, body)
+        asyncio.IncompleteReadError  if the connection is closed
+    '''
+
+    header = (await reader.readexactly(1))[0]
+
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+
+    return header >> 4, header & 0x0f, await reader.readexactly(length) if length else b''
+
+def parse_publish(flags: int, body: bytes) -> tuple[str, bytes, int, bool, int]:
+    '''Parses a PUBLISH body. Out: (topic, payload, qos, retain, packet_id)'''
+
+    size = struct.unpack_from('!H', body)[0]
+    topic = body[2:2 + size].decode()
+    offset = 2 + size
+    qos = (flags >> 1) & 0x03
+
+    packet_id = 0
+    if qos:
+        packet_id = struct.unpack_from('!H', body, offset)[0]
+        offset += 2
+
+    return topic, body[offset:], qos, bool(flags & 0x01), packet_id
+
+def _read_string(body: bytes, offset: int) -> tuple[bytes, int]:
+    size = struct.unpack_from('!H', body, offset)[0]
+    return body[offset + 2:offset + 2 + size], offset + 2 + size
+
+##-Broker
+class _TopicTree:
+    '''Subscriptions indexed by topic level (the matching cost does not depend on the number of subscriptions)'''
+
+    def __init__(self):
+        self.children: dict[str, _TopicTree] = {}
+        self.subscribers: dict[_BrokerSession, int] = {} # Session -> QoS
+
+    def add(self, levels: list[str], session, qos: int) -> None:
+        node = self
+        for level in levels:
+            node = node.children.setdefault(level, _TopicTree())
+        node.subscribers[session] = qos
+
+    def remove(self, levels: list[str], session) -> None:
+        node = self
+        for level in levels:
+            node = node.children.get(level)
+            if node is None:
+                return
+        node.subscribers.pop(session, None)
+
+    def match(self, levels: list[str], out: dict, index: int = 0) -> dict:
+        '''Fills `out` (session -> max QoS) with the subscribers of the topic `levels`'''
+
+        wildcard = self.children.get('#')
+        if wildcard is not None and not (index == 0 and levels[0].startswith('$')):
+            self._merge(wildcard.subscribers, out)
+
+        if index == len(levels):
+            self._merge(self.subscribers, out)
+            return out
+
+        for key in (levels[index], '+'):
+            child = self.children.get(key)
+            if child is not None and not (key == '+' and index == 0 and levels[0].startswith('$')):
+                child.match(levels, out, index + 1)
+
+        return out
+
+    @staticmethod
+    def _merge(subscribers: dict, out: dict) -> None:
+        for session, qos in subscribers.items():
+            if out.get(session, -1) < qos:
+                out[session] = qos
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    '''Tells if `topic` matches the subscription `pattern` (with `+` and `#` wildcards)'''
+
+    tree = _TopicTree()
+    tree.add(pattern.split('/'), None, 0)
+    return None in tree.match(topic.split('/'), {})
+
+
+class _BrokerSession:
+    '''One client connection of the broker'''
+
+    def __init__(self, broker: Broker, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.will = None # (topic, payload, qos, retain)
+        self.subscriptions: list[list[str]] = []
+        self._next_id = 0
+
+    def send(self, data: bytes) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def deliver(self, topic: str, payload: bytes, qos: int, retain: bool = False) -> None:
+        packet_id = 0
+        if qos:
+            self._next_id = self._next_id % 65535 + 1
+            packet_id = self._next_id
+
+        self.send(publish_packet(topic, payload, qos, retain, packet_id))
+
+    async def run(self) -> None:
+        clean = False
+
+        try:
+            kind, flags, body = await asyncio.wait_for(read_packet(self.reader), timeout=10)
+            if kind != CONNECT:
+                return
+            self._connect(body)
+
+            while True:
+                kind, flags, body = await read_packet(self.reader)
+
+                if kind == PUBLISH:
+                    topic, payload, qos, retain, packet_id = parse_publish(flags, body)
+                    if qos > 1:
+                        return # Unsupported
+                    if qos:
+                        self.send(packet(PUBACK, struct.pack('!H', packet_id)))
+                    self.broker.publish(topic, payload, qos, retain)
+
+                elif kind == SUBSCRIBE:
+                    self._subscribe(body)
+
+                elif kind == PINGREQ:
+                    self.send(packet(PINGRESP, b''))
+
+                elif kind == DISCONNECT:
+                    clean = True
+                    return
+
+                # PUBACK (from subscribers): nothing to do without retransmission
+
+                await self.writer.drain()
+
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError, struct.error):
+            pass
+
+        finally:
+            self.broker.close_session(self, clean)
+
+    def _connect(self, body: bytes) -> None:
+        _, offset = _read_string(body, 0) # Protocol name
+        flags = body[offset + 1]
+        offset += 4 # Level, flags, keep alive
+
+        client_id, offset = _read_string(body, offset)
+        self.client_id = client_id.decode()
+
+        if flags & 0x04:
+            will_topic, offset = _read_string(body, offset)
+            will_payload, offset = _read_string(body, offset)
+            self.will = (will_topic.decode(), will_payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+
+        self.broker.open_session(self)
+        self.send(packet(CONNACK, b'\x00\x00'))
+
+    def _subscribe(self, body: bytes) -> None:
+        packet_id = struct.unpack_from('!H', body)[0]
+        offset, granted = 2, bytearray()
+
+        while offset < len(body):
+            pattern, offset = _read_string(body, offset)
+            qos = min(body[offset], 1)
+            offset += 1
+
+            levels = pattern.decode().split('/')
+            self.broker.topics.add(levels, self, qos)
+            self.subscriptions.append(levels)
+            granted.append(qos)
+
+        self.send(packet(SUBACK, struct.pack('!H', packet_id) + bytes(granted)))
+
+        for levels in self.subscriptions[-len(granted):]:
+            self.broker.send_retained(self, levels)
+
+
+class Broker:
+    '''Embedded MQTT broker (cf module documentation)'''
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 1883):
+        self.host = host
+        self.port = port
+
+        self.topics = _TopicTree()
+        self.retained: dict[str, tuple[bytes, int]] = {} # Topic -> (payload, QoS)
+        self.sessions: dict[str, _BrokerSession] = {}   # Client id -> session
+        self.messages = 0
+
+        self._server = None
+        self._handlers = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=2**16, backlog=4096)
+        logger.info(f'MQTT broker stand-in listening on {self.host}:{self.port}')
+
+    async def stop(self) -> None:
+        '''Closes the connections (their Last Will is published) and stops listening'''
+
+        if self._server is not None:
+            self._server.close()
+            for session in list(self.sessions.values()):
+                session.writer.close()
+
+            # Let the sessions end by themselves (a cancelled connection handler is logged as an error)
+            if self._handlers:
+                await asyncio.wait(self._handlers, timeout=5)
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._handlers.add(task)
+
+        try:
+            await _BrokerSession(self, reader, writer).run()
+        finally:
+            writer.close()
+            self._handlers.discard(task)
+
+    def open_session(self, session: _BrokerSession) -> None:
+        previous = self.sessions.get(session.client_id)
+        if previous is not None: # Same client id: the old connection is closed (without its Last Will)
+            previous.will = None
+            previous.writer.close()
+
+        self.sessions[session.client_id] = session
+
+    def close_session(self, session: _BrokerSession, clean: bool) -> None:
+        for levels in session.subscriptions:
+            self.topics.remove(levels, session)
+
+        if self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+
+        if session.will is not None and not clean:
+            self.publish(*session.will)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False) -> None:
+        '''Routes a message to the matching subscribers'''
+
+        self.messages += 1
+
+        if retain:
+            if payload:
+                self.retained[topic] = (payload, qos)
+            else:
+                self.retained.pop(topic, None)
+
+        for session, granted in self.topics.match(topic.split('/'), {}).items():
+            session.deliver(topic, payload, min(qos, granted))
+
+    def send_retained(self, session: _BrokerSession, levels: list[str]) -> None:
+        pattern = '/'.join(levels)
+        wildcard = '+' in levels or '#' in levels
+
+        if not wildcard:
+            if pattern in self.retained:
+                payload, qos = self.retained[pattern]
+                session.deliver(pattern, payload, qos, retain=True)
+            return
+
+        for topic, (payload, qos) in self.retained.items():
+            if topic_matches(pattern, topic):
+                session.deliver(topic, payload, qos, retain=True)
+
+##-Client
+class MQTTClient:
+    '''
+    Asyncio MQTT client (one connection). Incoming messages are passed to `on_message(topic, payload)`.
+    QoS 1 publishes wait for their PUBACK.
+    '''
+
+    def __init__(self, client_id: str, on_message: Callable[[str, bytes], Awaitable[None] | None] | None = None, keepalive: int = 60):
+        self.client_id = client_id
+        self.on_message = on_message
+        self.keepalive = keepalive
+
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._pending: dict[int, asyncio.Future] = {} # Packet id -> PUBACK / SUBACK future
+        self._next_id = 0
+        self.connected = False
+
+    async def connect(self, host: str, port: int, will: tuple[str, str, int, bool] | None = None, timeout: float = 10) -> None:
+        '''
+        Connects to the broker
+
+        In:
+            - will: Last Will (topic, payload, qos, retain)
+        Out:
+            None             if connected
+            ConnectionError  if the broker refused the connection
+        '''
+
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+        flags = 0x02 # Clean session
+        payload = _string(self.client_id)
+        if will is not None:
+            topic, message, qos, retain = will
+            flags |= 0x04 | qos << 3 | (0x20 if retain else 0)
+            payload += _string(topic) + _string(message)
+
+        self._writer.write(packet(CONNECT, _string('MQTT') + bytes([4, flags]) + struct.pack('!H', self.keepalive) + payload))
+
+        kind, _, body = await asyncio.wait_for(read_packet(self._reader), timeout)
+        if kind != CONNACK or body[1] != 0:
+            raise ConnectionError(f'MQTT connection refused ({self.client_id})')
+
+        self.connected = True
+        self._tasks = [asyncio.create_task(self._read_loop()), asyncio.create_task(self._ping_loop())]
+
+    async def subscribe(self, topics: list[tuple[str, int]], timeout: float = 10) -> None:
+        packet_id, future = self._new_request()
+        body = struct.pack('!H', packet_id) + b''.join(_string(topic) + bytes([qos]) for topic, qos in topics)
+
+        self._writer.write(packet(SUBSCRIBE, body, 0x02))
+        await asyncio.wait_for(future, timeout)
+
+    async def publish(self, topic: str, payload: str | bytes, qos: int = 0, retain: bool = False, timeout: float = 10) -> None:
+        data = payload.encode() if isinstance(payload, str) else payload
+
+        if not qos:
+            self._writer.write(publish_packet(topic, data, 0, retain))
+            await self._writer.drain()
+            return
+
+        packet_id, future = self._new_request()
+        self._writer.write(publish_packet(topic, data, 1, retain, packet_id))
+        await asyncio.wait_for(future, timeout)
+
+    async def disconnect(self) -> None:
+        '''Clean disconnection (the Last Will is not published)'''
+
+        if self.connected:
+            self._writer.write(packet(DISCONNECT, b''))
+            await self.close()
+
+    async def close(self) -> None:
+        '''Drops the connection (the broker publishes the Last Will)'''
+
+        self.connected = False
+        for task in self._tasks:
+            task.cancel()
+
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def _new_request(self) -> tuple[int, asyncio.Future]:
+        if not self.connected:
+            raise ConnectionError(f'MQTT client not connected ({self.client_id})')
+
+        self._next_id = self._next_id % 65535 + 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        return self._next_id, future
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                kind, flags, body = await read_packet(self._reader)
+
+                if kind == PUBLISH:
+                    topic, payload, qos, _, packet_id = parse_publish(flags, body)
+                    if qos:
+                        self._writer.write(packet(PUBACK, struct.pack('!H', packet_id)))
+
+                    if self.on_message is not None:
+                        result = self.on_message(topic, payload)
+                        if asyncio.iscoroutine(result):
+                            await result
+
+                elif kind in (PUBACK, SUBACK):
+                    future = self._pending.pop(struct.unpack_from('!H', body)[0], None)
+                    if future is not None and not future.done():
+                        future.set_result(None)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        finally:
+            self.connected = False
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'MQTT connection lost ({self.client_id})'))
+            self._pending.clear()
+
+    async def _ping_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.keepalive * 0.75)
+            self._writer.write(packet(PINGREQ, b''))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Replay of a captured traffic (`CAPTURE_DIR`, cf `src/services/traffic_capture.py`) on a test instance.
+
+The captured events are re-issued at their captured times divided by `speed` (1: real time, 10: ten times faster),
+or as fast as possible (`speed` 0). The events of a node (its POSTs / PATCHes, the UI calls on it and its MQTT
+messages) are sent one after the other, in their captured order: an event of a node waits for the response to the
+previous one. The other events (lists, user management, ...) are sent at their time, concurrently.
+
+    - `http`: the request is sent again, with a JWT signed with the secret of the test instance for the captured
+      claims, and the node token of the test instance in place of the redacted one (the other redacted values,
+      e.g the badge bytes, keep their pseudonym: `python -m loadtest pseudonymize` gives the same pseudonyms to the
+      badges of the test database)
+    - `mqtt_in`: the message of the node is published to the broker of the test instance
+    - `mqtt_out` (commands of the captured platform): not sent, the replayed requests make the test instance send its own
+
+The test instance needs the captured nodes and users (e.g a copy of the production database), with `node_token` as
+token of the nodes, and their badges pseudonymized with the `CAPTURE_KEY` of the capture.
+'''
+
+##-Imports
+from __future__ import annotations
+
+import asyncio
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+from urllib.parse import urlencode
+
+from loadtest.http import HTTPClient
+from loadtest.mqtt import MQTTClient
+from loadtest.stats import Recorder
+from loadtest.users import user_token
+
+##-Capture files
+def capture_files(paths: list[str]) -> list[str]:
+    '''The capture files of `paths` (files, or directories of `*.jsonl` / `*.jsonl.gz` files)'''
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '*.jsonl')) + glob.glob(os.path.join(path, '*.jsonl.gz')))
+        else:
+            files.append(path)
+
+    return files
+
+def read_events(path: str) -> list[dict]:
+    '''
+    The events of a capture file. A file cut by a killed process (last gzip member incomplete) is read up to the
+    last complete line.
+    '''
+
+    opener = gzip.open if path.endswith('.gz') else open
+    events = []
+
+    with opener(path, 'rt') as f:
+        try:
+            for line in f:
+                if line.endswith('\n'):
+                    events.append(json.loads(line))
+
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            print(f'Warning: {path} is truncated, the events after the {len(events)}th are ignored', file=sys.stderr)
+
+    return events
+
+def load_capture(paths: list[str], since: float | None = None, until: float | None = None) -> list[dict]:
+    '''
+    The events of the capture files of `paths` (all the processes merged), sorted by time
+
+    In:
+        - since, until: only the events in this time window (epoch seconds)
+    '''
+
+    events = []
+    for path in capture_files(paths):
+        events += [
+            event for event in read_events(path)
+            if (since is None or event['ts'] >= since) and (until is None or event['ts'] < until)
+        ]
+
+    events.sort(key=lambda event: event['ts'])
+    return events
+
+##-Replay
+class Replayer:
+    '''Re-issues captured events on a test instance (cf module documentation)'''
+
+    def __init__(self, events: list[dict], platform: HTTPClient, mqtt: MQTTClient | None, recorder: Recorder,
+                 jwt_secret: str, node_token: str, speed: float = 1.0):
+        '''
+        In:
+            - events: the captured events, sorted by time (cf `load_capture`)
+            - mqtt: client connected to the broker of the test instance (None: the `mqtt_in` events are skipped)
+            - speed: time speed-up, 0 for as fast as possible
+        '''
+
+        self.events = events
+        self.platform = platform
+        self.mqtt = mqtt
+        self.recorder = recorder
+        self.jwt_secret = jwt_secret
+        self.node_token = node_token
+        self.speed = speed
+
+        self._tokens: dict[tuple[str, bool], str] = {} # (uid, is_admin) -> JWT
+        self._origin = 0.0  # Captured time of the first event
+        self._started = 0.0 # Replay time of the first event (monotonic)
+
+    async def run(self) -> None:
+        if not self.events:
+            return
+
+        lanes: dict[str, list[dict]] = {} # Node -> its events, in order
+        others = []
+        for event in self.events:
+            if event['kind'] == 'mqtt_out' or (event['kind'] == 'mqtt_in' and self.mqtt is None):
+                self.recorder.count(f'skipped.{event["kind"]}')
+            elif event.get('node'):
+                lanes.setdefault(event['node'], []).append(event)
+            else:
+                others.append(event)
+
+        self._origin = self.events[0]['ts']
+        self._started = time.monotonic()
+
+        await asyncio.gather(self._dispatch(others), *(self._lane(events) for events in lanes.values()))
+
+    async def _wait(self, event: dict) -> None:
+        '''Waits for the time of `event`, and records how late it is sent (the replay cannot keep up)'''
+
+        if not self.speed:
+            return
+
+        delay = self._started + (event['ts'] - self._origin) / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            self.recorder.record('replay.lag', -delay)
+
+    async def _lane(self, events: list[dict]) -> None:
+        '''The events of a node, one after the other'''
+
+        for event in events:
+            await self._wait(event)
+            await self._send(event)
+
+    async def _dispatch(self, events: list[dict]) -> None:
+        '''The events of no node, each at its time'''
+
+        tasks = set()
+        for event in events:
+            await self._wait(event)
+            task = asyncio.create_task(self._send(event))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    def _token(self, auth: dict) -> str:
+        if auth.get('invalid'):
+            return 'invalid_token'
+
+        key = (auth['uid'], auth['is_admin'])
+        if key not in self._tokens:
+            self._tokens[key] = user_token(auth['uid'], self.jwt_secret, is_admin=auth['is_admin'])
+        return self._tokens[key]
+
+    async def _send(self, event: dict) -> None:
+        if event['kind'] == 'http':
+            await self._send_http(event)
+        else:
+            await self._send_mqtt(event)
+
+    async def _send_http(self, event: dict) -> None:
+        operation = f'{event["method"]} {event["route"] or event["path"]}'
+
+        headers = {'Authorization': self._token(event['auth'])} if event.get('auth') else {}
+
+        body = event.get('body')
+        if isinstance(body, dict) and 'token' in body and event.get('node'): # Node authentication
+            body = {**body, 'token': self.node_token}
+
+        path = event['path'] + (f'?{urlencode(event["query"])}' if event.get('query') else '')
+
+        started = time.perf_counter()
+        try:
+            response = await self.platform.request(event['method'], path, json_data=body, headers=headers)
+
+        except (OSError, asyncio.TimeoutError) as e:
+            self.recorder.record(operation, time.perf_counter() - started, type(e).__name__)
+            return
+
+        self.recorder.record(operation, response.elapsed, f'HTTP {response.status}' if response.status >= 400 else None)
+        if response.status != event.get('status'):
+            self.recorder.count(f'status_changed.{event.get("status")}->{response.status}')
+
+    async def _send_mqtt(self, event: dict) -> None:
+        operation = f'mqtt.{event["topic"].rsplit("/", 1)[-1]}'
+
+        started = time.perf_counter()
+        try:
+            await self.mqtt.publish(event['topic'], event['payload'], qos=event.get('qos', 0))
+
+        except (OSError, asyncio.TimeoutError) as e:
+            self.recorder.record(operation, time.perf_counter() - started, type(e).__name__)
+            return
+
+        self.recorder.record(operation, time.perf_counter() - started)
+
+async def replay(options) -> dict:
+    '''Replays the capture of `options.captures`. Out: the report (cf `Recorder.report`) and a summary of the capture'''
+
+    events = load_capture(options.captures, options.since, options.until)
+    if not events:
+        raise ValueError('no captured event (check the capture files and the time window)')
+
+    recorder = Recorder()
+    platform = HTTPClient(options.platform_url, options.connections, options.timeout)
+
+    mqtt = None
+    if not options.no_mqtt and any(event['kind'] == 'mqtt_in' for event in events):
+        mqtt = MQTTClient(f'loadtest_replay_{os.getpid()}')
+        await mqtt.connect(options.mqtt_host, options.mqtt_port)
+
+    captured_s = events[-1]['ts'] - events[0]['ts']
+    speed = f'x{options.speed:g}' if options.speed else 'as fast as possible'
+    print(f'Replaying {len(events)} events ({captured_s:.0f} s captured) {speed}...', file=sys.stderr)
+
+    recorder.started = time.perf_counter()
+    await Replayer(events, platform, mqtt, recorder, options.jwt_secret, options.node_token, options.speed).run()
+    recorder.stop()
+
+    await platform.close()
+    if mqtt is not None:
+        await mqtt.disconnect()
+
+    return {
+        **recorder.report(),
+        'capture': {
+            'events': len(events),
+            'nodes': len({event['node'] for event in events if event.get('node')}),
+            'captured_s': round(captured_s, 2),
+            'speed': options.speed,
+        },
+    }
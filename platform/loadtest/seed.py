@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Creates (and removes) the nodes and users of a load test in the database of the platform.
+
+The ids start with a prefix (`loadtest_` by default), so that the load test data can be removed without touching
+the real nodes and users. The users have a blank badge (`auth_bytes` set to zeros) and no password: the load
+test signs their JWT itself (with `JWT_SHARED_TOKEN`).
+
+`pseudonymize_badges` prepares a copy of the production database for a replay: it replaces the badge bytes of the
+users by their pseudonym in the capture (same function and `CAPTURE_KEY`), so that the replayed badge
+authentications match.
+'''
+
+##-Imports
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+from src.virtualization.digital_replica.dr_factory import DRFactory
+from src.virtualization.digital_replica.schema_registry import SchemaRegistry
+from src.services.database_service import DatabaseService
+from src.services.traffic_capture import capture_key, pseudonymize
+
+from config.config_loader import ConfigLoader
+
+##-Init
+DEFAULT_PREFIX = 'loadtest_'
+ZONES_PER_SITE = 3
+
+##-Layout
+def node_layout(nb_nodes: int, nb_sites: int, prefix: str = DEFAULT_PREFIX) -> list[dict]:
+    '''The nodes of a load test: [{_id, site, zone}] (spread over `nb_sites` sites of `ZONES_PER_SITE` zones)'''
+
+    return [
+        {'_id': f'{prefix}node_{k}', 'site': f'{prefix}site_{k % nb_sites}', 'zone': f'zone_{k // nb_sites % ZONES_PER_SITE}'}
+        for k in range(nb_nodes)
+    ]
+
+def user_ids(nb_users: int, prefix: str = DEFAULT_PREFIX) -> list[str]:
+    return [f'{prefix}user_{k}' for k in range(nb_users)]
+
+##-Database
+def connect_database() -> DatabaseService:
+    '''Connects to the database of the platform (environment variables and .env, as the platform)'''
+
+    schema_registry = SchemaRegistry()
+    schema_registry.load_schema('node', 'src/virtualization/templates/node.yaml')
+    schema_registry.load_schema('user', 'src/virtualization/templates/user.yaml')
+
+    db_config = ConfigLoader.load_database_config_env()
+    db_service = DatabaseService(
+        connection_string=ConfigLoader.build_connection_string(db_config),
+        db_name=db_config['settings']['name'],
+        schema_registry=schema_registry,
+    )
+    db_service.connect()
+
+    return db_service
+
+def cleanup(db_service: DatabaseService, prefix: str = DEFAULT_PREFIX) -> int:
+    '''Removes the nodes and users whose id starts with `prefix`. Out: the number of removed DRs'''
+
+    removed = 0
+    for dr_type in ('node', 'user'):
+        for dr in db_service.query_drs(dr_type, {'_id': {'$regex': f'^{prefix}'}}):
+            db_service.delete_dr(dr_type, dr['_id'])
+            removed += 1
+
+    return removed
+
+def pseudonymize_badges(db_service: DatabaseService, secret: str) -> int:
+    '''
+    Replaces the badge bytes (`auth_bytes`) of all the users by their pseudonym in a capture made with the
+    `CAPTURE_KEY` `secret`. Only for a test database, once (the pseudonym of a pseudonym does not match)
+
+    Out: the number of updated users
+    '''
+
+    key = capture_key(secret)
+    updated = 0
+    for user in db_service.query_drs('user'):
+        if user.get('auth_bytes'):
+            db_service.update_dr('user', user['_id'], {'auth_bytes': pseudonymize(user['auth_bytes'], key)})
+            updated += 1
+
+    return updated
+
+def seed(db_service: DatabaseService, nb_nodes: int, nb_users: int, nb_sites: int, node_token: str, prefix: str = DEFAULT_PREFIX) -> None:
+    '''
+    (Re)creates the nodes and users of a load test (the previous ones are removed first: their badges
+    and statuses are reset)
+
+    In:
+        - nb_nodes: number of nodes (all `free`)
+        - nb_users: number of users (the UI users, then the walk-in drivers)
+        - nb_sites: number of sites the nodes are spread over (for the group commands)
+        - node_token: the secret token of all the nodes
+    '''
+
+    cleanup(db_service, prefix)
+
+    node_factory = DRFactory('src/virtualization/templates/node.yaml')
+    for k, node in enumerate(node_layout(nb_nodes, nb_sites, prefix)):
+        db_service.save_dr('node', node_factory.create_dr('node', {
+            '_id': node['_id'],
+            'profile': {'id': k, 'position': f'{node["site"]} / {node["zone"]} / {k}', 'token': node_token, 'site': node['site'], 'zone': node['zone']},
+        }))
+
+    user_factory = DRFactory('src/virtualization/templates/user.yaml')
+    badge_expiration = datetime.utcnow() + timedelta(days=365)
+    for uid in user_ids(nb_users, prefix):
+        db_service.save_dr('user', user_factory.create_dr('user', {
+            '_id': uid,
+            'profile': {'username': uid, 'email': f'{uid}@example.invalid', 'is_admin': False, 'badge_expiration': badge_expiration},
+        }))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Latency and throughput statistics of a load test, per operation'''
+
+##-Imports
+from __future__ import annotations
+
+from array import array
+from collections import Counter, defaultdict
+import math
+import time
+
+##-Recorder
+class Recorder:
+    '''Records the latency of every operation, and the errors and events (counters)'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ended = None
+
+        self._latencies: dict[str, array] = defaultdict(lambda: array('d')) # Operation -> latencies (s)
+        self._errors: dict[str, Counter] = defaultdict(Counter)              # Operation -> reason -> count
+        self.events = Counter()                                              # Event -> count (arrivals, transitions, ...)
+
+    def record(self, operation: str, seconds: float, error: str | None = None) -> None:
+        '''
+        Records one operation
+
+        In:
+            - operation: e.g `node.auth`
+            - seconds: its latency
+            - error: the reason if it failed (e.g `HTTP 500`), None if it succeeded
+        '''
+
+        self._latencies[operation].append(seconds)
+        if error is not None:
+            self._errors[operation][error] += 1
+
+    def count(self, event: str, n: int = 1) -> None:
+        self.events[event] += n
+
+    def stop(self) -> None:
+        self.ended = time.perf_counter()
+
+    @staticmethod
+    def percentile(values: list[float], p: float) -> float:
+        '''Nearest-rank percentile of sorted `values`'''
+
+        return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+    def report(self) -> dict:
+        '''
+        Out:
+            {duration_s, operations: {operation: {count, errors, throughput_per_s, p50_ms, p95_ms, p99_ms, max_ms, error_reasons}}, events}
+        '''
+
+        duration = (self.ended or time.perf_counter()) - self.started
+
+        operations = {}
+        for operation in sorted(self._latencies):
+            values = sorted(self._latencies[operation])
+            operations[operation] = {
+                'count': len(values),
+                'errors': sum(self._errors[operation].values()),
+                'throughput_per_s': round(len(values) / duration, 2) if duration else None,
+                **{f'p{p}_ms': round(self.percentile(values, p) * 1000, 2) for p in (50, 95, 99)},
+                'max_ms': round(values[-1] * 1000, 2),
+                'error_reasons': dict(self._errors[operation].most_common(5)),
+            }
+
+        return {'duration_s': round(duration, 2), 'operations': operations, 'events': dict(sorted(self.events.items()))}
+
+def format_report(report: dict) -> str:
+    '''Text table of a report'''
+
+    lines = [f'Duration: {report["duration_s"]} s', '']
+
+    header = f'{"operation":<28}{"count":>9}{"errors":>8}{"ops/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}'
+    lines += [header, '-' * len(header)]
+    for operation, stats in report['operations'].items():
+        lines.append(
+            f'{operation:<28}{stats["count"]:>9}{stats["errors"]:>8}{stats["throughput_per_s"]:>10}'
+            f'{stats["p50_ms"]:>10}{stats["p95_ms"]:>10}{stats["p99_ms"]:>10}{stats["max_ms"]:>10}'
+        )
+
+    errors = [(operation, stats['error_reasons']) for operation, stats in report['operations'].items() if stats['error_reasons']]
+    if errors:
+        lines += ['', 'Errors:']
+        lines += [f'  {operation}: {reasons}' for operation, reasons in errors]
+
+    if report['events']:
+        lines += ['', 'Events:']
+        lines += [f'  {event}: {count}' for event, count in report['events'].items()]
+
+    if report.get('faults'):
+        lines += ['', format_faults(report['faults'])]
+
+    return '\n'.join(lines)
+
+def format_faults(faults: dict) -> str:
+    '''Text of the faults injected by the platform (cf `GET /api/diagnostics/faults`)'''
+
+    if not faults['enabled']:
+        return 'Injected faults: none'
+
+    rules = '; '.join(
+        f'{rule["component"]}.{rule["fault"]}' + (f'={rule["value"]}' if rule['value'] else '') + f'@{rule["probability"]:g}'
+        for rule in faults['rules']
+    )
+    lines = [f'Injected faults: {rules}']
+    lines += [f'  {fault}: {count} (one worker)' for fault, count in faults['injected'].items()]
+
+    return '\n'.join(lines)
+
+##-Comparison
+def compare_reports(baseline: dict, report: dict) -> list[dict]:
+    '''
+    Degradation of the p99 latency, the throughput and the errors of each operation, compared with a baseline run
+    (e.g the same load without injected faults)
+
+    Out:
+        [{operation, p99_ms: (baseline, current), p99_change, throughput_per_s: (baseline, current), throughput_change,
+          error_rate: (baseline, current)}], the changes being relative (None when the operation is missing in a run)
+    '''
+
+    def change(previous, current):
+        return None if previous is None or current is None or not previous else current / previous - 1
+
+    def error_rate(stats):
+        return stats['errors'] / stats['count'] if stats and stats['count'] else None
+
+    rows = []
+    for operation in sorted(set(baseline['operations']) | set(report['operations'])):
+        previous = baseline['operations'].get(operation)
+        current = report['operations'].get(operation)
+
+        p99 = (previous and previous['p99_ms'], current and current['p99_ms'])
+        throughput = (previous and previous['throughput_per_s'], current and current['throughput_per_s'])
+        rows.append({
+            'operation': operation,
+            'p99_ms': p99,
+            'p99_change': change(*p99),
+            'throughput_per_s': throughput,
+            'throughput_change': change(*throughput),
+            'error_rate': (error_rate(previous), error_rate(current)),
+        })
+
+    return rows
+
+def format_comparison(rows: list[dict]) -> str:
+    '''Text table of a comparison with a baseline run (cf `compare_reports`)'''
+
+    def value(x, unit=''):
+        return '-' if x is None else f'{x}{unit}'
+
+    def percent(x):
+        return '-' if x is None else f'{x:+.0%}'
+
+    header = (
+        f'{"operation":<28}{"p99 base":>10}{"p99 now":>10}{"change":>10}'
+        f'{"ops/s base":>12}{"ops/s now":>11}{"change":>10}{"err base":>10}{"err now":>9}'
+    )
+    lines = ['Compared with the baseline run', '', header, '-' * len(header)]
+    for row in rows:
+        errors = ['-' if rate is None else f'{rate:.1%}' for rate in row['error_rate']]
+        lines.append(
+            f'{row["operation"]:<28}{value(row["p99_ms"][0]):>10}{value(row["p99_ms"][1]):>10}{percent(row["p99_change"]):>10}'
+            f'{value(row["throughput_per_s"][0]):>12}{value(row["throughput_per_s"][1]):>11}{percent(row["throughput_change"]):>10}'
+            f'{errors[0]:>10}{errors[1]:>9}'
+        )
+
+    return '\n'.join(lines)
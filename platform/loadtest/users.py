@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Simulated users of the reservation page: they list the reservable nodes, reserve one, then cancel, do not
+show up, or drive to it and badge (cf `Fleet.park`).
+
+With a frontend URL, the users go through the UI endpoints (`GET /reservation_page` to list the nodes,
+`POST /reservation_page` to reserve / cancel, with the `token` cookie). Otherwise they call the platform
+API like the frontend does (`GET /api/nodes?reservable`, `PATCH /api/nodes/<id>` with `"source": "ui"`).
+'''
+
+##-Imports
+from __future__ import annotations
+
+import asyncio
+import random
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+import jwt
+
+from loadtest.fleet import Badge, Fleet, RESERVED, RESERVATION_TIMEOUT_S
+from loadtest.http import HTTPClient
+from loadtest.stats import Recorder
+
+##-Init
+FREE_NODE_PATTERN = re.compile(r'class="free-node-row" data-node-id="([^"]+)"')
+
+NO_SHOW_WAIT_S = RESERVATION_TIMEOUT_S + 30 # A no-show user reserves again after the reservation timed out
+
+##-User
+def user_token(uid: str, secret: str, duration: timedelta = timedelta(days=1), is_admin: bool = False) -> str:
+    '''JWT of a load test user (same payload as the frontend `TokenManager.generate_token`)'''
+
+    payload = {'uid': uid, 'username': uid, 'is_admin': is_admin, 'exp': datetime.now(timezone.utc) + duration}
+    return jwt.encode(payload, secret, algorithm='HS256')
+
+class SimulatedUser:
+    '''One user of the reservation page (one reservation at a time)'''
+
+    def __init__(self, fleet: Fleet, badge: Badge, token: str, platform: HTTPClient, ui: HTTPClient | None, recorder: Recorder):
+        '''
+        In:
+            - badge: the badge of the user (its UID is the user id)
+            - token: the JWT of the user
+            - platform: HTTP client of the platform
+            - ui: HTTP client of the frontend (None to call the platform API directly)
+        '''
+
+        self.fleet = fleet
+        self.badge = badge
+        self.token = token
+        self.platform = platform
+        self.ui = ui
+        self.recorder = recorder
+        self.options = fleet.options
+
+    async def run(self) -> None:
+        options = self.options
+
+        while True:
+            await asyncio.sleep(random.expovariate(1 / options.think_time) / options.speed)
+
+            node_ids = await self._list_reservable()
+            node_ids = [node_id for node_id in node_ids or () if node_id in self.fleet.nodes_by_id]
+            if not node_ids:
+                self.recorder.count('users.nothing_to_reserve')
+                continue
+
+            node_id = random.choice(node_ids)
+            self.fleet.expect(node_id, 'reserved')
+            if not await self._reservation('reserve', node_id):
+                self.fleet.forget(node_id, 'reserved')
+                continue
+
+            self.recorder.count('users.reservations')
+            draw = random.random()
+
+            if draw < options.cancel_rate: # Changes their mind
+                await asyncio.sleep(random.uniform(10, 300) / options.speed)
+                self.fleet.expect(node_id, 'free')
+                if await self._reservation('cancel', node_id):
+                    self.recorder.count('users.cancellations')
+                else:
+                    self.fleet.forget(node_id, 'free')
+
+            elif draw < options.cancel_rate + options.no_show_rate: # The node times out
+                self.recorder.count('users.no_shows')
+                await asyncio.sleep(NO_SHOW_WAIT_S / options.speed)
+
+            else: # Drives to the spot
+                await asyncio.sleep(random.uniform(60, 600) / options.speed)
+                node = self.fleet.nodes_by_id[node_id]
+                if node.occupancy:
+                    self.recorder.count('users.spot_taken')
+                    continue
+                if node.state != RESERVED:
+                    self.recorder.count('users.arrived_late')
+
+                await self.fleet.park(node, self.badge)
+
+    async def _list_reservable(self) -> list[str] | None:
+        '''The ids of the reservable nodes (None on error)'''
+
+        started = time.perf_counter()
+        try:
+            if self.ui is not None:
+                response = await self.ui.request('GET', '/reservation_page', headers={'Cookie': f'token={self.token}'})
+            else:
+                response = await self.platform.request('GET', '/api/nodes?reservable', headers={'Authorization': self.token})
+
+        except (OSError, asyncio.TimeoutError) as e:
+            self.recorder.record('ui.list_reservable', time.perf_counter() - started, type(e).__name__)
+            return None
+
+        if response.status != 200:
+            self.recorder.record('ui.list_reservable', response.elapsed, f'HTTP {response.status}')
+            return None
+
+        self.recorder.record('ui.list_reservable', response.elapsed)
+
+        if self.ui is not None:
+            return FREE_NODE_PATTERN.findall(response.body.decode(errors='replace'))
+        return [node['_id'] for node in response.json()['nodes']]
+
+    async def _reservation(self, action: str, node_id: str) -> bool:
+        '''
+        Reserves or cancels (`action`: reserve | cancel) the node `node_id`
+
+        Out:
+            True if accepted. A refused reservation (e.g the node was taken by another user) is not an error.
+        '''
+
+        operation = f'ui.{action}'
+        started = time.perf_counter()
+        try:
+            if self.ui is not None:
+                response = await self.ui.request(
+                    'POST', '/reservation_page', json_data={'action': action, 'node_id': node_id}, headers={'Cookie': f'token={self.token}'}
+                )
+            else:
+                response = await self.platform.request(
+                    'PATCH', f'/api/nodes/{node_id}', headers={'Authorization': self.token},
+                    json_data={'data_to_update': {'status': 'reserved' if action == 'reserve' else 'free'}, 'source': 'ui'},
+                )
+
+        except (OSError, asyncio.TimeoutError) as e:
+            self.recorder.record(operation, time.perf_counter() - started, type(e).__name__)
+            return False
+
+        refused = response.status == 400 and b'reservation_error' in response.body
+        self.recorder.record(operation, response.elapsed, None if response.status == 200 or refused else f'HTTP {response.status}')
+
+        if refused:
+            self.recorder.count(f'users.{action}_refused')
+
+        return response.status == 200
@@ -4,7 +4,7 @@
 ##-Imports
 from flask import Blueprint, request, jsonify, current_app
 
-# from datetime import datetime
+from datetime import datetime
 # from bson import ObjectId
 
 from src.application.authentication import token_required
@@ -44,15 +44,88 @@ def get_digital_twin(dt_id):
         dt = current_app.config['DT_FACTORY'].get_dt(dt_id)
         if not dt:
             return jsonify({'error': 'Digital Twin not found'}), 404
+
+        # The DR references are listed by GET /api/dt/<dt_id>/digital_replicas
+        dt['digital_replicas_by_type'] = current_app.config['DT_FACTORY'].count_dt_members([dt_id]).get(dt_id, {})
+        dt['nb_digital_replicas'] = sum(dt['digital_replicas_by_type'].values())
         return jsonify(dt), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@dt_api.route('/<dt_id>/digital_replicas', methods=['GET'])
+@token_required(only_admins=True)
+def list_dt_digital_replicas(dt_id):
+    """
+    List the Digital Replica references of a Digital Twin
+
+    Query parameters:
+        - dr_type: only list this type of DR
+        - page: page number (from 0, default: 0)
+        - page_size: references per page (default: 100, max: 1000)
+    """
+    try:
+        try:
+            page = int(request.args.get('page', 0))
+            page_size = min(int(request.args.get('page_size', 100)), 1000)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid parameter: {e}'}), 400
+
+        refs = current_app.config['DT_FACTORY'].list_digital_replicas(
+            dt_id,
+            dr_type=request.args.get('dr_type'),
+            page=page,
+            page_size=page_size
+        )
+        return jsonify({'page': page, 'page_size': page_size, 'digital_replicas': refs}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@dt_api.route('/<dt_id>/forecast', methods=['GET'])
+@token_required()
+def get_dt_forecast(dt_id):
+    """
+    Get the probability that the parking spots of a Digital Twin are free at a given time
+    (the DT must have the OccupancyForecastService)
+
+    Query parameters:
+        - at: ISO 8601 time of the forecast, naive UTC or with an offset (e.g `Z`) (default: now)
+        - node_id: only forecast this node
+        - scope: 'nodes' or 'zones' (both by default)
+        - dr_type: type of the parking spot DRs (default: node)
+    """
+    try:
+        service_params = {'status_history': current_app.config['STATUS_HISTORY']}
+
+        if 'at' in request.args:
+            try:
+                service_params['at'] = datetime.fromisoformat(request.args['at'])
+            except ValueError as e:
+                return jsonify({'error': f'Invalid parameter: {e}'}), 400
+
+        if 'node_id' in request.args:
+            service_params['node_id'] = request.args['node_id']
+        if 'scope' in request.args:
+            service_params['attribute'] = request.args['scope']
+        if 'dr_type' in request.args:
+            service_params['dr_type'] = request.args['dr_type']
+
+        # Runs on the live instance of the DT, which keeps the fitted model and the cached predictions
+        forecast = current_app.config['DT_MANAGER'].execute_service(dt_id, 'OccupancyForecastService', **service_params)
+        return jsonify(forecast), 200
+    except LookupError:
+        return jsonify({'error': 'Digital Twin not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @dt_api.route('/', methods=['GET'])
 @token_required(only_admins=True)
 def list_digital_twins():
-    """List all Digital Twins"""
+    """List all Digital Twins (summaries with DR counts)"""
     try:
         dts = current_app.config['DT_FACTORY'].list_dts()
         return jsonify(dts), 200
@@ -78,11 +151,22 @@ def get_digital_replica(dr_type, dr_id):
 @dt_management_api.route('/assign/<dt_id>', methods=['POST'])
 @token_required(only_admins=True)
 def assign_dr_to_dt(dt_id):
-    """Assign a Digital Replica to a Digital Twin"""
+    """
+    Assign Digital Replicas to a Digital Twin
+
+    Body: {"dr_type": ..., "dr_id": ...}
+      or  {"digital_replicas": [{"type": ..., "id": ...}, ...]} (bulk)
+    """
     try:
         data = request.get_json()
+
+        if data and 'digital_replicas' in data:
+            result = current_app.config['DT_FACTORY'].add_digital_replicas(dt_id, data['digital_replicas'])
+            current_app.config['DT_MANAGER'].invalidate(dt_id)
+            return jsonify({'status': 'success', **result}), 200
+
         required_fields = ['dr_type', 'dr_id']
-        if not all(field in data for field in required_fields):
+        if not data or not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
 
         current_app.config['DT_FACTORY'].add_digital_replica(
@@ -90,32 +174,177 @@ def assign_dr_to_dt(dt_id):
             data['dr_type'],
             data['dr_id']
         )
+        current_app.config['DT_MANAGER'].invalidate(dt_id)
 
         return jsonify({'status': 'success'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@dt_management_api.route('/assign/<dt_id>', methods=['DELETE'])
+@token_required(only_admins=True)
+def unassign_dr_from_dt(dt_id):
+    """
+    Remove Digital Replicas from a Digital Twin
+
+    Body: {"digital_replicas": [{"type": ..., "id": ...}, ...]}
+    """
+    try:
+        data = request.get_json()
+        if not data or 'digital_replicas' not in data:
+            return jsonify({'error': 'Missing required fields'}), 400
+
+        removed = current_app.config['DT_FACTORY'].remove_digital_replicas(dt_id, data['digital_replicas'])
+        current_app.config['DT_MANAGER'].invalidate(dt_id)
+
+        return jsonify({'status': 'success', 'removed': removed}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @dt_management_api.route('/stats/<dt_id>', methods=['GET'])
 @token_required(only_admins=True)
 def get_dt_stats(dt_id):
-    """Get statistics from a Digital Twin's services"""
-    try:
-        dt = current_app.config['DT_FACTORY'].get_dt(dt_id)
-        if not dt:
-            return jsonify({'error': 'Digital Twin not found'}), 404
+    """
+    Get statistics from a Digital Twin's services
 
+    Query parameters:
+        - service: AggregationService (default) or OccupancyService
+        - dr_type, measure_type: forwarded to the service (`dr_type`, `attribute`)
+        - start, end: ISO 8601 time window (OccupancyService only)
+        - sketch: also return the mergeable sketches (AggregationService only, cf `AggregationService.merge`)
+        - max_age: maximum age (in seconds) of a cached result (default: DT_RESULTS_MAX_AGE_S)
+        - refresh: recompute the result
+
+    The cache metadata is returned in the headers: `Age`, `X-Computed-At`, `X-Stale` and `X-Result-Source`.
+    """
+    try:
         params = request.args.to_dict()
-        dr_type = params.get('dr_type')
-        measure_type = params.get('measure_type')
+        service_name = params.get('service', 'AggregationService')
+
+        # Service parameters (only the given ones, so that they match the scheduled executions)
+        service_params = {}
+        if 'dr_type' in params:
+            service_params['dr_type'] = params['dr_type']
+        if 'measure_type' in params:
+            service_params['attribute'] = params['measure_type']
+
+        if service_name == 'OccupancyService':
+            for field in ('start', 'end'):
+                if field in params:
+                    try:
+                        datetime.fromisoformat(params[field])
+                    except ValueError as e:
+                        return jsonify({'error': f'Invalid parameter: {e}'}), 400
+
+                    service_params[field] = params[field]
+
+        elif service_name == 'AggregationService' and 'sketch' in params:
+            service_params['include_sketch'] = True
+
+        try:
+            max_age = 0 if 'refresh' in params else float(params.get('max_age', current_app.config['DT_RESULTS_MAX_AGE_S']))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid parameter: {e}'}), 400
+
+        # Served from the cache, or computed on the live instance of the DT (cf ServiceScheduler, DTInstanceManager)
+        stats, metadata = current_app.config['DT_SCHEDULER'].get_result(
+            dt_id,
+            service_name,
+            service_params,
+            max_age_s=max_age
+        )
+
+        response = jsonify(stats)
+        response.headers['Age'] = str(int(metadata['age_s']))
+        response.headers['X-Computed-At'] = metadata['computed_at'].isoformat()
+        response.headers['X-Result-Source'] = metadata['source']
+        if metadata['stale'] is not None:
+            response.headers['X-Stale'] = str(metadata['stale']).lower()
+
+        return response, 200
+    except LookupError:
+        return jsonify({'error': 'Digital Twin not found'}), 404
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@dt_management_api.route('/simulate/<dt_id>', methods=['POST'])
+@token_required(only_admins=True)
+def simulate_dt(dt_id):
+    """
+    Run a what-if simulation on the nodes of a Digital Twin (the DT must have the SimulationService)
+
+    Body (all optional):
+        {
+            "policies": [{"reservation_timeout_s": 1800, "max_reservations": 10, "spots": 40, "demand_scale": 1.2}, ...],
+            "scenarios": 1000, "horizon_hours": 24, "step_s": 60, "start_hour": 0, "seed": 42,
+            "window_days": 28, "dr_type": "node",
+            "max_age": 3600   # maximum age (in seconds) of a cached result for the same body (default: 0)
+        }
+    """
+    try:
+        data = request.get_json(silent=True) or {}
 
-        stats = current_app.config['DT_FACTORY'].get_dt_instance(dt_id).execute_service(
-            'AggregationService',
-            dr_type=dr_type,
-            attribute=measure_type
+        allowed = ('policies', 'scenarios', 'horizon_hours', 'step_s', 'start_hour', 'seed', 'window_days', 'dr_type')
+        unknown = set(data) - set(allowed) - {'max_age'}
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {sorted(unknown)}'}), 400
+
+        try:
+            max_age = float(data.get('max_age', 0))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid parameter: {e}'}), 400
+
+        service_params = {field: data[field] for field in allowed if field in data}
+
+        result, metadata = current_app.config['DT_SCHEDULER'].get_result(
+            dt_id,
+            'SimulationService',
+            service_params,
+            max_age_s=max_age
         )
 
-        return jsonify(stats), 200
+        response = jsonify(result)
+        response.headers['Age'] = str(int(metadata['age_s']))
+        response.headers['X-Result-Source'] = metadata['source']
+        return response, 200
+    except LookupError:
+        return jsonify({'error': 'Digital Twin not found'}), 404
+    except TimeoutError as e:
+        return jsonify({'error': str(e)}), 504
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@dt_management_api.route('/executions', methods=['GET'])
+@token_required(only_admins=True)
+def list_service_executions():
+    """Get the service executions running in this worker, and the metrics per service"""
+    try:
+        engine = current_app.config.get('DT_ENGINE')
+        if engine is None:
+            return jsonify({'error': 'Service execution engine disabled'}), 404
+
+        return jsonify({'running': engine.running(), **engine.stats()}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@dt_management_api.route('/executions/<execution_id>', methods=['DELETE'])
+@token_required(only_admins=True)
+def cancel_service_execution(execution_id):
+    """Cancel a running service execution (of this worker)"""
+    try:
+        engine = current_app.config.get('DT_ENGINE')
+        if engine is None or not engine.cancel(execution_id):
+            return jsonify({'error': 'Execution not found'}), 404
+
+        return jsonify({'status': 'success'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -134,6 +363,7 @@ def add_service_to_dt(dt_id):
             service_name=data['name'],
             service_config=data.get('config', {})
         )
+        current_app.config['DT_MANAGER'].invalidate(dt_id)
         return jsonify({'status': 'success', 'message': f"Service {data['name']} added"}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Diagnostics endpoints, for the admins (`/api/diagnostics/...`): query monitor, request profiles,
+traces, memory and injected faults.
+
+The query statistics, traces and tracemalloc state are those of the worker handling the request (each gunicorn worker has its own),
+the profiles and memory snapshots are stored on disk and shared by the workers.
+'''
+
+##-Imports
+from flask import Blueprint, request, current_app, jsonify, send_file
+
+from src.application.authentication import token_required
+from observability.tracing import TRACER
+from src.services.fault_injection import FAULTS
+from src.services.memory_diagnostics import process_memory, object_counts
+
+##-Init
+diagnostics_api = Blueprint('diagnostics_api', __name__, url_prefix='/api/diagnostics')
+
+def register_diagnostics_blueprint(app):
+    app.register_blueprint(diagnostics_api)
+
+##-Query monitor
+@diagnostics_api.route('/queries', methods=['GET'])
+@token_required(only_admins=True)
+def top_queries():
+    '''
+    Get the slowest MongoDB query shapes (cf `src/services/query_monitor.py`).
+
+    In (query string):
+        top (int)   : number of shapes (default 20)
+        sort (str)  : total_ms (default), mean_ms, max_ms, count or slow
+
+    Out:
+        {stats: {commands, slow_commands, shapes, slow_ms}, queries: [{shape, count, total_ms, mean_ms, max_ms, returned, slow, last_route, last_slow_route, plan}]}
+    '''
+
+    query_monitor = current_app.config.get('QUERY_MONITOR')
+    if query_monitor is None:
+        return jsonify({'error': 'The query monitor is disabled (MONGO_QUERY_MONITOR)'}), 404
+
+    try:
+        queries = query_monitor.top(int(request.args.get('top', 20)), request.args.get('sort', 'total_ms'))
+        return jsonify({'stats': query_monitor.stats(), 'queries': queries}), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@diagnostics_api.route('/queries', methods=['DELETE'])
+@token_required(only_admins=True)
+def reset_queries():
+    '''Forget the recorded query shapes'''
+
+    query_monitor = current_app.config.get('QUERY_MONITOR')
+    if query_monitor is None:
+        return jsonify({'error': 'The query monitor is disabled (MONGO_QUERY_MONITOR)'}), 404
+
+    query_monitor.reset()
+    return jsonify({'message': 'Query statistics reset'}), 200
+
+##-Profiles
+@diagnostics_api.route('/profiles', methods=['GET'])
+@token_required(only_admins=True)
+def list_profiles():
+    '''
+    List the request profiles, newest first (cf `observability/profiling.py`, in `shared/`).
+
+    In (query string):
+        limit (int) : maximum number of profiles (default 50)
+        route (str) : only the profiles of this route pattern (e.g `/api/nodes/<node_id>`)
+
+    Out:
+        {profiles: [{id, mode, trigger, method, route, path, status, duration_ms, started_at, pid, samples, file}]}
+    '''
+
+    profiler = current_app.config.get('PROFILER')
+    if profiler is None:
+        return jsonify({'error': 'Profiling is disabled (PROFILING_ENABLED)'}), 404
+
+    try:
+        profiles = profiler.list_profiles(int(request.args.get('limit', 50)), request.args.get('route'))
+        return jsonify({'profiles': profiles}), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@diagnostics_api.route('/profiles/<profile_id>', methods=['GET'])
+@token_required(only_admins=True)
+def download_profile(profile_id):
+    '''Download a profile (`.folded` collapsed stacks, or `.prof` pstats file)'''
+
+    profiler = current_app.config.get('PROFILER')
+    if profiler is None:
+        return jsonify({'error': 'Profiling is disabled (PROFILING_ENABLED)'}), 404
+
+    try:
+        return send_file(profiler.profile_path(profile_id), as_attachment=True)
+
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+
+##-Traces
+@diagnostics_api.route('/traces', methods=['GET'])
+@token_required(only_admins=True)
+def slowest_traces():
+    '''
+    Get the slowest traces of the worker (cf `observability/tracing.py`, in `shared/`), with the time spent per hop.
+
+    In (query string):
+        limit (int) : number of traces (default 20)
+
+    Out:
+        {stats: {...}, traces: [{trace_id, name, start, duration_ms, status, remote_parent, hops_ms: {hop: ms}, spans: [{name, offset_ms, duration_ms, ...}]}]}
+    '''
+
+    if not TRACER.enabled:
+        return jsonify({'error': 'Tracing is disabled (TRACING_ENABLED)'}), 404
+
+    try:
+        return jsonify({'stats': TRACER.stats(), 'traces': TRACER.slowest(int(request.args.get('limit', 20)))}), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@diagnostics_api.route('/traces', methods=['DELETE'])
+@token_required(only_admins=True)
+def reset_traces():
+    '''Forget the slowest traces'''
+
+    TRACER.reset()
+    return jsonify({'message': 'Slowest traces reset'}), 200
+
+##-Memory
+@diagnostics_api.route('/memory', methods=['GET'])
+@token_required(only_admins=True)
+def memory_status():
+    '''
+    Get the memory of the worker (cf `src/services/memory_diagnostics.py`).
+
+    In (query string):
+        objects (int) : if set, also count the objects of the most common types (walks all the objects: slow)
+
+    Out:
+        {process: {pid, rss_mb, peak_rss_mb, threads, siblings: [...]}, tracemalloc: {...}, caches: {...}, snapshots: [...], objects: [...]}
+    '''
+
+    memory_diagnostics = current_app.config['MEMORY_DIAGNOSTICS']
+
+    try:
+        response = {
+            'process': process_memory(),
+            'tracemalloc': memory_diagnostics.status(),
+            'caches': memory_diagnostics.cache_sizes(),
+            'snapshots': memory_diagnostics.list_snapshots(),
+        }
+        if request.args.get('objects'):
+            response['objects'] = object_counts(int(request.args['objects']))
+
+        return jsonify(response), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@diagnostics_api.route('/memory/tracemalloc', methods=['POST'])
+@token_required(only_admins=True)
+def control_tracemalloc():
+    '''
+    Start or stop tracemalloc in the worker.
+
+    In (body):
+        action (str) : start | stop
+        frames (int) : frames stored per allocation (start, default TRACEMALLOC_FRAMES)
+    '''
+
+    memory_diagnostics = current_app.config['MEMORY_DIAGNOSTICS']
+    data = request.get_json(silent=True) or {}
+
+    if data.get('action') == 'start':
+        frames = data.get('frames')
+        if frames is not None:
+            try:
+                frames = int(frames)
+            except (TypeError, ValueError):
+                frames = 0
+            if frames < 1:
+                return jsonify({'error': 'field "frames": should be a positive integer'}), 400
+
+        return jsonify(memory_diagnostics.start(frames)), 200
+
+    if data.get('action') == 'stop':
+        return jsonify(memory_diagnostics.stop()), 200
+
+    return jsonify({'error': 'field "action": should be either "start" or "stop"'}), 400
+
+@diagnostics_api.route('/memory/snapshots', methods=['POST'])
+@token_required(only_admins=True)
+def take_memory_snapshot():
+    '''
+    Take a tracemalloc snapshot of the worker (tracemalloc must be started).
+
+    In (query string):
+        limit (int)     : number of allocation sites returned (default 20)
+        group_by (str)  : lineno (default), filename or traceback
+    '''
+
+    try:
+        snapshot = current_app.config['MEMORY_DIAGNOSTICS'].take_snapshot(
+            int(request.args.get('limit', 20)), request.args.get('group_by', 'lineno')
+        )
+        return jsonify(snapshot), 201
+
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@diagnostics_api.route('/memory/snapshots/<snapshot_id>', methods=['GET'])
+@token_required(only_admins=True)
+def memory_snapshot_top(snapshot_id):
+    '''Get the largest allocation sites of a snapshot (query string: `limit`, `group_by`)'''
+
+    try:
+        top = current_app.config['MEMORY_DIAGNOSTICS'].top(
+            snapshot_id, int(request.args.get('limit', 20)), request.args.get('group_by', 'lineno')
+        )
+        return jsonify(top), 200
+
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@diagnostics_api.route('/memory/diff', methods=['GET'])
+@token_required(only_admins=True)
+def memory_snapshot_diff():
+    '''
+    Compare two snapshots by allocation site, largest growth first.
+
+    In (query string):
+        from (str), to (str) : the snapshot ids
+        limit (int)          : number of allocation sites (default 20)
+        group_by (str)       : lineno (default), filename or traceback
+    '''
+
+    if not request.args.get('from') or not request.args.get('to'):
+        return jsonify({'error': 'missing "from" or "to" snapshot id'}), 400
+
+    try:
+        diff = current_app.config['MEMORY_DIAGNOSTICS'].diff(
+            request.args['from'], request.args['to'], int(request.args.get('limit', 20)), request.args.get('group_by', 'lineno')
+        )
+        return jsonify(diff), 200
+
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+##-Fault injection
+@diagnostics_api.route('/faults', methods=['GET'])
+@token_required(only_admins=True)
+def injected_faults():
+    '''
+    Get the fault injection rules and the faults injected by the worker (cf `src/services/fault_injection.py`).
+
+    Out:
+        {enabled, rules: [{component, fault, value, probability}], injected: {<component>.<fault>: count}, outages: {component: remaining s}}
+    '''
+
+    return jsonify(FAULTS.stats()), 200
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Prometheus endpoint (`GET /metrics`) and per-route request latency (cf `src/services/metrics.py`).
+
+When `PROMETHEUS_MULTIPROC_DIR` is set, the metrics of all the processes (gunicorn workers, MQTT gateway)
+are aggregated from the files of this directory; otherwise only the current process is exported.
+'''
+
+##-Imports
+from flask import Blueprint, Response, g, request, current_app, jsonify
+
+import hmac
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+from prometheus_client import multiprocess
+
+from src.services.metrics import HTTP_REQUEST_SECONDS
+
+##-Init
+metrics_api = Blueprint('metrics_api', __name__)
+
+##-Request timing
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+def _record_request(response):
+    '''Records the duration of the request, labelled by route pattern (e.g `/api/nodes/<node_id>`), not by URL'''
+
+    started = g.pop('request_started', None)
+
+    if started is not None and request.endpoint != 'metrics_api.export_metrics':
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.labels(request.method, route, str(response.status_code)).observe(time.perf_counter() - started)
+
+    return response
+
+def register_metrics(app):
+    '''Registers the `/metrics` endpoint and the request timing hooks'''
+
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.register_blueprint(metrics_api)
+
+##-Endpoint
+@metrics_api.route('/metrics', methods=['GET'])
+def export_metrics():
+    '''
+    Exports the metrics in the Prometheus text format.
+
+    If `METRICS_TOKEN` is set, the scraper must send `Authorization: Bearer <METRICS_TOKEN>`.
+    '''
+
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()): # Constant time
+        return jsonify({'message': 'Invalid metrics token'}), 401
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Single MQTT gateway shared by all the gunicorn workers.
+
+The gateway process owns the only broker connection (a `NodeMQTTHandler`).
+The workers talk to it over a Unix socket through `MQTTGatewayClient`, which exposes the same interface as `NodeMQTTHandler`.
+
+Protocol (one JSON object per line, in both directions):
+    request:   {"method": str, "args": list, "traceparent": str | null}
+    response:  {"ok": bool, "result": Any}  or  {"ok": false, "error": str}
+
+Run it standalone (sidecar) with:
+    python -m src.application.mqtt_gateway [socket_path]
+
+Otherwise, it is started by the gunicorn master (see `gunicorn.conf.py`).
+'''
+
+##-Imports
+from flask import Flask
+from dotenv import load_dotenv
+
+import os
+import json
+import socket
+import socketserver
+import signal
+import logging
+from threading import Lock, Thread
+from sys import argv
+
+from src.application.mqtt_handler import NodeMQTTHandler
+from src.virtualization.digital_replica.schema_registry import SchemaRegistry
+from src.services.database_service import DatabaseService
+from src.services.status_history import StatusHistory
+from observability.tracing import TRACER, configure_tracing
+from src.services.fault_injection import FAULTS, configure_faults
+from src.services.traffic_capture import CAPTURE, configure_capture
+
+from config.config_loader import ConfigLoader
+
+##-Init
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = '/tmp/iot_mqtt_gateway.sock'
+
+# Methods of `NodeMQTTHandler` that the workers are allowed to call
+EXPOSED_METHODS = (
+    'is_connected',
+    'reserve_node',
+    'cancel_reservation',
+    'send_group_command',
+    'get_group_command',
+)
+
+##-Gateway (server side)
+class _GatewayRequestHandler(socketserver.StreamRequestHandler):
+    '''Handles one worker connection (kept open for the whole life of the worker)'''
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+
+                # Continue the trace of the worker request (if it is traced)
+                with TRACER.start_span(f'mqtt_gateway.{request["method"]}', kind='server', parent=request.get('traceparent')):
+                    response = {'ok': True, 'result': self.server.gateway.dispatch(request['method'], request.get('args', []))}
+
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+
+            self.wfile.write(json.dumps(response, default=str).encode() + b'\n')
+            self.wfile.flush()
+
+
+class _GatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MQTTGateway:
+    '''Owns the broker connection and serves the workers on a Unix socket'''
+
+    def __init__(self, app, socket_path: str = DEFAULT_SOCKET_PATH):
+        '''
+        Initiates the gateway
+
+        In:
+            - app: an object with a `config` dict containing `MQTT_CONFIG` (as for `NodeMQTTHandler`)
+            - socket_path: the path of the Unix socket to listen on
+        '''
+
+        self.socket_path = socket_path
+        self.mqtt_handler = NodeMQTTHandler(app)
+        self.server = None
+
+    def dispatch(self, method: str, args: list):
+        '''
+        Calls `method` on the MQTT handler.
+
+        In:
+            - method: the name of the method (must be in `EXPOSED_METHODS`)
+            - args: the positional arguments
+        Out:
+            The result of the call
+            ValueError  if the method is not exposed
+        '''
+
+        if method not in EXPOSED_METHODS:
+            raise ValueError(f'Method not exposed by the MQTT gateway: {method}')
+
+        attr = getattr(self.mqtt_handler, method)
+
+        return attr(*args) if callable(attr) else attr
+
+    def serve_forever(self):
+        '''Connects to the broker and serves the workers until stopped'''
+
+        # Remove a stale socket left by a previous run
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.mqtt_handler.start()
+
+        self.server = _GatewayServer(self.socket_path, _GatewayRequestHandler)
+        self.server.gateway = self
+
+        logger.info(f'MQTT gateway listening on {self.socket_path}')
+
+        try:
+            self.server.serve_forever()
+
+        finally:
+            self.mqtt_handler.stop()
+            self.server.server_close()
+            CAPTURE.stop()
+
+            if 'STATUS_HISTORY' in self.mqtt_handler.app.config:
+                self.mqtt_handler.app.config['STATUS_HISTORY'].stop()
+
+            if 'DB_SERVICE' in self.mqtt_handler.app.config:
+                self.mqtt_handler.app.config['DB_SERVICE'].disconnect()
+
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        '''Stops `serve_forever` (to call from an other thread)'''
+
+        if self.server is not None:
+            self.server.shutdown()
+
+    @staticmethod
+    def create(socket_path: str = DEFAULT_SOCKET_PATH) -> 'MQTTGateway':
+        '''Creates an instance of this class by reading environment variables (and .env file).'''
+
+        load_dotenv(os.path.join(
+            os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            '.env'
+        ))
+
+        configure_tracing('mqtt_gateway', ConfigLoader.load_tracing_config_env())
+        configure_faults(ConfigLoader.load_fault_injection_config_env())
+        configure_capture('mqtt_gateway', ConfigLoader.load_capture_config_env()) # The MQTT messages and commands
+
+        # The group commands need the database (and record the status transitions)
+        schema_registry = SchemaRegistry()
+        schema_registry.load_schema('node', 'src/virtualization/templates/node.yaml')
+        schema_registry.load_schema('user', 'src/virtualization/templates/user.yaml')
+
+        db_config = ConfigLoader.load_database_config_env()
+        ConfigLoader.check_shared_database(db_config) # Separate process from the workers
+        db_service = DatabaseService(
+            connection_string=ConfigLoader.build_connection_string(db_config),
+            db_name=db_config["settings"]["name"],
+            schema_registry=schema_registry,
+        )
+        db_service.connect()
+        db_service = FAULTS.wrap('db', db_service)
+
+        history_config = ConfigLoader.load_status_history_config_env()
+        status_history = StatusHistory(
+            db_service,
+            retention_days=history_config['retention_days'],
+            batch_size=history_config['batch_size'],
+            flush_period=history_config['flush_period_s'],
+        )
+        status_history.start()
+
+        app = Flask('mqtt_gateway')
+        app.config['DB_SERVICE'] = db_service
+        app.config['STATUS_HISTORY'] = status_history
+        app.config['MQTT_CONFIG'] = {
+            'broker': os.environ.get('MQTT_DOMAIN'),
+            'port': os.environ.get('MQTT_PORT'),
+            'username': os.environ.get('MQTT_USERNAME'),
+            'password': os.environ.get('MQTT_PWD')
+        }
+        app.config['TELEMETRY_CONFIG'] = ConfigLoader.load_telemetry_config_env()
+
+        return MQTTGateway(app, socket_path)
+
+
+def run_gateway(socket_path: str = DEFAULT_SOCKET_PATH):
+    '''Entry point of the gateway process'''
+
+    logging.basicConfig(level=logging.INFO)
+    gateway = MQTTGateway.create(socket_path)
+
+    # Stop cleanly (flush the buffers) when terminated by the gunicorn master.
+    # `shutdown` blocks until `serve_forever` returns, so it is called from an other thread.
+    signal.signal(signal.SIGTERM, lambda signum, frame: Thread(target=gateway.shutdown).start())
+
+    gateway.serve_forever()
+
+##-Client (worker side)
+class MQTTGatewayClient:
+    '''Drop-in replacement of `NodeMQTTHandler` that forwards the calls to the MQTT gateway'''
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = 5.0):
+        '''
+        Initiates the client. The connection to the gateway is opened lazily.
+
+        In:
+            - socket_path: the path of the gateway Unix socket
+            - timeout: timeout (in seconds) for one call
+        '''
+
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+        self._sock = None
+        self._rfile = None
+        self._lock = Lock() # The connection is shared by all the threads of the worker
+
+    def _open(self):
+        '''Opens the connection to the gateway'''
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.socket_path)
+        self._rfile = self._sock.makefile('rb')
+
+    def _close(self):
+        '''Closes the connection to the gateway (if it exists)'''
+
+        if self._sock is not None:
+            try:
+                self._rfile.close()
+                self._sock.close()
+            except OSError:
+                pass
+
+        self._sock = None
+        self._rfile = None
+
+    def _call(self, method: str, *args):
+        '''
+        Calls `method` on the gateway's MQTT handler.
+        Retries once on a fresh connection when the request could not be delivered (the gateway was
+        restarted by the gunicorn master, and the connection is stale). Never retries once the request
+        is sent: the gateway may be running it (e.g a slow group command), and would run it twice.
+
+        Out:
+            The result of the call
+            ConnectionError  if the gateway cannot be reached
+            RuntimeError     if the call failed in the gateway
+        '''
+
+        # The gateway continues the trace (`traceparent` is None when the call is not traced)
+        with TRACER.start_span(f'mqtt_gateway.{method}', kind='client') as span:
+            payload = json.dumps({'method': method, 'args': list(args), 'traceparent': span.traceparent}).encode() + b'\n'
+
+            with self._lock:
+                for attempt in range(2):
+                    try:
+                        if self._sock is None:
+                            self._open()
+
+                        self._sock.sendall(payload)
+                        break
+
+                    except OSError as e:
+                        self._close()
+
+                        if attempt == 1:
+                            raise ConnectionError(f'MQTT gateway unreachable: {e}')
+
+                try:
+                    line = self._rfile.readline()
+
+                except OSError as e:
+                    self._close()
+                    raise ConnectionError(f'No response from the MQTT gateway to {method}: {e}')
+
+                if not line:
+                    self._close()
+                    raise ConnectionError(f'Connection closed by the MQTT gateway during {method}')
+
+            response = json.loads(line)
+            if not response['ok']:
+                raise RuntimeError(f'MQTT gateway error: {response["error"]}')
+
+            return response['result']
+
+    def start(self):
+        '''Nothing to start: the broker connection is owned by the gateway'''
+
+        pass
+
+    def stop(self):
+        '''Closes the connection to the gateway'''
+
+        with self._lock:
+            self._close()
+
+    @property
+    def is_connected(self) -> bool:
+        '''Check if the gateway is currently connected to the broker'''
+
+        try:
+            return self._call('is_connected')
+
+        except (ConnectionError, RuntimeError) as e:
+            logger.error(f'MQTT gateway: {e}')
+            return False
+
+    def reserve_node(self, node_id: str) -> bool:
+        '''Same as `NodeMQTTHandler.reserve_node`, through the gateway'''
+
+        try:
+            return self._call('reserve_node', node_id)
+
+        except (ConnectionError, RuntimeError) as e:
+            logger.error(f'MQTT gateway: {e}')
+            return False
+
+    def cancel_reservation(self, node_id: str) -> bool:
+        '''Same as `NodeMQTTHandler.cancel_reservation`, through the gateway'''
+
+        try:
+            return self._call('cancel_reservation', node_id)
+
+        except (ConnectionError, RuntimeError) as e:
+            logger.error(f'MQTT gateway: {e}')
+            return False
+
+    def send_group_command(self, command: str, site: str | None = None, zone: str | None = None) -> dict:
+        '''Same as `NodeMQTTHandler.send_group_command`, through the gateway'''
+
+        try:
+            return self._call('send_group_command', command, site, zone)
+
+        except RuntimeError as e:
+            raise ValueError(str(e))
+
+    def get_group_command(self, command_id: str) -> dict | None:
+        '''Same as `NodeMQTTHandler.get_group_command`, through the gateway'''
+
+        return self._call('get_group_command', command_id)
+
+##-Main
+if __name__ == '__main__':
+    if len(argv) > 1:
+        run_gateway(argv[1])
+    else:
+        run_gateway()
@@ -3,10 +3,30 @@ import paho.mqtt.client as mqtt
 import logging
 import time
 import ssl
-from threading import Thread, Event
+import json
+from bson import ObjectId
+from collections import Counter, OrderedDict
+from datetime import datetime
+from threading import Thread, Event, Lock
+
+from src.application.node_liveness import NodeLivenessTracker, FLUSH_PERIOD_S
+from src.application.telemetry import TelemetryIngestion
+from src.services.metrics import MQTT_PUBLISH_ACK_SECONDS, MQTT_PUBLISH_FAILURES, MQTT_COMMAND_ACK_SECONDS
+from observability.tracing import TRACER
+from src.services.traffic_capture import CAPTURE
 
 logger = logging.getLogger(__name__)
 
+# Group commands: command -> (statuses of the nodes it applies to, new status)
+GROUP_COMMANDS = {
+    'free': (('reserved',), 'free'),                       # Release the reservations
+    'maintenance': (('free', 'reserved'), 'maintenance'),  # Close the spots (occupied ones are left untouched)
+    'open': (('maintenance',), 'free'),                    # Reopen the spots after maintenance
+}
+
+MAX_TRACKED_COMMANDS = 100 # Number of group commands for which the acknowledgements are kept
+MAX_TRACKED_PUBLISHES = 1000 # Number of publishes waiting for their PUBACK (publish latency metric)
+
 
 class NodeMQTTHandler:
     '''Handles the MQTT connection for the platform -> node communication'''
@@ -17,12 +37,24 @@ class NodeMQTTHandler:
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
 
         self._setup_mqtt()
 
         self.connected = False
         self.stopping = Event()
         self.reconnect_thread = None
+        self.flush_thread = None
+
+        self.liveness = NodeLivenessTracker(app)
+        self.telemetry = TelemetryIngestion(app)
+
+        self._commands = OrderedDict() # command_id -> group command state (acknowledgements)
+        self._commands_lock = Lock()
+
+        self._publishes = OrderedDict()  # mid -> (kind, publish time), until the PUBACK
+        self._early_acks = OrderedDict() # mid -> PUBACK time, for PUBACKs received before `publish` returned
+        self._publishes_lock = Lock()
 
     def _setup_mqtt(self):
         """Setup MQTT client with configuration from app"""
@@ -61,6 +93,13 @@ class NodeMQTTHandler:
             self.reconnect_thread.daemon = True
             self.reconnect_thread.start()
 
+            # Start the thread that writes the buffered liveness to the DB
+            self.flush_thread = Thread(target=self._flush_loop)
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+
+            self.telemetry.start()
+
             logger.info("MQTT handler started")
 
         except Exception as e:
@@ -74,6 +113,12 @@ class NodeMQTTHandler:
         if self.reconnect_thread:
             self.reconnect_thread.join(timeout=1.0)
 
+        if self.flush_thread:
+            self.flush_thread.join(timeout=1.0)
+            self.liveness.flush() # Last flush
+
+        self.telemetry.stop()
+
         self.client.loop_stop()
         if self.connected:
             self.client.disconnect()
@@ -105,6 +150,12 @@ class NodeMQTTHandler:
 
             time.sleep(5)  # Wait 5 seconds between reconnection attempts
 
+    def _flush_loop(self):
+        """Background thread that periodically writes the buffered data to the DB"""
+
+        while not self.stopping.wait(FLUSH_PERIOD_S):
+            self.liveness.flush()
+
     def _on_connect(self, client, userdata, flags, rc):
         """Handle connection to broker"""
 
@@ -112,6 +163,14 @@ class NodeMQTTHandler:
             self.connected = True
             logger.info("Connected to MQTT broker")
 
+            # (Re)subscribe (subscriptions are lost with the session)
+            client.subscribe([
+                ('nodes/+/ack', 1),
+                ('nodes/+/status', 1),    # 'online' on connection, 'offline' as Last Will
+                ('nodes/+/heartbeat', 0),
+                ('nodes/+/telemetry', 0),
+            ])
+
         else:
             self.connected = False
             logger.error(f"Failed to connect to MQTT broker with code: {rc}")
@@ -124,9 +183,96 @@ class NodeMQTTHandler:
             logger.warning(f"Unexpected disconnection from MQTT broker: {rc}")
 
     def _on_message(self, client, userdata, msg):
-        """Handle incoming messages (none should come)"""
+        """Handle incoming messages (group commands acknowledgements, liveness, telemetry)"""
+
+        parts = msg.topic.split('/')
+
+        if len(parts) != 3 or parts[0] != 'nodes':
+            return
+
+        node_id, kind = parts[1], parts[2]
+        CAPTURE.record_mqtt('mqtt_in', msg.topic, msg.payload, node_id, qos=msg.qos)
+
+        if kind == 'heartbeat':
+            self.liveness.on_heartbeat(node_id)
+
+        elif kind == 'status':
+            self.liveness.on_status(node_id, msg.payload.decode(errors='replace'))
+
+        elif kind == 'telemetry':
+            self.liveness.on_heartbeat(node_id)
+            self.telemetry.ingest(node_id, msg.payload)
+
+        elif kind == 'ack':
+            self.liveness.on_heartbeat(node_id)
+            self._on_ack(node_id, msg.payload.decode(errors='replace'))
+
+    def _on_ack(self, node_id: str, command_id: str):
+        """Records the acknowledgement of the group command `command_id` by the node `node_id`"""
+
+        now = datetime.utcnow()
+
+        with self._commands_lock:
+            command = self._commands.get(command_id)
+
+            if command is None or node_id not in command['expected'] or node_id in command['acked']:
+                return
+
+            command['acked'][node_id] = now
+
+        MQTT_COMMAND_ACK_SECONDS.observe((now - command['sent_at']).total_seconds())
+
+    def _publish(self, kind: str, topic: str, payload: str):
+        '''
+        Publishes `payload` on `topic` (QoS 1) and tracks the time until the broker acknowledges it.
+
+        In:
+            - kind: the metric label of the message (reserve, cancel, group_command)
+        Out:
+            The `MQTTMessageInfo` of the publish
+        '''
+
+        started = time.perf_counter()
+
+        with TRACER.start_span(f'mqtt.publish {kind}', kind='producer', attributes={'messaging.system': 'mqtt', 'messaging.destination': topic}) as span:
+            res = self.client.publish(topic, payload, qos=1, retain=False)
+            CAPTURE.record_mqtt('mqtt_out', topic, payload, topic.split('/')[1] if topic.startswith('nodes/') else None, command=kind, rc=res[0])
+
+            if res[0] != 0:
+                span.record_error(f'publish failed (rc={res[0]})')
+                MQTT_PUBLISH_FAILURES.labels(kind).inc()
+                return res
+
+        # The lock is not held during `publish`: paho calls `on_publish` with its own lock held
+        with self._publishes_lock:
+            acked_at = self._early_acks.pop(res[1], None)
+
+            if acked_at is None:
+                self._publishes[res[1]] = (kind, started)
+                while len(self._publishes) > MAX_TRACKED_PUBLISHES:
+                    self._publishes.popitem(last=False)
+
+        if acked_at is not None:
+            MQTT_PUBLISH_ACK_SECONDS.labels(kind).observe(acked_at - started)
+
+        return res
 
-        pass
+    def _on_publish(self, client, userdata, mid):
+        """Handle the acknowledgement of a publish by the broker (PUBACK)"""
+
+        now = time.perf_counter()
+
+        with self._publishes_lock:
+            pending = self._publishes.pop(mid, None)
+
+            if pending is None:
+                self._early_acks[mid] = now
+                while len(self._early_acks) > MAX_TRACKED_PUBLISHES:
+                    self._early_acks.popitem(last=False)
+
+        if pending is not None:
+            kind, started = pending
+            MQTT_PUBLISH_ACK_SECONDS.labels(kind).observe(now - started)
 
     @property
     def is_connected(self):
@@ -143,7 +289,7 @@ class NodeMQTTHandler:
         '''
     
         topic = f'nodes/{node_id}'
-        res = self.client.publish(topic, 'reserved', qos=1, retain=False)
+        res = self._publish('reserve', topic, 'reserved')
 
         return res[0] == 0
 
@@ -156,6 +302,144 @@ class NodeMQTTHandler:
         '''
     
         topic = f'nodes/{node_id}'
-        res = self.client.publish(topic, 'free', qos=1, retain=False)
+        res = self._publish('cancel', topic, 'free')
 
         return res[0] == 0
+
+    @staticmethod
+    def get_group_topic(site: str | None = None, zone: str | None = None) -> str:
+        '''
+        Gets the broadcast topic for a group of nodes.
+        Nodes subscribe to `groups/all`, `groups/<site>/all` and `groups/<site>/<zone>`.
+
+        In:
+            - site: the site of the nodes. None or '+' for all sites
+            - zone: the zone of the nodes in the site. None or '+' for all zones
+        Out:
+            The topic
+        '''
+
+        if site in (None, '+'):
+            return 'groups/all'
+
+        if zone in (None, '+'):
+            return f'groups/{site}/all'
+
+        return f'groups/{site}/{zone}'
+
+    def send_group_command(self, command: str, site: str | None = None, zone: str | None = None) -> dict:
+        '''
+        Applies `command` to all the nodes of a group:
+            - updates the matching nodes with one `update_many` per previous state (status and user: one for the free
+              or maintenance nodes, one per user for the reserved ones), conditioned on that state;
+            - publishes one broadcast message on the group topic (`{"cmd": command, "id": command_id}`).
+
+        A node whose status changed between the selection and the update (e.g reserved or occupied meanwhile) is left
+        untouched, and is not part of the command.
+
+        The nodes acknowledge by publishing the command id on `nodes/<node_id>/ack`.
+        Acknowledgements are collected asynchronously (cf `get_group_command`).
+
+        In:
+            - command: the command, in `GROUP_COMMANDS`
+            - site: the site of the nodes. None or '+' for all sites
+            - zone: the zone of the nodes in the site. None or '+' for all zones (a zone needs a site)
+        Out:
+            {command_id: str, topic: str, nodes: list[str], published: bool}
+            ValueError  if unknown command, or zone without site
+        '''
+
+        if command not in GROUP_COMMANDS:
+            raise ValueError(f'Unknown group command "{command}", should be in {tuple(GROUP_COMMANDS)}')
+
+        if site in (None, '+') and zone not in (None, '+'):
+            raise ValueError('A zone needs a site (the nodes only subscribe to the zones of their site)')
+
+        db_service = self.app.config['DB_SERVICE']
+        from_statuses, new_status = GROUP_COMMANDS[command]
+        command_id = str(ObjectId())
+
+        #---Select the nodes
+        query = {'data.status': {'$in': list(from_statuses)}}
+        if site not in (None, '+'):
+            query['profile.site'] = site
+        if zone not in (None, '+'):
+            query['profile.zone'] = zone
+
+        states: dict[tuple[str, str], list[str]] = {} # (status, used_by) -> nodes
+        for n in db_service.query_drs('node', query):
+            states.setdefault((n['data']['status'], n['used_by']), []).append(n['_id'])
+
+        #---Update the database, only the nodes still in their selected state
+        # The updated nodes are stamped with the command id, to find them if some changed meanwhile
+        modified = {} # Node -> its previous state
+        for (status, used_by), ids in states.items():
+            nb_modified = db_service.update_drs(
+                'node',
+                {'_id': {'$in': ids}, 'data.status': status, 'used_by': used_by},
+                {'data.status': new_status, 'used_by': '', 'metadata.group_command': command_id},
+            )
+
+            if nb_modified == len(ids):
+                modified.update((node_id, (status, used_by)) for node_id in ids)
+            elif nb_modified:
+                stamped = db_service.query_drs('node', {'_id': {'$in': ids}, 'metadata.group_command': command_id})
+                modified.update((n['_id'], (status, used_by)) for n in stamped)
+
+        node_ids = list(modified)
+
+        # Released reservations, one update per number of reservations released (a user may have several)
+        released = Counter(used_by for status, used_by in modified.values() if status == 'reserved' and used_by != '')
+        by_count: dict[int, list[str]] = {}
+        for uid, count in released.items():
+            by_count.setdefault(count, []).append(uid)
+        for count, uids in by_count.items():
+            db_service.increment_drs('user', {'_id': {'$in': uids}}, {'nb_reservations': -count})
+
+        status_history = self.app.config.get('STATUS_HISTORY')
+        if status_history is not None:
+            now = datetime.utcnow()
+            for node_id, (status, used_by) in modified.items():
+                status_history.record(node_id, status, new_status, used_by, 'group_command', now)
+
+        #---Broadcast
+        topic = self.get_group_topic(site, zone)
+
+        with self._commands_lock:
+            self._commands[command_id] = {
+                'command': command,
+                'topic': topic,
+                'sent_at': datetime.utcnow(),
+                'expected': set(node_ids),
+                'acked': {},
+            }
+
+            while len(self._commands) > MAX_TRACKED_COMMANDS:
+                self._commands.popitem(last=False)
+
+        res = self._publish('group_command', topic, json.dumps({'cmd': command, 'id': command_id}))
+
+        return {'command_id': command_id, 'topic': topic, 'nodes': node_ids, 'published': res[0] == 0}
+
+    def get_group_command(self, command_id: str) -> dict | None:
+        '''
+        Gets the acknowledgement state of a group command.
+
+        Out:
+            None  if unknown command id (or too old)
+            {command: str, topic: str, sent_at: datetime, acked: dict[str, datetime], missing: list[str]}  otherwise
+        '''
+
+        with self._commands_lock:
+            command = self._commands.get(command_id)
+
+            if command is None:
+                return None
+
+            return {
+                'command': command['command'],
+                'topic': command['topic'],
+                'sent_at': command['sent_at'],
+                'acked': dict(command['acked']),
+                'missing': sorted(command['expected'] - command['acked'].keys()),
+            }
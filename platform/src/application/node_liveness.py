@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tracks whether the nodes are online, from their MQTT heartbeats and Last Will.
+
+The nodes publish:
+    - `online` (retained) on `nodes/<node_id>/status` when they connect;
+    - `offline` (retained) on `nodes/<node_id>/status`, as Last Will (published by the broker when the node dies);
+    - a heartbeat on `nodes/<node_id>/heartbeat` every `HEARTBEAT_PERIOD_S`.
+
+The last-seen timestamps are kept in memory and flushed to the database in batches (one `bulk_write`),
+so the database is not written once per heartbeat.
+The state is stored in the node documents as `liveness: {online: bool, last_seen: datetime}`.
+'''
+
+##-Imports
+import logging
+from datetime import datetime, timedelta
+from threading import Lock
+
+##-Init
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_PERIOD_S = 30                   # Period of the heartbeats sent by the nodes
+OFFLINE_TIMEOUT_S = 3 * HEARTBEAT_PERIOD_S  # A node not seen for this long is considered offline
+LAST_SEEN_RESOLUTION_S = 60               # `liveness.last_seen` is only rewritten in the DB when older than this
+FLUSH_PERIOD_S = 10                       # Period of the flushes to the database
+
+##-Tracker
+class NodeLivenessTracker:
+    '''In-memory table of the nodes last-seen timestamps, flushed to the database in batches'''
+
+    def __init__(self, app):
+        '''
+        Initiates the tracker
+
+        In:
+            - app: the Flask app (the database is read from `app.config['DB_SERVICE']` at flush time)
+        '''
+
+        self.app = app
+
+        self._table: dict[str, dict] = {} # node_id -> {online: bool | None, last_seen: datetime | None, persisted_at: datetime | None}
+        self._dirty: set[str] = set()     # Nodes to write at next flush
+        self._lock = Lock()
+
+    def on_status(self, node_id: str, status: str):
+        '''
+        Handles a message on `nodes/<node_id>/status` (`online`, or `offline` from the Last Will).
+
+        In:
+            - node_id: the ID of the node
+            - status: the payload ("online" | "offline")
+        '''
+
+        if status not in ('online', 'offline'):
+            return
+
+        with self._lock:
+            entry = self._get_entry(node_id)
+            online = status == 'online'
+
+            if online:
+                entry['last_seen'] = datetime.utcnow()
+
+            if entry['online'] != online:
+                entry['online'] = online
+                self._dirty.add(node_id)
+
+    def on_heartbeat(self, node_id: str):
+        '''Handles a heartbeat from `node_id`. Does not touch the database.'''
+
+        now = datetime.utcnow()
+
+        with self._lock:
+            entry = self._get_entry(node_id)
+            entry['last_seen'] = now
+
+            if entry['online'] is not True:
+                entry['online'] = True
+                self._dirty.add(node_id)
+
+            elif entry['persisted_at'] is None or now - entry['persisted_at'] > timedelta(seconds=LAST_SEEN_RESOLUTION_S):
+                self._dirty.add(node_id)
+
+    def _get_entry(self, node_id: str) -> dict:
+        '''Gets (or creates) the entry of `node_id` in the table. The lock must be held.'''
+
+        if node_id not in self._table:
+            self._table[node_id] = {'online': None, 'last_seen': None, 'persisted_at': None} # None: unknown
+
+        return self._table[node_id]
+
+    def get(self, node_id: str) -> dict | None:
+        '''
+        Gets the in-memory liveness of `node_id`.
+
+        Out:
+            None                                       if the node has never been seen by this process
+            {online: bool, last_seen: datetime | None}  otherwise
+        '''
+
+        with self._lock:
+            entry = self._table.get(node_id)
+
+            if entry is None:
+                return None
+
+            return {'online': entry['online'], 'last_seen': entry['last_seen']}
+
+    def flush(self) -> int:
+        '''
+        Marks the silent nodes as offline, and writes the changes to the database
+        (one `bulk_write` for the tracked nodes, one `update_many` for the nodes that this process never heard of).
+
+        Out:
+            The number of node documents written
+        '''
+
+        now = datetime.utcnow()
+        deadline = now - timedelta(seconds=OFFLINE_TIMEOUT_S)
+
+        #---Collect the updates
+        with self._lock:
+            for node_id, entry in self._table.items():
+                if entry['online'] and entry['last_seen'] is not None and entry['last_seen'] < deadline:
+                    entry['online'] = False
+                    self._dirty.add(node_id)
+
+            updates = {}
+            for node_id in self._dirty:
+                entry = self._table[node_id]
+                updates[node_id] = {'liveness.online': entry['online']}
+
+                if entry['last_seen'] is not None:
+                    updates[node_id]['liveness.last_seen'] = entry['last_seen']
+
+                entry['persisted_at'] = now
+
+            self._dirty.clear()
+
+        #---Write
+        db_service = self.app.config.get('DB_SERVICE')
+        if db_service is None:
+            return 0
+
+        try:
+            nb = db_service.bulk_update_drs('node', updates) if updates else 0
+
+            # Nodes marked online in the DB but silent (e.g node died while the platform was down)
+            nb += db_service.update_drs(
+                'node',
+                {'liveness.online': True, 'liveness.last_seen': {'$lt': deadline}},
+                {'liveness.online': False}
+            )
+
+            return nb
+
+        except Exception as e:
+            logger.error(f'Failed to flush node liveness: {e}')
+
+            # Retry at next flush
+            with self._lock:
+                self._dirty.update(node_id for node_id in updates if node_id in self._table)
+
+            return 0
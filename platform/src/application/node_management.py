@@ -8,6 +8,7 @@ from src.application.mqtt_handler import NodeMQTTHandler
 from src.application.notification_handlers import Discorder, Emailer
 from src.application.user_management import UserCheck
 from src.services.database_service import DatabaseService
+from src.services.status_history import StatusHistory
 
 from datetime import datetime
 
@@ -15,7 +16,7 @@ from datetime import datetime
 class NodeManagement:
     '''Class handling node management (status update, reservation, ...)'''
 
-    def __init__(self, node_id: str, db_service: DatabaseService, mqtt_handler: NodeMQTTHandler):
+    def __init__(self, node_id: str, db_service: DatabaseService, mqtt_handler: NodeMQTTHandler, status_history: StatusHistory | None = None):
         '''
         Initiates the class
 
@@ -23,13 +24,16 @@ class NodeManagement:
             - node_id: the ID of the node
             - db_service: the DB controller
             - mqtt_handler: the MQTT handler
+            - status_history: where to record the status transitions (not recorded if None)
         '''
 
         self._node_id = node_id
         self._db_service = db_service
         self._mqtt_handler = mqtt_handler
+        self._status_history = status_history
 
         self._node: dict[str, str] | None = None # Will be set by self.is_id_valid in order to minimise calls to the DB
+        self._concerned_uid = '' # Last user set in `used_by` by this instance (for the status history)
 
     def is_id_valid(self) -> bool:
         '''
@@ -56,13 +60,15 @@ class NodeManagement:
 
         return self._node
 
-    def update_content(self, update_data: dict):
+    def update_content(self, update_data: dict, source: str = 'platform'):
         '''
         Updates the data of the node in the database.
         Does not do any check.
+        If the status changes, the transition is recorded in the status history (asynchronously).
 
         In:
             - update_data: the data to update, shaped as in the database.
+            - source: who triggered the update ('node', 'user', 'admin', ...). Only used for the history.
         '''
 
         # Always update the 'updated at' time stamp
@@ -70,6 +76,19 @@ class NodeManagement:
     
         self._db_service.update_dr('node', self._node_id, update_data)
 
+        # Record the status transition
+        if update_data.get('used_by'):
+            self._concerned_uid = update_data['used_by']
+
+        new_status = update_data.get('data', {}).get('status')
+
+        if new_status is not None and self._node is not None:
+            if self._status_history is not None:
+                used_by = self._concerned_uid or self._node['used_by']
+                self._status_history.record(self._node_id, self._node['data']['status'], new_status, used_by, source)
+
+            self._node['data']['status'] = new_status # Keep the cached node consistent with the DB
+
     def get_status(self) -> str:
         '''Retrieves the current status of the node from the database.'''
     
@@ -163,6 +182,10 @@ class NodeManagement:
         if self._node['data']['status'] != 'free':
             return False
 
+        # Check that the node is not offline (it would never receive the reservation)
+        if self._node.get('liveness', {}).get('online') is False:
+            return False
+
         # Take reservation
         user_check.increase_nb_reservations()
         self.update_content({'used_by': uid})
@@ -1,8 +1,9 @@
 from flask import Blueprint, request, jsonify, current_app
-from datetime import datetime
+from datetime import datetime, timedelta
 from src.application.node_management import NodeManagement
 from src.application.authentication import decode_token, token_required, is_admin, authenticate_node
 from src.application.user_management import UserCheck
+from src.application.telemetry import get_node_telemetry
 from src.virtualization.digital_replica.dr_factory import DRFactory
 
 nodes_api = Blueprint('nodes_api', __name__,url_prefix = '/api/nodes')
@@ -15,13 +16,17 @@ def register_node_blueprint(app):
 def list_nodes():
     '''
     Gets all nodes with optional filtering on `status`.
-    It is also possible to list the nodes reserved by self (from token) with `used_by_me`
+    It is also possible to list the nodes reserved by self (from token) with `used_by_me`,
+    and the nodes that can be reserved (free and not offline) with `reservable`.
+
+    `online` is null for the nodes that never sent a heartbeat.
 
     E.g
         GET /api/nodes/
         GET /api/nodes/?status=free
         GET /api/nodes/?used_by_me
         GET /api/nodes/?status=free&used_by_me
+        GET /api/nodes/?reservable
     '''
 
     try:
@@ -29,6 +34,10 @@ def list_nodes():
         if request.args.get('status'):
             filters['data.status'] = request.args.get('status')
 
+        if 'reservable' in request.args:
+            filters['data.status'] = 'free'
+            filters['liveness.online'] = {'$ne': False} # Nodes without heartbeat support are kept
+
         if 'used_by_me' in request.args:
             filters['used_by'] = decode_token()['uid']
 
@@ -41,12 +50,14 @@ def list_nodes():
                 '_id': n['_id'],
                 'status': n['data']['status'],
                 'position': n['profile']['position'],
+                'online': n.get('liveness', {}).get('online'),
             })
 
             # For admins, add more data
             if is_admin():
                 nodes_cleaned[-1]['metadata'] = n['metadata']
                 nodes_cleaned[-1]['used_by'] = n['used_by']
+                nodes_cleaned[-1]['last_seen'] = n.get('liveness', {}).get('last_seen')
 
         return jsonify({"nodes": nodes_cleaned}), 200
 
@@ -80,6 +91,55 @@ def create_node():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@nodes_api.route('/group_commands', methods=['POST'])
+@token_required(only_admins=True)
+def send_group_command():
+    '''
+    Sends a command to a whole group of nodes (one DB update + one MQTT broadcast).
+
+    Data to post:
+    {
+        "command": str,   # "free" (release reservations) | "maintenance" (close) | "open" (reopen after maintenance)
+        "site": str,      # Optional, all sites if missing or "+"
+        "zone": str       # Optional, all zones of the site if missing or "+"
+    }
+
+    Out:
+        {status: str, command_id: str, topic: str, nodes: list[str], published: bool}
+    '''
+
+    try:
+        data = request.get_json()
+
+        if 'command' not in data:
+            return jsonify({'status': 'error', 'message': 'Field "command" missing in payload'}), 400
+
+        try:
+            res = current_app.config['MQTT_HANDLER'].send_group_command(data['command'], data.get('site'), data.get('zone'))
+
+        except ValueError as err:
+            return jsonify({'status': 'error', 'message': str(err)}), 400
+
+        return jsonify({'status': 'success', **res}), 200
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@nodes_api.route('/group_commands/<command_id>', methods=['GET'])
+@token_required(only_admins=True)
+def get_group_command(command_id):
+    '''Gets the acknowledgements received for a group command'''
+
+    try:
+        command = current_app.config['MQTT_HANDLER'].get_group_command(command_id)
+        if command is None:
+            return jsonify({'status': 'error', 'message': 'command not found'}), 404
+
+        return jsonify({'status': 'success', **command}), 200
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @nodes_api.route('/<node_id>', methods=['GET'])
 @token_required()
 def get_node(node_id):
@@ -95,18 +155,79 @@ def get_node(node_id):
             '_id': node['_id'],
             'status': node['data']['status'],
             'position': node['profile']['position'],
+            'online': node.get('liveness', {}).get('online'),
         }
 
         # For admins, add more data
         if is_admin():
             node_cleaned['metadata'] = node['metadata']
             node_cleaned['used_by'] = node['used_by']
+            node_cleaned['last_seen'] = node.get('liveness', {}).get('last_seen')
 
         return jsonify(node_cleaned), 200
 
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@nodes_api.route('/<node_id>/telemetry', methods=['GET'])
+@token_required(only_admins=True)
+def get_telemetry(node_id):
+    '''
+    Gets the health metrics (rssi, uptime, free_heap, rfid_errors) sent by the node.
+
+    Optional query parameters (ISO 8601 dates, UTC):
+        - start: default is 24 hours before `end`
+        - end: default is now
+
+    E.g
+        GET /api/nodes/node_0/telemetry?start=2026-01-01T00:00:00
+    '''
+
+    try:
+        try:
+            end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else datetime.utcnow()
+            start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else end - timedelta(days=1)
+
+        except ValueError as err:
+            return jsonify({'status': 'error', 'message': f'Invalid date: {err}'}), 400
+
+        samples = get_node_telemetry(current_app.config['DB_SERVICE'], node_id, start, end)
+
+        return jsonify({'node_id': node_id, 'samples': samples}), 200
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@nodes_api.route('/<node_id>/history', methods=['GET'])
+@token_required(only_admins=True)
+def get_status_history(node_id):
+    '''
+    Gets the status transitions of the node (most recent first).
+
+    Optional query parameters:
+        - start, end: ISO 8601 dates (UTC)
+        - limit: maximum number of transitions (default: 1000)
+
+    E.g
+        GET /api/nodes/node_0/history?start=2026-01-01T00:00:00&limit=50
+    '''
+
+    try:
+        try:
+            start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else None
+            end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else None
+            limit = int(request.args.get('limit', 1000))
+
+        except ValueError as err:
+            return jsonify({'status': 'error', 'message': f'Invalid parameter: {err}'}), 400
+
+        transitions = current_app.config['STATUS_HISTORY'].node_history(node_id, start, end, limit)
+
+        return jsonify({'node_id': node_id, 'transitions': transitions}), 200
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @nodes_api.route('/<node_id>', methods=['POST'])
 def authentication_request(node_id):
     '''
@@ -143,7 +264,7 @@ def authentication_request(node_id):
 
         #---Node authentication
         # Check that node exists
-        node_management = NodeManagement(node_id, current_app.config['DB_SERVICE'], current_app.config['MQTT_HANDLER'])
+        node_management = NodeManagement(node_id, current_app.config['DB_SERVICE'], current_app.config['MQTT_HANDLER'], current_app.config.get('STATUS_HISTORY'))
         if not node_management.is_id_valid():
             return jsonify({'status': 'error', 'message': 'node not found'}), 404
 
@@ -177,7 +298,7 @@ def authentication_request(node_id):
             user_checker.send_cloning_event(node_id)
 
             # Set node status to violation
-            node_management.update_content({'data': {'status': 'violation'}})
+            node_management.update_content({'data': {'status': 'violation'}}, 'node')
 
             # Return
             return jsonify({'status': 'violation', 'message': 'Wrong authentication token'}), 403
@@ -206,7 +327,7 @@ def authentication_request(node_id):
         user_checker.update_content({'is_parked': True})
 
         # Set `node.status = occupied` and `node.used_by = UID`
-        node_management.update_content({'data': {'status': 'occupied'}, 'used_by': uid})
+        node_management.update_content({'data': {'status': 'occupied'}, 'used_by': uid}, 'node')
 
         return jsonify({'status': 'success', 'message': 'User is legally parked'}), 200
 
@@ -262,7 +383,7 @@ def update_node(node_id):
 
     try:
         #---Check that node exists
-        node_management = NodeManagement(node_id, current_app.config['DB_SERVICE'], current_app.config['MQTT_HANDLER'])
+        node_management = NodeManagement(node_id, current_app.config['DB_SERVICE'], current_app.config['MQTT_HANDLER'], current_app.config.get('STATUS_HISTORY'))
         if not node_management.is_id_valid():
             return jsonify({'status': 'error', 'message': 'node not found'}), 404
 
@@ -288,8 +409,8 @@ def update_node(node_id):
         if type(data['data_to_update']) != dict:
             return jsonify({'status': 'error', 'message': 'Field "data_to_update": should be a dict'}), 400
 
-        if 'status' in data['data_to_update'] and data['data_to_update']['status'] not in ('free', 'reserved', 'waiting_for_authentication', 'occupied', 'violation', 'unauthorized'):
-            return jsonify({'status': 'error', 'message': 'Field "status": must be in ("free", "reserved", "waiting_for_authentication", "occupied", "violation", "unauthorized")'}), 400
+        if 'status' in data['data_to_update'] and data['data_to_update']['status'] not in ('free', 'reserved', 'waiting_for_authentication', 'occupied', 'violation', 'unauthorized', 'maintenance'):
+            return jsonify({'status': 'error', 'message': 'Field "status": must be in ("free", "reserved", "waiting_for_authentication", "occupied", "violation", "unauthorized", "maintenance")'}), 400
 
         #---Authenticate the source
         #-Node
@@ -346,7 +467,7 @@ def update_node(node_id):
             update_data['data'] = {'status': new_status}
 
         # Update in database
-        node_management.update_content(update_data)
+        node_management.update_content(update_data, source)
 
         return jsonify({'status': 'success', 'message': 'node updated successfully'}), 200
 
@@ -13,6 +13,11 @@ import requests
 
 from dotenv import load_dotenv
 import os
+import time
+
+from src.services.metrics import NOTIFICATION_SECONDS
+from observability.tracing import TRACER
+from src.services.fault_injection import FAULTS
 
 ##-Util
 def load_env_vars():
@@ -129,7 +134,16 @@ class Emailer:
 
         text = message.as_string()
 
-        self._connect_and_send(recipient, text)
+        started = time.perf_counter()
+        outcome = 'error'
+
+        try:
+            with TRACER.start_span('smtp.send', kind='client', attributes={'smtp.server': self._smtp_url}):
+                self._connect_and_send(recipient, text)
+            outcome = 'ok'
+
+        finally:
+            NOTIFICATION_SECONDS.labels('email', outcome).observe(time.perf_counter() - started)
 
     def __repr__(self) -> str:
         '''stringify settings'''
@@ -151,7 +165,7 @@ class Emailer:
 
         emailer = Emailer(sender_addr, sender_pwd, smtp_url, smtp_port)
 
-        return emailer
+        return FAULTS.wrap('email', emailer) # Itself without fault injection
 
 ##-Discord
 class Discorder:
@@ -184,7 +198,17 @@ class Discorder:
             'content': msg
         }
 
-        response = requests.post(self._webhook_url, json=data)
+        started = time.perf_counter()
+        outcome = 'error'
+
+        try:
+            with TRACER.start_span('discord.send', kind='client') as span:
+                response = requests.post(self._webhook_url, json=data)
+                span.set_attribute('http.status_code', response.status_code)
+            outcome = 'ok' if response.status_code == 204 else 'failed'
+
+        finally:
+            NOTIFICATION_SECONDS.labels('discord', outcome).observe(time.perf_counter() - started)
 
         return response.status_code == 204
 
@@ -199,7 +223,7 @@ class Discorder:
         webhook_url = os.environ.get('DISCORD_WEBHOOK')
         discorder = Discorder(webhook_url)
 
-        return discorder
+        return FAULTS.wrap('discord', discorder) # Itself without fault injection
 
 
 ##-Test
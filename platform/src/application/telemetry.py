@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Ingestion of the node health metrics (telemetry).
+
+The nodes publish on `nodes/<node_id>/telemetry` a JSON object like:
+    {"rssi": int, "uptime": int, "free_heap": int, "rfid_errors": int}
+
+Samples are buffered in memory and written in batches (cf `BatchWriter`) into the
+MongoDB time-series collection `node_telemetry`, with `node_id` as metaField.
+
+With a downsampling interval (`min_interval_s`), the samples of a node are aggregated per interval
+into one record, stamped with the start of the interval:
+    - `samples`: the number of samples of the interval
+    - gauges (`rssi`, `free_heap`): the mean, and `<field>_min` / `<field>_max`
+    - counters since the boot of the node (`uptime`, `rfid_errors`): the last value
+An interval is written when the next sample of the node falls after it, or by a sweep of the idle
+nodes (on the samples of the other nodes, at most once per interval, and at stop).
+'''
+
+##-Imports
+import json
+import logging
+from datetime import datetime, timedelta
+from threading import Lock
+
+from src.services.batch_writer import BatchWriter
+
+##-Init
+logger = logging.getLogger(__name__)
+
+TELEMETRY_COLLECTION = 'node_telemetry'
+TELEMETRY_FIELDS = ('rssi', 'uptime', 'free_heap', 'rfid_errors')
+GAUGE_FIELDS = ('rssi', 'free_heap') # Aggregated as mean / min / max, the others keep their last value
+
+##-Downsampling
+class TelemetryInterval:
+    '''Aggregate of the samples of a node during one downsampling interval'''
+
+    def __init__(self, node_id: str, start: datetime):
+        self.node_id = node_id
+        self.start = start
+        self.samples = 0
+        self.last: dict[str, int] = {}
+        self.gauges: dict[str, list] = {} # field -> [sum, count, min, max]
+
+    def add(self, sample: dict):
+        '''Adds a sample (parsed fields only)'''
+
+        self.samples += 1
+
+        for field, value in sample.items():
+            if field in GAUGE_FIELDS:
+                gauge = self.gauges.get(field)
+                if gauge is None:
+                    self.gauges[field] = [value, 1, value, value]
+                else:
+                    gauge[0] += value
+                    gauge[1] += 1
+                    gauge[2] = min(gauge[2], value)
+                    gauge[3] = max(gauge[3], value)
+            else:
+                self.last[field] = value
+
+    def record(self) -> dict:
+        '''Gets the record of the interval'''
+
+        ret = {'timestamp': self.start, 'node_id': self.node_id, 'samples': self.samples, **self.last}
+
+        for field, (total, count, low, high) in self.gauges.items():
+            ret[field] = total / count
+            ret[f'{field}_min'] = low
+            ret[f'{field}_max'] = high
+
+        return ret
+
+##-Ingestion
+class TelemetryIngestion:
+    '''Receives the telemetry samples and writes them in batches'''
+
+    def __init__(self, app):
+        '''
+        Initiates the pipeline
+
+        In:
+            - app: the Flask app. Reads `app.config['TELEMETRY_CONFIG']` (cf `ConfigLoader.load_telemetry_config_env`)
+                   and `app.config['DB_SERVICE']` (when the first batch is written)
+        '''
+
+        self.app = app
+
+        config = app.config.get('TELEMETRY_CONFIG', {})
+        self.retention_days = config.get('retention_days', 30)
+        self.min_interval = timedelta(seconds=config.get('min_interval_s', 0))
+
+        self._intervals: dict[str, TelemetryInterval] = {} # node_id -> open interval (downsampling)
+        self._intervals_lock = Lock()
+        self._last_sweep = datetime.utcnow()
+        self._collection_ready = False
+
+        self.writer = BatchWriter(
+            'telemetry',
+            self._write,
+            batch_size=config.get('batch_size', 1000),
+            flush_period=config.get('flush_period_s', 2),
+        )
+
+        self.received = 0
+        self.rejected = 0
+
+    def start(self):
+        '''Starts the background writer'''
+
+        self.writer.start()
+
+    def stop(self):
+        '''Stops the background writer (flushes the open intervals and the remaining samples)'''
+
+        with self._intervals_lock:
+            for interval in self._intervals.values():
+                self.writer.add(interval.record())
+            self._intervals.clear()
+
+        self.writer.stop()
+
+    def ingest(self, node_id: str, payload: bytes):
+        '''
+        Handles one sample (called from the MQTT thread, does not touch the database).
+
+        In:
+            - node_id: the ID of the node
+            - payload: the raw MQTT payload
+        '''
+
+        self.received += 1
+        now = datetime.utcnow()
+
+        try:
+            data = json.loads(payload)
+            if not isinstance(data, dict):
+                raise TypeError('The telemetry is not a JSON object')
+
+            sample = {field: int(data[field]) for field in TELEMETRY_FIELDS if field in data}
+
+        except (ValueError, TypeError):
+            self.rejected += 1
+            return
+
+        if not self.min_interval:
+            self.writer.add({'timestamp': now, 'node_id': node_id, **sample})
+            return
+
+        # Downsampling
+        with self._intervals_lock:
+            interval = self._intervals.get(node_id)
+            if interval is not None and now - interval.start >= self.min_interval:
+                self.writer.add(interval.record())
+                interval = None
+
+            if interval is None:
+                interval = self._intervals[node_id] = TelemetryInterval(node_id, now)
+            interval.add(sample)
+
+            if now - self._last_sweep >= self.min_interval:
+                self._sweep(now)
+
+    def _sweep(self, now: datetime):
+        '''Writes the elapsed intervals of the nodes that stopped publishing (lock held)'''
+
+        self._last_sweep = now
+
+        for node_id, interval in list(self._intervals.items()):
+            if now - interval.start >= self.min_interval:
+                self.writer.add(interval.record())
+                del self._intervals[node_id]
+
+    def _write(self, samples: list[dict]):
+        '''Writes a batch of samples (called from the writer thread)'''
+
+        db_service = self.app.config['DB_SERVICE']
+
+        if not self._collection_ready:
+            db_service.ensure_timeseries_collection(
+                TELEMETRY_COLLECTION,
+                time_field='timestamp',
+                meta_field='node_id',
+                granularity='seconds',
+                expire_after_seconds=self.retention_days * 24 * 3600,
+            )
+            self._collection_ready = True
+
+        db_service.insert_records(TELEMETRY_COLLECTION, samples)
+
+    def stats(self) -> dict:
+        '''Gets the ingestion statistics'''
+
+        return {'received': self.received, 'rejected': self.rejected, 'open_intervals': len(self._intervals), **self.writer.stats()}
+
+
+def get_node_telemetry(db_service, node_id: str, start: datetime, end: datetime, limit: int = 10000) -> list[dict]:
+    '''
+    Gets the telemetry samples of a node in [start, end[.
+
+    In:
+        - db_service: the DB controller
+        - node_id: the ID of the node
+        - start, end: the time range
+        - limit: the maximum number of samples (the most recent ones)
+    Out:
+        The list of samples (most recent first), without `_id`
+    '''
+
+    return db_service.find_records(
+        TELEMETRY_COLLECTION,
+        {'node_id': node_id, 'timestamp': {'$gte': start, '$lt': end}},
+        projection={'_id': False},
+        sort=[('timestamp', -1)],
+        limit=limit,
+        unique=True,
+    )
@@ -1,10 +1,19 @@
 from typing import Dict, List, Optional
 from datetime import datetime
+import logging
 from bson import ObjectId
+from pymongo import UpdateOne
 from src.services.database_service import DatabaseService
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
 from src.digital_twin.core import DigitalTwin
 
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_COLLECTION = "dt_memberships"  # {dt_id, dr_type, dr_id, added_at}
+
+# Result of `DTFactory.execute_pipeline` for a service that does not run in the database
+NO_PIPELINE = object()
+
 
 class DTFactory:
     """Factory class for creating and managing Digital Twins"""
@@ -30,8 +39,7 @@ class DTFactory:
             "_id": str(ObjectId()),
             "name": name,
             "description": description,
-            "digital_replicas": [],  # List of DR references
-            "services": [],  # List of service references
+            "services": [],  # List of service references (DR references are in the membership collection)
             "metadata": {
                 "created_at": datetime.utcnow(),
                 "updated_at": datetime.utcnow(),
@@ -57,31 +65,194 @@ class DTFactory:
             dr_id: Digital Replica ID
         """
         try:
-            dt_collection = self.db_service.db["digital_twins"]
-
-            # Verify DR exists
-            dr = self.db_service.get_dr(dr_type, dr_id)
-            if not dr:
+            result = self.add_digital_replicas(dt_id, [{"type": dr_type, "id": dr_id}])
+            if result["missing"]:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
 
-            # Add DR reference
-            dt_collection.update_one(
-                {"_id": dt_id},
-                {
-                    "$push": {"digital_replicas": {"type": dr_type, "id": dr_id}},
-                    "$set": {"metadata.updated_at": datetime.utcnow()},
-                },
-            )
         except Exception as e:
             raise Exception(f"Failed to add Digital Replica: {str(e)}")
 
+    def add_digital_replicas(self, dt_id: str, dr_refs: List[Dict]) -> Dict:
+        """
+        Add several Digital Replica references to a Digital Twin (one query per DR type to check
+        that they exist, one bulk write to add them). References already in the DT are ignored.
+
+        Args:
+            dt_id: Digital Twin ID
+            dr_refs: References ({"type": ..., "id": ...})
+
+        Returns:
+            Dict: {"added": int, "missing": [references of the DRs not found]}
+        """
+        try:
+            if not self.get_dt(dt_id):
+                raise ValueError(f"Digital Twin not found: {dt_id}")
+
+            refs_by_type = self._group_refs(dr_refs)
+
+            # Verify DRs exist
+            existing = set()
+            for dr_type, ids in refs_by_type.items():
+                for dr in self.db_service.get_drs(dr_type, ids, {"_id": 1}):
+                    existing.add((dr_type, dr["_id"]))
+
+            now = datetime.utcnow()
+            operations = [
+                UpdateOne(
+                    {"dt_id": dt_id, "dr_type": dr_type, "dr_id": dr_id},
+                    {"$setOnInsert": {"added_at": now}},
+                    upsert=True,
+                )
+                for dr_type, dr_id in existing
+            ]
+
+            added = 0
+            if operations:
+                result = self.db_service.db[MEMBERSHIP_COLLECTION].bulk_write(operations, ordered=False)
+                added = result.upserted_count
+
+            if added:
+                self._touch(dt_id)
+
+            missing = [
+                {"type": dr_type, "id": dr_id}
+                for dr_type, ids in refs_by_type.items()
+                for dr_id in ids
+                if (dr_type, dr_id) not in existing
+            ]
+
+            return {"added": added, "missing": missing}
+
+        except Exception as e:
+            raise Exception(f"Failed to add Digital Replicas: {str(e)}")
+
+    def remove_digital_replicas(self, dt_id: str, dr_refs: List[Dict]) -> int:
+        """
+        Remove Digital Replica references from a Digital Twin (one query per DR type)
+
+        Args:
+            dt_id: Digital Twin ID
+            dr_refs: References ({"type": ..., "id": ...})
+
+        Returns:
+            int: Number of references removed
+        """
+        try:
+            memberships = self.db_service.db[MEMBERSHIP_COLLECTION]
+
+            removed = 0
+            for dr_type, ids in self._group_refs(dr_refs).items():
+                result = memberships.delete_many({"dt_id": dt_id, "dr_type": dr_type, "dr_id": {"$in": ids}})
+                removed += result.deleted_count
+
+            if removed:
+                self._touch(dt_id)
+
+            return removed
+
+        except Exception as e:
+            raise Exception(f"Failed to remove Digital Replicas: {str(e)}")
+
+    def list_digital_replicas(
+        self, dt_id: str, dr_type: str = None, page: int = 0, page_size: int = 100
+    ) -> List[Dict]:
+        """
+        List the Digital Replica references of a Digital Twin, one page at a time
+        (sorted by type then ID, served by the membership index)
+
+        Args:
+            dt_id: Digital Twin ID
+            dr_type: Only list this type of DR (all if None)
+            page: Page number (from 0)
+            page_size: Number of references per page
+
+        Returns:
+            List[Dict]: References ({"type": ..., "id": ...})
+        """
+        try:
+            query = {"dt_id": dt_id}
+            if dr_type is not None:
+                query["dr_type"] = dr_type
+
+            cursor = (
+                self.db_service.db[MEMBERSHIP_COLLECTION]
+                .find(query, {"_id": 0, "dr_type": 1, "dr_id": 1})
+                .sort([("dr_type", 1), ("dr_id", 1)])
+                .skip(page * page_size)
+                .limit(page_size)
+            )
+            return [{"type": m["dr_type"], "id": m["dr_id"]} for m in cursor]
+
+        except Exception as e:
+            raise Exception(f"Failed to list Digital Replicas: {str(e)}")
+
+    def get_dt_members(self, dt_id: str) -> Dict[str, List[str]]:
+        """
+        Get all the Digital Replica IDs of a Digital Twin, per type
+
+        Returns:
+            Dict[str, List[str]]: dr_type -> DR IDs
+        """
+        try:
+            members: Dict[str, List[str]] = {}
+            cursor = (
+                self.db_service.db[MEMBERSHIP_COLLECTION]
+                .find({"dt_id": dt_id}, {"_id": 0, "dr_type": 1, "dr_id": 1})
+                .sort([("dr_type", 1), ("dr_id", 1)])
+            )
+            for m in cursor:
+                members.setdefault(m["dr_type"], []).append(m["dr_id"])
+
+            return members
+
+        except Exception as e:
+            raise Exception(f"Failed to get Digital Twin members: {str(e)}")
+
+    def count_dt_members(self, dt_ids: List[str] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Count the Digital Replicas of Digital Twins, per type (computed server side)
+
+        Args:
+            dt_ids: Digital Twin IDs (all if None)
+
+        Returns:
+            Dict[str, Dict[str, int]]: dt_id -> dr_type -> count
+        """
+        pipeline = []
+        if dt_ids is not None:
+            pipeline.append({"$match": {"dt_id": {"$in": dt_ids}}})
+        pipeline.append({"$group": {"_id": {"dt_id": "$dt_id", "dr_type": "$dr_type"}, "count": {"$sum": 1}}})
+
+        counts: Dict[str, Dict[str, int]] = {}
+        for row in self.db_service.db[MEMBERSHIP_COLLECTION].aggregate(pipeline):
+            counts.setdefault(row["_id"]["dt_id"], {})[row["_id"]["dr_type"]] = row["count"]
+
+        return counts
+
+    @staticmethod
+    def _group_refs(dr_refs: List[Dict]) -> Dict[str, List[str]]:
+        """Group DR references by type"""
+        refs_by_type: Dict[str, List[str]] = {}
+        for dr_ref in dr_refs:
+            refs_by_type.setdefault(dr_ref["type"], []).append(dr_ref["id"])
+
+        return refs_by_type
+
+    def _touch(self, dt_id: str) -> None:
+        """Update `metadata.updated_at` of a Digital Twin"""
+        self.db_service.db["digital_twins"].update_one(
+            {"_id": dt_id}, {"$set": {"metadata.updated_at": datetime.utcnow()}}
+        )
+
     def _get_service_module_mapping(self) -> Dict[str, str]:
         """
         Returns a mapping of service names to their module paths
         """
         return {
             "AggregationService": "src.services.analytics",
-            "TemperaturePredictionService": "src.services.TemperaturePredictionService",
+            "OccupancyService": "src.services.occupancy",
+            "OccupancyForecastService": "src.services.forecasting",
+            "SimulationService": "src.services.simulation",
         }
 
     def add_service(
@@ -154,6 +325,19 @@ class DTFactory:
         except Exception as e:
             raise Exception(f"Failed to get Digital Twin: {str(e)}")
 
+    def get_dt_version(self, dt_id: str) -> Optional[datetime]:
+        """
+        Get `metadata.updated_at` of a Digital Twin (updated when its services or DR memberships change)
+
+        Returns:
+            Optional[datetime]: The version, None if the Digital Twin does not exist
+        """
+        try:
+            dt_data = self.db_service.db["digital_twins"].find_one({"_id": dt_id}, {"metadata.updated_at": 1})
+            return dt_data.get("metadata", {}).get("updated_at") if dt_data else None
+        except Exception as e:
+            raise Exception(f"Failed to get Digital Twin: {str(e)}")
+
     # def get_dt_by_name(self, name: str) -> Optional[Dict]:
     #     """
     #     Get a Digital Twin by name
@@ -172,14 +356,22 @@ class DTFactory:
 
     def list_dts(self) -> List[Dict]:
         """
-        List all Digital Twins
+        List all Digital Twins, as lightweight summaries
 
         Returns:
-            List[Dict]: List of Digital Twins
+            List[Dict]: {_id, name, description, services (names), metadata, nb_digital_replicas, digital_replicas_by_type}
         """
         try:
             dt_collection = self.db_service.db["digital_twins"]
-            return list(dt_collection.find())
+            dts = list(dt_collection.find({}, {"name": 1, "description": 1, "services.name": 1, "metadata": 1}))
+            counts = self.count_dt_members()
+
+            for dt in dts:
+                dt["services"] = [service["name"] for service in dt.get("services", [])]
+                dt["digital_replicas_by_type"] = counts.get(dt["_id"], {})
+                dt["nb_digital_replicas"] = sum(dt["digital_replicas_by_type"].values())
+
+            return dts
         except Exception as e:
             raise Exception(f"Failed to list Digital Twins: {str(e)}")
 
@@ -282,83 +474,224 @@ class DTFactory:
     #         raise Exception(f"Failed to remove service: {str(e)}")
 
     def _init_dt_collection(self) -> None:
-        """Initialize the Digital Twin collection in MongoDB"""
+        """Initialize the Digital Twin and membership collections in MongoDB"""
         if not self.db_service.is_connected():
             raise ConnectionError("Database service not connected")
 
         try:
             db = self.db_service.db
-            if "digital_twins" not in db.list_collection_names():
+            collections = db.list_collection_names()
+
+            if "digital_twins" not in collections:
                 db.create_collection("digital_twins")
                 dt_collection = db["digital_twins"]
                 dt_collection.create_index("name", unique=True)
                 dt_collection.create_index("metadata.created_at")
                 dt_collection.create_index("metadata.updated_at")
+
+            if MEMBERSHIP_COLLECTION not in collections:
+                db.create_collection(MEMBERSHIP_COLLECTION)
+                memberships = db[MEMBERSHIP_COLLECTION]
+                memberships.create_index([("dt_id", 1), ("dr_type", 1), ("dr_id", 1)], unique=True)
+                memberships.create_index([("dr_type", 1), ("dr_id", 1)])  # DTs of a DR
+
+            self._migrate_embedded_replicas()
+
         except Exception as e:
             raise Exception(f"Failed to initialize DT collection: {str(e)}")
 
-    def create_dt_from_data(self, dt_data: dict) -> DigitalTwin:
+    def _migrate_embedded_replicas(self) -> None:
+        """Move the DR references still embedded in DT documents (`digital_replicas` array) to the membership collection"""
+        db = self.db_service.db
+
+        for dt in db["digital_twins"].find({"digital_replicas": {"$exists": True}}, {"digital_replicas": 1}):
+            operations = [
+                UpdateOne(
+                    {"dt_id": dt["_id"], "dr_type": dr_ref["type"], "dr_id": dr_ref["id"]},
+                    {"$setOnInsert": {"added_at": datetime.utcnow()}},
+                    upsert=True,
+                )
+                for dr_ref in dt["digital_replicas"]
+            ]
+            if operations:
+                db[MEMBERSHIP_COLLECTION].bulk_write(operations, ordered=False)
+
+            db["digital_twins"].update_one({"_id": dt["_id"]}, {"$unset": {"digital_replicas": ""}})
+            logger.info("Migrated %d DR references of DT %s", len(operations), dt["_id"])
+
+    def create_dt_from_data(
+        self,
+        dt_data: dict,
+        projection: Optional[Dict] = None,
+        members: Optional[Dict[str, List[str]]] = None,
+    ) -> DigitalTwin:
         """
-        Create a DigitalTwin instance from database data with enhanced debugging
+        Create a DigitalTwin instance from database data
+
+        The DRs are loaded with one `$in` query per DR type (not one query per DR).
+
+        Args:
+            dt_data: Digital Twin data (as returned by `get_dt`)
+            projection: Fields of the DRs to load (all if None). `_id` and `type` are always loaded.
+            members: DR IDs per type (as returned by `get_dt_members`), read from the database if None
         """
-        print("\n=== Creating DT Instance ===")
+        logger.debug("Creating DT instance for %s", dt_data.get("name", "unnamed"))
+
         try:
-            # Create new DT instance
             dt = DigitalTwin()
-            print(f"Created new DT instance for {dt_data.get('name', 'unnamed')}")
 
             # Add Digital Replicas
-            for dr_ref in dt_data.get("digital_replicas", []):
-                dr = self.db_service.get_dr(dr_ref["type"], dr_ref["id"])
-                if dr:
-                    dt.add_digital_replica(dr)
-                    print(f"Added DR: {dr_ref['type']} - {dr_ref['id']}")
-
-            # Add Services
-            print("\nLoading services...")
-            service_mapping = self._get_service_module_mapping()
-            print(f"Service mapping: {service_mapping}")
+            dr_ids = members if members is not None else self.get_dt_members(dt_data["_id"])
 
-            for service_data in dt_data.get("services", []):
-                service_name = service_data["name"]
-                print(f"\nProcessing service: {service_name}")
+            if projection is not None:
+                projection = {**projection, "type": 1}
 
-                if service_name in service_mapping:
-                    try:
-                        module_name = service_mapping[service_name]
-                        print(f"Loading module: {module_name}")
+            loaded: Dict[tuple, Dict] = {}
+            for dr_type, ids in dr_ids.items():
+                drs = self.db_service.get_drs(dr_type, ids, projection)
+                for dr in drs:
+                    loaded[(dr_type, dr["_id"])] = dr
 
-                        service_module = __import__(
-                            module_name, fromlist=[service_name]
-                        )
-                        print(f"Module loaded successfully")
+                logger.debug("Loaded %d/%d DRs of type %s", len(drs), len(ids), dr_type)
 
-                        service_class = getattr(service_module, service_name)
-                        print(f"Got service class: {service_class}")
+            # Keep the order of the references
+            for dr_type, ids in dr_ids.items():
+                for dr_id in ids:
+                    dr = loaded.get((dr_type, dr_id))
+                    if dr:
+                        dt.add_digital_replica(dr)
+                    else:
+                        logger.warning("DR not found: %s - %s", dr_type, dr_id)
 
-                        service = service_class()
-                        print(f"Service instance created")
+            # Add Services
+            for service_data in dt_data.get("services", []):
+                service_name = service_data["name"]
 
-                        if hasattr(service, "configure") and "config" in service_data:
-                            service.configure(service_data["config"])
-                            print(f"Service configured with: {service_data['config']}")
+                try:
+                    dt.add_service(self._instantiate_service(service_data))
+                    logger.debug("Service %s added (config: %s)", service_name, service_data.get("config"))
 
-                        dt.add_service(service)
-                        print(f"Service added to DT")
-                        print(f"Current DT services: {dt.list_services()}")
-                    except Exception as e:
-                        print(f"Error adding service {service_name}: {str(e)}")
-                        print(f"Exception type: {type(e)}")
-                else:
-                    print(f"Warning: Service {service_name} not found in mapping")
+                except Exception as e:
+                    logger.error("Error adding service %s: %s: %s", service_name, type(e).__name__, e)
 
             return dt
 
         except Exception as e:
-            print(f"Error creating DT: {str(e)}")
-            print(f"Exception type: {type(e)}")
+            logger.error("Error creating DT: %s: %s", type(e).__name__, e)
             raise Exception(f"Failed to create DT from data: {str(e)}")
 
+    def _instantiate_service(self, service_data: Dict):
+        """
+        Instantiate and configure a service from its reference in a Digital Twin
+
+        Args:
+            service_data: Service reference ({"name": ..., "config": ...})
+        """
+        service_name = service_data["name"]
+        service_mapping = self._get_service_module_mapping()
+
+        if service_name not in service_mapping:
+            raise ValueError(f"Service {service_name} not configured in module mapping")
+
+        service_module = __import__(service_mapping[service_name], fromlist=[service_name])
+        service = getattr(service_module, service_name)()
+
+        if hasattr(service, "configure") and "config" in service_data:
+            service.configure(service_data["config"])
+
+        service.limits = service_data.get("config", {}).get("limits", {})
+
+        return service
+
+    def execute_service(
+        self,
+        dt_data: Dict,
+        service_name: str,
+        dr_type: str = None,
+        attribute: str = None,
+        **kwargs,
+    ):
+        """
+        Execute a service of a Digital Twin.
+
+        When the service compiles to a MongoDB pipeline (cf `BaseService.build_pipeline`), it runs
+        server side on the collections of the DRs referenced by the DT, and only the aggregated rows
+        are transferred. Otherwise, the DT is loaded in memory and the service runs in Python.
+
+        Args:
+            dt_data: Digital Twin data (as returned by `get_dt`)
+            service_name: Name of a service added to the DT
+            dr_type: Type of DR to process
+            attribute: Specific attribute to analyze
+            **kwargs: Additional service parameters
+
+        Returns:
+            The service result
+        """
+        service_data = next(
+            (s for s in dt_data.get("services", []) if s["name"] == service_name), None
+        )
+        if service_data is None:
+            raise ValueError(f"Service {service_name} not found")
+
+        service = self._instantiate_service(service_data)
+        members = self.get_dt_members(dt_data["_id"])
+
+        result = self.execute_pipeline(service, members, dr_type, attribute, **kwargs)
+        if result is not NO_PIPELINE:
+            return result
+
+        # Python fallback, on the DRs loaded in memory (only the fields the service reads)
+        dt = self.create_dt_from_data(dt_data, projection=service.dr_projection, members=members)
+        return dt.execute_service(service_name, dr_type=dr_type, attribute=attribute, **kwargs)
+
+    def execute_pipeline(
+        self,
+        service,
+        members: Dict[str, List[str]],
+        dr_type: str = None,
+        attribute: str = None,
+        **kwargs,
+    ):
+        """
+        Execute a service server side, if it compiles to a MongoDB pipeline on the collections of the
+        DRs of the Digital Twin (cf `BaseService.build_pipeline`)
+
+        Args:
+            service: Configured service instance
+            members: DR IDs of the Digital Twin, per type (as returned by `get_dt_members`)
+            dr_type: Type of DR to process
+            attribute: Specific attribute to analyze
+            **kwargs: Additional service parameters
+
+        Returns:
+            The service result, `NO_PIPELINE` if the service does not run in the database (or not in the
+            storage backend)
+        """
+        dr_ids = {
+            ref_type: ids for ref_type, ids in members.items() if dr_type is None or ref_type == dr_type
+        }
+
+        pipelines = {
+            ref_type: service.build_pipeline(ids, ref_type, attribute, **kwargs)
+            for ref_type, ids in dr_ids.items()
+        }
+
+        if not pipelines or any(pipeline is None for pipeline in pipelines.values()):
+            return NO_PIPELINE
+
+        try:
+            results = {
+                ref_type: self.db_service.aggregate_drs(ref_type, pipeline)
+                for ref_type, pipeline in pipelines.items()
+            }
+        except NotImplementedError as e:
+            # Embedded storage backend (e.g `$percentile` in memory or in SQLite): the service runs in Python
+            logger.debug("%s runs in Python: %s", service.name, e)
+            return NO_PIPELINE
+
+        return service.reduce_pipeline_results(results)
+
     def get_dt_instance(self, dt_id: str) -> Optional[DigitalTwin]:
         """
         Get a fully initialized DigitalTwin instance by ID
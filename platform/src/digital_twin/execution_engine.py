@@ -0,0 +1,324 @@
+from typing import Dict, List, Optional
+from multiprocessing.connection import Connection
+from queue import Queue, Empty
+from threading import BoundedSemaphore, Event, Lock
+import logging
+import os
+import subprocess
+import sys
+import time
+import uuid
+from src.digital_twin.core import DigitalTwin
+from src.services.metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Directory from which `src.` is importable (the platform directory)
+_PLATFORM_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ExecutionCancelled(RuntimeError):
+    """Raised by `ServiceExecutionEngine.execute` when the execution was cancelled"""
+
+
+class _Worker:
+    """A worker interpreter (cf `execution_worker`) and its pipes"""
+
+    def __init__(self):
+        task_r, task_w = os.pipe()
+        result_r, result_w = os.pipe()
+
+        env = {**os.environ, "OPENBLAS_NUM_THREADS": "1", "OMP_NUM_THREADS": "1"}
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "src.digital_twin.execution_worker", str(task_r), str(result_w)],
+            pass_fds=(task_r, result_w),
+            cwd=_PLATFORM_DIR,
+            env=env,
+        )
+        os.close(task_r)
+        os.close(result_w)
+
+        self.tasks = Connection(task_w, readable=False)
+        self.results = Connection(result_r, writable=False)
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.wait()
+        self.tasks.close()
+        self.results.close()
+
+
+class ServiceExecutionEngine:
+    """
+    Runs the CPU-bound Digital Twin services in a pool of worker processes, so they neither block
+    the request thread nor hold the GIL of the Flask worker.
+
+    A service runs in the pool when it implements the columnar interface (`to_columns` /
+    `execute_columns`): the DRs are converted in the Flask worker to a few NumPy arrays, which are
+    sent to the worker process as flat buffers (instead of pickling the DR dicts). Other services
+    run inline, as before.
+
+    Per service (configuration of the service in the DT, `limits` entry, or engine defaults):
+        - timeout_s: the worker is killed (and replaced) when the execution takes longer. The time limit
+          starts with the call: the waits for a slot and a worker, and the conversion to columns count in it
+        - memory_mb: memory the execution may allocate in the worker (MemoryError above)
+    Per service name, at most `max_concurrency` executions run at the same time in this process.
+    Running executions can be cancelled (`cancel`).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        timeout_s: float = 30.0,
+        memory_mb: int = 512,
+        max_concurrency: int = 2,
+        queue_timeout_s: float = 5.0,
+    ):
+        """
+        Args:
+            max_workers: Number of worker processes
+            timeout_s: Default time limit of an execution
+            memory_mb: Default memory limit of an execution
+            max_concurrency: Maximum number of concurrent executions of one service
+            queue_timeout_s: Maximum wait for a free worker / concurrency slot before rejecting
+        """
+        self.max_workers = max_workers
+        self.timeout_s = timeout_s
+        self.memory_mb = memory_mb
+        self.max_concurrency = max_concurrency
+        self.queue_timeout_s = queue_timeout_s
+
+        self._idle: "Queue[_Worker]" = Queue()
+        self._nb_workers = 0
+        self._workers_lock = Lock()
+
+        self._slots: Dict[str, BoundedSemaphore] = {}
+        self._running: Dict[str, Dict] = {}  # execution_id -> {service, dt_started, cancel}
+        self._metrics: Dict[str, Dict] = {}
+        self._lock = Lock()
+        self._running_metric = QUEUE_DEPTH.labels("dt_executions")
+
+    def execute(self, dt: DigitalTwin, service_name: str, **kwargs):
+        """
+        Execute a service of a Digital Twin (in the pool when the service supports it)
+
+        Raises:
+            ValueError: The service is not in the DT
+            TimeoutError: The execution exceeded its time limit
+            MemoryError: The execution exceeded its memory limit
+            ExecutionCancelled: The execution was cancelled
+            RuntimeError: The execution failed, or too many executions are running
+        """
+        if service_name not in dt.active_services:
+            raise ValueError(f"Service {service_name} not found")
+
+        service = dt.active_services[service_name]
+
+        if not hasattr(service, "execute_columns"):
+            return self._measure(service_name, lambda: dt.execute_service(service_name, **kwargs))
+
+        limits = getattr(service, "limits", {}) or {}
+        timeout_s = float(limits.get("timeout_s", self.timeout_s))
+        memory_mb = int(limits.get("memory_mb", self.memory_mb))
+        deadline = time.monotonic() + timeout_s
+
+        slot = self._slot(service_name)
+        if not slot.acquire(timeout=self.queue_timeout_s):
+            self._count(service_name, "rejected")
+            raise RuntimeError(f"Too many concurrent executions of {service_name}")
+
+        try:
+            return self._measure(
+                service_name,
+                lambda: self._run_in_worker(dt, service, service_name, kwargs, timeout_s, deadline, memory_mb),
+            )
+
+        finally:
+            slot.release()
+
+    def cancel(self, execution_id: str) -> bool:
+        """
+        Cancel a running execution (its worker is killed)
+
+        Returns:
+            bool: False if the execution is not running
+        """
+        with self._lock:
+            execution = self._running.get(execution_id)
+
+        if execution is None:
+            return False
+
+        execution["cancel"].set()
+        return True
+
+    def running(self) -> List[Dict]:
+        """Get the executions running in the pool"""
+        now = time.time()
+        with self._lock:
+            return [
+                {"execution_id": execution_id, "service": e["service"], "elapsed_s": now - e["started"]}
+                for execution_id, e in self._running.items()
+            ]
+
+    def stats(self) -> Dict:
+        """Get the metrics per service"""
+        with self._lock:
+            return {
+                "workers": self._nb_workers,
+                "idle_workers": self._idle.qsize(),
+                "services": {name: dict(metrics) for name, metrics in self._metrics.items()},
+            }
+
+    def shutdown(self) -> None:
+        """Stop the idle workers"""
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except Empty:
+                break
+
+            worker.kill()
+            with self._workers_lock:
+                self._nb_workers -= 1
+
+    def _slot(self, service_name: str) -> BoundedSemaphore:
+        with self._lock:
+            if service_name not in self._slots:
+                self._slots[service_name] = BoundedSemaphore(self.max_concurrency)
+            return self._slots[service_name]
+
+    def _count(self, service_name: str, counter: str, value: float = 1) -> None:
+        with self._lock:
+            metrics = self._metrics.setdefault(service_name, {
+                "executions": 0, "errors": 0, "timeouts": 0, "memory_errors": 0, "cancelled": 0,
+                "rejected": 0, "total_s": 0.0, "max_s": 0.0, "max_rss_mb": 0.0,
+            })
+            if counter in ("max_s", "max_rss_mb"):
+                metrics[counter] = max(metrics[counter], value)
+            else:
+                metrics[counter] += value
+
+    def _measure(self, service_name: str, run):
+        """Run `run()` and record its duration and outcome"""
+        started = time.perf_counter()
+
+        try:
+            result = run()
+
+        except TimeoutError:
+            self._count(service_name, "timeouts")
+            raise
+        except MemoryError:
+            self._count(service_name, "memory_errors")
+            raise
+        except ExecutionCancelled:
+            self._count(service_name, "cancelled")
+            raise
+        except Exception:
+            self._count(service_name, "errors")
+            raise
+
+        finally:
+            duration = time.perf_counter() - started
+            self._count(service_name, "executions")
+            self._count(service_name, "total_s", duration)
+            self._count(service_name, "max_s", duration)
+
+        return result
+
+    def _acquire_worker(self, timeout: float) -> _Worker:
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._workers_lock:
+            if self._nb_workers < self.max_workers:
+                self._nb_workers += 1
+                spawn = True
+            else:
+                spawn = False
+
+        if spawn:
+            try:
+                return _Worker()
+            except Exception:
+                with self._workers_lock:
+                    self._nb_workers -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except Empty:
+            raise RuntimeError("No execution worker available")
+
+    def _discard_worker(self, worker: _Worker) -> None:
+        worker.kill()
+        with self._workers_lock:
+            self._nb_workers -= 1
+
+    def _run_in_worker(
+        self, dt: DigitalTwin, service, service_name: str, kwargs: Dict, timeout_s: float, deadline: float, memory_mb: int
+    ):
+        # The deadline is checked before each step, so an expired execution does no more work
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"{service_name} exceeded its time limit ({timeout_s} s) before it started")
+
+        columns = service.to_columns(dt.get_dt_data(), **kwargs)
+        kwargs = {key: value for key, value in kwargs.items() if key not in service.context_params}
+
+        try:
+            worker = self._acquire_worker(max(0.0, min(self.queue_timeout_s, deadline - time.monotonic())))
+        except RuntimeError:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"{service_name} exceeded its time limit ({timeout_s} s) waiting for a worker")
+            raise
+
+        if time.monotonic() >= deadline:
+            self._idle.put(worker)
+            raise TimeoutError(f"{service_name} exceeded its time limit ({timeout_s} s) before it started")
+
+        execution_id = str(uuid.uuid4())
+        cancel = Event()
+        with self._lock:
+            self._running[execution_id] = {"service": service_name, "started": time.time(), "cancel": cancel}
+            self._running_metric.set(len(self._running))
+
+        try:
+            try:
+                worker.tasks.send((service, columns, kwargs, memory_mb))
+            except OSError as e:
+                self._discard_worker(worker)
+                raise RuntimeError(f"Execution worker died: {e}")
+
+            while not worker.results.poll(max(0.0, min(0.05, deadline - time.monotonic()))):
+                if cancel.is_set() or time.monotonic() >= deadline or worker.process.poll() is not None:
+                    self._discard_worker(worker)
+
+                    if cancel.is_set():
+                        raise ExecutionCancelled(f"Execution of {service_name} cancelled")
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"{service_name} exceeded its time limit ({timeout_s} s)")
+                    raise RuntimeError("Execution worker died")
+
+            try:
+                status, payload, max_rss_mb = worker.results.recv()
+            except (EOFError, OSError) as e:
+                self._discard_worker(worker)
+                raise RuntimeError(f"Execution worker died: {e}")
+
+            self._idle.put(worker)
+            self._count(service_name, "max_rss_mb", max_rss_mb)
+
+            if status == "memory":
+                raise MemoryError(f"{service_name}: {payload}")
+            if status == "error":
+                raise RuntimeError(f"{service_name} failed: {payload}")
+
+            return payload
+
+        finally:
+            with self._lock:
+                del self._running[execution_id]
+                self._running_metric.set(len(self._running))
@@ -0,0 +1,77 @@
+"""
+Worker process of the `ServiceExecutionEngine`.
+
+Started as `python -m src.digital_twin.execution_worker <read_fd> <write_fd>`: a fresh interpreter
+(nothing inherited from the Flask worker: threads, sockets, locks), that receives tasks on one pipe
+and sends the results on the other.
+
+Task:    (service, columns, kwargs, memory_mb)   # `service` is the configured service instance
+Result:  (status, payload, max_rss_mb)           # status: "ok" | "memory" | "error"
+"""
+
+import os
+import resource
+import sys
+from multiprocessing.connection import Connection
+
+
+def _address_space() -> int:
+    """Current virtual memory size of the process (bytes)"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmSize:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _set_memory_limit(memory_mb: int) -> None:
+    """Allow `memory_mb` more of address space than currently used (0: no limit)"""
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+
+    if memory_mb:
+        limit = _address_space() + memory_mb * 1024 * 1024
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+    else:
+        limit = hard
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(read_fd: int, write_fd: int) -> None:
+    tasks = Connection(read_fd, writable=False)
+    results = Connection(write_fd, readable=False)
+
+    while True:
+        try:
+            task = tasks.recv()
+        except (EOFError, OSError):
+            break
+
+        try:
+            service, columns, kwargs, memory_mb = task
+            _set_memory_limit(memory_mb)
+
+            try:
+                result = service.execute_columns(columns, **kwargs)
+            finally:
+                _set_memory_limit(0)
+
+            results.send(("ok", result, _max_rss_mb()))
+
+        except MemoryError:
+            _set_memory_limit(0)
+            results.send(("memory", f"memory limit exceeded ({memory_mb} MB)", _max_rss_mb()))
+
+        except Exception as e:
+            results.send(("error", f"{type(e).__name__}: {e}", _max_rss_mb()))
+
+
+if __name__ == "__main__":
+    # One BLAS thread per worker: the engine already runs several workers
+    os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+    main(int(sys.argv[1]), int(sys.argv[2]))
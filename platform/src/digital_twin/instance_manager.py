@@ -0,0 +1,404 @@
+from typing import Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock, Thread, Event
+import logging
+import time
+from src.digital_twin.core import DigitalTwin
+from src.digital_twin.dt_factory import DTFactory, MEMBERSHIP_COLLECTION, NO_PIPELINE
+from src.digital_twin.execution_engine import ServiceExecutionEngine
+
+logger = logging.getLogger(__name__)
+
+# Margin on the `metadata.updated_at` of the DRs written by other processes (clocks of the hosts)
+CLOCK_SKEW = timedelta(seconds=5)
+
+
+class _LiveDT:
+    """A hydrated Digital Twin and the DRs to reload before its next use"""
+
+    def __init__(self, dt_data: Dict, dt: DigitalTwin, members: Dict[str, List[str]], loaded_at: datetime):
+        self.dt_data = dt_data
+        self.dt = dt
+        self.members = members  # dr_type -> DR IDs
+
+        # (dr_type, dr_id) -> DR, in the order of the references
+        self.replicas: Dict[Tuple[str, str], Dict] = OrderedDict(
+            ((dr["type"], dr["_id"]), dr) for dr in dt.digital_replicas
+        )
+        self.dr_types: Set[str] = set(members)
+
+        self.dirty_ids: Dict[str, Set[str]] = {}  # dr_type -> IDs modified since the last refresh
+        self.stale_types: Set[str] = set()        # DR types modified by query (unknown IDs)
+        self.refresh_lock = Lock()
+
+        # Last check of the writes of the other processes (cf `DTInstanceManager._revalidate`)
+        self.validated_at = time.monotonic()
+        self.validated_since = loaded_at  # DRs updated since then (database clock) are reloaded
+
+    def is_dirty(self) -> bool:
+        return bool(self.dirty_ids or self.stale_types)
+
+
+class DTInstanceManager:
+    """
+    Keeps hydrated `DigitalTwin` instances (DRs loaded, services instantiated and configured)
+    in memory, with LRU eviction, and keeps them up to date incrementally.
+
+    DR changes come from the writes made through the `DatabaseService` of this process
+    (cf `DatabaseService.add_change_listener`) and, optionally, from a MongoDB change stream
+    (writes made by other processes, e.g the other workers or the MQTT gateway; needs a replica set).
+    A change only marks the DR as dirty: the modified DRs are reloaded in one `$in` query per type
+    when the DT is next used.
+
+    Without change stream, an instance older than `max_age_s` is revalidated when used: the DT is rebuilt
+    if its version (`metadata.updated_at`) changed, and the DRs updated since the last check are reloaded.
+
+    The services compiling to a pipeline run in the database whether the DT is resident or not
+    (cf `DTFactory.execute_pipeline`), the instances only serve the services running in Python.
+    """
+
+    def __init__(
+        self,
+        dt_factory: DTFactory,
+        max_instances: int = 32,
+        watch_changes: bool = False,
+        engine: Optional[ServiceExecutionEngine] = None,
+        max_age_s: float = 5.0,
+    ):
+        """
+        Args:
+            dt_factory: Factory used to load the Digital Twins
+            max_instances: Maximum number of resident Digital Twins (0: no residency, services run
+                           through `DTFactory.execute_service`)
+            watch_changes: Also follow the DR changes made by other processes (MongoDB change stream)
+            engine: Runs the services out of the request thread (inline if None)
+            max_age_s: Age (s) above which an instance is checked against the writes of the other processes,
+                       when they are not followed by a change stream
+        """
+        self.dt_factory = dt_factory
+        self.engine = engine
+        self.db_service = dt_factory.db_service
+        self.max_instances = max_instances
+        self.watch_changes = watch_changes
+        self.max_age_s = max_age_s
+
+        self._instances: "OrderedDict[str, _LiveDT]" = OrderedDict()
+        self._dr_index: Dict[Tuple[str, str], Set[str]] = {}  # (dr_type, dr_id) -> resident DT IDs
+        self._lock = Lock()
+
+        self._stopping = Event()
+        self._watch_thread: Optional[Thread] = None
+        self._watching = False  # The change stream is followed
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
+        self.db_service.add_change_listener(self.on_dr_change)
+
+    def start(self) -> None:
+        """Start following the change stream (if enabled)"""
+        if self.watch_changes and self.max_instances and self._watch_thread is None:
+            self._stopping.clear()
+            self._watching = True
+            self._watch_thread = Thread(target=self._watch_loop, name="dt_change_stream", daemon=True)
+            self._watch_thread.start()
+
+    def stop(self) -> None:
+        """Stop following the change stream"""
+        self._stopping.set()
+        self._watching = False
+        self._watch_thread = None
+
+    def get(self, dt_id: str) -> Optional[DigitalTwin]:
+        """
+        Get the live instance of a Digital Twin (hydrated on first use, refreshed if DRs changed)
+
+        Returns:
+            Optional[DigitalTwin]: The instance, None if the Digital Twin does not exist
+        """
+        live = self._get_live(dt_id)
+        return live.dt if live is not None else None
+
+    def _get_live(self, dt_id: str, dt_data: Optional[Dict] = None, members: Optional[Dict] = None) -> Optional[_LiveDT]:
+        """The up to date instance of a Digital Twin (`dt_data` and `members`: already loaded, for a miss)"""
+        live = self._resident(dt_id)
+
+        if live is not None and not self._watching and time.monotonic() - live.validated_at > self.max_age_s:
+            live = self._revalidate(dt_id, live)
+
+        if live is None:
+            loaded_at = datetime.utcnow()
+            dt_data = dt_data or self.dt_factory.get_dt(dt_id)
+            if not dt_data:
+                return None
+
+            members = members if members is not None else self.dt_factory.get_dt_members(dt_id)
+            live = _LiveDT(dt_data, self.dt_factory.create_dt_from_data(dt_data, members=members), members, loaded_at)
+            live = self._insert(dt_id, live)
+
+        if live.is_dirty():
+            self._refresh(live)
+
+        return live
+
+    def _resident(self, dt_id: str) -> Optional[_LiveDT]:
+        """The resident instance of a Digital Twin (counted as a hit or a miss), as is"""
+        with self._lock:
+            live = self._instances.get(dt_id)
+            if live is not None:
+                self._instances.move_to_end(dt_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return live
+
+    def execute_service(self, dt_id: str, service_name: str, **kwargs):
+        """
+        Execute a service of a Digital Twin: in the database if it compiles to a pipeline,
+        otherwise on the live instance of the DT
+
+        Args:
+            dt_id: Digital Twin ID
+            service_name: Name of a service added to the DT
+            **kwargs: Service parameters (dr_type, attribute, ...)
+
+        Raises:
+            LookupError: The Digital Twin does not exist
+        """
+        if not self.max_instances:
+            dt_data = self.dt_factory.get_dt(dt_id)
+            if not dt_data:
+                raise LookupError(f"Digital Twin not found: {dt_id}")
+
+            return self.dt_factory.execute_service(dt_data, service_name, **kwargs)
+
+        # The resident instance provides the configured service and the members (no query), otherwise
+        # they are loaded once, for the pipeline and, if needed, the hydration
+        with self._lock:
+            live = self._instances.get(dt_id)
+
+        if live is not None and (self._watching or time.monotonic() - live.validated_at <= self.max_age_s):
+            service, members, dt_data = live.dt.active_services.get(service_name), live.members, None
+        else:
+            dt_data = self.dt_factory.get_dt(dt_id)
+            if not dt_data:
+                raise LookupError(f"Digital Twin not found: {dt_id}")
+
+            members = self.dt_factory.get_dt_members(dt_id)
+            service_data = next((s for s in dt_data.get("services", []) if s["name"] == service_name), None)
+            service = self.dt_factory._instantiate_service(service_data) if service_data is not None else None
+
+        if service is None:
+            raise ValueError(f"Service {service_name} not found")
+
+        result = self.dt_factory.execute_pipeline(service, members, **kwargs)
+        if result is not NO_PIPELINE:
+            return result
+
+        live = self._get_live(dt_id, dt_data, members)
+        if live is None:
+            raise LookupError(f"Digital Twin not found: {dt_id}")
+
+        if self.engine is not None:
+            return self.engine.execute(live.dt, service_name, **kwargs)
+
+        return live.dt.execute_service(service_name, **kwargs)
+
+    def invalidate(self, dt_id: str) -> None:
+        """Drop the instance of a Digital Twin (to call when its DR memberships or services change)"""
+        with self._lock:
+            live = self._instances.pop(dt_id, None)
+            if live is not None:
+                self._unindex(dt_id, live)
+
+    def _invalidate_all(self) -> None:
+        """Drop all the instances"""
+        with self._lock:
+            self._instances.clear()
+            self._dr_index.clear()
+
+    def on_dr_change(self, dr_type: str, dr_ids: Optional[List[str]]) -> None:
+        """
+        Mark DRs as modified in the resident instances (cheap: no database access)
+
+        Args:
+            dr_type: Type of the modified DRs
+            dr_ids: IDs of the modified DRs, None if unknown (every DR of this type is reloaded)
+        """
+        with self._lock:
+            if dr_ids is None:
+                for live in self._instances.values():
+                    if dr_type in live.dr_types:
+                        live.stale_types.add(dr_type)
+                return
+
+            for dr_id in dr_ids:
+                for dt_id in self._dr_index.get((dr_type, dr_id), ()):
+                    self._instances[dt_id].dirty_ids.setdefault(dr_type, set()).add(dr_id)
+
+    def stats(self) -> Dict:
+        """Get the cache statistics"""
+        with self._lock:
+            return {
+                "instances": len(self._instances),
+                "max_instances": self.max_instances,
+                "replicas": sum(len(live.replicas) for live in self._instances.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "revalidations": self.revalidations,
+                "change_stream": self._watching,
+            }
+
+    def _insert(self, dt_id: str, live: _LiveDT) -> _LiveDT:
+        """Add a hydrated instance (or return the one another thread added meanwhile) and evict the LRU ones"""
+        with self._lock:
+            if dt_id in self._instances:
+                return self._instances[dt_id]
+
+            self._instances[dt_id] = live
+            for dr_type, dr_id in self._references(live):
+                self._dr_index.setdefault((dr_type, dr_id), set()).add(dt_id)
+
+            while len(self._instances) > self.max_instances:
+                evicted_id, evicted = self._instances.popitem(last=False)
+                self._unindex(evicted_id, evicted)
+                self.evictions += 1
+                logger.debug("Evicted DT instance %s", evicted_id)
+
+        return live
+
+    def _unindex(self, dt_id: str, live: _LiveDT) -> None:
+        """Remove a DT from the DR index. The lock must be held."""
+        for key in self._references(live):
+            dt_ids = self._dr_index.get(key)
+            if dt_ids is not None:
+                dt_ids.discard(dt_id)
+                if not dt_ids:
+                    del self._dr_index[key]
+
+    @staticmethod
+    def _references(live: _LiveDT):
+        return ((dr_type, dr_id) for dr_type, ids in live.members.items() for dr_id in ids)
+
+    def _refresh(self, live: _LiveDT) -> None:
+        """Reload the modified DRs of an instance (one `$in` query per DR type)"""
+        with live.refresh_lock:
+            with self._lock:
+                dirty_ids, live.dirty_ids = live.dirty_ids, {}
+                stale_types, live.stale_types = live.stale_types, set()
+
+            if not dirty_ids and not stale_types:
+                return  # Refreshed by another thread
+
+            try:
+                for dr_type in stale_types | set(dirty_ids):
+                    if dr_type in stale_types:
+                        ids = live.members[dr_type]
+                    else:
+                        ids = list(dirty_ids[dr_type])
+
+                    found = {dr["_id"]: dr for dr in self.db_service.get_drs(dr_type, ids)}
+
+                    for dr_id in ids:
+                        if dr_id in found:
+                            live.replicas[(dr_type, dr_id)] = found[dr_id]
+                        else:
+                            live.replicas.pop((dr_type, dr_id), None)  # Deleted
+
+                    logger.debug("Refreshed %d DRs of type %s", len(ids), dr_type)
+
+            except Exception:
+                # Retry at next use
+                with self._lock:
+                    live.stale_types |= stale_types
+                    for dr_type, ids in dirty_ids.items():
+                        live.dirty_ids.setdefault(dr_type, set()).update(ids)
+                raise
+
+            # Swap the whole list, so services running meanwhile keep a consistent view
+            live.dt.digital_replicas = list(live.replicas.values())
+
+    def _revalidate(self, dt_id: str, live: _LiveDT) -> Optional[_LiveDT]:
+        """
+        Check an instance against the writes of the other processes: None if the DT changed (to rebuild) or was
+        deleted, otherwise the instance, with the DRs updated since the last check reloaded and the deleted DRs
+        removed (deleting a DR does not change the version of its DTs)
+        """
+        with live.refresh_lock:
+            if time.monotonic() - live.validated_at <= self.max_age_s:
+                return live  # Revalidated by another thread
+
+            checked_at = datetime.utcnow()
+            version = self.dt_factory.get_dt_version(dt_id)
+            if version is None or version != live.dt_data.get("metadata", {}).get("updated_at"):
+                self.invalidate(dt_id)
+                return None
+
+            # Only the IDs of the DRs, and the DRs updated since the last check, are transferred
+            since = live.validated_since - CLOCK_SKEW
+            nb_updated = 0
+            for dr_type, ids in list(live.members.items()):
+                existing = {dr["_id"] for dr in self.db_service.get_drs(dr_type, ids, {"_id": 1})}
+                if len(existing) < len(ids):
+                    for dr_id in set(ids) - existing:
+                        live.replicas.pop((dr_type, dr_id), None)
+                        nb_updated += 1
+                    live.members[dr_type] = [dr_id for dr_id in ids if dr_id in existing]
+
+                for dr in self.db_service.query_drs(dr_type, {"_id": {"$in": ids}, "metadata.updated_at": {"$gte": since}}):
+                    live.replicas[(dr_type, dr["_id"])] = dr
+                    nb_updated += 1
+
+            if nb_updated:
+                # Swap the whole list, so services running meanwhile keep a consistent view
+                live.dt.digital_replicas = list(live.replicas.values())
+
+            live.validated_at = time.monotonic()
+            live.validated_since = checked_at
+            with self._lock:
+                self.revalidations += 1
+
+        return live
+
+    def _watch_loop(self) -> None:
+        """Follow the change stream of the database and mark the modified DRs"""
+        collections = {
+            self.db_service.schema_registry.get_collection_name(dr_type): dr_type
+            for dr_type in self.db_service.schema_registry.schemas
+        }
+        pipeline = [{"$match": {
+            "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+            "ns.coll": {"$in": [*collections, "digital_twins", MEMBERSHIP_COLLECTION]},
+        }}]
+
+        try:
+            with self.db_service.db.watch(pipeline) as stream:
+                while not self._stopping.is_set():
+                    change = stream.try_next()
+                    if change is None:
+                        continue
+
+                    collection = change["ns"]["coll"]
+                    doc_id = change["documentKey"]["_id"]
+
+                    if collection == "digital_twins":
+                        self.invalidate(doc_id)
+                    elif collection == MEMBERSHIP_COLLECTION:
+                        if "fullDocument" in change:
+                            self.invalidate(change["fullDocument"]["dt_id"])
+                        else:
+                            self._invalidate_all()  # The DT of a deleted membership is not in the event
+                    else:
+                        self.on_dr_change(collections[collection], [doc_id])
+
+        except Exception as e:
+            # E.g standalone MongoDB (change streams need a replica set): the instances are revalidated by age
+            logger.warning("DT change stream stopped, the live instances are revalidated after %s s: %s", self.max_age_s, e)
+
+        finally:
+            self._watching = False
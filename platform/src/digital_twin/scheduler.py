@@ -0,0 +1,269 @@
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+import hashlib
+import json
+import logging
+import time
+from pymongo.errors import DuplicateKeyError
+from src.digital_twin.instance_manager import DTInstanceManager
+
+logger = logging.getLogger(__name__)
+
+RESULTS_COLLECTION = "dt_service_results"
+
+
+class ServiceScheduler:
+    """
+    Runs the Digital Twin services on intervals and caches their results.
+
+    A service is scheduled by its configuration (cf `DTFactory.add_service`):
+        {"schedule": {"interval_s": 300, "params": {"dr_type": "node"}}}
+    where `params` (a dict, or a list of dicts for several runs) are the parameters of `execute`.
+
+    Results are stored in the `dt_service_results` collection, keyed by (DT, service, parameters),
+    so they are shared by all the workers. A lease (`next_run`) stored with each result makes sure
+    that only one worker runs a scheduled execution.
+
+    On-demand executions (`get_result`) are deduplicated: concurrent requests for the same key
+    share one execution.
+    """
+
+    def __init__(
+        self,
+        dt_manager: DTInstanceManager,
+        service_context: Optional[Dict[str, Dict]] = None,
+        tick: float = 5.0,
+        max_workers: int = 2,
+    ):
+        """
+        Args:
+            dt_manager: Live Digital Twin instances, used to run the services
+            service_context: Service name -> objects passed to `execute` in addition to the parameters
+                             (e.g {"OccupancyService": {"status_history": ...}})
+            tick: Period (in seconds) of the checks for due executions
+            max_workers: Maximum number of scheduled executions running at the same time
+        """
+        self.dt_manager = dt_manager
+        self.db_service = dt_manager.db_service
+        self.service_context = service_context or {}
+        self.tick = tick
+
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dt_scheduler")
+
+        self._stopping = Event()
+        self._thread: Optional[Thread] = None
+        self._collection_ready = False
+
+        self.executions = 0
+        self.deduplicated = 0
+        self.failures = 0
+
+    def start(self) -> None:
+        """Start the scheduling thread"""
+        if self._thread is not None:
+            return
+
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, name="dt_scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the scheduling thread (running executions complete)"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.tick + 1)
+            self._thread = None
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def result_key(dt_id: str, service_name: str, params: Dict) -> str:
+        """Cache key of a (DT, service, parameters) execution"""
+        raw = json.dumps({"dt_id": dt_id, "service": service_name, "params": params}, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get_result(
+        self,
+        dt_id: str,
+        service_name: str,
+        params: Optional[Dict] = None,
+        max_age_s: Optional[float] = None,
+    ) -> Tuple[Any, Dict]:
+        """
+        Get the result of a service, from the cache when it is recent enough
+
+        Args:
+            dt_id: Digital Twin ID
+            service_name: Name of a service added to the DT
+            params: Parameters of `execute` (dr_type, attribute, ...)
+            max_age_s: Maximum age of a cached result (None: any age, 0: always recompute)
+
+        Returns:
+            Tuple[Any, Dict]: The result, and its metadata:
+                {computed_at, age_s, interval_s (None if not scheduled), stale (older than interval_s), source ("cache" | "computed")}
+        """
+        params = params or {}
+        key = self.result_key(dt_id, service_name, params)
+
+        if max_age_s is None or max_age_s > 0:
+            cached = self._collection().find_one({"_id": key, "result": {"$exists": True}})
+            if cached is not None:
+                age_s = (datetime.utcnow() - cached["computed_at"]).total_seconds()
+                if max_age_s is None or age_s <= max_age_s:
+                    return cached["result"], self._metadata(cached, "cache")
+
+        doc = self._execute_deduplicated(key, dt_id, service_name, params)
+        return doc["result"], self._metadata(doc, "computed")
+
+    def _metadata(self, doc: Dict, source: str) -> Dict:
+        age_s = (datetime.utcnow() - doc["computed_at"]).total_seconds()
+        interval_s = doc.get("interval_s")
+
+        return {
+            "computed_at": doc["computed_at"],
+            "age_s": age_s,
+            "interval_s": interval_s,
+            "stale": age_s > interval_s if interval_s else None,
+            "source": source,
+        }
+
+    def _execute_deduplicated(self, key: str, dt_id: str, service_name: str, params: Dict, interval_s: float = None) -> Dict:
+        """Run the service, or wait for the identical execution already running in this process"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.deduplicated += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            doc = self._execute(key, dt_id, service_name, params, interval_s)
+            future.set_result(doc)
+            return doc
+
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _execute(self, key: str, dt_id: str, service_name: str, params: Dict, interval_s: float = None) -> Dict:
+        """Run the service and store its result"""
+        started = time.perf_counter()
+
+        try:
+            kwargs = {**params, **self.service_context.get(service_name, {})}
+            result = self.dt_manager.execute_service(dt_id, service_name, **kwargs)
+
+        except Exception:
+            self.failures += 1
+            raise
+
+        self.executions += 1
+
+        doc = {
+            "dt_id": dt_id,
+            "service": service_name,
+            "params": params,
+            "result": result,
+            "computed_at": datetime.utcnow(),
+            "duration_s": time.perf_counter() - started,
+        }
+        if interval_s is not None:
+            doc["interval_s"] = interval_s
+
+        try:
+            self._collection().update_one({"_id": key}, {"$set": doc}, upsert=True)
+
+        except Exception as e:
+            logger.error("Failed to store the result of %s on DT %s: %s", service_name, dt_id, e)
+
+        return doc
+
+    def _collection(self):
+        collection = self.db_service.db[RESULTS_COLLECTION]
+
+        if not self._collection_ready:
+            collection.create_index("dt_id")
+            self._collection_ready = True
+
+        return collection
+
+    def _scheduled_jobs(self) -> List[Tuple[str, str, Dict, float]]:
+        """Get the (dt_id, service_name, params, interval_s) of the scheduled services"""
+        jobs = []
+        dts = self.db_service.db["digital_twins"].find(
+            {"services.config.schedule": {"$exists": True}}, {"services": 1}
+        )
+
+        for dt in dts:
+            for service in dt.get("services", []):
+                schedule = service.get("config", {}).get("schedule")
+                if not schedule or service.get("status", "active") != "active":
+                    continue
+
+                params_list = schedule.get("params", {})
+                if isinstance(params_list, dict):
+                    params_list = [params_list]
+
+                for params in params_list:
+                    jobs.append((dt["_id"], service["name"], params, float(schedule.get("interval_s", 300))))
+
+        return jobs
+
+    def _claim(self, key: str, interval_s: float) -> bool:
+        """Take the lease of a scheduled execution (False if it is not due, or another worker took it)"""
+        now = datetime.utcnow()
+
+        try:
+            self._collection().update_one(
+                {"_id": key, "$or": [{"next_run": {"$lte": now}}, {"next_run": {"$exists": False}}]},
+                {"$set": {"next_run": now + timedelta(seconds=interval_s)}},
+                upsert=True,
+            )
+            return True
+
+        except DuplicateKeyError:
+            return False  # The result exists and is not due
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.tick):
+            try:
+                for dt_id, service_name, params, interval_s in self._scheduled_jobs():
+                    key = self.result_key(dt_id, service_name, params)
+
+                    if self._claim(key, interval_s):
+                        self._executor.submit(self._run_job, key, dt_id, service_name, params, interval_s)
+
+            except Exception as e:
+                logger.error("Service scheduler: %s", e)
+
+    def _run_job(self, key: str, dt_id: str, service_name: str, params: Dict, interval_s: float) -> None:
+        try:
+            self._execute_deduplicated(key, dt_id, service_name, params, interval_s)
+            logger.debug("Scheduled %s on DT %s done", service_name, dt_id)
+
+        except Exception as e:
+            logger.error("Scheduled %s on DT %s failed: %s", service_name, dt_id, e)
+
+    def stats(self) -> Dict:
+        """Get the scheduler statistics"""
+        with self._inflight_lock:
+            inflight = len(self._inflight)
+
+        return {
+            "executions": self.executions,
+            "deduplicated": self.deduplicated,
+            "failures": self.failures,
+            "inflight": inflight,
+        }
@@ -1,17 +1,116 @@
-from typing import List, Dict
-from datetime import datetime
+from typing import List, Dict, Iterable, Optional
+from itertools import chain
+from operator import itemgetter
 from .base import BaseService
+from .sketches import RunningStats, TDigest
+import numpy as np
 
-from typing import List, Dict, Any
-from datetime import datetime
-from .base import BaseService
-import statistics
+
+class MeasureAccumulator:
+    """
+    Streaming statistics of one measure type.
+
+    Values are converted in chunks of `CHUNK_SIZE` into NumPy arrays and folded into a `RunningStats`
+    and a `TDigest`, so memory does not grow with the number of measurements.
+    """
+
+    CHUNK_SIZE = 65_536
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, compression: int = 100):
+        self.stats = RunningStats()
+        self.digest = TDigest(compression=compression)
+        self.error = None
+        self.invalid = 0
+        self._chunk: List[float] = []
+
+    def add(self, value) -> None:
+        """Add one raw value (converted to float)"""
+        try:
+            self._chunk.append(float(value))
+
+        except (TypeError, ValueError) as e:
+            self.error = str(e)
+            self.invalid += 1
+            return
+
+        if len(self._chunk) >= self.CHUNK_SIZE:
+            self.flush()
+
+    def add_array(self, values: np.ndarray) -> None:
+        """Add a batch of float values"""
+        self.flush()
+        self.stats.update(values)
+        self.digest.update(values)
+
+    def flush(self) -> None:
+        """Fold the current chunk into the sketches"""
+        if self._chunk:
+            values = np.fromiter(self._chunk, dtype=float, count=len(self._chunk))
+            self.stats.update(values)
+            self.digest.update(values)
+            self._chunk = []
+
+    def merge(self, other: "MeasureAccumulator") -> None:
+        """Add the values summarized by `other`"""
+        self.flush()
+        other.flush()
+        self.stats.merge(other.stats)
+        self.digest.merge(other.digest)
+        self.error = self.error or other.error
+        self.invalid += other.invalid
+
+    def summary(self, include_sketch: bool = False) -> Dict:
+        """
+        Args:
+            include_sketch: Add the serialized sketches, to merge the result with others (cf `AggregationService.merge`)
+        """
+        self.flush()
+
+        if self.error is not None:
+            return {"error": self.error, "count": self.stats.count + self.invalid}
+
+        result = {
+            "count": self.stats.count,
+            "mean": self.stats.mean,
+            "min": self.stats.min,
+            "max": self.stats.max,
+            "stddev": self.stats.stddev,
+        }
+        for p in self.PERCENTILES:
+            result[f"p{p}"] = self.digest.quantile(p / 100)
+
+        if include_sketch:
+            result["sketch"] = {"stats": self.stats.to_dict(), "digest": self.digest.to_dict()}
+
+        return result
+
+    @classmethod
+    def from_sketch(cls, sketch: Dict) -> "MeasureAccumulator":
+        accumulator = cls(compression=sketch["digest"]["compression"])
+        accumulator.stats = RunningStats.from_dict(sketch["stats"])
+        accumulator.digest = TDigest.from_dict(sketch["digest"])
+        return accumulator
 
 
 class AggregationService(BaseService):
     """Service for aggregating measurements across different Digital Replicas"""
 
-    def execute(self, data: Dict, dr_type: str = None, attribute: str = None) -> Dict:
+    dr_projection = {"type": 1, "data.measurements": 1}
+
+    def __init__(self):
+        super().__init__()
+        self.compression = 100
+
+    def configure(self, config: Dict) -> None:
+        """
+        Args:
+            config: Service configuration. Supported keys:
+                - compression: Accuracy / size trade-off of the percentile sketch
+        """
+        self.compression = config.get("compression", self.compression)
+
+    def execute(self, data: Dict, dr_type: str = None, attribute: str = None, include_sketch: bool = False) -> Dict:
         """
         Execute aggregation on measurements from specified DR type
 
@@ -19,6 +118,7 @@ class AggregationService(BaseService):
             data: Dictionary containing the DT data including all DRs
             dr_type: Type of DR to aggregate (e.g., 'bottle', 'device')
             attribute: Specific measurement type to aggregate (e.g., 'temperature')
+            include_sketch: Add the serialized sketches to each measure type (cf `merge`)
         """
         if not data or 'digital_replicas' not in data:
             raise ValueError("Invalid data: missing digital replicas")
@@ -29,43 +129,243 @@ class AggregationService(BaseService):
         if not drs:
             return {"error": f"No digital replicas found of type {dr_type}"}
 
-        # Collect all measurements
-        all_measurements = []
+        accumulators = self.accumulate(drs, attribute)
+
+        if not accumulators:
+            return {"error": f"No measurements found for attribute {attribute}"}
+
+        return {
+            measure_type: accumulator.summary(include_sketch)
+            for measure_type, accumulator in accumulators.items()
+        }
+
+    def accumulate(self, drs: Iterable[Dict], attribute: str = None) -> Dict[str, MeasureAccumulator]:
+        """
+        Fold the measurements of the DRs into one accumulator per measure type, in one pass
+
+        Args:
+            drs: Digital Replicas (any iterable, e.g a database cursor)
+            attribute: Only keep this measure type (all if None)
+        """
+        accumulators: Dict[str, MeasureAccumulator] = {}
+
         for dr in drs:
-            if 'data' in dr and 'measurements' in dr['data']:
-                measurements = dr['data']['measurements']
-                if attribute:
-                    # Filter measurements by attribute
-                    measurements = [m for m in measurements
-                                    if m['measure_type'] == attribute]
-                all_measurements.extend(measurements)
-
-        if not all_measurements:
+            for measure in dr.get('data', {}).get('measurements', []):
+                measure_type = measure['measure_type']
+                if attribute and measure_type != attribute:
+                    continue
+
+                if measure_type not in accumulators:
+                    accumulators[measure_type] = MeasureAccumulator(self.compression)
+
+                accumulators[measure_type].add(measure['value'])
+
+        return accumulators
+
+    def to_columns(self, data: Dict, dr_type: str = None, attribute: str = None, **kwargs) -> Dict:
+        """
+        Convert the measurements to columns (cf `ServiceExecutionEngine`):
+            {"types": [measure types], "codes": int32 array (index in types), "values": float64 array,
+             "invalid": {measure type: [count, last error]}}
+        or {"error": ...} when there is nothing to aggregate.
+        """
+        if not data or 'digital_replicas' not in data:
+            raise ValueError("Invalid data: missing digital replicas")
+
+        drs = [dr for dr in data['digital_replicas'] if dr_type is None or dr['type'] == dr_type]
+        if not drs:
+            return {"error": f"No digital replicas found of type {dr_type}"}
+
+        # Only the type and value of the measurements are read, through C iterators (`map` / `itemgetter`)
+        # that `np.fromiter` consumes without building lists of Python floats
+        measures = list(chain.from_iterable(dr.get('data', {}).get('measurements', []) for dr in drs))
+        if attribute:
+            measures = [measure for measure in measures if measure['measure_type'] == attribute]
+
+        measure_types = list(map(itemgetter('measure_type'), measures))
+        types = {measure_type: code for code, measure_type in enumerate(dict.fromkeys(measure_types))}
+        if not types:
             return {"error": f"No measurements found for attribute {attribute}"}
 
-        # Group measurements by type
-        grouped_measurements = {}
-        for measure in all_measurements:
-            measure_type = measure['measure_type']
-            if measure_type not in grouped_measurements:
-                grouped_measurements[measure_type] = []
-            grouped_measurements[measure_type].append(float(measure['value']))
-
-        # Calculate statistics for each measurement type
-        stats = {}
-        for measure_type, values in grouped_measurements.items():
-            try:
-                stats[measure_type] = {
-                    'count': len(values),
-                    'mean': statistics.mean(values),
-                    'min': min(values),
-                    'max': max(values),
-                    'stddev': statistics.stdev(values) if len(values) > 1 else 0
+        codes = np.fromiter(map(types.__getitem__, measure_types), dtype=np.int32, count=len(measures))
+        invalid: Dict[str, List] = {}
+
+        try:
+            values = np.fromiter(map(itemgetter('value'), measures), dtype=np.float64, count=len(measures))
+            converted = not np.isnan(values).any()  # NumPy converts None to NaN, where `float` raises
+        except (TypeError, ValueError):
+            converted = False
+
+        if not converted:
+            # Some values are not numbers: convert them one by one, and count the invalid ones
+            values = np.empty(len(measures), dtype=np.float64)
+            valid = np.ones(len(measures), dtype=bool)
+
+            for i, measure in enumerate(measures):
+                try:
+                    values[i] = float(measure['value'])
+
+                except (TypeError, ValueError) as e:
+                    valid[i] = False
+                    entry = invalid.setdefault(measure['measure_type'], [0, None])
+                    entry[0] += 1
+                    entry[1] = str(e)
+
+            codes, values = codes[valid], values[valid]
+
+        return {
+            "types": list(types),
+            "codes": codes,
+            "values": values,
+            "invalid": invalid,
+        }
+
+    def execute_columns(self, columns: Dict, include_sketch: bool = False, **kwargs) -> Dict:
+        """Same result as `execute`, from the output of `to_columns` (vectorized per measure type)"""
+        if "error" in columns:
+            return {"error": columns["error"]}
+
+        codes, values = columns["codes"], columns["values"]
+
+        # Sort the values by measure type once, then slice
+        order = np.argsort(codes, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(columns["types"])))])
+        values = values[order]
+
+        result = {}
+        for code, measure_type in enumerate(columns["types"]):
+            accumulator = MeasureAccumulator(self.compression)
+            accumulator.add_array(values[bounds[code]:bounds[code + 1]])
+
+            if measure_type in columns["invalid"]:
+                accumulator.invalid, accumulator.error = columns["invalid"][measure_type]
+
+            result[measure_type] = accumulator.summary(include_sketch)
+
+        return result
+
+    def build_pipeline(self, dr_ids: List[str], dr_type: str = None, attribute: str = None, **kwargs) -> Optional[List[Dict]]:
+        """
+        Same aggregation as `execute`, as a MongoDB pipeline: only one row per measure type leaves the server.
+        Percentiles use `$percentile` (approximate method, MongoDB >= 7.0).
+        """
+        if kwargs.get("include_sketch"):
+            return None  # The sketches can only be built in Python
+
+        pipeline = [
+            {"$match": {"_id": {"$in": dr_ids}}},
+            {"$project": {"_id": 0, "measure": "$data.measurements"}},
+            {"$unwind": "$measure"},
+        ]
+
+        if attribute:
+            pipeline.append({"$match": {"measure.measure_type": attribute}})
+
+        pipeline += [
+            {
+                "$project": {
+                    "measure_type": "$measure.measure_type",
+                    "value": {
+                        "$convert": {"input": "$measure.value", "to": "double", "onError": None, "onNull": None}
+                    },
                 }
-            except (statistics.StatisticsError, ValueError) as e:
-                stats[measure_type] = {
-                    'error': str(e),
-                    'count': len(values)
+            },
+            {
+                "$group": {
+                    "_id": "$measure_type",
+                    "count": {"$sum": 1},
+                    "valid": {"$sum": {"$cond": [{"$eq": [{"$type": "$value"}, "double"]}, 1, 0]}},
+                    "mean": {"$avg": "$value"},
+                    "min": {"$min": "$value"},
+                    "max": {"$max": "$value"},
+                    "stddev": {"$stdDevSamp": "$value"},
+                    "percentiles": {
+                        "$percentile": {
+                            "input": "$value",
+                            "p": [p / 100 for p in MeasureAccumulator.PERCENTILES],
+                            "method": "approximate",
+                        }
+                    },
                 }
+            },
+        ]
+
+        return pipeline
+
+    def reduce_pipeline_results(self, results: Dict[str, List[Dict]]) -> Dict:
+        """
+        Merge the rows of the DR collections into the `execute` output format.
+        When a measure type spans several collections, the percentiles are count-weighted averages (approximations).
+        """
+        merged: Dict[str, Dict] = {}
+
+        for rows in results.values():
+            for row in rows:
+                measure_type = row["_id"]
+                if measure_type not in merged:
+                    merged[measure_type] = {"stats": RunningStats(), "invalid": 0, "percentiles": []}
+
+                entry = merged[measure_type]
+                entry["invalid"] += row["count"] - row["valid"]
+
+                if row["valid"]:
+                    n = row["valid"]
+                    entry["stats"].merge(RunningStats.from_dict({
+                        "count": n,
+                        "mean": row["mean"],
+                        "m2": (row["stddev"] or 0.0) ** 2 * (n - 1),
+                        "min": row["min"],
+                        "max": row["max"],
+                    }))
+                    entry["percentiles"].append((n, row["percentiles"]))
+
+        if not merged:
+            return {"error": "No measurements found"}
+
+        output = {}
+        for measure_type, entry in merged.items():
+            stats = entry["stats"]
+
+            if entry["invalid"]:
+                output[measure_type] = {
+                    "error": f"{entry['invalid']} non-numeric values",
+                    "count": stats.count + entry["invalid"],
+                }
+                continue
+
+            output[measure_type] = {
+                "count": stats.count,
+                "mean": stats.mean,
+                "min": stats.min,
+                "max": stats.max,
+                "stddev": stats.stddev,
+            }
+            for i, p in enumerate(MeasureAccumulator.PERCENTILES):
+                output[measure_type][f"p{p}"] = (
+                    sum(n * values[i] for n, values in entry["percentiles"]) / stats.count
+                )
+
+        return output
+
+    @staticmethod
+    def merge(results: List[Dict]) -> Dict:
+        """
+        Merge results of `execute(..., include_sketch=True)` (e.g computed on several Digital Twins)
+
+        Returns:
+            Dict: Same format as `execute`, for the union of the measurements
+        """
+        merged: Dict[str, MeasureAccumulator] = {}
+
+        for result in results:
+            for measure_type, summary in result.items():
+                if not isinstance(summary, dict) or "sketch" not in summary:
+                    continue
+
+                accumulator = MeasureAccumulator.from_sketch(summary["sketch"])
+                if measure_type in merged:
+                    merged[measure_type].merge(accumulator)
+                else:
+                    merged[measure_type] = accumulator
 
-        return stats
\ No newline at end of file
+        return {measure_type: accumulator.summary() for measure_type, accumulator in merged.items()}
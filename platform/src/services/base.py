@@ -1,9 +1,21 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 class BaseService(ABC):
     """Base class for all services in the pool"""
 
+    # Fields of the DRs that the service reads (MongoDB projection), None for the whole documents.
+    # The DRs are loaded with this projection when the service runs in Python (cf `DTFactory.execute_service`).
+    dr_projection: Optional[Dict] = None
+
+    # Execution limits ({"timeout_s": ..., "memory_mb": ...}), from the `limits` entry of the service
+    # configuration (cf `ServiceExecutionEngine`)
+    limits: Dict = {}
+
+    # Parameters of `execute` only used by `to_columns`, in the Flask worker (e.g database handles):
+    # they are not sent to the worker process with the columns (cf `ServiceExecutionEngine`)
+    context_params: tuple = ()
+
     def __init__(self):
         self.name = self.__class__.__name__
 
@@ -18,4 +30,28 @@ class BaseService(ABC):
         Returns:
             Processed data in any format
         """
-        pass
\ No newline at end of file
+        pass
+
+    def build_pipeline(self, dr_ids: List[str], dr_type: str = None, attribute: str = None, **kwargs) -> Optional[List[Dict]]:
+        """
+        Compile the service into a MongoDB aggregation pipeline, run on the collection of `dr_type`
+        (cf `DTFactory.execute_service`). Services that cannot run in the database return None,
+        and are executed in Python on the loaded DRs.
+
+        Args:
+            dr_ids: IDs of the DRs of the Digital Twin in this collection
+            dr_type: Type of DR of the collection
+            attribute: Specific attribute to analyze
+        Returns:
+            The pipeline, or None
+        """
+        return None
+
+    def reduce_pipeline_results(self, results: Dict[str, List[Dict]]) -> Any:
+        """
+        Build the service result from the outputs of `build_pipeline`
+
+        Args:
+            results: DR type -> rows returned by the pipeline on its collection
+        """
+        raise NotImplementedError(f"{self.name} does not run in the database")
@@ -0,0 +1,186 @@
+from typing import Callable, Dict, List, Optional
+from collections import deque
+from threading import Thread, Event, Lock
+import logging
+from src.services.metrics import QUEUE_DEPTH, QUEUE_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+class PartialWriteError(Exception):
+    """Raised by a `write` function when only some documents of the batch were written"""
+
+    def __init__(self, message: str, failed: List[Dict]):
+        """
+        Args:
+            message: Error message
+            failed: Documents of the batch that were not written (the only ones retried)
+        """
+        super().__init__(message)
+        self.failed = failed
+
+
+class BatchWriter:
+    """
+    Buffers documents in memory and inserts them in batches from a background thread.
+
+    `add` only appends to a deque, so it can be called from hot paths (MQTT callbacks, request handlers).
+    The buffer is flushed every `flush_period` seconds, or as soon as `batch_size` documents are waiting.
+    When the database cannot keep up, the oldest documents are dropped above `max_buffer`.
+
+    A batch whose write fails is kept aside and written first by the next flush, after a full
+    `flush_period` (at most one batch at a time, so the memory stays bounded). It is dropped, logged
+    and counted in `dropped` after `max_retries` failed retries. When `write` raises
+    `PartialWriteError`, only the documents it lists are retried. For any other error the outcome is
+    unknown and the whole batch is retried, so delivery is at least once: a document can be stored
+    twice, and the readers of the collection deduplicate by `_id`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        write: Callable[[List[Dict]], None],
+        batch_size: int = 1000,
+        flush_period: float = 2.0,
+        max_buffer: int = 100_000,
+        max_retries: int = 3,
+    ):
+        """
+        Args:
+            name: Name used in the logs and stats
+            write: Function inserting a batch of documents (e.g a `DatabaseService.insert_records` partial)
+            batch_size: Maximum number of documents per write
+            flush_period: Maximum time (in seconds) a document waits in the buffer
+            max_buffer: Maximum number of buffered documents
+            max_retries: Number of retries of a batch whose write failed, before it is dropped
+        """
+        self.name = name
+        self._write = write
+        self.batch_size = batch_size
+        self.flush_period = flush_period
+        self.max_retries = max_retries
+
+        self._buffer = deque(maxlen=max_buffer)
+        self._retry: List[Dict] = []  # Batch whose write failed (written first by the next flush)
+        self._attempts = 0
+        self._flush_lock = Lock()
+        self._wake_up = Event()
+        self._stopping = Event()
+        self._thread: Optional[Thread] = None
+
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.retried_batches = 0
+
+        self._depth_metric = QUEUE_DEPTH.labels(name)
+        self._dropped_metric = QUEUE_DROPPED.labels(name)
+
+    def add(self, doc: Dict) -> None:
+        """Buffer a document (never blocks on the database)"""
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+            self._dropped_metric.inc()
+
+        self._buffer.append(doc)
+
+        if len(self._buffer) >= self.batch_size:
+            self._wake_up.set()
+
+    def start(self) -> None:
+        """Start the background flushing thread"""
+        if self._thread is not None:
+            return
+
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, name=f"batch_writer_{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread and flush what remains"""
+        self._stopping.set()
+        self._wake_up.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout=5.0)
+            self._thread = None
+
+        self.flush()
+
+        lost = len(self._retry) + len(self._buffer)
+        if lost:
+            self.dropped += lost
+            self._dropped_metric.inc(lost)
+            self._retry = []
+            self._buffer.clear()
+            logger.error(f"BatchWriter {self.name}: {lost} documents not written at stop")
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wake_up.wait(self.flush_period)
+            self._wake_up.clear()
+            self._depth_metric.set(len(self._buffer))  # Sampled once per flush (not on `add`)
+            self.flush()
+
+            if self._retry:  # The last write failed: give the database a full period before retrying
+                self._stopping.wait(self.flush_period)
+
+    def flush(self) -> int:
+        """
+        Write all the buffered documents, `batch_size` at a time
+
+        Returns:
+            int: number of documents written
+        """
+        nb = 0
+
+        with self._flush_lock:
+            while self._retry or self._buffer:
+                if self._retry:
+                    batch = self._retry
+                else:
+                    batch = []
+                    while self._buffer and len(batch) < self.batch_size:
+                        batch.append(self._buffer.popleft())
+
+                try:
+                    self._write(batch)
+                    nb += len(batch)
+                    self._retry = []
+                    self._attempts = 0
+
+                except Exception as e:
+                    self.failed_batches += 1
+
+                    if isinstance(e, PartialWriteError):
+                        nb += len(batch) - len(e.failed)
+                        batch = e.failed
+
+                    if self._attempts < self.max_retries:
+                        self._attempts += 1
+                        self.retried_batches += 1
+                        self._retry = batch
+                        logger.warning(
+                            f"BatchWriter {self.name}: failed to write {len(batch)} documents "
+                            f"(retry {self._attempts}/{self.max_retries}): {str(e)}"
+                        )
+                    else:
+                        self._retry = []
+                        self._attempts = 0
+                        self.dropped += len(batch)
+                        self._dropped_metric.inc(len(batch))
+                        logger.error(f"BatchWriter {self.name}: dropped {len(batch)} documents after {self.max_retries} retries: {str(e)}")
+                    break
+
+        self.written += nb
+        return nb
+
+    def stats(self) -> Dict:
+        """Get the buffer statistics"""
+        return {
+            "queued": len(self._buffer) + len(self._retry),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_batches": self.failed_batches,
+            "retried_batches": self.retried_batches,
+        }
@@ -1,27 +1,126 @@
-from typing import Dict, List, Optional, Any
-from pymongo import MongoClient
+from typing import Callable, Dict, List, Optional, Any
+from functools import wraps
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from datetime import datetime
+import time
+from src.services.metrics import DB_OPERATION_SECONDS, DB_OPERATION_ERRORS
+from src.services.storage import backend_name, create_client
+from src.services.batch_writer import PartialWriteError
+from observability.tracing import TRACER, NOOP_SPAN
 from src.virtualization.digital_replica.schema_registry import SchemaRegistry
 
 
+def _timed(operation: str, on_dr_type: bool = True):
+    """
+    Record the duration of a `DatabaseService` method (`db_operation_duration_seconds`, and a span when traced)
+
+    Args:
+        operation: Operation label (get, query, aggregate, insert, update, delete)
+        on_dr_type: The first argument of the method is a DR type (otherwise a collection name)
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, target: str, *args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                span = TRACER.start_span(f"db.{operation}", kind="client")
+                if span is not NOOP_SPAN:
+                    collection = self._collection_label(target, on_dr_type)
+                    span.name = f"db.{operation} {collection}"
+                    span.attributes.update({"db.system": self.backend, "db.operation": method.__name__, "db.collection": collection})
+
+                with span:
+                    return method(self, target, *args, **kwargs)
+
+            except Exception:
+                DB_OPERATION_ERRORS.labels(operation, self._collection_label(target, on_dr_type)).inc()
+                raise
+
+            finally:
+                DB_OPERATION_SECONDS.labels(operation, self._collection_label(target, on_dr_type)).observe(
+                    time.perf_counter() - started
+                )
+
+        return wrapper
+
+    return decorator
+
+
 class DatabaseService:
-    """Manages the connection and communication to the MongoDB database"""
+    """
+    Manages the connection and communication to the database: MongoDB, or an embedded storage backend
+    selected by the connection string (`memory://`, `sqlite:///path.db`, cf `storage`)
+    """
 
     def __init__(
-        self, connection_string: str, db_name: str, schema_registry: SchemaRegistry
+        self, connection_string: str, db_name: str, schema_registry: SchemaRegistry,
+        event_listeners: Optional[List] = None, client_factory: Optional[Callable[..., Any]] = None,
     ):
+        """
+        Args:
+            event_listeners: pymongo monitoring listeners given to the client (e.g `QueryMonitor`)
+            client_factory: Creates the client from the connection string (by default, the client of the
+                            backend of its scheme, cf `storage.create_client`)
+        """
         self.connection_string = connection_string
         self.db_name = db_name
         self.schema_registry = schema_registry
+        self.event_listeners = event_listeners or []
+        self.client_factory = client_factory or create_client
+        self.backend = backend_name(connection_string)
         self.client = None
         self.db = None
+        self._change_listeners: List[Callable[[str, Optional[List[str]]], None]] = []
+        self._collection_labels: Dict[str, str] = {}  # DR type -> collection (metrics labels)
+
+    def add_change_listener(self, listener: Callable[[str, Optional[List[str]]], None]) -> None:
+        """
+        Register a function called after each Digital Replica write made through this service
+
+        Args:
+            listener: Called with (dr_type, dr_ids). `dr_ids` is None when the modified DRs are
+                      not known (query-based updates).
+        """
+        self._change_listeners.append(listener)
+
+    def _notify_change(self, dr_type: str, dr_ids: Optional[List[str]]) -> None:
+        for listener in self._change_listeners:
+            listener(dr_type, dr_ids)
+
+    def _collection_label(self, target: str, on_dr_type: bool) -> str:
+        if not on_dr_type:
+            return target
+
+        label = self._collection_labels.get(target)
+        if label is None:
+            try:
+                label = self.schema_registry.get_collection_name(target)
+            except Exception:
+                label = target  # Unknown DR type (the operation fails anyway)
+            self._collection_labels[target] = label
+
+        return label
 
     def connect(self) -> None:
         try:
-            self.client = MongoClient(self.connection_string)
+            self.client = self.client_factory(self.connection_string, event_listeners=self.event_listeners)
             self.db = self.client[self.db_name]
         except Exception as e:
-            raise ConnectionError(f"Failed to connect to MongoDB: {str(e)}")
+            raise ConnectionError(f"Failed to connect to the database ({self.backend}): {str(e)}")
+
+    def ensure_indexes(self) -> None:
+        """Create the indexes declared by the schemas (`indexes` section), if they do not exist"""
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        for dr_type in self.schema_registry.schemas:
+            collection = self.db[self.schema_registry.get_collection_name(dr_type)]
+            for fields in self.schema_registry.get_indexes(dr_type):
+                collection.create_index([(field, 1) for field in fields])
 
     def disconnect(self) -> None:
         if self.client:
@@ -32,6 +131,7 @@ class DatabaseService:
     def is_connected(self) -> bool:
         return self.client is not None and self.db is not None
 
+    @_timed("insert")
     def save_dr(self, dr_type: str, dr_data: Dict) -> str:
         """Save a Digital Replica in the DB."""
 
@@ -47,11 +147,13 @@ class DatabaseService:
             collection = self.db[collection_name]
 
             result = collection.insert_one(dr_data)
+            self._notify_change(dr_type, [dr_data["_id"]])
             return str(dr_data["_id"])
 
         except Exception as e:
             raise Exception(f"Failed to save Digital Replica: {str(e)}")
 
+    @_timed("get")
     def get_dr(self, dr_type: str, dr_id: str) -> Optional[Dict]:
         if not self.is_connected():
             raise ConnectionError("Not connected to MongoDB")
@@ -63,6 +165,31 @@ class DatabaseService:
         except Exception as e:
             raise Exception(f"Failed to get Digital Replica: {str(e)}")
 
+    @_timed("get")
+    def get_drs(self, dr_type: str, dr_ids: List[str], projection: Optional[Dict] = None) -> List[Dict]:
+        """
+        Get several Digital Replicas of the same type in one query (`$in`)
+
+        Args:
+            dr_type: Type of the Digital Replicas
+            dr_ids: IDs of the Digital Replicas
+            projection: Fields to return (all if None)
+
+        Returns:
+            List[Dict]: The Digital Replicas found (in no particular order)
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.schema_registry.get_collection_name(dr_type)
+            return list(self.db[collection_name].find({"_id": {"$in": list(dr_ids)}}, projection))
+
+        except Exception as e:
+            raise Exception(f"Failed to get Digital Replicas: {str(e)}")
+
+    @_timed("query")
     def query_drs(self, dr_type: str, query: Optional[Dict] = None) -> List[Dict]:
         if not self.is_connected():
             raise ConnectionError("Not connected to MongoDB")
@@ -74,6 +201,29 @@ class DatabaseService:
         except Exception as e:
             raise Exception(f"Failed to query Digital Replicas: {str(e)}")
 
+    @_timed("aggregate")
+    def aggregate_drs(self, dr_type: str, pipeline: List[Dict]) -> List[Dict]:
+        """
+        Run an aggregation pipeline on the collection of `dr_type` (server side) and return its result
+
+        Raises:
+            NotImplementedError: if the storage backend does not support a stage or operator of the pipeline
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.schema_registry.get_collection_name(dr_type)
+            return list(self.db[collection_name].aggregate(pipeline))
+
+        except NotImplementedError:
+            raise  # Stage or operator the embedded backend does not support (the caller can fall back to Python)
+
+        except Exception as e:
+            raise Exception(f"Failed to aggregate Digital Replicas: {str(e)}")
+
+    @_timed("update")
     def update_dr(self, dr_type: str, dr_id: str, update_data: Dict) -> None:
         if not self.is_connected():
             raise ConnectionError("Not connected to MongoDB")
@@ -95,9 +245,103 @@ class DatabaseService:
             if result.matched_count == 0:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
 
+            self._notify_change(dr_type, [dr_id])
+
         except Exception as e:
             raise Exception(f"Failed to update Digital Replica: {str(e)}")
 
+    @_timed("update")
+    def update_drs(self, dr_type: str, query: Dict, update_data: Dict) -> int:
+        """
+        Update all the Digital Replicas matching `query` with a single `update_many`.
+
+        `update_data` is applied with `$set`, so nested fields should use the dotted notation
+        (e.g `{"data.status": "free"}`).
+
+        Returns:
+            int: the number of modified Digital Replicas
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.schema_registry.get_collection_name(dr_type)
+
+            update_data = {**update_data, "metadata.updated_at": datetime.utcnow()}
+
+            result = self.db[collection_name].update_many(query, {"$set": update_data})
+            if result.modified_count:
+                self._notify_change(dr_type, None)
+
+            return result.modified_count
+
+        except Exception as e:
+            raise Exception(f"Failed to update Digital Replicas: {str(e)}")
+
+    @_timed("update")
+    def bulk_update_drs(self, dr_type: str, updates: Dict[str, Dict]) -> int:
+        """
+        Apply a different `$set` to several Digital Replicas in a single `bulk_write`.
+
+        Args:
+            dr_type: Type of the Digital Replicas
+            updates: dr_id -> data to `$set` (dotted notation for nested fields)
+
+        Returns:
+            int: the number of modified Digital Replicas
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        if not updates:
+            return 0
+
+        try:
+            collection_name = self.schema_registry.get_collection_name(dr_type)
+            now = datetime.utcnow()
+
+            operations = [
+                UpdateOne({"_id": dr_id}, {"$set": {**update_data, "metadata.updated_at": now}})
+                for dr_id, update_data in updates.items()
+            ]
+
+            result = self.db[collection_name].bulk_write(operations, ordered=False)
+            self._notify_change(dr_type, list(updates))
+            return result.modified_count
+
+        except Exception as e:
+            raise Exception(f"Failed to bulk update Digital Replicas: {str(e)}")
+
+    @_timed("update")
+    def increment_drs(self, dr_type: str, query: Dict, increments: Dict) -> int:
+        """
+        Atomically increment numeric fields (`$inc`) of all the Digital Replicas matching `query`.
+
+        Returns:
+            int: the number of modified Digital Replicas
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            collection_name = self.schema_registry.get_collection_name(dr_type)
+
+            result = self.db[collection_name].update_many(
+                query,
+                {"$inc": increments, "$set": {"metadata.updated_at": datetime.utcnow()}}
+            )
+            if result.modified_count:
+                self._notify_change(dr_type, None)
+
+            return result.modified_count
+
+        except Exception as e:
+            raise Exception(f"Failed to increment Digital Replicas: {str(e)}")
+
+    @_timed("delete")
     def delete_dr(self, dr_type: str, dr_id: str) -> None:
         if not self.is_connected():
             raise ConnectionError("Not connected to MongoDB")
@@ -109,5 +353,149 @@ class DatabaseService:
             if result.deleted_count == 0:
                 raise ValueError(f"Digital Replica not found: {dr_id}")
 
+            self._notify_change(dr_type, [dr_id])
+
         except Exception as e:
             raise Exception(f"Failed to delete Digital Replica: {str(e)}")
+
+    def ensure_timeseries_collection(
+        self,
+        collection_name: str,
+        time_field: str = "timestamp",
+        meta_field: str = "node_id",
+        granularity: str = "seconds",
+        expire_after_seconds: Optional[int] = None,
+    ) -> None:
+        """
+        Create a MongoDB time-series collection if it does not exist.
+        If it exists, only the retention (`expireAfterSeconds`) is updated.
+
+        The embedded backends keep the options in the process (cf `memory_database.TTL`): they are declared
+        by each process.
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            if self.backend != "mongodb" or collection_name not in self.db.list_collection_names():
+                options = {
+                    "timeseries": {
+                        "timeField": time_field,
+                        "metaField": meta_field,
+                        "granularity": granularity,
+                    }
+                }
+                if expire_after_seconds:
+                    options["expireAfterSeconds"] = expire_after_seconds
+
+                self.db.create_collection(collection_name, **options)
+                self.db[collection_name].create_index([(meta_field, 1), (time_field, -1)])
+
+            else:
+                self.db.command(
+                    "collMod",
+                    collection_name,
+                    expireAfterSeconds=expire_after_seconds if expire_after_seconds else "off",
+                )
+
+        except Exception as e:
+            raise Exception(f"Failed to initialize time-series collection {collection_name}: {str(e)}")
+
+    @_timed("insert", on_dr_type=False)
+    def insert_records(self, collection_name: str, records: List[Dict]) -> int:
+        """
+        Insert a batch of records (e.g time-series measurements) with a single unordered `insert_many`
+
+        `insert_many` sets the `_id` of the records, which they keep when a failed batch is retried
+        (cf `BatchWriter`): the readers can deduplicate them (`find_records(..., unique=True)`).
+
+        Returns:
+            int: the number of inserted records
+
+        Raises:
+            PartialWriteError: Some records were not inserted (the others are, the insert is unordered)
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        if not records:
+            return 0
+
+        try:
+            result = self.db[collection_name].insert_many(records, ordered=False)
+            return len(result.inserted_ids)
+
+        except BulkWriteError as e:
+            failed = [records[error["index"]] for error in e.details.get("writeErrors", [])]
+            if failed:
+                raise PartialWriteError(
+                    f"Failed to insert {len(failed)} of {len(records)} records in {collection_name}: {str(e)}", failed
+                )
+            raise Exception(f"Failed to insert records in {collection_name}: {str(e)}")
+
+        except Exception as e:
+            raise Exception(f"Failed to insert records in {collection_name}: {str(e)}")
+
+    @_timed("query", on_dr_type=False)
+    def find_records(
+        self,
+        collection_name: str,
+        query: Optional[Dict] = None,
+        projection: Optional[Dict] = None,
+        sort: Optional[List] = None,
+        limit: int = 0,
+        unique: bool = False,
+    ) -> List[Dict]:
+        """
+        Find records (e.g time-series measurements) in a collection
+
+        Args:
+            unique: Only return the first record of each `_id`. Time-series collections do not enforce
+                    a unique `_id`, and a batch retried by `BatchWriter` can store a record twice
+        """
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        hide_id = False
+        if unique and projection is not None and not projection.get("_id", True):
+            hide_id = True
+            projection = {key: value for key, value in projection.items() if key != "_id"} or None
+
+        try:
+            cursor = self.db[collection_name].find(query or {}, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+
+            if not unique:
+                return list(cursor)
+
+            records, seen = [], set()
+            for record in cursor:
+                if record["_id"] not in seen:
+                    seen.add(record["_id"])
+                    if hide_id:
+                        del record["_id"]
+                    records.append(record)
+
+            return records
+
+        except Exception as e:
+            raise Exception(f"Failed to find records in {collection_name}: {str(e)}")
+
+    @_timed("aggregate", on_dr_type=False)
+    def aggregate_records(self, collection_name: str, pipeline: List[Dict]) -> List[Dict]:
+        """Run an aggregation pipeline on a collection (server side) and return its result"""
+
+        if not self.is_connected():
+            raise ConnectionError("Not connected to MongoDB")
+
+        try:
+            return list(self.db[collection_name].aggregate(pipeline))
+
+        except Exception as e:
+            raise Exception(f"Failed to aggregate records in {collection_name}: {str(e)}")
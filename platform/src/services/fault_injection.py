@@ -0,0 +1,280 @@
+"""
+Fault injection: latency, errors and disconnects on the dependencies of the hot paths, to measure how the
+tail latency and the throughput degrade when they are slow or failing (cf `python -m loadtest run --compare`).
+
+The faults are configured at startup by a spec (`FAULTS` environment variable), rules separated by `;`:
+
+    <component>.<fault>[=<value>][@<probability>]
+
+    email.stub; email.latency=30s@1            SMTP taking 30 s (without sending the emails)
+    discord.stub; discord.error=429@0.5        Half of the Discord webhooks rejected (as with a HTTP 429)
+    db.latency=5ms-50ms@0.1                    10 % of the database operations 5 to 50 ms slower
+    mqtt.disconnect=10s@0.001                  The broker connection lost for 10 s (0.1 % of the calls start an outage)
+
+Components: `email` (`Emailer.send`), `discord` (`Discorder.send`), `db` (the `DatabaseService` operations) and
+`mqtt` (`NodeMQTTHandler` or `MQTTGatewayClient`: reservations and group commands). Faults:
+    - `latency=<duration>` or `<min>-<max>` (uniform): the call is delayed
+    - `error[=<label>]`: the call fails
+    - `disconnect=<duration>`: an outage starts, during which all the calls of the component fail
+    - `stub` (email and discord only, no probability): the real dependency is not called, the call succeeds
+
+A failed call fails as the real one does: the methods reporting a failure by their result return it (`False`
+for a Discord send or an MQTT publish), the others raise `InjectedError` (or `InjectedDisconnect`, a
+`ConnectionError`). Each worker draws its own faults (`FAULTS_SEED` makes the draws reproducible) and counts them
+in the `faults_injected_total` metric.
+
+Without spec, `FAULTS.wrap` returns the components themselves: no cost.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from threading import Lock
+import functools
+import random
+import re
+import time
+
+from src.services.metrics import FAULTS_INJECTED
+from observability.tracing import TRACER
+
+# Result of a failed call: the call raises
+RAISE = object()
+
+# Component -> wrapped method -> result of a failed call
+COMPONENTS: Dict[str, Dict[str, Any]] = {
+    "email": {"send": RAISE},
+    "discord": {"send": False},  # Non-204 response
+    "db": {
+        name: RAISE
+        for name in (
+            "save_dr", "get_dr", "get_drs", "query_drs", "aggregate_drs", "update_dr", "update_drs",
+            "bulk_update_drs", "increment_drs", "delete_dr", "insert_records", "find_records", "aggregate_records",
+        )
+    },
+    "mqtt": {"reserve_node": False, "cancel_reservation": False, "send_group_command": RAISE},  # Publish rejected
+}
+
+# Component -> method -> result of a stubbed call
+STUB_RESULTS: Dict[str, Dict[str, Any]] = {
+    "email": {"send": None},
+    "discord": {"send": True},
+}
+
+FAULT_TYPES = ("latency", "error", "disconnect", "stub")
+
+_RULE_PATTERN = re.compile(r"^(?P<component>\w+)\.(?P<fault>\w+)(?:=(?P<value>[^@]+))?(?:@(?P<probability>[\d.]+))?$")
+_DURATION_PATTERN = re.compile(r"^([\d.]+)(ms|s|m)?$")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, None: 1.0}
+
+
+class InjectedError(Exception):
+    """Error injected in a call"""
+
+
+class InjectedDisconnect(ConnectionError):
+    """Call made during an injected outage"""
+
+
+def parse_duration(text: str) -> float:
+    """
+    Duration in seconds of `30s`, `250ms`, `2m` or `1.5` (seconds)
+
+    Raises:
+        ValueError: if `text` is not a duration
+    """
+    match = _DURATION_PATTERN.match(text.strip())
+    if match is None:
+        raise ValueError(f"Invalid duration: {text!r} (e.g 30s, 250ms, 2m)")
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+
+class FaultRule:
+    """A fault of a component (cf module documentation)"""
+
+    def __init__(self, component: str, fault: str, probability: float = 1.0, value: Optional[str] = None):
+        """
+        Raises:
+            ValueError: for an unknown component or fault, a probability out of [0, 1] or an invalid duration
+        """
+        if component not in COMPONENTS:
+            raise ValueError(f"Unknown fault injection component: {component} (expected {', '.join(COMPONENTS)})")
+        if fault not in FAULT_TYPES:
+            raise ValueError(f"Unknown fault: {fault} (expected {', '.join(FAULT_TYPES)})")
+        if fault == "stub" and component not in STUB_RESULTS:
+            raise ValueError(f"The {component} component cannot be stubbed (only {', '.join(STUB_RESULTS)})")
+        if not 0 <= probability <= 1 or (fault == "stub" and probability != 1):
+            raise ValueError(f"Invalid probability of {component}.{fault}: {probability}")
+
+        self.component = component
+        self.fault = fault
+        self.probability = probability
+        self.value = value
+
+        # Duration range (s) of a latency or of an outage
+        self.duration: Tuple[float, float] = (0.0, 0.0)
+        if fault in ("latency", "disconnect"):
+            if not value:
+                raise ValueError(f"{component}.{fault} needs a duration (e.g {component}.{fault}=1s@0.1)")
+            low, _, high = value.partition("-")
+            self.duration = (parse_duration(low), parse_duration(high or low))
+
+    def draw_duration(self, rng: random.Random) -> float:
+        low, high = self.duration
+        return low if low == high else rng.uniform(low, high)
+
+    def to_dict(self) -> Dict:
+        return {"component": self.component, "fault": self.fault, "value": self.value, "probability": self.probability}
+
+    def __repr__(self) -> str:
+        value = f"={self.value}" if self.value else ""
+        return f"{self.component}.{self.fault}{value}@{self.probability:g}"
+
+
+def parse_faults(spec: str) -> List[FaultRule]:
+    """
+    Rules of a spec (cf module documentation), e.g `email.latency=30s@1; discord.error=429@0.5`
+
+    Raises:
+        ValueError: if a rule is invalid
+    """
+    rules = []
+    for text in filter(None, (text.strip() for text in re.split(r"[;\n]", spec or ""))):
+        match = _RULE_PATTERN.match(text.replace(" ", ""))
+        if match is None:
+            raise ValueError(f"Invalid fault rule: {text!r} (expected <component>.<fault>[=<value>][@<probability>])")
+        probability = float(match.group("probability")) if match.group("probability") is not None else 1.0
+        rules.append(FaultRule(match.group("component"), match.group("fault"), probability, match.group("value")))
+    return rules
+
+
+class FaultProxy:
+    """A component whose methods listed in `COMPONENTS` go through the injector (the other attributes are forwarded)"""
+
+    def __init__(self, injector: "FaultInjector", component: str, target: Any):
+        self._injector = injector
+        self._component = component
+        self._target = target
+
+    def __getattr__(self, name: str) -> Any:
+        value = getattr(self._target, name)
+        if name not in COMPONENTS[self._component] or not callable(value):
+            return value
+        return functools.partial(self._injector.call, self._component, name, value)
+
+    def __repr__(self) -> str:
+        return f"FaultProxy({self._component}, {self._target!r})"
+
+
+class FaultInjector:
+    """Draws the faults of the calls of the wrapped components (cf module documentation)"""
+
+    def __init__(self):
+        self.rules: Dict[str, List[FaultRule]] = {}
+        self._random = random.Random()
+        self._down_until: Dict[str, float] = {}  # Component -> end of its outage (monotonic)
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rules)
+
+    def configure(self, rules: List[FaultRule], seed: Optional[int] = None) -> None:
+        by_component: Dict[str, List[FaultRule]] = {}
+        for rule in rules:
+            by_component.setdefault(rule.component, []).append(rule)
+
+        with self._lock:
+            self.rules = by_component
+            self._random = random.Random(seed)
+            self._down_until.clear()
+            self._counts.clear()
+
+    def wrap(self, component: str, target: Any) -> Any:
+        """`target` itself if no rule applies to `component`, otherwise a `FaultProxy` of it"""
+        if component not in self.rules:
+            return target
+        return FaultProxy(self, component, target)
+
+    def _count(self, component: str, fault: str) -> None:
+        with self._lock:
+            self._counts[(component, fault)] = self._counts.get((component, fault), 0) + 1
+        FAULTS_INJECTED.labels(component, fault).inc()
+
+    def _fail(self, component: str, method: str, error: Exception) -> Any:
+        result = COMPONENTS[component][method]
+        if result is RAISE:
+            raise error
+        return result
+
+    def call(self, component: str, method: str, function: Callable, *args, **kwargs) -> Any:
+        """Calls `function` (the method `method` of the component) with the faults of the component"""
+
+        rules = self.rules.get(component, ())
+        now = time.monotonic()
+
+        if self._down_until.get(component, 0.0) > now:
+            self._count(component, "disconnect")
+            return self._fail(component, method, InjectedDisconnect(f"Injected outage of {component} ({method})"))
+
+        stubbed = False
+        for rule in rules:
+            if rule.fault == "stub":
+                stubbed = True
+                continue
+
+            with self._lock:
+                drawn = self._random.random() < rule.probability
+                duration = rule.draw_duration(self._random) if drawn else 0.0
+            if not drawn:
+                continue
+
+            self._count(component, rule.fault)
+
+            if rule.fault == "latency":
+                with TRACER.start_span(f"fault.{component}.latency", attributes={"fault.delay_ms": round(duration * 1000, 3)}):
+                    time.sleep(duration)
+
+            elif rule.fault == "error":
+                label = f" ({rule.value})" if rule.value else ""
+                return self._fail(component, method, InjectedError(f"Injected error{label} in {component}.{method}"))
+
+            else:  # disconnect
+                with self._lock:
+                    self._down_until[component] = max(self._down_until.get(component, 0.0), time.monotonic() + duration)
+                return self._fail(component, method, InjectedDisconnect(f"Injected disconnect of {component} ({method})"))
+
+        if stubbed:
+            return STUB_RESULTS[component][method]
+
+        return function(*args, **kwargs)
+
+    def stats(self) -> Dict:
+        """{enabled, rules, injected: {<component>.<fault>: count}, outages: {component: remaining s}} of this process"""
+
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "rules": [rule.to_dict() for rules in self.rules.values() for rule in rules],
+                "injected": {f"{component}.{fault}": count for (component, fault), count in sorted(self._counts.items())},
+                "outages": {component: round(end - now, 3) for component, end in self._down_until.items() if end > now},
+            }
+
+
+# Fault injector of the process (disabled until `configure_faults` is called with rules)
+FAULTS = FaultInjector()
+
+
+def configure_faults(config: Dict) -> None:
+    """
+    Configure `FAULTS` for this process
+
+    Args:
+        config: {spec, seed}, cf module documentation for the spec
+
+    Raises:
+        ValueError: if the spec is invalid
+    """
+    rules = parse_faults(config["spec"])
+    if rules:
+        FAULTS.configure(rules, config["seed"])
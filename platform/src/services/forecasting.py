@@ -0,0 +1,450 @@
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+import logging
+import numpy as np
+from pymongo import UpdateOne
+from .base import BaseService
+from .status_history import StatusHistory
+
+logger = logging.getLogger(__name__)
+
+MODELS_COLLECTION = "occupancy_forecast_models"
+
+# Slots are counted from a Monday (UTC), so that the slot of the week is `slot % slots_per_week`
+_EPOCH = datetime(1970, 1, 5)
+_WEEK_S = 7 * 86400
+
+
+class _ForecastModel:
+    """Forecast state of a set of nodes (one row per node)"""
+
+    def __init__(self, node_ids: List[str], slots_per_week: int):
+        self.node_ids = node_ids
+        self.index = {node_id: i for i, node_id in enumerate(node_ids)}
+
+        n = len(node_ids)
+        self.baseline = np.zeros((n, slots_per_week), dtype=np.float32)  # Free fraction per slot of the week
+        self.counts = np.zeros((n, slots_per_week), dtype=np.uint16)     # Observations per slot of the week
+        self.level = np.zeros(n, dtype=np.float64)                        # Recent deviation from the baseline
+        self.fitted_until = np.zeros(n, dtype=np.int64)                   # Absolute slot up to which each node is fitted
+        self.last_status: List[Optional[str]] = [None] * n                # Status at `fitted_until`
+
+
+class OccupancyForecastService(BaseService):
+    """
+    Forecast of the availability of the parking nodes of a Digital Twin, learned from the status history.
+
+    Time is cut in slots (15 minutes by default). For each node, the model is:
+        - a seasonal baseline: the free fraction of each slot of the week, averaged with an EWMA
+          over the past weeks (`alpha`)
+        - a level: EWMA (`beta`) of the deviation of the recent slots from the baseline, damped
+          by `phi` per slot of horizon (a damped Holt-Winters model without trend)
+
+        P(free at T) = clip(baseline[slot_of_week(T)] + level * phi ** horizon, 0, 1)
+
+    Fitting is vectorized over all the nodes (the time spent free in each slot is computed for
+    every node at once) and incremental: the model of each node is stored in the
+    `occupancy_forecast_models` collection with the slot it is fitted up to, so a refit only
+    reads the transitions since the previous one (e.g one day for a nightly refit, cf the
+    `schedule` configuration of `ServiceScheduler`). The model is also brought up to date when it
+    lags more than `max_lag_minutes` behind.
+
+    Predictions are cached per slot until the next refit.
+    """
+
+    FREE_STATUS = "free"
+
+    DEFAULT_SLOT_MINUTES = 15
+    DEFAULT_HISTORY_DAYS = 28
+    DEFAULT_ALPHA = 0.1
+    DEFAULT_BETA = 0.3
+    DEFAULT_PHI = 0.9
+    DEFAULT_MAX_LAG_MINUTES = 60
+    PREDICTION_CACHE_SIZE = 256
+    CHUNK_DAYS = 1
+
+    dr_projection = {"type": 1, "profile.site": 1, "profile.zone": 1}
+
+    def __init__(self):
+        super().__init__()
+        self.slot_minutes = self.DEFAULT_SLOT_MINUTES
+        self.history_days = self.DEFAULT_HISTORY_DAYS
+        self.alpha = self.DEFAULT_ALPHA
+        self.beta = self.DEFAULT_BETA
+        self.phi = self.DEFAULT_PHI
+        self.max_lag_minutes = self.DEFAULT_MAX_LAG_MINUTES
+
+        self._model: Optional[_ForecastModel] = None
+        self._predictions: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._lock = Lock()
+
+    def configure(self, config: Dict) -> None:
+        """
+        Args:
+            config: Service configuration. Supported keys:
+                - slot_minutes: Length of a slot (must divide a day)
+                - history_days: History used to fit a new node
+                - alpha: Learning rate of the seasonal baseline
+                - beta: Learning rate of the level
+                - phi: Damping of the level per slot of horizon
+                - max_lag_minutes: Refit before predicting when the model is older than this
+        """
+        slot_minutes = int(config.get("slot_minutes", self.slot_minutes))
+        if slot_minutes <= 0 or 1440 % slot_minutes:
+            raise ValueError("slot_minutes must divide a day")
+
+        self.slot_minutes = slot_minutes
+        self.history_days = int(config.get("history_days", self.history_days))
+        self.alpha = float(config.get("alpha", self.alpha))
+        self.beta = float(config.get("beta", self.beta))
+        self.phi = float(config.get("phi", self.phi))
+        self.max_lag_minutes = float(config.get("max_lag_minutes", self.max_lag_minutes))
+
+    @property
+    def slot_s(self) -> int:
+        return self.slot_minutes * 60
+
+    @property
+    def slots_per_week(self) -> int:
+        return _WEEK_S // self.slot_s
+
+    def execute(
+        self,
+        data: Dict,
+        dr_type: str = None,
+        attribute: str = None,
+        status_history: StatusHistory = None,
+        at: Optional[datetime | str] = None,
+        node_id: Optional[str] = None,
+        refit: bool = False,
+    ) -> Dict:
+        """
+        Forecast the probability that the nodes of the Digital Twin are free at a given time
+
+        Args:
+            data: Dictionary containing the DT data including all DRs
+            dr_type: Type of the parking spot DRs (default: 'node')
+            attribute: Restrict the result to 'nodes' or 'zones' (both if None)
+            status_history: History of the node status transitions (cf `StatusHistory`)
+            at: Time of the forecast, datetime or ISO 8601 (default: now). With an offset (e.g the `Z` of
+                JavaScript `toISOString`), it is converted to UTC: the slots are naive UTC
+            node_id: Only forecast this node
+            refit: Only bring the model up to date (e.g scheduled nightly) and return its state
+        """
+        if not data or "digital_replicas" not in data:
+            raise ValueError("Invalid data: missing digital replicas")
+
+        if status_history is None:
+            raise ValueError("OccupancyForecastService needs the status history")
+
+        if isinstance(at, str):
+            at = datetime.fromisoformat(at)
+        if at is not None and at.tzinfo is not None:
+            at = at.astimezone(timezone.utc).replace(tzinfo=None)
+
+        dr_type = dr_type or "node"
+        nodes = {dr["_id"]: dr for dr in data["digital_replicas"] if dr.get("type") == dr_type}
+
+        if not nodes:
+            return {"error": f"No digital replicas found of type {dr_type}"}
+
+        if node_id is not None and node_id not in nodes:
+            raise ValueError(f"Node {node_id} not found in the Digital Twin")
+
+        now = datetime.utcnow()
+
+        with self._lock:
+            model = self._get_model(sorted(nodes), status_history)
+
+            lag_s = (self._slot_of(now) - int(model.fitted_until.min())) * self.slot_s
+            if refit or lag_s > self.max_lag_minutes * 60:
+                self._update(model, status_history, now)
+
+            if refit:
+                return {
+                    "nb_nodes": len(model.node_ids),
+                    "fitted_until": self._time_of(int(model.fitted_until.min())),
+                    "observed_slots": int(np.count_nonzero(model.counts)),
+                }
+
+            at = at or now
+            probabilities = self._predict(model, self._slot_of(at))
+
+        result = {
+            "at": at,
+            "fitted_until": self._time_of(int(model.fitted_until.min())),
+            "slot_minutes": self.slot_minutes,
+        }
+
+        if node_id is not None:
+            result["nodes"] = {node_id: self._probability(probabilities[model.index[node_id]])}
+            return result
+
+        if attribute in (None, "nodes"):
+            result["nodes"] = {
+                node: self._probability(probabilities[model.index[node]]) for node in nodes
+            }
+
+        if attribute in (None, "zones"):
+            result["zones"] = self._zone_forecast(nodes, model, probabilities)
+
+        return result
+
+    def _slot_of(self, t: datetime) -> int:
+        """Absolute slot containing `t`"""
+        return int((t - _EPOCH).total_seconds() // self.slot_s)
+
+    def _time_of(self, slot: int) -> datetime:
+        """Start of an absolute slot"""
+        return _EPOCH + timedelta(seconds=slot * self.slot_s)
+
+    @staticmethod
+    def _probability(p: float) -> Optional[float]:
+        return None if np.isnan(p) else float(p)
+
+    def _predict(self, model: _ForecastModel, slot: int) -> np.ndarray:
+        """P(free) of every node of the model during an absolute slot (NaN: never observed)"""
+        cached = self._predictions.get(slot)
+        if cached is not None:
+            self._predictions.move_to_end(slot)
+            return cached
+
+        week_slot = slot % self.slots_per_week
+        horizon = np.maximum(slot - model.fitted_until, 0)
+
+        baseline = model.baseline[:, week_slot].astype(np.float64)
+        probabilities = np.clip(baseline + model.level * self.phi ** horizon, 0.0, 1.0)
+        probabilities[model.counts[:, week_slot] == 0] = np.nan
+
+        self._predictions[slot] = probabilities
+        if len(self._predictions) > self.PREDICTION_CACHE_SIZE:
+            self._predictions.popitem(last=False)
+
+        return probabilities
+
+    def _zone_forecast(self, nodes: Dict[str, Dict], model: _ForecastModel, probabilities: np.ndarray) -> Dict:
+        """Per `site/zone`: expected number of free nodes and probability that at least one is free"""
+        zones: Dict[str, List[int]] = {}
+
+        for node_id, dr in nodes.items():
+            profile = dr.get("profile", {})
+            zone = f"{profile.get('site') or '-'}/{profile.get('zone') or '-'}"
+            zones.setdefault(zone, []).append(model.index[node_id])
+
+        result = {}
+        for zone, rows in zones.items():
+            p = probabilities[rows]
+            known = p[~np.isnan(p)]
+
+            result[zone] = {
+                "nb_nodes": len(rows),
+                "nb_forecast": int(known.size),
+                "expected_free": float(known.sum()),
+                "p_any_free": float(1.0 - np.prod(1.0 - known)) if known.size else None,
+            }
+
+        return result
+
+    def _model_key(self, node_id: str) -> str:
+        return f"{node_id}:{self.slot_minutes}"
+
+    def _get_model(self, node_ids: List[str], status_history: StatusHistory) -> _ForecastModel:
+        """The model of `node_ids`, loaded from the database the first time (or when the nodes change)"""
+        if self._model is not None and self._model.node_ids == node_ids:
+            return self._model
+
+        model = _ForecastModel(node_ids, self.slots_per_week)
+        new_node_slot = self._slot_of(datetime.utcnow() - timedelta(days=self.history_days))
+        model.fitted_until[:] = new_node_slot
+
+        collection = status_history.db_service.db[MODELS_COLLECTION]
+        keys = [self._model_key(node_id) for node_id in node_ids]
+
+        for doc in collection.find({"_id": {"$in": keys}}):
+            i = model.index[doc["node_id"]]
+            model.baseline[i] = np.frombuffer(doc["baseline"], dtype=np.float32)
+            model.counts[i] = np.frombuffer(doc["counts"], dtype=np.uint16)
+            model.level[i] = doc["level"]
+            model.fitted_until[i] = doc["fitted_until"]
+            model.last_status[i] = doc.get("last_status")
+
+        self._model = model
+        self._predictions.clear()
+        return model
+
+    def _save_model(self, model: _ForecastModel, status_history: StatusHistory) -> None:
+        operations = [
+            UpdateOne(
+                {"_id": self._model_key(node_id)},
+                {"$set": {
+                    "node_id": node_id,
+                    "slot_minutes": self.slot_minutes,
+                    "baseline": model.baseline[i].tobytes(),
+                    "counts": model.counts[i].tobytes(),
+                    "level": float(model.level[i]),
+                    "fitted_until": int(model.fitted_until[i]),
+                    "last_status": model.last_status[i],
+                    "updated_at": datetime.utcnow(),
+                }},
+                upsert=True,
+            )
+            for i, node_id in enumerate(model.node_ids)
+        ]
+
+        collection = status_history.db_service.db[MODELS_COLLECTION]
+        for i in range(0, len(operations), 1000):
+            collection.bulk_write(operations[i:i + 1000], ordered=False)
+
+    def _update(self, model: _ForecastModel, status_history: StatusHistory, now: datetime) -> None:
+        """Fit the model on the complete slots since the oldest `fitted_until` (one day of history at a time)"""
+        end_slot = self._slot_of(now)
+        oldest_slot = self._slot_of(now - timedelta(days=self.history_days))
+
+        # Nodes that were not refitted for longer than the history restart from the history start
+        model.fitted_until = np.maximum(model.fitted_until, oldest_slot)
+        start_slot = int(model.fitted_until.min())
+
+        if start_slot >= end_slot:
+            return
+
+        chunk_slots = self.CHUNK_DAYS * 86400 // self.slot_s
+        statuses = None
+
+        for chunk_start in range(start_slot, end_slot, chunk_slots):
+            chunk_end = min(chunk_start + chunk_slots, end_slot)
+            start = self._time_of(chunk_start)
+
+            if statuses is None:
+                statuses = self._statuses_at(model, chunk_start, status_history)
+
+            transitions = status_history.query_range(
+                start,
+                self._time_of(chunk_end),
+                model.node_ids,
+                projection={"_id": False, "node_id": True, "timestamp": True, "new_status": True},
+            )
+
+            free_fraction, statuses = self._free_fraction(model, start, chunk_end - chunk_start, statuses, transitions)
+            self._fit(model, chunk_start, free_fraction)
+
+        model.last_status = statuses
+        self._predictions.clear()
+        self._save_model(model, status_history)
+
+        logger.debug(
+            "Forecast model of %d nodes fitted on %d slots", len(model.node_ids), end_slot - start_slot
+        )
+
+    def _statuses_at(self, model: _ForecastModel, slot: int, status_history: StatusHistory) -> List[Optional[str]]:
+        """
+        Status of the nodes at the start of `slot`: the status stored at the end of the previous fit
+        when the node is fitted up to `slot`, otherwise the last transition before (server side)
+        """
+        statuses = [
+            status if fitted_until == slot else None
+            for status, fitted_until in zip(model.last_status, model.fitted_until)
+        ]
+
+        missing = [node_id for node_id, status in zip(model.node_ids, statuses) if status is None]
+        if missing:
+            known = status_history.statuses_at(self._time_of(slot), missing)
+            for node_id in missing:
+                statuses[model.index[node_id]] = known.get(node_id)
+
+        return statuses
+
+    def _free_fraction(
+        self,
+        model: _ForecastModel,
+        start: datetime,
+        nb_slots: int,
+        statuses: List[Optional[str]],
+        transitions: List[Dict],
+    ) -> Tuple[np.ndarray, List[Optional[str]]]:
+        """
+        Fraction of each slot each node spent free, for all nodes at once.
+
+        The status of a node is piecewise constant, so the time it spent free since `start` is a
+        piecewise linear function of time. Laying the nodes end to end on one time axis (node `i`
+        occupies [i * 2 * span, i * 2 * span + span]) turns the time free in every slot of every node
+        into one `np.interp` of the cumulated time free at the slot bounds.
+
+        Returns:
+            Tuple[np.ndarray, List[Optional[str]]]: The (nodes, slots) free fractions (NaN where the
+                status is unknown for most of the slot), and the status of each node at the end
+        """
+        n = len(model.node_ids)
+        span = nb_slots * self.slot_s
+        width = 2.0 * span
+
+        # Segments: the status at `start` of each node, then its transitions
+        seg_node = np.arange(n)
+        seg_t = np.zeros(n)
+        seg_status = np.array(statuses, dtype=object)
+
+        if transitions:
+            seg_node = np.concatenate([seg_node, [model.index[t["node_id"]] for t in transitions]])
+            offsets = (
+                np.array([t["timestamp"] for t in transitions], dtype="datetime64[ms]") - np.datetime64(start, "ms")
+            ) / np.timedelta64(1, "s")
+            seg_t = np.concatenate([seg_t, offsets])
+            seg_status = np.concatenate([seg_status, np.array([t["new_status"] for t in transitions], dtype=object)])
+
+            order = np.lexsort((np.arange(seg_node.size), seg_t, seg_node))
+            seg_node, seg_t, seg_status = seg_node[order], seg_t[order], seg_status[order]
+
+        is_last = np.append(seg_node[1:] != seg_node[:-1], True)
+        seg_end = np.append(seg_t[1:], span)
+        seg_end[is_last] = span
+        duration = seg_end - seg_t
+
+        is_free = seg_status == self.FREE_STATUS
+        is_known = np.array([status is not None for status in seg_status], dtype=bool)
+
+        # Cumulated time (free, known) at the start of each segment and at the end of each node
+        x = np.concatenate([seg_node * width + seg_t, np.arange(n) * width + span])
+        order = np.argsort(x, kind="stable")
+        x = x[order]
+
+        bounds = np.arange(n)[:, None] * width + np.arange(nb_slots + 1)[None, :] * self.slot_s
+
+        slot_time = []
+        for mask in (is_free, is_known):
+            weighted = duration * mask
+            cumulated = np.cumsum(weighted)
+            y = np.concatenate([cumulated - weighted, cumulated[is_last]])[order]
+            at_bounds = np.interp(bounds.ravel(), x, y).reshape(n, nb_slots + 1)
+            slot_time.append(np.diff(at_bounds, axis=1))
+
+        free_s, known_s = slot_time
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(known_s >= self.slot_s / 2, free_s / known_s, np.nan)
+
+        return fraction, list(seg_status[is_last])
+
+    def _fit(self, model: _ForecastModel, first_slot: int, free_fraction: np.ndarray) -> None:
+        """Update the baselines and levels with the consecutive slots starting at `first_slot` (vectorized over nodes)"""
+        nb_slots = free_fraction.shape[1]
+        observed = ~np.isnan(free_fraction)
+        observed &= (first_slot + np.arange(nb_slots))[None, :] >= model.fitted_until[:, None]
+        values = np.where(observed, free_fraction, 0.0)
+
+        for k in range(nb_slots):
+            week_slot = (first_slot + k) % self.slots_per_week
+            mask = observed[:, k]
+            x = values[:, k]
+
+            baseline = model.baseline[:, week_slot].astype(np.float64)
+            counts = model.counts[:, week_slot]
+
+            # First observations of a slot are averaged, then the older weeks fade out at `alpha`
+            rate = np.maximum(self.alpha, 1.0 / (counts + 1.0))
+            residual = np.where(counts > 0, x - baseline, 0.0)
+
+            model.level = np.where(mask, (1 - self.beta) * model.level + self.beta * residual, model.level)
+            model.baseline[:, week_slot] = np.where(mask, baseline + rate * (x - baseline), baseline)
+            model.counts[:, week_slot] = np.where(mask & (counts < np.iinfo(np.uint16).max), counts + 1, counts)
+
+        model.fitted_until = np.maximum(model.fitted_until, first_slot + nb_slots)
@@ -0,0 +1,815 @@
+"""
+In-memory stand-in for a MongoDB database: the subset of the pymongo API used by the platform, without server.
+
+Selected by the `memory://` connection string (cf `storage`):
+
+    db_service = DatabaseService("memory://", "iot_parking", schema_registry)
+
+Used by the benchmarks (deterministic, no network): the documents are copied on each write and read, as they are
+(de)serialized by a real database, so that callers cannot modify the stored documents.
+
+Supported:
+    - queries: implicit equality (with dotted paths and arrays), $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin,
+      $exists, $regex, $not, $size, $all, $elemMatch, $and, $or, $nor
+    - updates: $set, $unset, $inc, $min, $max, $push, $pull, $addToSet, $setOnInsert (and upserts)
+    - aggregation stages: $match, $project (inclusion / exclusion), $group ($sum, $avg, $min, $max, $first, $last,
+      $push, $addToSet), $sort, $skip, $limit, $unwind, $count
+    - TTL of the time-series collections (`expireAfterSeconds` of `create_collection` and `collMod`): the expired
+      documents are deleted by the inserts, at most every `TTL_PERIOD_S` (cf `TTL`)
+Not supported (NotImplementedError): other aggregation stages and operators, change streams, transactions,
+replacement documents, TTL indexes.
+
+The indexes (`create_index`, e.g the ones declared in the schemas, cf `DatabaseService.ensure_indexes`) are hash
+indexes on their first field: the equality and `$in` conditions on that field only scan the matching documents.
+The unique indexes reject the duplicates.
+
+The data only lives in the process: one process per database (e.g the benchmarks, tests, or a single worker
+without separate MQTT gateway). Cf `sqlite_database` to share an embedded database between processes.
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import re
+import threading
+import time
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+
+TTL_PERIOD_S = 60  # Period of the deletion of the expired documents (as the MongoDB TTL monitor)
+
+
+def _copy(value: Any) -> Any:
+    """Copy of a document (faster than `copy.deepcopy` for JSON-like values; scalars are immutable)"""
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _get_values(document: Any, path: List[str]) -> List[Any]:
+    """Values at a dotted path, traversing the arrays (as MongoDB does). Empty if the path does not exist"""
+    if not path:
+        return [document]
+
+    if isinstance(document, dict):
+        if path[0] not in document:
+            return []
+        return _get_values(document[path[0]], path[1:])
+
+    if isinstance(document, list):
+        if path[0].isdigit():
+            index = int(path[0])
+            return _get_values(document[index], path[1:]) if index < len(document) else []
+        values = []
+        for item in document:
+            values.extend(_get_values(item, path))
+        return values
+
+    return []
+
+
+def get_value(document: Dict, path: str, default: Any = None) -> Any:
+    """Value at a dotted path (no array traversal), `default` if missing"""
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+def _compare(value: Any, other: Any, operator: Callable[[Any, Any], bool]) -> bool:
+    try:
+        return value is not None and other is not None and operator(value, other)
+    except TypeError:  # Different types never match (MongoDB compares by type first)
+        return False
+
+
+def _candidates(values: List[Any]) -> List[Any]:
+    """The values to compare with: each value, and the elements of the arrays"""
+    candidates = []
+    for value in values:
+        candidates.append(value)
+        if isinstance(value, list):
+            candidates.extend(value)
+    return candidates
+
+
+def _match_operators(values: List[Any], condition: Dict) -> bool:
+    for operator, argument in condition.items():
+        candidates = _candidates(values)
+
+        if operator == "$eq":
+            ok = argument in candidates or (argument is None and not values)
+        elif operator == "$ne":
+            ok = not (argument in candidates or (argument is None and not values))
+        elif operator == "$in":
+            ok = any(_match_value(values, item) for item in argument)
+        elif operator == "$nin":
+            ok = not any(_match_value(values, item) for item in argument)
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            compare = {
+                "$gt": lambda a, b: a > b, "$gte": lambda a, b: a >= b,
+                "$lt": lambda a, b: a < b, "$lte": lambda a, b: a <= b,
+            }[operator]
+            ok = any(_compare(candidate, argument, compare) for candidate in candidates)
+        elif operator == "$exists":
+            ok = bool(values) == bool(argument)
+        elif operator == "$regex":
+            flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+            pattern = argument if isinstance(argument, re.Pattern) else re.compile(argument, flags)
+            ok = any(isinstance(candidate, str) and pattern.search(candidate) for candidate in candidates)
+        elif operator == "$options":
+            continue
+        elif operator == "$not":
+            ok = not _match_operators(values, argument)
+        elif operator == "$size":
+            ok = any(isinstance(value, list) and len(value) == argument for value in values)
+        elif operator == "$all":
+            ok = all(item in candidates for item in argument)
+        elif operator == "$elemMatch":
+            ok = any(
+                isinstance(value, list) and any(
+                    matches(item, argument) if isinstance(item, dict) else _match_operators([item], argument)
+                    for item in value
+                )
+                for value in values
+            )
+        else:
+            raise NotImplementedError(f"Query operator not supported in memory: {operator}")
+
+        if not ok:
+            return False
+
+    return True
+
+
+def _match_value(values: List[Any], expected: Any) -> bool:
+    if isinstance(expected, re.Pattern):
+        return any(isinstance(candidate, str) and expected.search(candidate) for candidate in _candidates(values))
+    if expected is None:
+        return not values or None in _candidates(values)
+    return expected in _candidates(values)
+
+
+def matches(document: Dict, query: Optional[Dict]) -> bool:
+    """Tells if `document` matches the MongoDB `query`"""
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            ok = all(matches(document, sub_query) for sub_query in condition)
+        elif key == "$or":
+            ok = any(matches(document, sub_query) for sub_query in condition)
+        elif key == "$nor":
+            ok = not any(matches(document, sub_query) for sub_query in condition)
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator not supported in memory: {key}")
+        else:
+            values = _get_values(document, key.split("."))
+            if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+                ok = _match_operators(values, condition)
+            else:
+                ok = _match_value(values, condition)
+
+        if not ok:
+            return False
+
+    return True
+
+
+def _set_path(document: Dict, path: str, value: Any) -> None:
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.setdefault(key, {})
+    document[keys[-1]] = value
+
+
+def _unset_path(document: Dict, path: str) -> None:
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+    document.pop(keys[-1], None)
+
+
+def apply_update(document: Dict, update: Dict, inserting: bool = False) -> None:
+    """Applies the MongoDB `update` (operators) to `document`, in place"""
+    for operator, fields in update.items():
+        if operator == "$setOnInsert" and not inserting:
+            continue
+
+        for path, value in fields.items():
+            current = get_value(document, path, _MISSING)
+
+            if operator in ("$set", "$setOnInsert"):
+                _set_path(document, path, _copy(value))
+            elif operator == "$unset":
+                _unset_path(document, path)
+            elif operator == "$inc":
+                _set_path(document, path, (0 if current is _MISSING else current) + value)
+            elif operator == "$min":
+                if current is _MISSING or value < current:
+                    _set_path(document, path, value)
+            elif operator == "$max":
+                if current is _MISSING or value > current:
+                    _set_path(document, path, value)
+            elif operator == "$push":
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                _set_path(document, path, (current if isinstance(current, list) else []) + _copy(items))
+            elif operator == "$addToSet":
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                array = list(current) if isinstance(current, list) else []
+                array.extend(item for item in _copy(items) if item not in array)
+                _set_path(document, path, array)
+            elif operator == "$pull":
+                if isinstance(current, list):
+                    if isinstance(value, dict):
+                        kept = [item for item in current if not (matches(item, value) if isinstance(item, dict) else _match_operators([item], value))]
+                    else:
+                        kept = [item for item in current if item != value]
+                    _set_path(document, path, kept)
+            else:
+                raise NotImplementedError(f"Update operator not supported in memory: {operator}")
+
+
+def project(document: Dict, projection: Optional[Dict]) -> Dict:
+    """Applies a find projection (inclusion or exclusion of dotted paths)"""
+    if not projection:
+        return _copy(document)
+
+    include_id = projection.get("_id", 1)
+    fields = {key: value for key, value in projection.items() if key != "_id"}
+
+    if fields and all(fields.values()):  # Inclusion
+        result = {"_id": document["_id"]} if include_id and "_id" in document else {}
+        for path in fields:
+            value = get_value(document, path, _MISSING)
+            if value is not _MISSING:
+                _set_path(result, path, _copy(value))
+        return result
+
+    result = _copy(document)  # Exclusion
+    for path in fields:
+        _unset_path(result, path)
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def _sort_key(value: Any) -> Tuple:
+    # Missing / None values first in ascending order, then by type (numbers, strings, others)
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (4, value)
+
+
+def sort_documents(documents: List[Dict], keys: List[Tuple[str, int]]) -> List[Dict]:
+    for path, direction in reversed(keys):  # Stable sorts, least significant key first
+        documents.sort(key=lambda document: _sort_key(get_value(document, path, _MISSING)), reverse=direction < 0)
+    return documents
+
+
+class WriteResult:
+    """Result of a write (same attributes as the pymongo results)"""
+
+    def __init__(self, **attributes):
+        self.acknowledged = True
+        self.__dict__.update(attributes)
+
+
+class MemoryCursor:
+    """Result of `find`: iterable, with `sort`, `skip` and `limit`"""
+
+    def __init__(self, documents: List[Dict], projection: Optional[Dict]):
+        self._documents = documents
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction: Optional[int] = None) -> "MemoryCursor":
+        keys = [(key_or_list, direction or ASCENDING)] if isinstance(key_or_list, str) else list(key_or_list)
+        sort_documents(self._documents, keys)
+        return self
+
+    def skip(self, skip: int) -> "MemoryCursor":
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int) -> "MemoryCursor":
+        self._limit = limit
+        return self
+
+    def __iter__(self) -> Iterator[Dict]:
+        end = self._skip + self._limit if self._limit else None
+        for document in self._documents[self._skip:end]:
+            yield project(document, self._projection)
+
+
+class _Index:
+    """
+    Hash index of a collection on the first field of `keys` (secondary index: the documents by value of the field,
+    with the elements of the arrays, and the missing field as None), used for equality and `$in` conditions.
+    A unique index also maps the values of all its fields to the document, to reject the duplicates.
+    """
+
+    def __init__(self, keys: List[Tuple[str, int]], unique: bool):
+        self.keys = keys
+        self.unique = unique
+        self._path = keys[0][0].split(".")
+        self._entries: Dict[Any, set] = {}
+        self._unhashable: set = set()  # Documents with a sub-document at the field: candidates of every lookup
+        self._unique_entries: Dict[Tuple, Any] = {}
+
+    def _values(self, document: Dict) -> List[Any]:
+        return _candidates(_get_values(document, self._path)) or [None]
+
+    def _unique_key(self, document: Dict) -> Tuple:
+        return tuple(repr(get_value(document, field)) for field, _ in self.keys)
+
+    def check(self, document: Dict, collection_name: str) -> None:
+        """:raise DuplicateKeyError: if a unique index already holds an other document with the same values"""
+        if self.unique:
+            owner = self._unique_entries.get(self._unique_key(document), document["_id"])
+            if owner != document["_id"]:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {collection_name} index: {self.keys}")
+
+    def add(self, document: Dict) -> None:
+        for value in self._values(document):
+            try:
+                self._entries.setdefault(value, set()).add(document["_id"])
+            except TypeError:
+                self._unhashable.add(document["_id"])
+
+        if self.unique:
+            self._unique_entries[self._unique_key(document)] = document["_id"]
+
+    def remove(self, document: Dict) -> None:
+        for value in self._values(document):
+            try:
+                ids = self._entries.get(value)
+            except TypeError:
+                continue
+            if ids is not None:
+                ids.discard(document["_id"])
+                if not ids:
+                    del self._entries[value]
+        self._unhashable.discard(document["_id"])
+
+        if self.unique and self._unique_entries.get(self._unique_key(document)) == document["_id"]:
+            del self._unique_entries[self._unique_key(document)]
+
+    def lookup(self, query: Dict) -> Optional[set]:
+        """The ids of the candidate documents of `query` (a superset), None if the index cannot be used"""
+        field = self.keys[0][0]
+        if field not in query:
+            return None
+
+        condition = query[field]
+        if isinstance(condition, dict):
+            if set(condition) == {"$eq"}:
+                values = [condition["$eq"]]
+            elif set(condition) == {"$in"} and not any(isinstance(value, re.Pattern) for value in condition["$in"]):
+                values = list(condition["$in"])
+            else:
+                return None
+        elif isinstance(condition, re.Pattern):
+            return None
+        else:
+            values = [condition]
+
+        ids = set(self._unhashable)
+        for value in values:
+            try:
+                ids.update(self._entries.get(value, ()))
+            except TypeError:
+                return None  # Sub-document value: not indexed
+
+        return ids
+
+
+class TTL:
+    """
+    Expiration of the documents of a collection (`expireAfterSeconds` of a time-series collection): the documents
+    whose `field` is older than `seconds` are deleted by the writes of the collection, at most every `TTL_PERIOD_S`
+    """
+
+    def __init__(self, field: str, seconds: int):
+        self.field = field
+        self.seconds = seconds
+        self._next_expiration = 0.0  # Monotonic
+        self._lock = threading.Lock()
+
+    def expire(self, collection) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_expiration:
+                return
+            self._next_expiration = now + TTL_PERIOD_S
+
+        collection.delete_many({self.field: {"$lt": datetime.utcnow() - timedelta(seconds=self.seconds)}})
+
+
+def set_collection_options(collection, options: Dict) -> None:
+    """Applies the options of `create_collection` supported by the embedded backends (time-series TTL)"""
+    time_field = options.get("timeseries", {}).get("timeField")
+    seconds = options.get("expireAfterSeconds")
+    collection.ttl = TTL(time_field, int(seconds)) if time_field and seconds and seconds != "off" else None
+
+
+def run_command(database, command: Any, value: Any = None, **kwargs) -> Dict:
+    """
+    `Database.command` of the embedded backends: `collMod` (TTL) and `ping`
+
+    Raises:
+        NotImplementedError: for the other commands, and for a TTL on a collection without time field
+    """
+    if command == "ping":
+        return {"ok": 1.0}
+
+    if command != "collMod" or set(kwargs) - {"expireAfterSeconds"}:
+        raise NotImplementedError(f"Database command not supported by the embedded backends: {command} {sorted(kwargs)}")
+
+    collection = database[value]
+    seconds = kwargs.get("expireAfterSeconds")
+    if seconds in (None, "off", 0):
+        collection.ttl = None
+    elif collection.ttl is not None:
+        collection.ttl = TTL(collection.ttl.field, int(seconds))
+    else:
+        raise NotImplementedError(f"TTL of {value}: only time-series collections (created with their timeField) expire")
+
+    return {"ok": 1.0}
+
+
+class MemoryCollection:
+    """
+    A collection: documents by `_id`, with secondary hash indexes (cf `create_index`).
+    The writes are serialized by a lock, so that the update operators (e.g `$inc`) are atomic.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents: Dict[Any, Dict] = {}
+        self.indexes: List[_Index] = []
+        self._order: Dict[Any, int] = {}  # _id -> insertion rank (natural order of the results)
+        self._next_rank = 0
+        self._lock = threading.RLock()
+        self.ttl: Optional[TTL] = None  # Cf `set_collection_options`
+
+    # Reads
+
+    def _scan(self, query: Optional[Dict]) -> Iterator[Dict]:
+        if query and "_id" in query and not isinstance(query["_id"], (dict, re.Pattern)):  # Primary key lookup
+            document = self.documents.get(query["_id"])
+            if document is not None and matches(document, query):
+                yield document
+            return
+
+        candidates = None
+        if query:
+            for index in self.indexes:
+                ids = index.lookup(query)
+                if ids is not None and (candidates is None or len(ids) < len(candidates)):
+                    candidates = ids
+
+        if candidates is None:
+            documents = list(self.documents.values())
+        else:
+            documents = [self.documents[_id] for _id in sorted(candidates, key=lambda _id: self._order.get(_id, 0)) if _id in self.documents]
+
+        for document in documents:
+            if matches(document, query):
+                yield document
+
+    def find(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None, **kwargs) -> MemoryCursor:
+        return MemoryCursor(list(self._scan(filter)), projection)
+
+    def find_one(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None, **kwargs) -> Optional[Dict]:
+        for document in self._scan(filter):
+            return project(document, projection)
+        return None
+
+    def count_documents(self, filter: Dict, **kwargs) -> int:
+        return sum(1 for _ in self._scan(filter))
+
+    def aggregate(self, pipeline: List[Dict], **kwargs) -> Iterator[Dict]:
+        documents = list(self.documents.values())
+        if pipeline and "$match" in pipeline[0]:  # The first `$match` can use the indexes
+            documents = list(self._scan(pipeline[0]["$match"]))
+            pipeline = pipeline[1:]
+        return iter(aggregate(documents, pipeline))
+
+    # Writes
+
+    def _store(self, document: Dict, previous: Optional[Dict] = None) -> None:
+        """Stores the new version of a document (and updates the indexes), `previous` its stored version"""
+        for index in self.indexes:
+            index.check(document, self.name)
+
+        if previous is not None:
+            for index in self.indexes:
+                index.remove(previous)
+
+        self.documents[document["_id"]] = document
+        for index in self.indexes:
+            index.add(document)
+
+    def _remove(self, document: Dict) -> None:
+        for index in self.indexes:
+            index.remove(document)
+        del self.documents[document["_id"]]
+        del self._order[document["_id"]]
+
+    def insert_one(self, document: Dict, **kwargs) -> WriteResult:
+        if "_id" not in document:
+            document["_id"] = ObjectId()  # As pymongo, the caller's document gets its `_id`
+
+        if self.ttl is not None:
+            self.ttl.expire(self)
+
+        with self._lock:
+            if document["_id"] in self.documents:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} dup key: {{ _id: {document['_id']!r} }}")
+
+            self._store(_copy(document))
+            self._order[document["_id"]] = self._next_rank
+            self._next_rank += 1
+
+        return WriteResult(inserted_id=document["_id"])
+
+    def insert_many(self, documents: List[Dict], ordered: bool = True, **kwargs) -> WriteResult:
+        return WriteResult(inserted_ids=[self.insert_one(document).inserted_id for document in documents])
+
+    def _update(self, filter: Dict, update: Dict, many: bool, upsert: bool) -> WriteResult:
+        if any(not key.startswith("$") for key in update):
+            raise NotImplementedError("Replacement documents are not supported in memory (use update operators)")
+
+        with self._lock:
+            matched = modified = 0
+            for document in list(self._scan(filter)):
+                matched += 1
+                updated = _copy(document)
+                apply_update(updated, update)
+                if updated != document:
+                    self._store(updated, document)
+                    modified += 1
+                if not many:
+                    break
+
+            upserted_id = None
+            if not matched and upsert:
+                upserted_id = self.insert_one(upsert_document(filter, update)).inserted_id
+
+        return WriteResult(matched_count=matched, modified_count=modified, upserted_id=upserted_id)
+
+    def update_one(self, filter: Dict, update: Dict, upsert: bool = False, **kwargs) -> WriteResult:
+        return self._update(filter, update, False, upsert)
+
+    def update_many(self, filter: Dict, update: Dict, upsert: bool = False, **kwargs) -> WriteResult:
+        return self._update(filter, update, True, upsert)
+
+    def delete_one(self, filter: Dict, **kwargs) -> WriteResult:
+        with self._lock:
+            for document in self._scan(filter):
+                self._remove(document)
+                return WriteResult(deleted_count=1)
+        return WriteResult(deleted_count=0)
+
+    def delete_many(self, filter: Dict, **kwargs) -> WriteResult:
+        with self._lock:
+            documents = list(self._scan(filter))
+            for document in documents:
+                self._remove(document)
+        return WriteResult(deleted_count=len(documents))
+
+    def bulk_write(self, requests: List, ordered: bool = True, **kwargs) -> WriteResult:
+        with self._lock:
+            return apply_bulk_write(self, requests)
+
+    def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        """Creates a hash index on the first field of `keys` (TTL and other options are ignored)"""
+        keys = [(keys, ASCENDING)] if isinstance(keys, str) else list(keys)
+
+        with self._lock:
+            if all(index.keys != keys for index in self.indexes):
+                index = _Index(keys, unique)
+                for document in self.documents.values():
+                    index.check(document, self.name)
+                    index.add(document)
+                self.indexes.append(index)
+
+        return index_name(keys)
+
+    def drop(self) -> None:
+        with self._lock:
+            self.documents.clear()
+            self._order.clear()
+            self.indexes = []
+
+
+def index_name(keys: List[Tuple[str, int]]) -> str:
+    """Name of an index, as MongoDB names it (e.g `profile.site_1_profile.zone_1`)"""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def upsert_document(filter: Dict, update: Dict) -> Dict:
+    """The document inserted by an upsert: the equality fields of `filter`, updated by `update`"""
+    document = {}
+    for key, value in filter.items():
+        if not key.startswith("$") and not isinstance(value, (dict, re.Pattern)):
+            _set_path(document, key, _copy(value))
+    apply_update(document, update, inserting=True)
+    return document
+
+
+def apply_bulk_write(collection, requests: List) -> WriteResult:
+    """
+    Applies pymongo `UpdateOne`, `UpdateMany`, `InsertOne`, `DeleteOne` and `DeleteMany` requests to a collection
+    of this module or of `sqlite_database` (through their `_update`, `insert_one` and `delete_*` methods)
+    """
+    totals = {"inserted_count": 0, "matched_count": 0, "modified_count": 0, "deleted_count": 0, "upserted_count": 0}
+
+    for request in requests:
+        kind = type(request).__name__
+        if kind in ("UpdateOne", "UpdateMany"):
+            result = collection._update(request._filter, request._doc, kind == "UpdateMany", bool(request._upsert))
+            totals["matched_count"] += result.matched_count
+            totals["modified_count"] += result.modified_count
+            totals["upserted_count"] += result.upserted_id is not None
+        elif kind == "InsertOne":
+            collection.insert_one(request._doc)
+            totals["inserted_count"] += 1
+        elif kind in ("DeleteOne", "DeleteMany"):
+            delete = collection.delete_many if kind == "DeleteMany" else collection.delete_one
+            totals["deleted_count"] += delete(request._filter).deleted_count
+        else:
+            raise NotImplementedError(f"Bulk operation not supported: {kind}")
+
+    return WriteResult(**totals)
+
+
+def _expression(document: Dict, expression: Any) -> Any:
+    """Value of an aggregation expression: `$field.path`, a literal, or a dict of expressions"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return get_value(document, expression[1:])
+    if isinstance(expression, dict):
+        if any(key.startswith("$") for key in expression):
+            raise NotImplementedError(f"Aggregation operator not supported in memory: {list(expression)}")
+        return {key: _expression(document, value) for key, value in expression.items()}
+    return expression
+
+
+def _group(documents: List[Dict], specification: Dict) -> List[Dict]:
+    groups: Dict[Any, Dict] = {}
+    keys: Dict[Any, Any] = {}
+
+    for document in documents:
+        key = _expression(document, specification["_id"])
+        hashable = repr(key)
+        keys.setdefault(hashable, key)
+        group = groups.setdefault(hashable, {})
+
+        for field, accumulator in specification.items():
+            if field == "_id":
+                continue
+            (operator, argument), = accumulator.items()
+            value = _expression(document, argument)
+            state = group.get(field, _MISSING)
+
+            if operator == "$sum":
+                group[field] = (0 if state is _MISSING else state) + (value if isinstance(value, (int, float)) else 0)
+            elif operator == "$avg":
+                total, count = (0, 0) if state is _MISSING else state
+                group[field] = (total + value, count + 1) if isinstance(value, (int, float)) else (total, count)
+            elif operator in ("$min", "$max"):
+                if value is not None and (state is _MISSING or (value < state if operator == "$min" else value > state)):
+                    group[field] = value
+            elif operator == "$first":
+                if state is _MISSING:
+                    group[field] = value
+            elif operator == "$last":
+                group[field] = value
+            elif operator in ("$push", "$addToSet"):
+                items = [] if state is _MISSING else state
+                if operator == "$push" or value not in items:
+                    items.append(value)
+                group[field] = items
+            else:
+                raise NotImplementedError(f"Group accumulator not supported in memory: {operator}")
+
+    results = []
+    for hashable, group in groups.items():
+        row = {"_id": keys[hashable]}
+        for field, accumulator in specification.items():
+            if field == "_id":
+                continue
+            value = group.get(field)
+            if next(iter(accumulator)) == "$avg":
+                value = value[0] / value[1] if value and value[1] else None
+            row[field] = value
+        results.append(row)
+
+    return results
+
+
+def aggregate(documents: List[Dict], pipeline: List[Dict]) -> List[Dict]:
+    """Runs an aggregation `pipeline` on `documents` (cf module documentation for the supported stages)"""
+    documents = [_copy(document) for document in documents]
+
+    for stage in pipeline:
+        (name, argument), = stage.items()
+
+        if name == "$match":
+            documents = [document for document in documents if matches(document, argument)]
+        elif name == "$project":
+            if all(value in (0, 1, True, False) for value in argument.values()):
+                documents = [project(document, argument) for document in documents]
+            else:
+                documents = [
+                    {
+                        **({"_id": document.get("_id")} if argument.get("_id", 1) else {}),
+                        **{
+                            field: get_value(document, field) if value in (1, True) else _expression(document, value)
+                            for field, value in argument.items() if field != "_id"
+                        },
+                    }
+                    for document in documents
+                ]
+        elif name == "$group":
+            documents = _group(documents, argument)
+        elif name == "$sort":
+            documents = sort_documents(documents, list(argument.items()))
+        elif name == "$skip":
+            documents = documents[argument:]
+        elif name == "$limit":
+            documents = documents[:argument]
+        elif name == "$unwind":
+            path = (argument["path"] if isinstance(argument, dict) else argument)[1:]
+            unwound = []
+            for document in documents:
+                for item in get_value(document, path) or []:
+                    copy = _copy(document)
+                    _set_path(copy, path, item)
+                    unwound.append(copy)
+            documents = unwound
+        elif name == "$count":
+            documents = [{argument: len(documents)}] if documents else []
+        else:
+            raise NotImplementedError(f"Aggregation stage not supported in memory: {name}")
+
+    return documents
+
+
+class MemoryDatabase:
+    """A database: collections created on first use"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = MemoryCollection(name)
+        return collection
+
+    def list_collection_names(self, **kwargs) -> List[str]:
+        return list(self.collections)
+
+    def create_collection(self, name: str, **options) -> MemoryCollection:
+        collection = self[name]  # Also for an existing collection (the options are updated)
+        set_collection_options(collection, options)
+        return collection
+
+    def command(self, command: Any, value: Any = None, **kwargs) -> Dict:
+        return run_command(self, command, value, **kwargs)
+
+    def watch(self, *args, **kwargs):
+        raise NotImplementedError("Change streams are not supported in memory")
+
+
+class MemoryClient:
+    """Replaces `MongoClient` (same constructor arguments, ignored)"""
+
+    def __init__(self, connection_string: Optional[str] = None, **kwargs):
+        self.databases: Dict[str, MemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        database = self.databases.get(name)
+        if database is None:
+            database = self.databases[name] = MemoryDatabase(name)
+        return database
+
+    def close(self) -> None:
+        pass
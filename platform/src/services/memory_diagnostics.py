@@ -0,0 +1,285 @@
+"""
+Memory diagnostics: tracemalloc control, snapshots and their diffs, process RSS and object cache sizes.
+
+tracemalloc traces the allocations of the current process only: with several gunicorn workers, each worker
+is started / stopped separately (the responses give the pid), or all of them at startup with the
+`PYTHONTRACEMALLOC=<frames>` environment variable. The snapshots are written to a directory shared by the
+workers, so that two snapshots can be compared from any worker.
+
+Tracing costs memory and CPU (roughly 2x slower allocations): stop it when done.
+"""
+
+from typing import Callable, Dict, List, Optional
+from datetime import datetime
+from threading import Lock
+import gc
+import os
+import re
+import tracemalloc
+
+# Allocations of the diagnostics themselves
+_IGNORED_FRAMES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+GROUP_BY = ("lineno", "filename", "traceback")
+
+_SNAPSHOT_ID_PATTERN = re.compile(r"^[\w-]+$")
+
+
+def _read_status(pid: int) -> Optional[Dict]:
+    """Memory of a process, from /proc/<pid>/status (Linux). None if it cannot be read"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+
+    def mb(field: str) -> Optional[float]:
+        value = fields.get(field)
+        return round(int(value.split()[0]) / 1024, 1) if value else None  # kB
+
+    return {
+        "pid": pid,
+        "name": fields.get("Name", "").strip(),
+        "rss_mb": mb("VmRSS"),
+        "peak_rss_mb": mb("VmHWM"),
+        "threads": int(fields["Threads"]) if "Threads" in fields else None,
+    }
+
+
+def process_memory() -> Dict:
+    """
+    Memory of the current process, and of its siblings (the other gunicorn workers and the MQTT gateway,
+    when running under gunicorn)
+
+    Returns:
+        {pid, rss_mb, peak_rss_mb, threads, siblings: [{pid, name, rss_mb, peak_rss_mb, threads}]}
+    """
+    pid = os.getpid()
+    current = _read_status(pid)
+
+    if current is None:  # Not Linux: peak RSS only
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"pid": pid, "rss_mb": None, "peak_rss_mb": round(peak / 1024, 1), "threads": None, "siblings": []}
+
+    siblings = []
+    parent = os.getppid()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == pid:
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+        if ppid == parent and parent != 1:
+            status = _read_status(int(entry))
+            if status is not None:
+                siblings.append(status)
+
+    return {**current, "siblings": siblings}
+
+
+def object_counts(limit: int = 20) -> List[Dict]:
+    """Most common types among the objects tracked by the garbage collector (walks all the objects: slow)"""
+    counts: Dict[str, int] = {}
+    for obj in gc.get_objects():
+        name = type(obj).__qualname__
+        counts[name] = counts.get(name, 0) + 1
+
+    return [{"type": name, "count": count} for name, count in sorted(counts.items(), key=lambda item: -item[1])[:limit]]
+
+
+class MemoryDiagnostics:
+    """Controls tracemalloc and manages the snapshots (cf module documentation)"""
+
+    def __init__(self, snapshot_dir: str, max_snapshots: int = 10, frames: int = 10):
+        """
+        Args:
+            snapshot_dir: Directory of the snapshots (shared by the workers)
+            max_snapshots: Only the newest snapshots are kept
+            frames: Default number of frames stored per allocation (more frames: better tracebacks, more memory)
+        """
+        self.snapshot_dir = snapshot_dir
+        self.max_snapshots = max_snapshots
+        self.frames = frames
+
+        self._caches: Dict[str, Callable[[], object]] = {}
+        self._lock = Lock()
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    def register_cache(self, name: str, size: Callable[[], object]) -> None:
+        """
+        Register an object cache, reported by `cache_sizes`
+
+        Args:
+            name: Name of the cache
+            size: Returns its size (a number, or a dict of statistics)
+        """
+        self._caches[name] = size
+
+    def cache_sizes(self) -> Dict[str, object]:
+        sizes = {}
+        for name, size in self._caches.items():
+            try:
+                sizes[name] = size()
+            except Exception as e:
+                sizes[name] = {"error": str(e)}
+        return sizes
+
+    # tracemalloc
+
+    def start(self, frames: Optional[int] = None) -> Dict:
+        """Start tracing the allocations of this process (no-op if already tracing)"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames or self.frames)
+        return self.status()
+
+    def stop(self) -> Dict:
+        """Stop tracing (frees the traces; the snapshots on disk are kept)"""
+        tracemalloc.stop()
+        return self.status()
+
+    @staticmethod
+    def status() -> Dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+
+        return {
+            "pid": os.getpid(),
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else None,
+            "traced_mb": round(current / 2**20, 2),
+            "traced_peak_mb": round(peak / 2**20, 2),
+            "overhead_mb": round(tracemalloc.get_tracemalloc_memory() / 2**20, 2) if tracing else 0,
+        }
+
+    # Snapshots
+
+    def take_snapshot(self, limit: int = 20, group_by: str = "lineno") -> Dict:
+        """
+        Take a snapshot of the traced allocations and write it to the snapshot directory
+
+        Raises:
+            RuntimeError: tracemalloc is not started
+            ValueError: Invalid group_by (checked before anything is written)
+
+        Returns:
+            {id, pid, total_mb, top: [...]} (cf `top`)
+        """
+        self._check_group_by(group_by)
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not started")
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED_FRAMES)
+        taken_at = datetime.utcnow()
+        snapshot_id = f"{taken_at.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}"
+
+        with self._lock:
+            snapshot.dump(self._path(snapshot_id))
+            self._prune()
+
+        return {"id": snapshot_id, "pid": os.getpid(), **self._top(snapshot, limit, group_by)}
+
+    def list_snapshots(self) -> List[Dict]:
+        """The snapshots on disk, newest first"""
+        snapshots = []
+        for name in sorted(os.listdir(self.snapshot_dir), reverse=True):
+            if name.endswith(".snapshot"):
+                snapshot_id = name[: -len(".snapshot")]
+                snapshots.append({
+                    "id": snapshot_id,
+                    "pid": int(snapshot_id.rsplit("-", 1)[1]),
+                    "size_mb": round(os.path.getsize(os.path.join(self.snapshot_dir, name)) / 2**20, 2),
+                })
+        return snapshots
+
+    def top(self, snapshot_id: str, limit: int = 20, group_by: str = "lineno") -> Dict:
+        """
+        Largest allocation sites of a snapshot
+
+        Returns:
+            {id, total_mb, top: [{site, size_kb, count}]}
+        """
+        return {"id": snapshot_id, **self._top(self._load(snapshot_id), limit, group_by)}
+
+    def diff(self, from_id: str, to_id: str, limit: int = 20, group_by: str = "lineno") -> Dict:
+        """
+        Compare two snapshots by allocation site (e.g taken an hour apart, to find what keeps growing)
+
+        Returns:
+            {from, to, total_diff_mb, top: [{site, size_kb, size_diff_kb, count, count_diff}]} (largest growth first)
+        """
+        self._check_group_by(group_by)
+        old, new = self._load(from_id), self._load(to_id)
+
+        stats = new.compare_to(old, group_by)
+        total_diff = sum(stat.size_diff for stat in stats)
+
+        return {
+            "from": from_id,
+            "to": to_id,
+            "total_diff_mb": round(total_diff / 2**20, 3),
+            "top": [
+                {
+                    "site": self._site(stat.traceback, group_by),
+                    "size_kb": round(stat.size / 1024, 1),
+                    "size_diff_kb": round(stat.size_diff / 1024, 1),
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:limit]
+            ],
+        }
+
+    # Internals
+
+    def _path(self, snapshot_id: str) -> str:
+        if not _SNAPSHOT_ID_PATTERN.match(snapshot_id):
+            raise LookupError(f"Snapshot not found: {snapshot_id}")
+        return os.path.join(self.snapshot_dir, f"{snapshot_id}.snapshot")
+
+    def _load(self, snapshot_id: str) -> tracemalloc.Snapshot:
+        path = self._path(snapshot_id)
+        if not os.path.isfile(path):
+            raise LookupError(f"Snapshot not found: {snapshot_id}")
+        return tracemalloc.Snapshot.load(path)
+
+    def _prune(self) -> None:
+        for snapshot in self.list_snapshots()[self.max_snapshots:]:
+            try:
+                os.remove(self._path(snapshot["id"]))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _check_group_by(group_by: str) -> None:
+        if group_by not in GROUP_BY:
+            raise ValueError(f"Invalid group_by: {group_by} (expected one of {GROUP_BY})")
+
+    @staticmethod
+    def _site(traceback: tracemalloc.Traceback, group_by: str):
+        if group_by == "traceback":
+            return [f"{frame.filename}:{frame.lineno}" for frame in traceback]
+        frame = traceback[0]
+        return frame.filename if group_by == "filename" else f"{frame.filename}:{frame.lineno}"
+
+    def _top(self, snapshot: tracemalloc.Snapshot, limit: int, group_by: str) -> Dict:
+        self._check_group_by(group_by)
+        stats = snapshot.statistics(group_by)
+
+        return {
+            "total_mb": round(sum(stat.size for stat in stats) / 2**20, 2),
+            "top": [
+                {"site": self._site(stat.traceback, group_by), "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+                for stat in stats[:limit]
+            ],
+        }
@@ -0,0 +1,84 @@
+"""
+Prometheus metrics of the platform hot paths (exported by `GET /metrics`, cf `src/application/metrics_api.py`).
+
+Recording a value is a short lock-protected update in the current process. With several gunicorn
+workers, set `PROMETHEUS_MULTIPROC_DIR` (before the processes start): each process then writes its
+values to memory-mapped files in this directory, which `/metrics` aggregates (prometheus_client
+multiprocess mode), so the metrics of all the workers and of the MQTT gateway are exported together.
+"""
+
+import os
+
+# The directory must exist before the first value is recorded (gunicorn.conf.py also empties it at startup)
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Seconds, from 1 ms (DB reads) to 10 s (SMTP)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Duration of the HTTP requests, per route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+DB_OPERATION_SECONDS = Histogram(
+    "db_operation_duration_seconds",
+    "Duration of the DatabaseService operations, per collection",
+    ["operation", "collection"],
+    buckets=LATENCY_BUCKETS,
+)
+
+DB_OPERATION_ERRORS = Counter(
+    "db_operation_errors_total",
+    "Failed DatabaseService operations, per collection",
+    ["operation", "collection"],
+)
+
+MQTT_PUBLISH_ACK_SECONDS = Histogram(
+    "mqtt_publish_ack_seconds",
+    "Time between an MQTT publish (QoS 1) and its acknowledgement by the broker",
+    ["kind"],
+    buckets=LATENCY_BUCKETS,
+)
+
+MQTT_PUBLISH_FAILURES = Counter(
+    "mqtt_publish_failures_total",
+    "MQTT publishes rejected by the client (e.g disconnected)",
+    ["kind"],
+)
+
+MQTT_COMMAND_ACK_SECONDS = Histogram(
+    "mqtt_group_command_ack_seconds",
+    "Time between the publish of a group command and its acknowledgement by a node",
+    buckets=LATENCY_BUCKETS,
+)
+
+NOTIFICATION_SECONDS = Histogram(
+    "notification_send_duration_seconds",
+    "Duration of the notification deliveries",
+    ["channel", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+FAULTS_INJECTED = Counter(
+    "faults_injected_total",
+    "Faults injected in the calls to the dependencies (cf FAULTS)",
+    ["component", "fault"],
+)
+
+QUEUE_DEPTH = Gauge(
+    "queue_depth",
+    "Items waiting in the in-memory queues (batch writers, service executions)",
+    ["queue"],
+    multiprocess_mode="livesum",
+)
+
+QUEUE_DROPPED = Counter(
+    "queue_dropped_total",
+    "Items dropped by the in-memory queues",
+    ["queue"],
+)
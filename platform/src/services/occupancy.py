@@ -0,0 +1,231 @@
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from .base import BaseService
+from .status_history import StatusHistory
+
+
+class OccupancyService(BaseService):
+    """
+    Occupancy analytics of the parking nodes of a Digital Twin, computed from the status history.
+
+    For each node and each zone, over a time window:
+        - occupancy_rate: fraction of the time a vehicle was on the spot
+        - mean_dwell_s: mean duration (in seconds) of a stay on the spot
+        - no_show_rate: fraction of the reservations that ended (cancelled or expired) without a vehicle
+        - violations_per_day: number of violations per day
+
+    The per-transition work (durations, counters) is done by MongoDB in one aggregation pipeline;
+    Python only merges one row per node.
+    """
+
+    # Statuses where a vehicle is on the spot
+    PRESENT_STATUSES = ["waiting_for_authentication", "occupied", "violation", "unauthorized"]
+
+    DEFAULT_WINDOW_DAYS = 7
+
+    dr_projection = {"type": 1, "profile.site": 1, "profile.zone": 1}
+
+    def __init__(self):
+        super().__init__()
+        self.window_days = self.DEFAULT_WINDOW_DAYS
+
+    def configure(self, config: Dict) -> None:
+        """
+        Args:
+            config: Service configuration. Supported keys:
+                - window_days: Length of the default time window (ending now)
+        """
+        self.window_days = config.get("window_days", self.window_days)
+
+    def execute(
+        self,
+        data: Dict,
+        dr_type: str = None,
+        attribute: str = None,
+        status_history: StatusHistory = None,
+        start: Optional[datetime | str] = None,
+        end: Optional[datetime | str] = None,
+    ) -> Dict:
+        """
+        Compute the occupancy statistics of the nodes of the Digital Twin
+
+        Args:
+            data: Dictionary containing the DT data including all DRs
+            dr_type: Type of the parking spot DRs (default: 'node')
+            attribute: Restrict the result to 'nodes' or 'zones' (both if None)
+            status_history: History of the node status transitions (cf `StatusHistory`)
+            start: Start of the time window, datetime or ISO 8601 (default: `end` - `window_days`)
+            end: End of the time window, datetime or ISO 8601 (default: now)
+        """
+        if not data or "digital_replicas" not in data:
+            raise ValueError("Invalid data: missing digital replicas")
+
+        if status_history is None:
+            raise ValueError("OccupancyService needs the status history")
+
+        if isinstance(start, str):
+            start = datetime.fromisoformat(start)
+        if isinstance(end, str):
+            end = datetime.fromisoformat(end)
+
+        dr_type = dr_type or "node"
+        end = end or datetime.utcnow()
+        start = start or end - timedelta(days=self.window_days)
+
+        if start >= end:
+            raise ValueError("Invalid time window: start must be before end")
+
+        nodes = {dr["_id"]: dr for dr in data["digital_replicas"] if dr.get("type") == dr_type}
+
+        if not nodes:
+            return {"error": f"No digital replicas found of type {dr_type}"}
+
+        window_s = (end - start).total_seconds()
+        node_ids = list(nodes)
+
+        # Status of each node when the window opens
+        initial_statuses = status_history.statuses_at(start, node_ids)
+        rows = {
+            row["_id"]: row
+            for row in status_history.aggregate(self._build_pipeline(start, end, node_ids))
+        }
+
+        node_stats = {}
+        for node_id in node_ids:
+            counters = self._node_counters(
+                rows.get(node_id),
+                initial_statuses.get(node_id),
+                start,
+                window_s,
+            )
+            node_stats[node_id] = counters
+
+        result = {
+            "window": {"start": start, "end": end},
+        }
+
+        if attribute in (None, "nodes"):
+            result["nodes"] = {
+                node_id: self._rates(counters, window_s, 1)
+                for node_id, counters in node_stats.items()
+            }
+
+        if attribute in (None, "zones"):
+            result["zones"] = self._zone_stats(nodes, node_stats, window_s)
+
+        return result
+
+    def _build_pipeline(self, start: datetime, end: datetime, node_ids: List[str]) -> List[Dict]:
+        """
+        Pipeline computing, per node, the time spent with a vehicle and the event counters.
+
+        Each transition lasts until the next transition of the same node (or the end of the window),
+        which `$setWindowFields` gives without leaving the server.
+        """
+        present = self.PRESENT_STATUSES
+
+        return [
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}, "node_id": {"$in": node_ids}}},
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$node_id",
+                    "sortBy": {"timestamp": 1},
+                    "output": {
+                        "next_timestamp": {"$shift": {"output": "$timestamp", "by": 1, "default": end}},
+                        "next_status": {"$shift": {"output": "$new_status", "by": 1, "default": None}},
+                    },
+                }
+            },
+            {
+                "$project": {
+                    "node_id": 1,
+                    "timestamp": 1,
+                    "duration_ms": {"$subtract": ["$next_timestamp", "$timestamp"]},
+                    "is_present": {"$in": ["$new_status", present]},
+                    "was_present": {"$in": [{"$ifNull": ["$old_status", ""]}, present]},
+                    "is_reservation": {"$eq": ["$new_status", "reserved"]},
+                    "is_no_show": {
+                        "$and": [{"$eq": ["$new_status", "reserved"]}, {"$eq": ["$next_status", "free"]}]
+                    },
+                    "is_violation": {"$eq": ["$new_status", "violation"]},
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$node_id",
+                    "first_timestamp": {"$min": "$timestamp"},
+                    "present_ms": {"$sum": {"$cond": ["$is_present", "$duration_ms", 0]}},
+                    "stays": {
+                        "$sum": {"$cond": [{"$and": ["$is_present", {"$not": ["$was_present"]}]}, 1, 0]}
+                    },
+                    "reservations": {"$sum": {"$cond": ["$is_reservation", 1, 0]}},
+                    "no_shows": {"$sum": {"$cond": ["$is_no_show", 1, 0]}},
+                    "violations": {"$sum": {"$cond": ["$is_violation", 1, 0]}},
+                }
+            },
+        ]
+
+    def _node_counters(
+        self,
+        row: Optional[Dict],
+        initial_status: Optional[str],
+        start: datetime,
+        window_s: float,
+    ) -> Dict:
+        """Add the period between the window start and the first transition to the pipeline result"""
+        counters = {
+            "present_s": 0.0,
+            "stays": 0,
+            "reservations": 0,
+            "no_shows": 0,
+            "violations": 0,
+        }
+
+        if row is not None:
+            counters["present_s"] = row["present_ms"] / 1000
+            for key in ("stays", "reservations", "no_shows", "violations"):
+                counters[key] = row[key]
+
+        if initial_status in self.PRESENT_STATUSES:
+            if row is None:
+                counters["present_s"] += window_s
+            else:
+                counters["present_s"] += (row["first_timestamp"] - start).total_seconds()
+            counters["stays"] += 1
+
+        return counters
+
+    def _rates(self, counters: Dict, window_s: float, nb_nodes: int) -> Dict:
+        """Turn the counters of one node (or the sum over `nb_nodes` nodes) into rates"""
+        window_days = window_s / 86400
+
+        return {
+            "occupancy_rate": counters["present_s"] / (window_s * nb_nodes),
+            "mean_dwell_s": counters["present_s"] / counters["stays"] if counters["stays"] else None,
+            "reservations": counters["reservations"],
+            "no_show_rate": (
+                counters["no_shows"] / counters["reservations"] if counters["reservations"] else None
+            ),
+            "violations": counters["violations"],
+            "violations_per_day": counters["violations"] / window_days,
+        }
+
+    def _zone_stats(self, nodes: Dict[str, Dict], node_stats: Dict[str, Dict], window_s: float) -> Dict:
+        """Sum the node counters per `site/zone` and turn them into rates"""
+        zones: Dict[str, Dict] = {}
+
+        for node_id, counters in node_stats.items():
+            profile = nodes[node_id].get("profile", {})
+            zone = f"{profile.get('site') or '-'}/{profile.get('zone') or '-'}"
+
+            if zone not in zones:
+                zones[zone] = {"nb_nodes": 0, **{key: 0 for key in counters}}
+
+            zones[zone]["nb_nodes"] += 1
+            for key, value in counters.items():
+                zones[zone][key] += value
+
+        return {
+            zone: {"nb_nodes": totals["nb_nodes"], **self._rates(totals, window_s, totals["nb_nodes"])}
+            for zone, totals in zones.items()
+        }
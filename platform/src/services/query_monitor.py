@@ -0,0 +1,366 @@
+"""
+MongoDB command monitoring: per query shape timings, slow-query log, and index checks.
+
+`QueryMonitor` is a pymongo `CommandListener` (cf `DatabaseService(event_listeners=...)`). For each
+command, it records the duration and the number of documents returned under the *shape* of the
+query: the command, the collection and the filter / pipeline with the values replaced by "?", e.g
+    find node_collection {"data.status": "?"}
+
+Commands slower than `slow_ms` are logged with the route (or thread) that issued them. The slow
+shapes are explained in the background (`executionStats`), which gives the documents and keys
+examined and the plan (IXSCAN / COLLSCAN) — command replies do not contain them.
+
+`assert_uses_index` checks that a query is answered with an index; `python -m src.services.query_monitor`
+runs it on the hot queries of the platform (`HOT_QUERIES`) and exits with 1 if one scans a collection.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock, current_thread
+import json
+import logging
+import time
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Commands that are not queries (driver housekeeping), or issued by the monitor itself
+IGNORED_COMMANDS = {
+    "hello", "ismaster", "isMaster", "ping", "buildInfo", "endSessions", "saslStart", "saslContinue",
+    "explain", "killCursors", "listCollections", "listIndexes", "createIndexes", "getMore",
+}
+
+# Fields of a command that are not part of the query (sessions, cluster time, ...)
+_SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "$clusterTime", "$db", "$readPreference"}
+
+
+def query_shape(command_name: str, command: Dict) -> str:
+    """Shape of a command: its name, collection and query with the values replaced by "?" """
+    collection = command.get(command_name)
+
+    if command_name in ("find", "count", "distinct"):
+        query = {"filter": command.get("filter", command.get("query", {}))}
+        if "sort" in command:
+            query["sort"] = command["sort"]
+    elif command_name == "aggregate":
+        query = {"pipeline": command.get("pipeline", [])}
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        query = {"filter": statements[0].get("q", {})}
+    elif command_name == "findAndModify":
+        query = {"filter": command.get("query", {})}
+    else:
+        return f"{command_name} {collection}"
+
+    return f"{command_name} {collection} {json.dumps(_shape(query), sort_keys=True)}"
+
+
+def _shape(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: _shape(item) if key.startswith("$") or isinstance(item, (dict, list)) else "?" for key, item in value.items()}
+    if isinstance(value, list):
+        # Pipelines and $and / $or keep their structure, value lists ($in) do not
+        return [_shape(item) for item in value] if value and all(isinstance(item, dict) for item in value) else "?"
+    return "?"
+
+
+def _nb_returned(command_name: str, reply: Dict) -> int:
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    return int(reply.get("n", 0))
+
+
+def _current_route() -> str:
+    """The route of the Flask request being handled, or the name of the thread"""
+    try:
+        from flask import has_request_context, request
+
+        if has_request_context():
+            rule = request.url_rule.rule if request.url_rule is not None else request.path
+            return f"{request.method} {rule}"
+
+    except ImportError:
+        pass
+
+    return current_thread().name
+
+
+def _find_key(document: Any, key: str) -> Any:
+    """First value of `key` in a nested explain output"""
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        items = document.values()
+    elif isinstance(document, list):
+        items = document
+    else:
+        return None
+
+    for item in items:
+        found = _find_key(item, key)
+        if found is not None:
+            return found
+    return None
+
+
+def plan_stages(explain: Dict) -> List[str]:
+    """Stages of the winning plan of an explain output (e.g ["FETCH", "IXSCAN"])"""
+    stages = []
+
+    def walk(node: Any) -> None:
+        if isinstance(node, dict):
+            if "stage" in node:
+                stages.append(node["stage"])
+            for key, value in node.items():
+                if key != "rejectedPlans":
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(_find_key(explain, "winningPlan") or explain)
+    return stages
+
+
+def assert_uses_index(collection, query: Dict, sort: Optional[List[Tuple[str, int]]] = None) -> List[str]:
+    """
+    Assert that a query on `collection` (a pymongo `Collection`) is answered with an index
+
+    Raises:
+        AssertionError: The winning plan scans the collection (COLLSCAN)
+
+    Returns:
+        List[str]: The stages of the winning plan
+    """
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+
+    stages = plan_stages(cursor.explain())
+
+    if "COLLSCAN" in stages or not any(stage in ("IXSCAN", "IDHACK", "EXPRESS_IXSCAN", "CLUSTERED_IXSCAN") or stage.startswith("EXPRESS") for stage in stages):
+        raise AssertionError(f"{collection.name} {query}: no index used (plan: {stages})")
+
+    return stages
+
+
+class QueryMonitor(monitoring.CommandListener):
+    """Records the MongoDB commands per query shape (cf module documentation)"""
+
+    def __init__(self, slow_ms: float = 100.0, explain_slow: bool = True, max_shapes: int = 1000, explain_interval_s: float = 600.0):
+        """
+        Args:
+            slow_ms: Commands slower than this are logged (and their shape explained)
+            explain_slow: Explain the slow shapes in the background
+            max_shapes: Maximum number of shapes tracked (the others are counted under "other")
+            explain_interval_s: Minimum time between two explains of the same shape
+        """
+        self.slow_ms = slow_ms
+        self.explain_slow = explain_slow
+        self.max_shapes = max_shapes
+        self.explain_interval_s = explain_interval_s
+
+        self._started: Dict[int, Tuple[str, str, Dict]] = {}  # request_id -> (command name, shape, command)
+        self._shapes: Dict[str, Dict] = {}
+        self._lock = Lock()
+
+        self._db = None
+        self._explainer: Optional[ThreadPoolExecutor] = None
+        self._explaining = set()
+
+        self.commands = 0
+        self.slow_commands = 0
+
+    def attach(self, db) -> None:
+        """Give the monitor the database used to explain the slow queries (a pymongo `Database`)"""
+        self._db = db
+        if self.explain_slow and self._explainer is None:
+            self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query_explain")
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in IGNORED_COMMANDS:
+            return
+
+        try:
+            shape = query_shape(event.command_name, event.command)
+        except Exception:
+            shape = f"{event.command_name} ?"
+
+        self._started[event.request_id] = (event.command_name, shape, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        started = self._started.pop(event.request_id, None)
+        if started is not None:
+            self._record(started, event.duration_micros / 1000, _nb_returned(event.command_name, event.reply), False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        started = self._started.pop(event.request_id, None)
+        if started is not None:
+            self._record(started, event.duration_micros / 1000, 0, True)
+
+    def _record(self, started: Tuple[str, str, Dict], duration_ms: float, nb_returned: int, failed: bool) -> None:
+        command_name, shape, command = started
+        slow = duration_ms >= self.slow_ms
+        route = _current_route()
+
+        with self._lock:
+            self.commands += 1
+
+            stats = self._shapes.get(shape)
+            if stats is None:
+                if len(self._shapes) >= self.max_shapes:
+                    shape = "other"
+                    stats = self._shapes.get(shape)
+                if stats is None:
+                    stats = self._shapes[shape] = {
+                        "count": 0, "failures": 0, "slow": 0, "total_ms": 0.0, "max_ms": 0.0,
+                        "returned": 0, "last_route": None, "last_slow_route": None, "plan": None,
+                    }
+
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["returned"] += nb_returned
+            stats["last_route"] = route
+            if failed:
+                stats["failures"] += 1
+
+            if slow:
+                self.slow_commands += 1
+                stats["slow"] += 1
+                stats["last_slow_route"] = route
+
+                plan = stats["plan"]
+                explain = (
+                    self._explainer is not None
+                    and shape != "other"
+                    and shape not in self._explaining
+                    and (plan is None or time.time() - plan["explained_at"] > self.explain_interval_s)
+                )
+                if explain:
+                    self._explaining.add(shape)
+
+        if slow:
+            logger.warning("Slow query (%.1f ms, %d returned) from %s: %s", duration_ms, nb_returned, route, shape)
+
+            if explain:
+                self._explainer.submit(self._explain, shape, command_name, command)
+
+    def _explain(self, shape: str, command_name: str, command: Dict) -> None:
+        """Explain a slow command (in the background) and store its plan with its shape"""
+        try:
+            explained = {key: value for key, value in command.items() if key not in _SESSION_FIELDS}
+            explain = self._db.command("explain", explained, verbosity="executionStats")
+
+            plan = {
+                "stages": plan_stages(explain),
+                "docs_examined": _find_key(explain, "totalDocsExamined"),
+                "keys_examined": _find_key(explain, "totalKeysExamined"),
+                "returned": _find_key(explain, "nReturned"),
+                "explained_at": time.time(),
+            }
+
+            if "COLLSCAN" in plan["stages"]:
+                logger.warning("Slow query without index (%s docs examined): %s", plan["docs_examined"], shape)
+
+            with self._lock:
+                if shape in self._shapes:
+                    self._shapes[shape]["plan"] = plan
+
+        except Exception as e:
+            logger.debug("Failed to explain %s: %s", shape, e)
+
+        finally:
+            with self._lock:
+                self._explaining.discard(shape)
+
+    def top(self, n: int = 20, order_by: str = "total_ms") -> List[Dict]:
+        """
+        Get the `n` query shapes with the highest `order_by` (total_ms, max_ms, mean_ms, count or slow)
+        """
+        with self._lock:
+            rows = [
+                {
+                    "shape": shape,
+                    **{key: value for key, value in stats.items() if key != "plan"},
+                    "mean_ms": stats["total_ms"] / stats["count"],
+                    "plan": (
+                        {**stats["plan"], "explained_at": datetime.utcfromtimestamp(stats["plan"]["explained_at"])}
+                        if stats["plan"] else None
+                    ),
+                }
+                for shape, stats in self._shapes.items()
+            ]
+
+        if rows and order_by not in rows[0]:
+            raise ValueError(f"Invalid order: {order_by}")
+
+        return sorted(rows, key=lambda row: row[order_by], reverse=True)[:n]
+
+    def reset(self) -> None:
+        """Forget the recorded shapes"""
+        with self._lock:
+            self._shapes.clear()
+            self.commands = 0
+            self.slow_commands = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "commands": self.commands,
+                "slow_commands": self.slow_commands,
+                "shapes": len(self._shapes),
+                "slow_ms": self.slow_ms,
+            }
+
+
+# Queries issued on every request / status change: (collection, filter, sort)
+HOT_QUERIES = [
+    ("node_collection", {"_id": "?"}, None),
+    ("node_collection", {"data.status": "free"}, None),
+    ("node_collection", {"used_by": "?"}, None),
+    ("node_collection", {"data.status": {"$in": ["free", "reserved"]}, "profile.site": "?", "profile.zone": "?"}, None),
+    ("user_collection", {"_id": "?"}, None),
+    ("dt_memberships", {"dt_id": "?", "dr_type": "node"}, None),
+    ("node_status_history", {"node_id": "?", "timestamp": {"$gte": datetime(2000, 1, 1)}}, [("timestamp", -1)]),
+]
+
+
+def check_hot_queries(db) -> List[Tuple[str, Dict, Optional[List[str]], Optional[str]]]:
+    """
+    Check that the hot queries use an index
+
+    Returns:
+        List of (collection, filter, plan stages, error) (error is None when an index is used)
+    """
+    results = []
+
+    for collection_name, query, sort in HOT_QUERIES:
+        try:
+            stages = assert_uses_index(db[collection_name], query, sort)
+            results.append((collection_name, query, stages, None))
+        except AssertionError as e:
+            results.append((collection_name, query, None, str(e)))
+
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    from pymongo import MongoClient
+    from config.config_loader import ConfigLoader
+
+    db_config = ConfigLoader.load_database_config_env()
+    client = MongoClient(ConfigLoader.build_connection_string(db_config))
+
+    failures = 0
+    for collection_name, query, stages, error in check_hot_queries(client[db_config["settings"]["name"]]):
+        if error is None:
+            print(f"OK    {collection_name} {query}: {stages}")
+        else:
+            failures += 1
+            print(f"FAIL  {error}")
+
+    sys.exit(1 if failures else 0)
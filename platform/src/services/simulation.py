@@ -0,0 +1,424 @@
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+import numpy as np
+from .base import BaseService
+from .status_history import StatusHistory
+
+# Spot states of the simulation (cf the node FSM, `runStateMachine` in node.ino). WAIT_AUTH,
+# UNAUTHORIZED and VIOLATION last seconds to minutes and are folded into OCCUPIED.
+FREE, RESERVED, OCCUPIED, CLOSED = 0, 1, 2, 3
+
+
+class SimulationService(BaseService):
+    """
+    What-if simulation of the parking nodes of a Digital Twin.
+
+    The demand is learned from the status history of the nodes (over `window_days`):
+        - reservation requests and walk-in arrivals per hour of the day (Poisson rates)
+        - no-show probability of a reservation
+        - travel time (reservation to arrival) and dwell time: empirical distributions
+
+    Then, for each policy, `scenarios` independent days (or `horizon_hours`) are simulated against
+    the node FSM: a reservation takes a free spot until the driver arrives or the reservation times
+    out (drivers arriving after the timeout are lost), walk-ins take a free spot or are turned away.
+    Policy keys:
+        - reservation_timeout_s: Reservation timeout (default: `reservation_timeout_s` of the configuration)
+        - max_reservations: Maximum number of spots reserved at the same time (None: no limit)
+        - spots: Number of spots (default: number of nodes of the DT)
+        - demand_scale: Multiplier of the arrival rates (e.g 1.2 for 20% more demand)
+
+    The simulation is time-stepped (`step_s`) and vectorized with NumPy: all the (policy, scenario)
+    runs advance together as the rows of (runs, spots) arrays, so thousands of scenarios take seconds.
+    It runs in the worker processes of the `ServiceExecutionEngine` (columnar interface).
+    """
+
+    DEFAULT_WINDOW_DAYS = 28
+    DEFAULT_RESERVATION_TIMEOUT_S = 3600  # cf NodeManagement._send_reservation_timeout_event
+    DEFAULT_SCENARIOS = 1000
+    DEFAULT_HORIZON_HOURS = 24
+    DEFAULT_STEP_S = 60
+    MAX_RUNS = 100000
+
+    # Used when the history has no sample
+    DEFAULT_DWELL_S = 2 * 3600
+    DEFAULT_TRAVEL_S = 15 * 60
+
+    PRESENT_STATUSES = ["waiting_for_authentication", "occupied", "violation", "unauthorized"]
+
+    METRICS = [
+        "occupancy_rate", "reserved_rate", "walk_ins", "walk_ins_lost", "reservation_requests",
+        "reservations_rejected", "reservations_expired", "late_arrivals", "turn_away_rate",
+    ]
+
+    dr_projection = {"type": 1}
+    context_params = ("status_history",)
+
+    def __init__(self):
+        super().__init__()
+        self.window_days = self.DEFAULT_WINDOW_DAYS
+        self.reservation_timeout_s = self.DEFAULT_RESERVATION_TIMEOUT_S
+
+    def configure(self, config: Dict) -> None:
+        """
+        Args:
+            config: Service configuration. Supported keys:
+                - window_days: History used to learn the demand
+                - reservation_timeout_s: Reservation timeout of the default policy
+        """
+        self.window_days = config.get("window_days", self.window_days)
+        self.reservation_timeout_s = config.get("reservation_timeout_s", self.reservation_timeout_s)
+
+    def execute(
+        self,
+        data: Dict,
+        dr_type: str = None,
+        attribute: str = None,
+        status_history: StatusHistory = None,
+        **kwargs,
+    ) -> Dict:
+        """
+        Simulate the policies on the demand learned from the history of the nodes of the Digital Twin
+
+        Args:
+            data: Dictionary containing the DT data including all DRs
+            dr_type: Type of the parking spot DRs (default: 'node')
+            attribute: Unused
+            status_history: History of the node status transitions (cf `StatusHistory`)
+            **kwargs: Simulation parameters (cf `execute_columns`)
+        """
+        columns = self.to_columns(data, dr_type, status_history=status_history, **kwargs)
+        return self.execute_columns(columns, **kwargs)
+
+    def to_columns(
+        self,
+        data: Dict,
+        dr_type: str = None,
+        attribute: str = None,
+        status_history: StatusHistory = None,
+        window_days: Optional[float] = None,
+        **kwargs,
+    ) -> Dict:
+        """
+        Learn the demand from the history (cf `ServiceExecutionEngine`):
+            {"nb_nodes": int, "days": float, "reservation_rates": (24,) array, "walk_in_rates": (24,) array,
+             "no_show_rate": float, "travel_s": array, "dwell_s": array}
+        or {"error": ...} when the DT has no node.
+        """
+        if not data or "digital_replicas" not in data:
+            raise ValueError("Invalid data: missing digital replicas")
+
+        if status_history is None:
+            raise ValueError("SimulationService needs the status history")
+
+        dr_type = dr_type or "node"
+        node_ids = [dr["_id"] for dr in data["digital_replicas"] if dr.get("type") == dr_type]
+
+        if not node_ids:
+            return {"error": f"No digital replicas found of type {dr_type}"}
+
+        window_days = float(window_days or self.window_days)
+        end = datetime.utcnow()
+        start = end - timedelta(days=window_days)
+
+        rows = status_history.aggregate(self._build_pipeline(start, end, node_ids))
+
+        hours = np.array([row["hour"] for row in rows], dtype=np.int64)
+        old = np.array([row.get("old_status") or "" for row in rows], dtype=object)
+        new = np.array([row["new_status"] for row in rows], dtype=object)
+        following = np.array([row.get("next_status") or "" for row in rows], dtype=object)
+        duration_s = np.array([row["duration_ms"] / 1000 for row in rows], dtype=np.float64)
+
+        present = np.isin(new, self.PRESENT_STATUSES)
+        next_present = np.isin(following, self.PRESENT_STATUSES)
+
+        is_reservation = new == "reserved"
+        is_walk_in = present & (old == "free")
+        nb_reservations = int(is_reservation.sum())
+
+        return {
+            "nb_nodes": len(node_ids),
+            "days": window_days,
+            "reservation_rates": np.bincount(hours[is_reservation], minlength=24)[:24] / window_days,
+            "walk_in_rates": np.bincount(hours[is_walk_in], minlength=24)[:24] / window_days,
+            "no_show_rate": (
+                float((is_reservation & (following == "free")).sum()) / nb_reservations if nb_reservations else 0.0
+            ),
+            "travel_s": duration_s[is_reservation & next_present],
+            "dwell_s": duration_s[(new == "occupied") & (following == "free")],
+        }
+
+    def _build_pipeline(self, start: datetime, end: datetime, node_ids: List[str]) -> List[Dict]:
+        """One row per transition: hour of the day, statuses before / after / next, time to the next transition"""
+        return [
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}, "node_id": {"$in": node_ids}}},
+            {
+                "$setWindowFields": {
+                    "partitionBy": "$node_id",
+                    "sortBy": {"timestamp": 1},
+                    "output": {
+                        "next_timestamp": {"$shift": {"output": "$timestamp", "by": 1, "default": None}},
+                        "next_status": {"$shift": {"output": "$new_status", "by": 1, "default": None}},
+                    },
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "hour": {"$hour": "$timestamp"},
+                    "old_status": 1,
+                    "new_status": 1,
+                    "next_status": 1,
+                    "duration_ms": {"$subtract": [{"$ifNull": ["$next_timestamp", end]}, "$timestamp"]},
+                }
+            },
+        ]
+
+    def execute_columns(
+        self,
+        columns: Dict,
+        policies: Optional[List[Dict]] = None,
+        scenarios: int = DEFAULT_SCENARIOS,
+        horizon_hours: float = DEFAULT_HORIZON_HOURS,
+        step_s: float = DEFAULT_STEP_S,
+        start_hour: int = 0,
+        seed: Optional[int] = None,
+        **kwargs,
+    ) -> Dict:
+        """
+        Simulate the policies on the learned demand
+
+        Args:
+            columns: Output of `to_columns`
+            policies: Policies to compare (default: the current policy only)
+            scenarios: Number of simulated runs per policy
+            horizon_hours: Simulated duration of a run
+            step_s: Time step of the simulation
+            start_hour: Hour of the day (UTC) when the runs start, with all the spots free
+            seed: Seed of the random generator (for reproducible results)
+
+        Returns:
+            Dict: The learned demand, and per policy the mean, 5th and 95th percentiles of each metric over the scenarios
+        """
+        if "error" in columns:
+            return {"error": columns["error"]}
+
+        policies = [self._policy(policy, columns) for policy in (policies or [{}])]
+        scenarios = int(scenarios)
+
+        if scenarios <= 0 or len(policies) * scenarios > self.MAX_RUNS:
+            raise ValueError(f"scenarios must be positive, and at most {self.MAX_RUNS} runs in total")
+        if step_s <= 0 or horizon_hours <= 0:
+            raise ValueError("step_s and horizon_hours must be positive")
+
+        metrics = self._simulate(columns, policies, scenarios, float(horizon_hours), float(step_s), int(start_hour), seed)
+
+        result = {"demand": self._demand_summary(columns), "scenarios": scenarios, "horizon_hours": horizon_hours, "policies": []}
+
+        for i, policy in enumerate(policies):
+            rows = slice(i * scenarios, (i + 1) * scenarios)
+            result["policies"].append({
+                "policy": policy,
+                "metrics": {
+                    name: {
+                        "mean": float(values[rows].mean()),
+                        "p5": float(np.percentile(values[rows], 5)),
+                        "p95": float(np.percentile(values[rows], 95)),
+                    }
+                    for name, values in metrics.items()
+                },
+            })
+
+        return result
+
+    def _policy(self, policy: Dict, columns: Dict) -> Dict:
+        """Complete a policy with the defaults"""
+        unknown = set(policy) - {"reservation_timeout_s", "max_reservations", "spots", "demand_scale"}
+        if unknown:
+            raise ValueError(f"Unknown policy keys: {sorted(unknown)}")
+
+        max_reservations = policy.get("max_reservations")
+
+        ret = {
+            "reservation_timeout_s": float(policy.get("reservation_timeout_s", self.reservation_timeout_s)),
+            "max_reservations": None if max_reservations is None else int(max_reservations),
+            "spots": int(policy.get("spots", columns["nb_nodes"])),
+            "demand_scale": float(policy.get("demand_scale", 1.0)),
+        }
+
+        negative = [key for key, value in ret.items() if value is not None and value < 0]
+        if negative:
+            raise ValueError(f"Negative policy values: {sorted(negative)}")
+        if ret["spots"] < 1:
+            raise ValueError(f"A policy needs at least one spot (spots: {ret['spots']})")
+
+        return ret
+
+    def _demand_summary(self, columns: Dict) -> Dict:
+        def median(samples: np.ndarray) -> Optional[float]:
+            return float(np.median(samples)) if samples.size else None
+
+        return {
+            "nb_nodes": columns["nb_nodes"],
+            "days": columns["days"],
+            "reservations_per_day": float(columns["reservation_rates"].sum()),
+            "walk_ins_per_day": float(columns["walk_in_rates"].sum()),
+            "no_show_rate": columns["no_show_rate"],
+            "median_travel_s": median(columns["travel_s"]),
+            "median_dwell_s": median(columns["dwell_s"]),
+        }
+
+    @staticmethod
+    def _sampler(rng: np.random.Generator, samples: np.ndarray, default_mean_s: float):
+        """Draw from the empirical distribution (exponential of mean `default_mean_s` without samples)"""
+        if samples.size:
+            return lambda size: rng.choice(samples, size=size)
+        return lambda size: rng.exponential(default_mean_s, size=size)
+
+    def _simulate(
+        self,
+        columns: Dict,
+        policies: List[Dict],
+        scenarios: int,
+        horizon_hours: float,
+        step_s: float,
+        start_hour: int,
+        seed: Optional[int],
+    ) -> Dict[str, np.ndarray]:
+        """
+        Run every (policy, scenario) at once. Returns each metric per run.
+
+        Each spot has the time of its next event (`next_event`: departure, arrival of the driver or
+        reservation timeout) and each run keeps its number of free / reserved / occupied spots, so a
+        step only scans the spots with a due event and the runs with new arrivals.
+        """
+        rng = np.random.default_rng(seed)
+        draw_travel = self._sampler(rng, columns["travel_s"], self.DEFAULT_TRAVEL_S)
+        draw_dwell = self._sampler(rng, columns["dwell_s"], self.DEFAULT_DWELL_S)
+
+        # Parameters per run (row)
+        def per_run(key: str, default: float = np.inf) -> np.ndarray:
+            values = [default if policy[key] is None else policy[key] for policy in policies]
+            return np.repeat(np.array(values, dtype=np.float64), scenarios)
+
+        timeout_s = per_run("reservation_timeout_s")
+        max_reservations = per_run("max_reservations")
+        spots = per_run("spots").astype(np.int64)
+        demand_scale = per_run("demand_scale")
+
+        nb_runs, nb_spots = spots.size, max(int(spots.max()), 1)
+
+        # Spot state, and the times of its events
+        state = np.full((nb_runs, nb_spots), FREE, dtype=np.int8)
+        state[np.arange(nb_spots)[None, :] >= spots[:, None]] = CLOSED
+        next_event = np.full((nb_runs, nb_spots), np.inf)
+        arrival = np.full((nb_runs, nb_spots), np.inf)   # RESERVED: arrival of the driver (inf: no-show)
+        deadline = np.full((nb_runs, nb_spots), np.inf)  # RESERVED: timeout of the reservation
+        leave = np.full((nb_runs, nb_spots), np.inf)     # RESERVED / OCCUPIED: departure of the driver
+
+        nb_free = spots.copy()
+        nb_reserved = np.zeros(nb_runs, dtype=np.int64)
+        nb_occupied = np.zeros(nb_runs, dtype=np.int64)
+
+        counters = {name: np.zeros(nb_runs) for name in self.METRICS}
+        occupied_steps = np.zeros(nb_runs)
+        reserved_steps = np.zeros(nb_runs)
+
+        def count(runs: np.ndarray) -> np.ndarray:
+            return np.bincount(runs, minlength=nb_runs)
+
+        reservation_rates = columns["reservation_rates"] / 3600 * step_s
+        walk_in_rates = columns["walk_in_rates"] / 3600 * step_s
+        no_show_rate = columns["no_show_rate"]
+
+        flat_state, flat_next = state.reshape(-1), next_event.reshape(-1)
+        flat_arrival, flat_deadline, flat_leave = arrival.reshape(-1), deadline.reshape(-1), leave.reshape(-1)
+
+        nb_steps = int(np.ceil(horizon_hours * 3600 / step_s))
+
+        for step in range(nb_steps):
+            now = (step + 1) * step_s
+            hour = int(start_hour + step * step_s / 3600) % 24
+
+            # Due events: departures, reserved drivers arriving, reservations timing out
+            due = np.flatnonzero(flat_next <= now)
+            if due.size:
+                runs = due // nb_spots
+                occupied = flat_state[due] == OCCUPIED
+                arrived = ~occupied & (flat_arrival[due] <= flat_deadline[due])
+                expired = ~occupied & ~arrived
+
+                left = due[occupied]
+                flat_state[left] = FREE
+                flat_next[left] = np.inf
+
+                came = due[arrived]
+                flat_state[came] = OCCUPIED
+                flat_next[came] = flat_leave[came]
+
+                gone = due[expired]
+                flat_state[gone] = FREE
+                flat_next[gone] = np.inf
+
+                nb_left, nb_came, nb_gone = count(runs[occupied]), count(runs[arrived]), count(runs[expired])
+                nb_free += nb_left + nb_gone
+                nb_reserved -= nb_came + nb_gone
+                nb_occupied += nb_came - nb_left
+
+                counters["reservations_expired"] += nb_gone
+                counters["late_arrivals"] += count(runs[expired][np.isfinite(flat_arrival[gone])])
+
+            # New reservation requests and walk-ins (Poisson)
+            requests = rng.poisson(reservation_rates[hour] * demand_scale)
+            walk_ins = rng.poisson(walk_in_rates[hour] * demand_scale)
+
+            accepted = np.minimum(requests, np.minimum(nb_free, np.maximum(max_reservations - nb_reserved, 0))).astype(np.int64)
+            served = np.minimum(walk_ins, nb_free - accepted)
+
+            counters["reservation_requests"] += requests
+            counters["reservations_rejected"] += requests - accepted
+            counters["walk_ins"] += walk_ins
+            counters["walk_ins_lost"] += walk_ins - served
+
+            active = np.flatnonzero(accepted + served)
+            if active.size:
+                # The first free spots of each run take the reservations, the next ones the walk-ins
+                free = state[active] == FREE
+                rank = np.cumsum(free, axis=1)
+                to_reserve = free & (rank <= accepted[active, None])
+                to_occupy = free & ~to_reserve & (rank <= (accepted + served)[active, None])
+
+                rows, cols = np.nonzero(to_reserve)
+                if rows.size:
+                    runs = active[rows]
+                    shows = rng.random(rows.size) >= no_show_rate
+                    driver_arrival = np.where(shows, now + draw_travel(rows.size), np.inf)
+                    driver_deadline = now + timeout_s[runs]
+
+                    state[runs, cols] = RESERVED
+                    arrival[runs, cols] = driver_arrival
+                    deadline[runs, cols] = driver_deadline
+                    leave[runs, cols] = driver_arrival + draw_dwell(rows.size)
+                    next_event[runs, cols] = np.minimum(driver_arrival, driver_deadline)
+
+                rows, cols = np.nonzero(to_occupy)
+                if rows.size:
+                    runs = active[rows]
+                    state[runs, cols] = OCCUPIED
+                    next_event[runs, cols] = now + draw_dwell(rows.size)
+
+                nb_free -= accepted + served
+                nb_reserved += accepted
+                nb_occupied += served
+
+            occupied_steps += nb_occupied
+            reserved_steps += nb_reserved
+
+        spot_steps = np.maximum(spots, 1) * nb_steps
+        counters["occupancy_rate"] = occupied_steps / spot_steps
+        counters["reserved_rate"] = reserved_steps / spot_steps
+
+        demand = counters["reservation_requests"] + counters["walk_ins"]
+        lost = counters["reservations_rejected"] + counters["walk_ins_lost"] + counters["late_arrivals"]
+        counters["turn_away_rate"] = np.divide(lost, demand, out=np.zeros(nb_runs), where=demand > 0)
+
+        return counters
@@ -0,0 +1,191 @@
+from typing import Dict, List, Optional
+import math
+import numpy as np
+
+
+class RunningStats:
+    """
+    One-pass, mergeable count / mean / variance / min / max (Welford, with Chan's formula to add whole batches).
+
+    Batches are NumPy arrays, so the per-value work is vectorized and the state stays O(1).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of the squared differences to the mean
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of values"""
+        n = values.size
+        if n == 0:
+            return
+
+        batch_mean = float(values.mean())
+        batch_m2 = float(((values - batch_mean) ** 2).sum())
+
+        self._combine(n, batch_mean, batch_m2, float(values.min()), float(values.max()))
+
+    def merge(self, other: "RunningStats") -> None:
+        """Add the values summarized by `other`"""
+        if other.count:
+            self._combine(other.count, other.mean, other.m2, other.min, other.max)
+
+    def _combine(self, n: int, mean: float, m2: float, vmin: float, vmax: float) -> None:
+        total = self.count + n
+        delta = mean - self.mean
+
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    @property
+    def stddev(self) -> float:
+        """Sample standard deviation (0 with less than 2 values)"""
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> "RunningStats":
+        stats = cls()
+        stats.count = state["count"]
+        stats.mean = state["mean"]
+        stats.m2 = state["m2"]
+        stats.min = state["min"]
+        stats.max = state["max"]
+        return stats
+
+
+class TDigest:
+    """
+    Mergeable quantile sketch (merging t-digest, k1 scale function).
+
+    Values are buffered and folded into at most ~`compression` centroids with vectorized operations.
+    The centroids are small and serializable, so digests built on different Digital Twins (or processes)
+    can be merged to get the quantiles of the union.
+    """
+
+    def __init__(self, compression: int = 100, buffer_size: int = 50_000):
+        """
+        Args:
+            compression: Accuracy / size trade-off (number of centroids is ~ compression)
+            buffer_size: Number of values buffered before compressing
+        """
+        self.compression = compression
+        self.buffer_size = buffer_size
+
+        self._means = np.empty(0)
+        self._weights = np.empty(0)
+        self._buffer: List[np.ndarray] = []
+        self._buffered = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of values"""
+        if values.size == 0:
+            return
+
+        self._buffer.append(np.asarray(values, dtype=float))
+        self._buffered += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        if self._buffered >= self.buffer_size:
+            self._compress()
+
+    def merge(self, other: "TDigest") -> None:
+        """Add the values summarized by `other`"""
+        other._compress()
+        if other._weights.size == 0:
+            return
+
+        self._means = np.concatenate([self._means, other._means])
+        self._weights = np.concatenate([self._weights, other._weights])
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    @property
+    def count(self) -> float:
+        return float(self._weights.sum()) + self._buffered
+
+    def _compress(self) -> None:
+        """Fold the buffer and the centroids into at most ~`compression` centroids"""
+        if self._buffer:
+            values = np.concatenate(self._buffer)
+            means = np.concatenate([self._means, values])
+            weights = np.concatenate([self._weights, np.ones(values.size)])
+            self._buffer = []
+            self._buffered = 0
+        else:
+            means, weights = self._means, self._weights
+
+        if means.size == 0:
+            return
+
+        order = np.argsort(means, kind="stable")
+        means = means[order]
+        weights = weights[order]
+
+        # Quantile at the left edge of each centroid, mapped through the k1 scale function:
+        # centroids with the same integer k are merged (small centroids near the tails, large ones in the middle)
+        total = weights.sum()
+        q_left = (np.cumsum(weights) - weights) / total
+        k = self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * q_left - 1, -1, 1))
+        bucket = np.floor(k)
+
+        starts = np.flatnonzero(np.concatenate([[True], bucket[1:] != bucket[:-1]]))
+        merged_weights = np.add.reduceat(weights, starts)
+        merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+
+        self._means = merged_means
+        self._weights = merged_weights
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate the `q` quantile (0 <= q <= 1)
+
+        Returns:
+            Optional[float]: The estimate, None if the digest is empty
+        """
+        self._compress()
+
+        if self._weights.size == 0:
+            return None
+        if self._weights.size == 1:
+            return float(self._means[0])
+
+        # Each centroid is centered on its cumulative mid-weight; interpolate linearly,
+        # with the exact min and max at both ends
+        total = self._weights.sum()
+        centers = (np.cumsum(self._weights) - self._weights / 2) / total
+        xs = np.concatenate([[0.0], centers, [1.0]])
+        ys = np.concatenate([[self.min], self._means, [self.max]])
+
+        return float(np.interp(q, xs, ys))
+
+    def to_dict(self) -> Dict:
+        self._compress()
+        return {
+            "compression": self.compression,
+            "means": self._means.tolist(),
+            "weights": self._weights.tolist(),
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> "TDigest":
+        digest = cls(compression=state["compression"])
+        digest._means = np.asarray(state["means"], dtype=float)
+        digest._weights = np.asarray(state["weights"], dtype=float)
+        digest.min = state["min"]
+        digest.max = state["max"]
+        return digest
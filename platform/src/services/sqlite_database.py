@@ -0,0 +1,496 @@
+"""
+Embedded database in a SQLite file: the subset of the pymongo API of `memory_database`, shared by the processes of
+the platform (workers and MQTT gateway) without database server.
+
+Selected by the `sqlite:///path/to/file.db` connection string (`sqlite://`: private in-memory database), cf `storage`.
+
+Each collection is a table `(id, doc)` holding the documents as JSON (datetimes as `{"$date": ...}`, ObjectIds as
+`{"$oid": ...}`). The indexes (`create_index`) are SQLite expression indexes on `json_extract(doc, <field>)`:
+the conditions on `_id` and on the indexed fields (equality, `$in`, comparisons) are evaluated by SQLite, then the
+whole query is checked in Python on the returned documents (same semantics as `memory_database`). The documents
+holding an array on the path of an indexed field are listed in a side table (`<collection>$multikey`), so that
+they are always checked in Python (an array matches when one of its elements does).
+
+The TTL of the time-series collections is not stored in the file: each process declares it (cf
+`DatabaseService.ensure_timeseries_collection`) and deletes the expired documents (cf `memory_database.TTL`).
+
+Writes run in `BEGIN IMMEDIATE` transactions: the read-modify-write of the update operators (e.g `$inc`) is atomic
+across threads and processes. The file is in WAL mode (readers do not block the writer).
+"""
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from src.services.memory_database import (
+    TTL, MemoryCursor, WriteResult, aggregate, apply_bulk_write, apply_update, index_name, matches, project,
+    run_command, set_collection_options, upsert_document, _copy,
+)
+
+_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"  # Fixed width: the dates compare as strings
+_INDEXES_TABLE = '"$indexes"'  # (collection table, index name, keys as JSON, unique)
+_DATE_SUFFIX = '."$date"'  # Path of the date string of a stored datetime
+_COMPARISONS = {"$eq": "=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:  # Stored in UTC, returned naive (as pymongo does)
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return {"$date": value.strftime(_DATE_FORMAT)}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    return value
+
+
+def _decode_object(value: Dict) -> Any:
+    if len(value) == 1:
+        if "$date" in value:
+            return datetime.strptime(value["$date"], _DATE_FORMAT)
+        if "$oid" in value:
+            return ObjectId(value["$oid"])
+    return value
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(_encode(value), separators=(",", ":"), ensure_ascii=False)
+
+
+def _loads(text: str) -> Any:
+    return json.loads(text, object_hook=_decode_object)
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _field_expression(field: str, suffix: str = "") -> str:
+    """`json_extract` of a dotted field (the same text in the indexes and in the queries, so that they are used)"""
+    path = "$." + ".".join('"' + key.replace('"', '\\"') + '"' for key in field.split("."))
+    return "json_extract(doc, '" + (path + suffix).replace("'", "''") + "')"
+
+
+def _has_array(document: Any, field: str) -> bool:
+    """Tells if there is an array on the path of `field` (its value included)"""
+    for key in field.split("."):
+        if isinstance(document, list):
+            return True
+        if not isinstance(document, dict) or key not in document:
+            return False
+        document = document[key]
+    return isinstance(document, list)
+
+
+class SQLiteCollection:
+    """A collection: a table of JSON documents (cf module documentation)"""
+
+    def __init__(self, database: "SQLiteDatabase", name: str):
+        self.database = database
+        self.name = name
+        self._client = database.client
+        self._table_name = f"{database.name}.{name}"
+        self._table = _quote(self._table_name)
+        self._multikey = _quote(f"{self._table_name}$multikey")
+        self.ttl: Optional[TTL] = None  # Cf `memory_database.set_collection_options`
+
+        with self._client.transaction() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self._table} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._multikey} (field TEXT NOT NULL, id TEXT NOT NULL, PRIMARY KEY (field, id)) WITHOUT ROWID"
+            )
+            self._fields = self._load_fields(connection)
+
+    def _load_fields(self, connection: sqlite3.Connection) -> List[str]:
+        """The indexed fields (other than `_id`), whose conditions are evaluated by SQLite"""
+        fields = []
+        for (keys,) in connection.execute(f"SELECT keys FROM {_INDEXES_TABLE} WHERE collection = ?", (self._table_name,)):
+            fields.extend(field for field, _ in json.loads(keys) if field != "_id" and field not in fields)
+        return fields
+
+    # Queries
+
+    def _condition(self, field: str, condition: Any) -> Optional[Tuple[str, List]]:
+        """SQL condition selecting a superset of the documents matching `{field: condition}`, None if there is none"""
+
+        if field == "_id":
+            if isinstance(condition, dict):
+                if set(condition) == {"$eq"}:
+                    condition = condition["$eq"]
+                elif set(condition) == {"$in"} and not any(isinstance(value, (dict, re.Pattern)) for value in condition["$in"]):
+                    return f"id IN ({', '.join('?' * len(condition['$in']))})", [_dumps(value) for value in condition["$in"]]
+                else:
+                    return None
+            if isinstance(condition, re.Pattern):
+                return None
+            return "id = ?", [_dumps(condition)]
+
+        if field not in self._fields or any(key.isdigit() for key in field.split(".")):
+            return None
+
+        if not (isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)):
+            condition = {"$eq": condition}
+
+        clauses, parameters = [], []
+        for operator, argument in condition.items():
+            if operator == "$in" and isinstance(argument, list) and argument and all(isinstance(value, (str, int, float)) for value in argument):
+                clauses.append(f"{_field_expression(field)} IN ({', '.join('?' * len(argument))})")
+                parameters.extend(argument)
+            elif operator in _COMPARISONS and isinstance(argument, datetime):
+                clauses.append(f"{_field_expression(field, _DATE_SUFFIX)} {_COMPARISONS[operator]} ?")
+                parameters.append(_encode(argument)["$date"])
+            elif operator in _COMPARISONS and isinstance(argument, (str, int, float)) and not (isinstance(argument, bool) and operator != "$eq"):
+                clauses.append(f"{_field_expression(field)} {_COMPARISONS[operator]} ?")
+                parameters.append(argument)
+            # Other operators: checked in Python only
+
+        if not clauses:
+            return None
+
+        guard = f"id IN (SELECT id FROM {self._multikey} WHERE field = ?)"
+        return f"(({' AND '.join(clauses)}) OR {guard})", parameters + [field]
+
+    def _where(self, query: Optional[Dict]) -> Tuple[str, List]:
+        clauses, parameters = [], []
+
+        for key, condition in (query or {}).items():
+            if key == "$and":
+                parts = [self._where(sub_query) for sub_query in condition]
+            elif key == "$or":
+                parts = [self._where(sub_query) for sub_query in condition]
+                if any(sql == "1" for sql, _ in parts):
+                    continue  # A branch selects everything
+                parts = [(" OR ".join(f"({sql})" for sql, _ in parts), [value for _, values in parts for value in values])]
+            elif key.startswith("$"):
+                continue
+            else:
+                condition = self._condition(key, condition)
+                parts = [condition] if condition else []
+
+            for sql, values in parts:
+                if sql != "1":
+                    clauses.append(sql)
+                    parameters.extend(values)
+
+        return " AND ".join(clauses) or "1", parameters
+
+    def _select(self, connection: sqlite3.Connection, query: Optional[Dict]) -> Iterator[Tuple[str, Dict]]:
+        """(key, document) of the documents matching `query`, in insertion order"""
+        where, parameters = self._where(query)
+        for key, text in connection.execute(f"SELECT id, doc FROM {self._table} WHERE {where} ORDER BY rowid", parameters).fetchall():
+            document = _loads(text)
+            if matches(document, query):
+                yield key, document
+
+    def _documents(self, query: Optional[Dict]) -> List[Dict]:
+        with self._client.reading() as connection:
+            return [document for _, document in self._select(connection, query)]
+
+    def find(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self._documents(filter), projection)
+
+    def find_one(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None, **kwargs) -> Optional[Dict]:
+        with self._client.reading() as connection:
+            for _, document in self._select(connection, filter):
+                return project(document, projection)
+        return None
+
+    def count_documents(self, filter: Dict, **kwargs) -> int:
+        return len(self._documents(filter))
+
+    def aggregate(self, pipeline: List[Dict], **kwargs) -> Iterator[Dict]:
+        if pipeline and "$match" in pipeline[0]:  # The first `$match` can use the indexes
+            return iter(aggregate(self._documents(pipeline[0]["$match"]), pipeline[1:]))
+        return iter(aggregate(self._documents(None), pipeline))
+
+    # Writes
+
+    def _track_arrays(self, connection: sqlite3.Connection, key: str, document: Dict) -> None:
+        for field in self._fields:
+            if _has_array(document, field):
+                connection.execute(f"INSERT OR IGNORE INTO {self._multikey} (field, id) VALUES (?, ?)", (field, key))
+            else:
+                connection.execute(f"DELETE FROM {self._multikey} WHERE field = ? AND id = ?", (field, key))
+
+    def insert_one(self, document: Dict, **kwargs) -> WriteResult:
+        if "_id" not in document:
+            document["_id"] = ObjectId()  # As pymongo, the caller's document gets its `_id`
+
+        if self.ttl is not None:
+            self.ttl.expire(self)
+
+        key = _dumps(document["_id"])
+        with self._client.transaction() as connection:
+            self._fields = self._load_fields(connection)  # Indexes created by an other process
+            try:
+                connection.execute(f"INSERT INTO {self._table} (id, doc) VALUES (?, ?)", (key, _dumps(document)))
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} ({e}) dup key: {{ _id: {document['_id']!r} }}")
+            self._track_arrays(connection, key, document)
+
+        return WriteResult(inserted_id=document["_id"])
+
+    def insert_many(self, documents: List[Dict], ordered: bool = True, **kwargs) -> WriteResult:
+        if self.ttl is not None:
+            self.ttl.expire(self)  # Out of the transaction of the batch
+
+        with self._client.transaction():
+            return WriteResult(inserted_ids=[self.insert_one(document).inserted_id for document in documents])
+
+    def _update(self, filter: Dict, update: Dict, many: bool, upsert: bool) -> WriteResult:
+        if any(not key.startswith("$") for key in update):
+            raise NotImplementedError("Replacement documents are not supported by SQLite storage (use update operators)")
+
+        with self._client.transaction() as connection:
+            self._fields = self._load_fields(connection)
+
+            matched = modified = 0
+            for key, document in list(self._select(connection, filter)):
+                matched += 1
+                updated = _copy(document)
+                apply_update(updated, update)
+
+                if updated != document:
+                    try:
+                        connection.execute(f"UPDATE {self._table} SET doc = ? WHERE id = ?", (_dumps(updated), key))
+                    except sqlite3.IntegrityError as e:
+                        raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} ({e})")
+                    self._track_arrays(connection, key, updated)
+                    modified += 1
+
+                if not many:
+                    break
+
+            upserted_id = None
+            if not matched and upsert:
+                upserted_id = self.insert_one(upsert_document(filter, update)).inserted_id
+
+        return WriteResult(matched_count=matched, modified_count=modified, upserted_id=upserted_id)
+
+    def update_one(self, filter: Dict, update: Dict, upsert: bool = False, **kwargs) -> WriteResult:
+        return self._update(filter, update, False, upsert)
+
+    def update_many(self, filter: Dict, update: Dict, upsert: bool = False, **kwargs) -> WriteResult:
+        return self._update(filter, update, True, upsert)
+
+    def _delete(self, filter: Dict, many: bool) -> WriteResult:
+        with self._client.transaction() as connection:
+            keys = []
+            for key, _ in self._select(connection, filter):
+                keys.append(key)
+                if not many:
+                    break
+
+            for key in keys:
+                connection.execute(f"DELETE FROM {self._table} WHERE id = ?", (key,))
+                connection.execute(f"DELETE FROM {self._multikey} WHERE id = ?", (key,))
+
+        return WriteResult(deleted_count=len(keys))
+
+    def delete_one(self, filter: Dict, **kwargs) -> WriteResult:
+        return self._delete(filter, False)
+
+    def delete_many(self, filter: Dict, **kwargs) -> WriteResult:
+        return self._delete(filter, True)
+
+    def bulk_write(self, requests: List, ordered: bool = True, **kwargs) -> WriteResult:
+        with self._client.transaction():  # A single transaction (and fsync) for the batch
+            return apply_bulk_write(self, requests)
+
+    def create_index(self, keys, unique: bool = False, **kwargs) -> str:
+        """Creates a SQLite expression index on the fields of `keys` (TTL and other options are ignored)"""
+        keys = [(keys, ASCENDING)] if isinstance(keys, str) else list(keys)
+        name = index_name(keys)
+
+        columns = ", ".join(
+            ("id" if field == "_id" else _field_expression(field)) + (" DESC" if direction == -1 else "")
+            for field, direction in keys
+        )
+
+        with self._client.transaction() as connection:
+            try:
+                connection.execute(
+                    f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {_quote(f'{self._table_name}${name}')} ON {self._table} ({columns})"
+                )
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {name} ({e})")
+
+            connection.execute(
+                f"INSERT OR IGNORE INTO {_INDEXES_TABLE} (collection, name, keys, is_unique) VALUES (?, ?, ?, ?)",
+                (self._table_name, name, json.dumps(keys), int(unique)),
+            )
+
+            new_fields = [field for field, _ in keys if field != "_id" and field not in self._fields]
+            self._fields = self._load_fields(connection)
+            if new_fields:  # Documents already holding arrays on the new fields
+                for key, text in connection.execute(f"SELECT id, doc FROM {self._table}").fetchall():
+                    document = _loads(text)
+                    for field in new_fields:
+                        if _has_array(document, field):
+                            connection.execute(f"INSERT OR IGNORE INTO {self._multikey} (field, id) VALUES (?, ?)", (field, key))
+
+        return name
+
+    def drop(self) -> None:
+        with self._client.transaction() as connection:
+            connection.execute(f"DELETE FROM {self._table}")
+            connection.execute(f"DELETE FROM {self._multikey}")
+
+
+class SQLiteDatabase:
+    """A database: its collections are the tables prefixed by its name"""
+
+    def __init__(self, client: "SQLiteClient", name: str):
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, SQLiteCollection] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> SQLiteCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            with self._lock:
+                collection = self._collections.get(name)
+                if collection is None:
+                    collection = self._collections[name] = SQLiteCollection(self, name)
+        return collection
+
+    def list_collection_names(self, **kwargs) -> List[str]:
+        prefix = f"{self.name}."
+        with self.client.reading() as connection:
+            tables = [name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return [table[len(prefix):] for table in tables if table.startswith(prefix) and not table.endswith("$multikey")]
+
+    def create_collection(self, name: str, **options) -> SQLiteCollection:
+        collection = self[name]  # Also for an existing collection (the options of this process are updated)
+        set_collection_options(collection, options)
+        return collection
+
+    def command(self, command: Any, value: Any = None, **kwargs) -> Dict:
+        return run_command(self, command, value, **kwargs)
+
+    def watch(self, *args, **kwargs):
+        raise NotImplementedError("Change streams are not supported by SQLite storage")
+
+
+class SQLiteClient:
+    """
+    Replaces `MongoClient` (other arguments ignored).
+    One connection per thread (and per process), or a single shared one for an in-memory database.
+    """
+
+    def __init__(self, connection_string: str = "sqlite://", timeout: float = 30.0, **kwargs):
+        """
+        Args:
+            connection_string: `sqlite:///relative/path.db`, `sqlite:////absolute/path.db` or `sqlite://` (in memory)
+            timeout: How long a write waits for the lock of an other process (s)
+        """
+        path = connection_string[len("sqlite://"):]
+        path = path[1:] if path.startswith("/") else path
+
+        self.timeout = timeout
+        self.in_memory = path in ("", ":memory:")
+        self.path = f"file:memory_{uuid.uuid4().hex}?mode=memory&cache=shared" if self.in_memory else path
+
+        if not self.in_memory and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.RLock()  # In memory: serializes the use of the shared connection
+        self._shared: Optional[sqlite3.Connection] = None
+        self.databases: Dict[str, SQLiteDatabase] = {}
+
+        with self.transaction() as connection:
+            if connection.execute("SELECT json_valid('{}')").fetchone()[0] != 1:
+                raise RuntimeError("SQLite is built without the JSON1 functions")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {_INDEXES_TABLE} "
+                "(collection TEXT NOT NULL, name TEXT NOT NULL, keys TEXT NOT NULL, is_unique INTEGER NOT NULL, PRIMARY KEY (collection, name))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, uri=self.in_memory, check_same_thread=False)
+        if not self.in_memory:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # Durable at the checkpoints (WAL): no fsync per commit
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        if self.in_memory:
+            if self._shared is None:
+                self._shared = self._connect()
+            return self._shared
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():  # Not shared with a forked child
+            connection = self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+            self._local.depth = 0
+        return connection
+
+    @contextmanager
+    def reading(self) -> Iterator[sqlite3.Connection]:
+        """Connection of the current thread, for reads (a single statement is consistent)"""
+        if self.in_memory:
+            with self._lock:
+                yield self._connection()
+        else:
+            yield self._connection()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction (`BEGIN IMMEDIATE`: takes the write lock first). Nested calls join the outer one"""
+        with self._lock if self.in_memory else nullcontext():
+            connection = self._connection()
+            depth = getattr(self._local, "depth", 0)
+
+            if depth:
+                self._local.depth = depth + 1
+                try:
+                    yield connection
+                finally:
+                    self._local.depth = depth
+                return
+
+            connection.execute("BEGIN IMMEDIATE")
+            self._local.depth = 1
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+            finally:
+                self._local.depth = 0
+
+    def __getitem__(self, name: str) -> SQLiteDatabase:
+        database = self.databases.get(name)
+        if database is None:
+            database = self.databases[name] = SQLiteDatabase(self, name)
+        return database
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            self._shared = None
+            self._local = threading.local()
+
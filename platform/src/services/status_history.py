@@ -0,0 +1,205 @@
+from typing import Dict, List, Optional
+from datetime import datetime
+import logging
+from .batch_writer import BatchWriter
+from .database_service import DatabaseService
+
+logger = logging.getLogger(__name__)
+
+
+class StatusHistory:
+    """
+    Append-only history of the node status transitions.
+
+    Transitions are buffered and written in batches (cf `BatchWriter`) into the MongoDB
+    time-series collection `node_status_history` (metaField: `node_id`), so recording a
+    transition never waits for the database.
+
+    The collection (and its retention) is set up by `start`, or by the first write if the database was not
+    reachable: the reads never modify it (they return nothing until the collection exists).
+
+    Document format:
+        {
+            "timestamp": datetime,
+            "node_id": str,
+            "old_status": str,
+            "new_status": str,
+            "used_by": str,   # UID of the user concerned by the transition ("" if none)
+            "source": str     # who triggered it ("node", "user", "admin", "group_command", ...)
+        }
+
+    Delivery is at least once (cf `BatchWriter`): the reads deduplicate the transitions by `_id`.
+    """
+
+    COLLECTION = "node_status_history"
+
+    # Keeps one transition per `_id` (inserted after the `$match` of the pipelines, cf `aggregate`)
+    DEDUPE_STAGES = [
+        {"$group": {"_id": "$_id", "transition": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$transition"}},
+    ]
+
+    def __init__(
+        self,
+        db_service: DatabaseService,
+        retention_days: int = 0,
+        batch_size: int = 500,
+        flush_period: float = 1.0,
+    ):
+        """
+        Args:
+            db_service: Database service
+            retention_days: Transitions older than this are deleted by MongoDB (0: keep forever)
+            batch_size: Maximum number of transitions per write
+            flush_period: Maximum time (in seconds) before a transition is written
+        """
+        self.db_service = db_service
+        self.retention_days = retention_days
+        self._collection_ready = False
+
+        self.writer = BatchWriter(
+            "status_history", self._write, batch_size=batch_size, flush_period=flush_period
+        )
+
+    def start(self) -> None:
+        """Set up the collection and start the background writer"""
+        try:
+            self._ensure_collection()
+        except Exception as e:
+            logger.warning("Status history collection not set up (retried by the first write): %s", e)
+
+        self.writer.start()
+
+    def stop(self) -> None:
+        """Stop the background writer (flushes the pending transitions)"""
+        self.writer.stop()
+
+    def _ensure_collection(self) -> None:
+        if not self._collection_ready:
+            self.db_service.ensure_timeseries_collection(
+                self.COLLECTION,
+                time_field="timestamp",
+                meta_field="node_id",
+                granularity="seconds",
+                expire_after_seconds=self.retention_days * 24 * 3600,
+            )
+            self._collection_ready = True
+
+    def _write(self, transitions: List[Dict]) -> None:
+        self._ensure_collection()
+        self.db_service.insert_records(self.COLLECTION, transitions)
+
+    def record(
+        self,
+        node_id: str,
+        old_status: Optional[str],
+        new_status: str,
+        used_by: str = "",
+        source: str = "",
+        timestamp: Optional[datetime] = None,
+    ) -> None:
+        """Record a transition (buffered, returns immediately)"""
+        if old_status == new_status:
+            return
+
+        self.writer.add({
+            "timestamp": timestamp or datetime.utcnow(),
+            "node_id": node_id,
+            "old_status": old_status,
+            "new_status": new_status,
+            "used_by": used_by or "",
+            "source": source,
+        })
+
+    def query_range(
+        self,
+        start: datetime,
+        end: datetime,
+        node_ids: Optional[List[str]] = None,
+        projection: Optional[Dict] = None,
+    ) -> List[Dict]:
+        """
+        Get the transitions in [start, end[, sorted by node then time
+
+        Args:
+            start: Start of the time range
+            end: End of the time range
+            node_ids: Restrict to these nodes (all nodes if None)
+            projection: Fields to return (all but `_id` if None)
+        """
+        query = {"timestamp": {"$gte": start, "$lt": end}}
+        if node_ids is not None:
+            query["node_id"] = {"$in": list(node_ids)}
+
+        return self.db_service.find_records(
+            self.COLLECTION,
+            query,
+            projection=projection or {"_id": False},
+            sort=[("node_id", 1), ("timestamp", 1)],
+            unique=True,
+        )
+
+    def node_history(
+        self,
+        node_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: int = 0,
+    ) -> List[Dict]:
+        """Get the transitions of one node (most recent first)"""
+        query = {"node_id": node_id}
+        if start is not None or end is not None:
+            query["timestamp"] = {}
+            if start is not None:
+                query["timestamp"]["$gte"] = start
+            if end is not None:
+                query["timestamp"]["$lt"] = end
+
+        return self.db_service.find_records(
+            self.COLLECTION,
+            query,
+            projection={"_id": False},
+            sort=[("timestamp", -1)],
+            limit=limit,
+            unique=True,
+        )
+
+    def statuses_at(self, at: datetime, node_ids: Optional[List[str]] = None) -> Dict[str, str]:
+        """
+        Get the status of the nodes at a given time (last transition before `at`), computed server side
+
+        `$sort` on (node_id, timestamp desc) then `$group` with `$first` is the "last point" query of the
+        time-series collections: MongoDB reads the latest bucket of each node through the
+        (node_id, timestamp desc) index, so the cost does not grow with the history of the nodes.
+
+        Returns:
+            Dict[str, str]: node_id -> status (nodes without any transition before `at` are missing)
+        """
+        match = {"timestamp": {"$lt": at}}
+        if node_ids is not None:
+            match["node_id"] = {"$in": list(node_ids)}
+
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"node_id": 1, "timestamp": -1}},
+            {"$group": {"_id": "$node_id", "status": {"$first": "$new_status"}}},
+        ]
+
+        return {
+            row["_id"]: row["status"]
+            for row in self.db_service.aggregate_records(self.COLLECTION, pipeline)
+        }
+
+    def aggregate(self, pipeline: List[Dict]) -> List[Dict]:
+        """
+        Run an aggregation pipeline on the history (server side)
+
+        A retried batch can store a transition twice (cf `BatchWriter`): the transitions selected by the
+        leading `$match` of the pipeline are deduplicated by `_id` before its other stages.
+        """
+        start = 1 if pipeline and "$match" in pipeline[0] else 0
+        return self.db_service.aggregate_records(self.COLLECTION, pipeline[:start] + self.DEDUPE_STAGES + pipeline[start:])
+
+    def stats(self) -> Dict:
+        """Get the writer statistics"""
+        return self.writer.stats()
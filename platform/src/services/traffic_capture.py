@@ -0,0 +1,256 @@
+"""
+Traffic capture: records the workload of the platform, to replay it on a test instance (`python -m loadtest replay`).
+
+Events (one JSON object per line, `ts` being the wall-clock time of the event, in seconds):
+    - `http`: the API requests (node authentications and status updates, UI calls, ...), with their JSON body,
+      the claims of their JWT (`auth`: uid and is_admin), their status and duration (`ms`)
+    - `mqtt_in`: the messages of the nodes (heartbeats, status, telemetry, acknowledgements)
+    - `mqtt_out`: the commands published to the nodes (reservations, group commands)
+and `node`, the node the event is about (the replay keeps the order of the events of each node).
+
+Secrets are redacted before the events are queued: the JWTs are replaced by their claims, and the values of the
+`redact` fields (in the bodies and query strings, names compared case-insensitively) by a pseudonym, which keeps the
+hex values hex (of the same length). The pseudonyms are keyed hashes (`pseudonymize`): with the same `key`
+(`CAPTURE_KEY`, shared by all the processes), a value has the same pseudonym in every capture file, and
+`python -m loadtest pseudonymize` gives the badges of a test database the pseudonyms the replayed requests carry.
+They cannot be reversed without the key (without one, each process uses a random key that is not stored).
+
+The events are written from a background thread (`BatchWriter`) to `<directory>/<service>_<pid>.jsonl.gz`, each
+batch as a gzip member (the file stays readable if the process is killed). Each process (gunicorn workers, MQTT
+gateway) writes its own file; the capture stops when a file reaches `max_bytes`.
+"""
+
+from typing import Any, Dict, Iterable, List, Optional
+from threading import Lock
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import jwt
+
+from src.services.batch_writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+# Compared case-insensitively (e.g `AUTH_BYTES` of the nodes, `auth_bytes` of the admin user updates)
+DEFAULT_REDACT = ("token", "auth_bytes", "new_auth_bytes", "pwd_hash", "pwd_reset_tk", "password", "email")
+
+# Requests that are not part of the workload
+IGNORED_PATHS = ("/api/diagnostics", "/metrics")
+
+_HEX_PATTERN = re.compile(r"^[0-9a-fA-F]+$")
+
+
+def capture_key(secret: str) -> bytes:
+    """The key of the pseudonyms derived from a secret (`CAPTURE_KEY`), a random one if it is empty"""
+    if not secret:
+        return os.urandom(32)
+    return hashlib.blake2b(secret.encode(), digest_size=32, person=b"capture_key").digest()
+
+
+def pseudonymize(value: Any, key: bytes) -> str:
+    """
+    Keyed pseudonym of a secret: hex strings (e.g badge bytes) get a hex pseudonym of the same length, the other
+    values `redacted:<16 hex digits>`
+
+    Args:
+        value: The secret (converted to a string)
+        key: Key of the pseudonyms (cf `capture_key`)
+    """
+    text = str(value)
+    digest = hashlib.blake2b(text.encode(), key=key, digest_size=32).hexdigest()
+    if _HEX_PATTERN.match(text):
+        return (digest * (len(text) // len(digest) + 1))[: len(text)]
+    return f"redacted:{digest[:16]}"
+
+
+class CaptureFile:
+    """Appends batches of events to a gzip JSONL file, until it reaches `max_bytes`"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.full = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def write(self, events: List[Dict]) -> None:
+        if self.full:
+            return
+
+        data = gzip.compress("".join(json.dumps(event, separators=(",", ":"), default=str) + "\n" for event in events).encode())
+        if self.max_bytes and self.size + len(data) > self.max_bytes:
+            self.full = True
+            logger.warning(f"Traffic capture: {self.path} reached its maximum size, the capture is stopped")
+            return
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self.size += len(data)
+
+
+class TrafficCapture:
+    """Records the events of the process (disabled until `configure`, cf module documentation)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.capture_mqtt = True
+        self._redact: frozenset = frozenset(DEFAULT_REDACT)  # Lowercase
+        self._key = capture_key("")
+        self._pseudonyms: Dict[str, str] = {}
+        self._pseudonyms_lock = Lock()
+        self._file: Optional[CaptureFile] = None
+        self._writer: Optional[BatchWriter] = None
+
+    def configure(
+        self,
+        path: str,
+        max_bytes: int = 500 * 1024 * 1024,
+        redact: Iterable[str] = DEFAULT_REDACT,
+        capture_mqtt: bool = True,
+        flush_period: float = 1.0,
+        key: str = "",
+    ) -> None:
+        """
+        Start capturing
+
+        Args:
+            path: File of the events (gzip JSONL, its directory is created)
+            max_bytes: Size of the file above which the capture stops
+            redact: Fields whose values are replaced by a pseudonym (case-insensitive)
+            capture_mqtt: Also capture the MQTT messages of the nodes and the commands to the nodes
+            flush_period: Maximum time (in seconds) an event waits in memory
+            key: Secret the key of the pseudonyms is derived from (empty: a random key, for this process only)
+        """
+        self._key = capture_key(key)
+        with self._pseudonyms_lock:
+            self._pseudonyms.clear()
+        self._file = CaptureFile(path, max_bytes)
+        self._redact = frozenset(field.lower() for field in redact)
+        self.capture_mqtt = capture_mqtt
+
+        self._writer = BatchWriter("traffic_capture", self._file.write, batch_size=1000, flush_period=flush_period)
+        self._writer.start()
+        self.enabled = True
+
+    def stop(self) -> None:
+        """Write the pending events and stop capturing"""
+        self.enabled = False
+        if self._writer is not None:
+            self._writer.stop()
+
+    # Redaction
+
+    def pseudonym(self, value: Any) -> str:
+        """Pseudonym of a secret with the key of the capture (cf `pseudonymize`)"""
+        text = str(value)
+        with self._pseudonyms_lock:
+            pseudonym = self._pseudonyms.get(text)
+            if pseudonym is None:
+                pseudonym = pseudonymize(text, self._key)
+                if len(self._pseudonyms) < 100_000:
+                    self._pseudonyms[text] = pseudonym
+        return pseudonym
+
+    def redact(self, value: Any) -> Any:
+        """Copy of a JSON value whose `redact` fields are replaced by their pseudonym"""
+        if isinstance(value, dict):
+            return {
+                key: self.pseudonym(item) if key.lower() in self._redact and item not in (None, "") else self.redact(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self.redact(item) for item in value]
+        return value
+
+    @staticmethod
+    def claims(token: Optional[str]) -> Optional[Dict]:
+        """The claims of a JWT needed to sign an equivalent one (its signature is checked by the routes, not here)"""
+        if not token:
+            return None
+        try:
+            payload = jwt.decode(token, options={"verify_signature": False})
+        except jwt.InvalidTokenError:
+            return {"invalid": True}
+        return {"uid": payload.get("uid"), "is_admin": bool(payload.get("is_admin"))}
+
+    # Events
+
+    def record(self, kind: str, node: Optional[str], **fields) -> None:
+        """Queue an event (never blocks)"""
+        if self.enabled:
+            self._writer.add({"ts": round(time.time(), 6), "kind": kind, "node": node, **fields})
+
+    def record_mqtt(self, kind: str, topic: str, payload: Any, node: Optional[str], **fields) -> None:
+        """Queue a `mqtt_in` or `mqtt_out` event"""
+        if not (self.enabled and self.capture_mqtt):
+            return
+        if isinstance(payload, bytes):
+            payload = payload.decode(errors="replace")
+        self.record(kind, node, topic=topic, payload=payload, **fields)
+
+    def init_app(self, app) -> None:
+        """Capture the requests of a Flask app"""
+        from flask import g, request
+
+        def start_capture():
+            g.capture_started = (time.time(), time.perf_counter())
+
+        def record_request(response):
+            started = g.pop("capture_started", None)
+            if started is None or not self.enabled or request.path.startswith(IGNORED_PATHS) or request.method == "OPTIONS":
+                return response
+
+            query = {key: self.pseudonym(value) if key.lower() in self._redact else value for key, value in request.args.items()}
+            event = {
+                "ts": round(started[0], 6),
+                "kind": "http",
+                "node": (request.view_args or {}).get("node_id"),
+                "method": request.method,
+                "path": request.path,
+                "route": request.url_rule.rule if request.url_rule is not None else None,
+                "query": query or None,
+                "auth": self.claims(request.headers.get("Authorization")),
+                "body": self.redact(request.get_json(silent=True)) if request.is_json else None,
+                "status": response.status_code,
+                "ms": round((time.perf_counter() - started[1]) * 1000, 3),
+            }
+            self._writer.add(event)
+            return response
+
+        app.before_request(start_capture)
+        app.after_request(record_request)
+
+    def stats(self) -> Dict:
+        if self._writer is None:
+            return {"enabled": False}
+        return {"enabled": self.enabled, "path": self._file.path, "bytes": self._file.size, "full": self._file.full, **self._writer.stats()}
+
+
+# Traffic capture of the process (disabled until `configure_capture` is called with a directory)
+CAPTURE = TrafficCapture()
+
+
+def configure_capture(service_name: str, config: Dict) -> None:
+    """
+    Enable `CAPTURE` for this process, if the configuration has a directory
+
+    Args:
+        service_name: Name of the process (the events are written to `<directory>/<service_name>_<pid>.jsonl.gz`)
+        config: {directory, max_mb, redact, mqtt, key}, `redact` being a list of field names (None: `DEFAULT_REDACT`)
+    """
+    if not config["directory"]:
+        return
+
+    if not config["key"]:
+        logger.warning("Traffic capture: CAPTURE_KEY is not set, the pseudonyms differ between the processes and cannot be reproduced for a replay")
+
+    path = os.path.join(config["directory"], f"{service_name}_{os.getpid()}.jsonl.gz")
+    CAPTURE.configure(path, int(config["max_mb"] * 1024 * 1024), config["redact"] or DEFAULT_REDACT, config["mqtt"], key=config["key"])
@@ -1,10 +1,11 @@
-from typing import Dict, Any
+from typing import Dict, Any, List
 import yaml
 
 
 class SchemaRegistry:
     def __init__(self):
         self.schemas = {}
+        self.indexes = {}  # Schema type -> list of indexed field lists
 
     def load_schema(self, schema_type: str, yaml_path: str) -> None:
         """Load schema from YAML file"""
@@ -20,6 +21,10 @@ class SchemaRegistry:
                 raw_schema["schemas"]
             )
             self.schemas[schema_type] = validation_schema
+            self.indexes[schema_type] = [
+                [fields] if isinstance(fields, str) else list(fields)
+                for fields in raw_schema["schemas"].get("indexes") or []
+            ]
 
         except Exception as e:
             raise ValueError(f"Failed to load schema from {yaml_path}: {str(e)}")
@@ -97,3 +102,8 @@ class SchemaRegistry:
             raise ValueError(f"Schema not found for type: {schema_type}")
 
         return self.schemas[schema_type]
+
+    def get_indexes(self, schema_type: str) -> List[List[str]]:
+        """Get the indexes declared by the schema (one list of fields per index)"""
+
+        return self.indexes.get(schema_type, [])
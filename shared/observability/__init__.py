@@ -0,0 +1,6 @@
+'''
+Observability tools shared by the platform and the frontend (installed in both images from `shared/`):
+
+    - `profiling`: on-demand request profiling (`RequestProfiler`)
+    - `tracing`: distributed tracing (`TRACER`, W3C trace context, file and OTLP exporters)
+'''
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+On-demand request profiling.
+
+A request is profiled when an admin sends the `X-Profile` header (value `sample` or `cprofile`, anything
+else uses the default mode), or randomly with probability `sample_rate`. Each profile is written to
+`directory` with its metadata (route, status, duration, ...) and its id is returned in the `X-Profile-Id`
+response header. Only the `max_profiles` newest profiles are kept.
+
+Modes:
+    - `sample`   : statistical profile of the request thread (its stack is sampled every `interval_ms`),
+                   written as collapsed stacks (`.folded`, for flamegraph.pl / speedscope)
+    - `cprofile` : deterministic profile (`.prof`, for pstats / snakeviz). Slower, and only one request
+                   per process at a time (the others fall back to `sample`). cProfile is not bound to a
+                   thread: with concurrent requests (threaded workers), the profile also holds the frames
+                   of the other requests running meanwhile. Use `sample`, or a single-threaded worker, to
+                   profile one request only
+
+When no request is profiled, the cost is a header lookup per request.
+
+Used by the platform and the frontend.
+'''
+
+##-Imports
+from flask import request, g
+
+from datetime import datetime
+from threading import Lock, Thread, get_ident
+from collections import Counter
+from typing import Any, Callable
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+##-Init
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+MODES = ('sample', 'cprofile')
+EXTENSIONS = {'sample': '.folded', 'cprofile': '.prof'}
+
+PROFILE_ID_PATTERN = re.compile(r'^[\w-]+$')
+
+##-Stack sampler
+class StackSampler:
+    '''Samples the stacks of the registered threads in a background thread (running only while some are registered)'''
+
+    def __init__(self, interval_ms: float = 5):
+        self.interval = interval_ms / 1000
+
+        self._sessions: dict[int, Counter] = {} # Thread id -> number of samples per collapsed stack
+        self._labels: dict[Any, str] = {}       # Code object -> frame label
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self, thread_id: int) -> None:
+        '''Starts sampling the thread `thread_id`'''
+
+        with self._lock:
+            self._sessions[thread_id] = Counter()
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='profile_sampler', daemon=True)
+                self._thread.start()
+
+    def stop(self, thread_id: int) -> Counter:
+        '''Stops sampling the thread `thread_id` and returns its samples'''
+
+        with self._lock:
+            return self._sessions.pop(thread_id, Counter())
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+
+                frames = sys._current_frames()
+                for thread_id, samples in self._sessions.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self._collapse(frame)] += 1
+
+            del frames
+            time.sleep(self.interval)
+
+    def _collapse(self, frame) -> str:
+        '''Collapsed stack of `frame` (root first, `;` separated)'''
+
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+            labels.append(label)
+            frame = frame.f_back
+
+        return ';'.join(reversed(labels))
+
+##-Profiler
+class RequestProfiler:
+    '''Profiles requests of a Flask app on demand (cf module documentation)'''
+
+    def __init__(self, directory: str, is_admin: Callable[[], bool], sample_rate: float = 0.0, default_mode: str = 'sample',
+                 interval_ms: float = 5, max_profiles: int = 200):
+        '''
+        In:
+            - directory: where the profiles are written (shared by the workers)
+            - is_admin: tells if the current request comes from an admin (called only when the header is set)
+            - sample_rate: probability to profile a request without the header
+            - default_mode: `sample` or `cprofile`
+            - interval_ms: sampling interval of the `sample` mode
+            - max_profiles: number of profiles kept in `directory`
+        '''
+
+        if default_mode not in MODES:
+            raise ValueError(f'Invalid profiling mode: {default_mode} (expected one of {MODES})')
+
+        self.directory = directory
+        self.is_admin = is_admin
+        self.sample_rate = sample_rate
+        self.default_mode = default_mode
+        self.max_profiles = max_profiles
+
+        self._sampler = StackSampler(interval_ms)
+        self._cprofile_lock = Lock() # One cProfile profiler active at a time (per process)
+        self._count = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def init_app(self, app) -> None:
+        '''Registers the profiling hooks on `app`'''
+
+        app.before_request(self._start)
+        app.after_request(self._stop)
+        app.teardown_request(self._cleanup)
+
+    ##-Hooks
+    def _start(self) -> None:
+        header = request.headers.get(PROFILE_HEADER)
+
+        if header is not None:
+            try:
+                if not self.is_admin():
+                    return
+            except Exception:
+                return
+            trigger = 'header'
+
+        elif self.sample_rate and random.random() < self.sample_rate:
+            trigger = 'sample_rate'
+
+        else:
+            return
+
+        mode = header if header in MODES else self.default_mode
+
+        profiler = None
+        if mode == 'cprofile':
+            if self._cprofile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError: # Another profiling tool is active
+                    self._cprofile_lock.release()
+                    profiler = None
+
+            if profiler is None:
+                mode = 'sample'
+
+        if mode == 'sample':
+            self._sampler.start(get_ident())
+
+        g.profile = {'mode': mode, 'trigger': trigger, 'profiler': profiler, 'started': time.perf_counter(), 'started_at': datetime.utcnow()}
+
+    def _stop(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+
+        data = self._end(profile)
+        duration_ms = (time.perf_counter() - profile['started']) * 1000
+
+        try:
+            profile_id = self._write(profile, data, duration_ms, response.status_code)
+            response.headers['X-Profile-Id'] = profile_id
+
+        except OSError as e:
+            logger.warning(f'Failed to write the profile of {request.path}: {e}')
+
+        return response
+
+    def _cleanup(self, error=None) -> None:
+        '''Stops the profiler of a request that ended without response (unhandled exception)'''
+
+        profile = g.pop('profile', None)
+        if profile is not None:
+            self._end(profile)
+
+    def _end(self, profile: dict) -> Any:
+        '''Stops the profiler of the request and returns its data'''
+
+        if profile['mode'] == 'cprofile':
+            profile['profiler'].disable()
+            self._cprofile_lock.release()
+            return profile['profiler']
+
+        return self._sampler.stop(get_ident())
+
+    ##-Storage
+    def _write(self, profile: dict, data: Any, duration_ms: float, status: int) -> str:
+        '''Writes the profile and its metadata, and removes the oldest profiles. Returns the profile id'''
+
+        self._count += 1
+        profile_id = f'{profile["started_at"].strftime("%Y%m%dT%H%M%S%f")}-{os.getpid()}-{self._count}'
+        path = os.path.join(self.directory, profile_id + EXTENSIONS[profile['mode']])
+
+        if profile['mode'] == 'cprofile':
+            data.dump_stats(path)
+            nb_samples = None
+        else:
+            with open(path, 'w') as f:
+                for stack, count in data.most_common():
+                    f.write(f'{stack} {count}\n')
+            nb_samples = sum(data.values())
+
+        metadata = {
+            'id': profile_id,
+            'mode': profile['mode'],
+            'trigger': profile['trigger'],
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule is not None else None,
+            'path': request.path,
+            'status': status,
+            'duration_ms': round(duration_ms, 3),
+            'started_at': profile['started_at'].isoformat(),
+            'pid': os.getpid(),
+            'samples': nb_samples,
+            'file': os.path.basename(path),
+        }
+        with open(os.path.join(self.directory, profile_id + '.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        self._prune()
+        return profile_id
+
+    def _prune(self) -> None:
+        ids = sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith('.json'))
+
+        for profile_id in ids[:max(len(ids) - self.max_profiles, 0)]:
+            for extension in ('.json', *EXTENSIONS.values()):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + extension))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self, limit: int = 50, route: str | None = None) -> list[dict]:
+        '''
+        Lists the stored profiles, newest first
+
+        In:
+            - limit: maximum number of profiles
+            - route: only the profiles of this route pattern (e.g `/api/nodes/<node_id>`)
+        '''
+
+        profiles = []
+        for name in sorted((name for name in os.listdir(self.directory) if name.endswith('.json')), reverse=True):
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError): # Pruned or being written by another worker
+                continue
+
+            if route is None or metadata['route'] == route:
+                profiles.append(metadata)
+                if len(profiles) >= limit:
+                    break
+
+        return profiles
+
+    def profile_path(self, profile_id: str) -> str:
+        '''
+        Path of the profile file `profile_id`
+
+        Out:
+            The path       if found
+            LookupError    otherwise
+        '''
+
+        if PROFILE_ID_PATTERN.match(profile_id):
+            for extension in EXTENSIONS.values():
+                path = os.path.join(self.directory, profile_id + extension)
+                if os.path.isfile(path):
+                    return path
+
+        raise LookupError(f'Profile not found: {profile_id}')
@@ -0,0 +1,538 @@
+"""
+Distributed tracing: spans, W3C trace context propagation (`traceparent`) and exporters.
+
+A trace starts at a Flask request (`Tracer.init_app`): it continues the trace of the caller when the
+request has a `traceparent` header (e.g the frontend), otherwise a new trace is sampled with probability
+`sample_rate`. Inside a trace, the hot paths open child spans with `TRACER.start_span(...)`: database
+operations, MQTT publishes, MQTT gateway calls, SMTP and Discord sends. Outside of a trace (background
+threads, unsampled requests), `start_span` returns a no-op span, so the cost of an untraced call is a
+context variable lookup.
+
+When the local root span ends, the spans of the trace are queued for the exporters (written from a
+background thread):
+    - `FileExporter`: one JSON span per line (rotated above `max_bytes`)
+    - `OTLPExporter`: OTLP/HTTP JSON (`POST <endpoint>/v1/traces`, e.g an OpenTelemetry collector or Jaeger)
+and the slowest traces are kept in memory (`Tracer.slowest`, cf `GET /api/diagnostics/traces`).
+
+Used by the platform and the frontend. The frontend traces its requests and the `requests` calls to the
+platform (`Tracer.instrument_requests`), which continues the traces.
+
+Disabled by default: the file exporter writes to a local directory (`/tmp/traces` unless configured), which
+grows with the sample rate and is lost with the container. Enable it with an exporter suited to the
+deployment (e.g `otlp` to a collector, or `file` on a mounted volume).
+"""
+
+from typing import Any, Dict, List, Optional, Union
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
+import atexit
+import heapq
+import json
+import logging
+import os
+import random
+import re
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = "traceparent"
+_TRACEPARENT_PATTERN = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4, "consumer": 5}
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Dict]:
+    """
+    Parse a W3C `traceparent` header
+
+    Returns:
+        {trace_id, span_id, sampled}, or None if the header is missing or invalid
+    """
+    if not header:
+        return None
+
+    match = _TRACEPARENT_PATTERN.match(header.strip().lower())
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+
+    return {"trace_id": match.group(1), "span_id": match.group(2), "sampled": int(match.group(3), 16) & 1 == 1}
+
+
+class Span:
+    """A timed operation of a trace. Used as a context manager, it is the current span of its block"""
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "root_id", "name", "kind", "attributes",
+                 "start_ns", "end_ns", "status", "error", "_token")
+
+    def __init__(self, tracer: "Tracer", name: str, kind: str, trace_id: str, parent_id: Optional[str],
+                 root_id: Optional[str], attributes: Optional[Dict] = None):
+        """
+        Args:
+            root_id: Id of the local root span (the first span of the trace in this process), None for a local root
+        """
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.root_id = root_id or self.span_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes) if attributes else {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: Union[BaseException, str]) -> None:
+        self.status = "error"
+        self.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer._finish(self)
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if exc is not None:
+            self.record_error(exc)
+
+        if self._token is not None:
+            _current_span.reset(self._token)
+            self._token = None
+
+        self.end()
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "service": self.tracer.service_name,
+            "start": datetime.fromtimestamp(self.start_ns / 1e9, timezone.utc).isoformat(),
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Span of an untraced operation (records nothing)"""
+
+    traceparent = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def record_error(self, error: Union[BaseException, str]) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class FileExporter:
+    """Appends the spans to a file, one JSON object per line"""
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024):
+        """
+        Args:
+            path: File of the spans (its directory is created)
+            max_bytes: Above this size, the file is renamed to `<path>.1` (replacing the previous one)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, spans: List[Dict]) -> None:
+        # One append per batch, so that the processes sharing the file do not interleave their lines
+        data = "".join(json.dumps(span, default=str) + "\n" for span in spans).encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+        if self.max_bytes and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+
+
+class OTLPExporter:
+    """Sends the spans to an OTLP/HTTP endpoint, JSON encoded (e.g `http://otel-collector:4318`)"""
+
+    def __init__(self, endpoint: str, service_name: str, timeout: float = 5.0, headers: Optional[Dict[str, str]] = None):
+        self.url = endpoint.rstrip("/") + ("" if endpoint.rstrip("/").endswith("/v1/traces") else "/v1/traces")
+        self.service_name = service_name
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+
+    @staticmethod
+    def _value(value: Any) -> Dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _span(self, span: Dict) -> Dict:
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": SPAN_KINDS.get(span["kind"], 1),
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": [{"key": key, "value": self._value(value)} for key, value in span["attributes"].items()],
+            "status": {"code": 2, "message": span["error"] or ""} if span["status"] == "error" else {"code": 1},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        return otlp_span
+
+    def export(self, spans: List[Dict]) -> None:
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "iot-platform.tracing"}, "spans": [self._span(span) for span in spans]}],
+            }]
+        }
+
+        request = urllib.request.Request(self.url, data=json.dumps(body).encode(), headers=self.headers, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class Tracer:
+    """Creates the spans, propagates the trace context and exports the finished traces (cf module documentation)"""
+
+    def __init__(self, service_name: str = "platform", enabled: bool = False):
+        self.service_name = service_name
+        self.enabled = enabled
+        self.sample_rate = 1.0
+        self.exporters: List[Any] = []
+
+        self.max_slowest = 50
+        self.max_open_traces = 10_000
+        self._open_traces: "OrderedDict[str, List[Span]]" = OrderedDict()  # Local root span id -> finished spans
+        self._slowest: List = []  # Min-heap of (duration, sequence, trace summary)
+        self._sequence = 0
+        self._lock = Lock()
+
+        self._queue: deque = deque(maxlen=100_000)
+        self.flush_period = 2.0
+        self._wake_up = Event()
+        self._thread: Optional[Thread] = None
+        self.exported = 0
+        self.dropped = 0
+        self.failed_exports = 0
+
+    def configure(self, service_name: str, sample_rate: float = 1.0, exporters: Optional[List[Any]] = None,
+                  max_slowest: int = 50, flush_period: float = 2.0) -> None:
+        """
+        Enable the tracer
+
+        Args:
+            service_name: Name of the process in the exported spans (e.g platform, frontend, mqtt_gateway)
+            sample_rate: Probability to trace a request that does not continue a trace
+            exporters: Objects with an `export(spans: List[Dict])` method (e.g `FileExporter`, `OTLPExporter`)
+            max_slowest: Number of slowest traces kept in memory
+            flush_period: Maximum time (in seconds) a finished span waits before being exported
+        """
+        self.service_name = service_name
+        self.sample_rate = sample_rate
+        self.exporters = list(exporters or [])
+        self.max_slowest = max_slowest
+        self.flush_period = flush_period
+        self.enabled = True
+
+        if self.exporters and self._thread is None:
+            self._thread = Thread(target=self._run, name="trace_exporter", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    # Spans
+
+    def start_span(self, name: str, kind: str = "internal", attributes: Optional[Dict] = None,
+                   parent: Optional[str] = None, root: bool = False) -> Union[Span, _NoopSpan]:
+        """
+        Start a span, child of the current span (use it as a context manager to make it the current span)
+
+        Args:
+            name: Name of the operation (e.g `db.query node_collection`)
+            kind: internal, server, client, producer or consumer
+            attributes: Attributes of the span
+            parent: `traceparent` of a remote parent (e.g from a request header)
+            root: Start a new (sampled) trace when there is no current span nor remote parent.
+                  Otherwise, the operation is not traced.
+
+        Returns:
+            The span, or `NOOP_SPAN` if the operation is not traced
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+
+        current = _current_span.get()
+        if current is not None:
+            return Span(self, name, kind, current.trace_id, current.span_id, current.root_id, attributes)
+
+        remote = parse_traceparent(parent)
+        if remote is not None:
+            if not remote["sampled"]:
+                return NOOP_SPAN
+            return Span(self, name, kind, remote["trace_id"], remote["span_id"], None, attributes)
+
+        if root and random.random() < self.sample_rate:
+            return Span(self, name, kind, os.urandom(16).hex(), None, None, attributes)
+
+        return NOOP_SPAN
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    @staticmethod
+    def inject(headers: Dict[str, str]) -> Dict[str, str]:
+        """Add the `traceparent` of the current span to `headers` (if there is one)"""
+        span = _current_span.get()
+        if span is not None:
+            headers[TRACEPARENT_HEADER] = span.traceparent
+        return headers
+
+    def _finish(self, span: Span) -> None:
+        with self._lock:
+            spans = self._open_traces.get(span.root_id)
+            if spans is None:
+                spans = self._open_traces[span.root_id] = []
+                if len(self._open_traces) > self.max_open_traces:
+                    self._open_traces.popitem(last=False)  # Local root never ended
+            spans.append(span)
+
+            if span.root_id != span.span_id:
+                return
+
+            spans = self._open_traces.pop(span.root_id)
+            self._keep_if_slow(span, spans)
+
+        if self.exporters:
+            if len(self._queue) + len(spans) > self._queue.maxlen:
+                self.dropped += len(spans)
+            self._queue.extend(span.to_dict() for span in spans)
+
+    def _keep_if_slow(self, root: Span, spans: List[Span]) -> None:
+        """Keep the trace in the slowest ones (called with the lock)"""
+        duration = root.duration_ms
+        if len(self._slowest) >= self.max_slowest and duration <= self._slowest[0][0]:
+            return
+
+        hops: Dict[str, float] = {}
+        for span in spans:
+            if span is not root:
+                hop = span.name.split(" ")[0]
+                hops[hop] = hops.get(hop, 0.0) + span.duration_ms
+
+        summary = {
+            "trace_id": root.trace_id,
+            "name": root.name,
+            "service": self.service_name,
+            "start": datetime.fromtimestamp(root.start_ns / 1e9, timezone.utc).isoformat(),
+            "duration_ms": round(duration, 3),
+            "status": "error" if any(span.status == "error" for span in spans) else "ok",
+            "remote_parent": root.parent_id,
+            "hops_ms": {hop: round(total, 3) for hop, total in sorted(hops.items(), key=lambda item: -item[1])},
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "offset_ms": round((span.start_ns - root.start_ns) / 1e6, 3),
+                    "duration_ms": round(span.duration_ms, 3),
+                    "status": span.status,
+                    "error": span.error,
+                    "attributes": span.attributes,
+                }
+                for span in sorted(spans, key=lambda span: span.start_ns)
+            ],
+        }
+
+        self._sequence += 1
+        item = (duration, self._sequence, summary)
+        if len(self._slowest) < self.max_slowest:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heapreplace(self._slowest, item)
+
+    def slowest(self, n: int = 20) -> List[Dict]:
+        """Get the `n` slowest traces of this process (local spans only, with the time spent per hop)"""
+        with self._lock:
+            return [summary for _, _, summary in heapq.nlargest(n, self._slowest)]
+
+    def reset(self) -> None:
+        """Forget the slowest traces"""
+        with self._lock:
+            self._slowest.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "open_traces": len(self._open_traces),
+            "slowest": len(self._slowest),
+            "service": self.service_name,
+            "sample_rate": self.sample_rate,
+            "exporters": [type(exporter).__name__ for exporter in self.exporters],
+            "queued": len(self._queue),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed_exports": self.failed_exports,
+        }
+
+    # Export
+
+    def _run(self) -> None:
+        while True:
+            self._wake_up.wait(self.flush_period)
+            self._wake_up.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Export the queued spans"""
+        while self._queue:
+            batch = []
+            while self._queue and len(batch) < 512:
+                batch.append(self._queue.popleft())
+
+            for exporter in self.exporters:
+                try:
+                    exporter.export(batch)
+                except Exception as e:
+                    self.failed_exports += 1
+                    logger.warning(f"Failed to export {len(batch)} spans with {type(exporter).__name__}: {e}")
+
+            self.exported += len(batch)
+
+    # Integrations
+
+    def init_app(self, app) -> None:
+        """Trace the requests of a Flask app (server spans, continuing the `traceparent` of the caller)"""
+        from flask import g, request
+
+        def start_request_span():
+            rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            span = self.start_span(
+                f"{request.method} {rule}",
+                kind="server",
+                attributes={"http.method": request.method, "http.route": rule, "http.target": request.path},
+                parent=request.headers.get(TRACEPARENT_HEADER),
+                root=True,
+            )
+            if span is not NOOP_SPAN:
+                span.__enter__()
+                g.trace_span = span
+
+        def add_trace_header(response):
+            span = g.get("trace_span")
+            if span is not None:
+                span.set_attribute("http.status_code", response.status_code)
+                if response.status_code >= 500:
+                    span.status = "error"
+                response.headers["X-Trace-Id"] = span.trace_id
+            return response
+
+        def end_request_span(error=None):
+            span = g.pop("trace_span", None)
+            if span is not None:
+                span.__exit__(type(error) if error else None, error, None)
+
+        app.before_request(start_request_span)
+        app.after_request(add_trace_header)
+        app.teardown_request(end_request_span)
+
+    def instrument_requests(self, url_prefix: str) -> None:
+        """
+        Trace the `requests` calls to the URLs starting with `url_prefix` (client spans), and send them
+        the `traceparent` header (only to these URLs, the trace ids are not sent to third parties)
+        """
+        import requests
+
+        original = requests.Session.request
+        tracer = self
+
+        def request(session, method, url, *args, **kwargs):
+            if not str(url).startswith(url_prefix) or _current_span.get() is None:
+                return original(session, method, url, *args, **kwargs)
+
+            with tracer.start_span(f"http.{method.lower()}", kind="client", attributes={"http.method": method, "http.url": str(url).split("?")[0]}) as span:
+                kwargs["headers"] = tracer.inject(dict(kwargs.get("headers") or {}))
+                response = original(session, method, url, *args, **kwargs)
+                span.set_attribute("http.status_code", response.status_code)
+                if response.status_code >= 500:
+                    span.status = "error"
+                return response
+
+        requests.Session.request = request
+
+
+# Tracer of the process (disabled until `configure_tracing` is called)
+TRACER = Tracer()
+
+
+def configure_tracing(service_name: str, config: Dict) -> None:
+    """
+    Enable `TRACER` for this process, if the configuration enables it
+
+    Args:
+        service_name: Name of the process in the spans (the file exporter writes `<directory>/<service_name>.jsonl`)
+        config: {enabled, sample_rate, exporter, directory, max_file_mb, otlp_endpoint, slowest}, where `exporter`
+                is `file`, `otlp`, `file,otlp` or `none` (in-memory slowest traces only)
+    """
+    if not config["enabled"]:
+        return
+
+    exporters = []
+    for name in filter(None, (name.strip() for name in config["exporter"].split(","))):
+        if name == "file":
+            path = os.path.join(config["directory"], f"{service_name}.jsonl")
+            exporters.append(FileExporter(path, int(config["max_file_mb"] * 1024 * 1024)))
+        elif name == "otlp":
+            exporters.append(OTLPExporter(config["otlp_endpoint"], service_name))
+        elif name != "none":
+            raise ValueError(f"Invalid trace exporter: {name} (expected file, otlp or none)")
+
+    TRACER.configure(service_name, config["sample_rate"], exporters, max_slowest=config["slowest"])